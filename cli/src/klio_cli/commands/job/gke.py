@@ -42,6 +42,8 @@ K8S_LABEL_VALUE_REGEX = re.compile(
     r"^[a-zA-Z0-9]{0,1}$|^[a-zA-Z0-9]([a-zA-Z0-9\._\-]){,61}[a-zA-Z0-9]$"
 )
 K8S_RESERVED_KEY_PREFIXES = ("kubernetes.io", "k8s.io")
+# same as klio.metrics.prometheus.DEFAULT_PORT; klio isn't a dependency
+PROMETHEUS_DEFAULT_PORT = 9090
 
 
 class GKECommandMixin(object):
@@ -209,6 +211,7 @@ class RunPipelineGKE(GKECommandMixin, base.BaseDockerizedPipeline):
             if resource_config["kind"] == "Deployment":
                 self._apply_labels_to_deployment_config(resource_config)
                 self._apply_image_to_deployment_config(resource_config)
+                self._apply_metrics_port_to_deployment_config(resource_config)
             self._apply_resource(resource_config)
 
     def _apply_image_to_deployment_config(self, deployment_config):
@@ -239,6 +242,51 @@ class RunPipelineGKE(GKECommandMixin, base.BaseDockerizedPipeline):
                 "set in kubernetes/deployment.yaml file."
             )
 
+    def _apply_metrics_port_to_deployment_config(self, deployment_config):
+        # Declare the port of the Prometheus metrics endpoint on the job's
+        # container and annotate pods to be scraped, if the Prometheus
+        # metrics client is turned on. Ports & annotations already defined
+        # in the deployment are kept.
+        metrics_config = self.klio_config.job_config.metrics
+        prometheus_config = metrics_config.get("prometheus")
+        if prometheus_config is None or prometheus_config is False:
+            return
+        port = PROMETHEUS_DEFAULT_PORT
+        if isinstance(prometheus_config, dict):
+            port = prometheus_config.get("port", port)
+
+        ports_path = "spec.template.spec.containers.0.ports"
+        ports = glom.glom(deployment_config, ports_path, default=None) or []
+        declared = any(
+            p.get("name") == "metrics" or p.get("containerPort") == port
+            for p in ports
+        )
+        if not declared:
+            ports.append(
+                {"name": "metrics", "containerPort": port, "protocol": "TCP"}
+            )
+            glom.assign(deployment_config, ports_path, ports)
+
+        annotations = {
+            "prometheus.io/scrape": "true",
+            "prometheus.io/port": str(port),
+            "prometheus.io/path": "/metrics",
+        }
+        annotations.update(
+            glom.glom(
+                deployment_config,
+                "spec.template.metadata.annotations",
+                default=None,
+            )
+            or {}
+        )
+        glom.assign(
+            deployment_config,
+            "spec.template.metadata.annotations",
+            annotations,
+            missing=dict,
+        )
+
     @staticmethod
     def _validate_labels(label_path, label_dict):
         help_url = (
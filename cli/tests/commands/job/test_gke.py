@@ -13,6 +13,7 @@
 # limitations under the License.
 #
 
+import copy
 import os
 
 import glom
@@ -421,6 +422,88 @@ def test_apply_labels_to_deployment_config_overrides(
     assert expected_config == deployment_config
 
 
+@pytest.mark.parametrize(
+    "prometheus_config,exp_port",
+    ((True, 9090), ({}, 9090), ({"port": 9091}, 9091)),
+)
+def test_apply_metrics_port_to_deployment_config(
+    prometheus_config,
+    exp_port,
+    run_pipeline_gke,
+    monkeypatch,
+    deployment_config,
+):
+    monkeypatch.setattr(
+        run_pipeline_gke.klio_config.job_config,
+        "metrics",
+        {"prometheus": prometheus_config},
+    )
+
+    run_pipeline_gke._apply_metrics_port_to_deployment_config(
+        deployment_config
+    )
+
+    exp_ports = [
+        {"name": "metrics", "containerPort": exp_port, "protocol": "TCP"}
+    ]
+    exp_annotations = {
+        "prometheus.io/scrape": "true",
+        "prometheus.io/port": str(exp_port),
+        "prometheus.io/path": "/metrics",
+    }
+    assert exp_ports == glom.glom(
+        deployment_config, "spec.template.spec.containers.0.ports"
+    )
+    assert exp_annotations == glom.glom(
+        deployment_config, "spec.template.metadata.annotations"
+    )
+
+
+@pytest.mark.parametrize("metrics_config", ({}, {"prometheus": False}))
+def test_apply_metrics_port_to_deployment_config_off(
+    metrics_config, run_pipeline_gke, monkeypatch, deployment_config
+):
+    monkeypatch.setattr(
+        run_pipeline_gke.klio_config.job_config, "metrics", metrics_config
+    )
+    expected_config = copy.deepcopy(deployment_config)
+
+    run_pipeline_gke._apply_metrics_port_to_deployment_config(
+        deployment_config
+    )
+
+    assert expected_config == deployment_config
+
+
+def test_apply_metrics_port_to_deployment_config_existing(
+    run_pipeline_gke, monkeypatch, deployment_config
+):
+    monkeypatch.setattr(
+        run_pipeline_gke.klio_config.job_config,
+        "metrics",
+        {"prometheus": True},
+    )
+    ports = [{"name": "metrics", "containerPort": 8080}]
+    ports_path = "spec.template.spec.containers.0.ports"
+    glom.assign(deployment_config, ports_path, ports)
+    glom.assign(
+        deployment_config,
+        "spec.template.metadata.annotations",
+        {"prometheus.io/port": "8080"},
+    )
+
+    run_pipeline_gke._apply_metrics_port_to_deployment_config(
+        deployment_config
+    )
+
+    assert ports == glom.glom(deployment_config, ports_path)
+    annotations = glom.glom(
+        deployment_config, "spec.template.metadata.annotations"
+    )
+    assert "8080" == annotations["prometheus.io/port"]
+    assert "true" == annotations["prometheus.io/scrape"]
+
+
 def test_get_deployment_config(run_pipeline_gke, deployment_config):
     config = run_pipeline_gke.get_deployment_config(
         config_dir=TEST_K8S_DIRECTORY
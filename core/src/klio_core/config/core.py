@@ -162,6 +162,17 @@ class KlioJobConfig(object):
             non-KlioMessage messages.
         blocking (bool): Wait for Dataflow job to finish before exiting.
         metrics (dict): Dictionary representing desired metrics configuration.
+        parse_klio_message_once (bool): Keep incoming messages parsed as
+            ``KlioMessage`` objects between Klio's pre-processing
+            transforms rather than re-parsing them in each transform.
+        fused_ingress (bool): Run Klio's pre-processing of event inputs
+            as a single ``KlioIngress`` transform.
+        payload_store_threshold (int): Size in bytes above which message
+            payloads are kept in a worker-local payload store.
+        drop_logging (dict): Dictionary representing how dropped messages
+            are logged.
+        dedup (dict): Dictionary representing how messages received
+            more than once from Pub/Sub are deduplicated.
         events (``KlioIOConfigContainer``): Job event I/O configuration.
         data (``KlioIOConfigContainer``): Job data I/O configuration.
 
@@ -180,6 +191,11 @@ class KlioJobConfig(object):
     allow_non_klio_messages = utils.field(type=bool, default=False)
     metrics = utils.field(default={})
     blocking = utils.field(type=bool, default=False)
+    parse_klio_message_once = utils.field(type=bool, default=False)
+    fused_ingress = utils.field(type=bool, default=False)
+    payload_store_threshold = utils.field(type=int, default=0)
+    drop_logging = utils.field(default={})
+    dedup = utils.field(default={})
 
     def __config_post_init__(self, config_dict):
         self._raw = config_dict
@@ -106,6 +106,11 @@ def final_job_config_dict():
         "might": ["include"],
         "blocking": False,
         "allow_non_klio_messages": False,
+        "parse_klio_message_once": False,
+        "fused_ingress": False,
+        "payload_store_threshold": 0,
+        "drop_logging": {},
+        "dedup": {},
     }
 
 
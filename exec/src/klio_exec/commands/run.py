@@ -386,6 +386,10 @@ class KlioPipeline(object):
                 _ = input_exists.not_found | ack_inp_lbl >> beam.ParDo(
                     helpers.KlioAckInputMessage()
                 )
+            if self.config.job_config.dedup:
+                forget_lbl = lbl("Forget Not Found Data")
+                forget = helpers.KlioForgetDropped()
+                _ = input_exists.not_found | forget_lbl >> forget
             _ = (
                 input_exists.not_found
                 | lbl("Drop Not Found Data") >> helpers.KlioDrop()
@@ -396,6 +400,28 @@ class KlioPipeline(object):
 
         return to_process, to_pass_thru
 
+    def _serialize_parsed_messages(
+        self, to_process, to_pass_thru, label_pfx=None
+    ):
+        # Messages are kept as parsed KlioMessage objects between Klio's
+        # pre-processing transforms; user transforms & event outputs still
+        # expect bytes
+        pfx = ""
+        if label_pfx is not None:
+            pfx = "[{}] ".format(label_pfx)
+
+        def lbl(label):
+            return "{}{}".format(pfx, label)
+
+        to_process = to_process | lbl("Serialize to Process") >> beam.ParDo(
+            helpers._KlioSerializeMessage()
+        )
+        if to_pass_thru is not None:
+            to_pass_thru = to_pass_thru | lbl(
+                "Serialize to Pass Thru"
+            ) >> beam.ParDo(helpers._KlioSerializeMessage())
+        return to_process, to_pass_thru
+
     def _update_audit_log(self, in_pcol, label_pfx=None):
         label = "Updating KlioMessage Audit Log"
         if label_pfx:
@@ -440,6 +466,10 @@ class KlioPipeline(object):
                 helpers.KlioAckInputMessage()
             )
 
+        if self.config.job_config.dedup:
+            forget_lbl = lbl("Forget Messages to Ignore")
+            _ = to_drop | forget_lbl >> helpers.KlioForgetDropped()
+
         ignore_lbl = lbl("Drop Messages to Ignore")
         _ = to_drop | ignore_lbl >> helpers.KlioDrop()
 
@@ -448,6 +478,81 @@ class KlioPipeline(object):
         to_process = to_process_flatten | flatten_proc_lbl >> beam.Flatten()
         return to_process
 
+    def _setup_ingress(self, in_pcol, label_prefix=None):
+        # label prefixes are required for multiple inputs (to avoid label
+        # name collisions in Beam)
+        if self._has_multi_data_inputs or self._has_multi_data_outputs:
+            logging.error(
+                "Klio does not (yet) support multiple data inputs and outputs."
+            )
+            raise SystemExit(1)
+
+        data_in_config, data_out_config = None, None
+        if self._has_data_inputs:
+            data_in_config = self.config.job_config.data.inputs[0]
+        if self._has_data_outputs:
+            data_out_config = self.config.job_config.data.outputs[0]
+
+        pfx = ""
+        if label_prefix is not None:
+            pfx = "[{}] ".format(label_prefix)
+
+        def lbl(label):
+            return "{}{}".format(pfx, label)
+
+        filter_ping = bool(data_in_config)
+        check_output_exists = bool(
+            data_out_config and not data_out_config.skip_klio_existence_check
+        )
+        check_input_exists = bool(
+            data_in_config and not data_in_config.skip_klio_existence_check
+        )
+
+        # version tagging, recipient checks, audit log update, ping/force
+        # filters and data existence checks all happen in one transform
+        ingress = in_pcol | lbl("Klio Ingress") >> helpers.KlioIngress(
+            filter_ping=filter_ping,
+            check_output_exists=check_output_exists,
+            check_input_exists=check_input_exists,
+        )
+
+        # TODO: update me to `var.KlioRunner.DIRECT_GKE_RUNNER` once
+        #       direct_on_gke_runner_clean is merged
+        if self.config.pipeline_options.runner == "DirectGKERunner":
+            ack_inp_lbl = lbl("Ack Dropped Input Message")
+            _ = ingress.drop | ack_inp_lbl >> beam.ParDo(
+                helpers.KlioAckInputMessage()
+            )
+
+        _ = ingress.drop | lbl("Drop Messages") >> helpers.KlioDrop()
+
+        to_pass_thru = None
+        if filter_ping or check_output_exists:
+            to_pass_thru = ingress.pass_thru
+
+        return ingress.process, to_pass_thru
+
+    def _setup_dedup(self, in_pcol, label_prefix=None):
+        pfx = ""
+        if label_prefix is not None:
+            pfx = "[{}] ".format(label_prefix)
+
+        def lbl(label):
+            return "{}{}".format(pfx, label)
+
+        dedup_lbl = lbl("Deduplicate Messages")
+        dedup = in_pcol | dedup_lbl >> helpers.KlioDeduplicate()
+
+        # TODO: update me to `var.KlioRunner.DIRECT_GKE_RUNNER` once
+        #       direct_on_gke_runner_clean is merged
+        if self.config.pipeline_options.runner == "DirectGKERunner":
+            ack_dup_lbl = lbl("Ack Duplicate Messages")
+            _ = dedup.drop | ack_dup_lbl >> beam.ParDo(
+                helpers.KlioAckDuplicateMessage()
+            )
+
+        return dedup.process
+
     # TODO this can prob go away if/when we make event_inputs a
     # dictionary rather than a list of dicts (@lynn)
     def _generate_input_conf_names(self):
@@ -495,11 +600,20 @@ class KlioPipeline(object):
         in_pcol = pipeline | label >> transform_cls_in(
             **input_config.to_io_kwargs()
         )
+        if input_config.name == "pubsub" and self.config.job_config.dedup:
+            in_pcol = self._setup_dedup(in_pcol, label_prefix)
+        if self.config.job_config.fused_ingress:
+            return self._setup_ingress(in_pcol, label_prefix)
+
         intended_msgs = self._filter_intended_recipients(in_pcol, label_prefix)
         audit_logged_msgs = self._update_audit_log(intended_msgs, label_prefix)
         to_process, to_pass_thru = self._setup_data_io_filters(
             audit_logged_msgs, label_prefix
         )
+        if self.config.job_config.parse_klio_message_once:
+            to_process, to_pass_thru = self._serialize_parsed_messages(
+                to_process, to_pass_thru, label_prefix
+            )
         return to_process, to_pass_thru
 
     # mutates the pipeline object, no need to return it
@@ -525,6 +639,12 @@ class KlioPipeline(object):
         # TODO: update me to `var.KlioRunner.DIRECT_GKE_RUNNER` once
         #       direct_on_gke_runner_clean is merged
         if self.config.pipeline_options.runner == "DirectGKERunner":
+            if self.config.job_config.payload_store_threshold:
+                # stored payloads are evicted once a message is acked, and
+                # can't leave the worker, so inline them beforehand
+                out_pcol = out_pcol | "Inline Stored Payloads" >> beam.ParDo(
+                    helpers.KlioInlinePayload()
+                )
             if to_pass_thru:
                 to_ack_input = (
                     out_pcol,
@@ -548,6 +668,15 @@ class KlioPipeline(object):
                         to_output_tuple | "Flatten to Output" >> beam.Flatten()
                     )
 
+                # TODO: update me to `var.KlioRunner.DIRECT_GKE_RUNNER` once
+                #       direct_on_gke_runner_clean is merged
+                if self.config.pipeline_options.runner == "DirectGKERunner":
+                    # delivery tokens are only valid within this worker
+                    detach_lbl = "Detach Delivery Tokens"
+                    to_output = to_output | detach_lbl >> beam.ParDo(
+                        helpers.KlioDetachDeliveryToken()
+                    )
+
                 _ = to_output | transform_cls_out(
                     **output_config.to_io_kwargs()
                 )
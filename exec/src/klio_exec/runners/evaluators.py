@@ -13,31 +13,356 @@
 # limitations under the License.
 #
 
+import copy
+import datetime
 import logging
+import multiprocessing
+import queue
+import threading
+import time
 
 from apache_beam.io.gcp import pubsub as beam_pubsub
+from apache_beam.options import pipeline_options
 from apache_beam.runners.direct import direct_runner
 from apache_beam.runners.direct import transform_evaluator
 from apache_beam.utils import timestamp as beam_timestamp
 from google.api_core import exceptions as g_exceptions
 from google.cloud import pubsub as g_pubsub
+from google.cloud.pubsub_v1 import types as g_pubsub_types
 
 from klio.message import pubsub_message_manager as pmsg_mgr
 
 
+_LOCK = threading.Lock()
+_SUBSCRIBER_CLIENT = None
+_MESSAGE_MANAGERS = {}
+_STREAMING_PULLS = {}
+_WATER_MARKS = {}
+
+
+class KlioPubSubReadOptions(pipeline_options.PipelineOptions):
+    """How ``DirectGKERunner`` reads from Pub/Sub.
+
+    Set in ``klio-job.yaml::pipeline_options``.
+    """
+
+    @classmethod
+    def _add_argparse_args(cls, parser):
+        parser.add_argument(
+            "--pubsub_max_messages",
+            type=int,
+            default=1,
+            help="Most messages to read from Pub/Sub at a time.",
+        )
+        parser.add_argument(
+            "--pubsub_streaming_pull",
+            action="store_true",
+            default=False,
+            help=(
+                "Receive messages over a streaming pull rather than pulling "
+                "them on every read."
+            ),
+        )
+        parser.add_argument(
+            "--pubsub_max_outstanding_messages",
+            type=int,
+            default=None,
+            help=(
+                "Most messages received over a streaming pull that aren't "
+                "done yet. Defaults to the default thread limit of "
+                "transforms (the worker's CPU count)."
+            ),
+        )
+        parser.add_argument(
+            "--pubsub_max_outstanding_bytes",
+            type=int,
+            default=100 * 1024 * 1024,
+            help=(
+                "Most bytes of messages received over a streaming pull that "
+                "aren't done yet."
+            ),
+        )
+        parser.add_argument(
+            "--pubsub_high_water_mark",
+            type=int,
+            default=None,
+            help=(
+                "Stop reading from Pub/Sub once this many messages are in "
+                "progress. Not limited by default."
+            ),
+        )
+        parser.add_argument(
+            "--pubsub_low_water_mark",
+            type=int,
+            default=None,
+            help=(
+                "Resume reading from Pub/Sub once fewer messages are in "
+                "progress. Defaults to half the high water mark, but at "
+                "least 1."
+            ),
+        )
+        parser.add_argument(
+            "--pubsub_high_water_mark_bytes",
+            type=int,
+            default=None,
+            help=(
+                "Stop reading from Pub/Sub once this many bytes of messages "
+                "are in progress. Not limited by default."
+            ),
+        )
+        parser.add_argument(
+            "--pubsub_low_water_mark_bytes",
+            type=int,
+            default=None,
+            help=(
+                "Resume reading from Pub/Sub once fewer bytes of messages "
+                "are in progress. Defaults to half the high water mark."
+            ),
+        )
+
+
+def _get_or_create_subscriber_client():
+    # One client per process keeps its gRPC channel open across reads,
+    # rather than setting up a channel for every pull.
+    global _SUBSCRIBER_CLIENT
+    with _LOCK:
+        if _SUBSCRIBER_CLIENT is None:
+            _SUBSCRIBER_CLIENT = g_pubsub.SubscriberClient()
+    return _SUBSCRIBER_CLIENT
+
+
+def _get_or_create_message_manager(sub_name):
+    with _LOCK:
+        message_manager = _MESSAGE_MANAGERS.get(sub_name)
+        if message_manager is None:
+            message_manager = pmsg_mgr.MessageManager(sub_name)
+            _MESSAGE_MANAGERS[sub_name] = message_manager
+    return message_manager
+
+
+class _StreamingPull(object):
+    """Receives messages of a subscription over a streaming pull.
+
+    Messages are buffered until read. Pub/Sub's flow control stops
+    sending messages while ``max_messages`` or ``max_bytes`` of them are
+    outstanding, i.e. received but not yet acknowledged through their
+    lease (see :meth:`MessageManager.add
+    <klio.message.pubsub_message_manager.MessageManager.add>`).
+
+    The streaming pull extends the deadlines of outstanding messages
+    itself (for up to the flow control's ``max_lease_duration``, an hour
+    by default), so ``MessageManager`` doesn't extend them as well.
+
+    Args:
+        client (google.cloud.pubsub.SubscriberClient): client to pull with.
+        sub_name (str): subscription to pull from.
+        max_messages (int): most outstanding messages.
+        max_bytes (int): most outstanding bytes.
+    """
+
+    # how long a read waits for a first message
+    WAIT_SEC = 0.1
+
+    def __init__(self, client, sub_name, max_messages, max_bytes):
+        self._received = queue.Queue()
+        flow_control = g_pubsub_types.FlowControl(
+            max_messages=max_messages, max_bytes=max_bytes
+        )
+        self.future = client.subscribe(
+            sub_name, self._received.put, flow_control=flow_control
+        )
+
+    def read(self, max_messages):
+        """Read the messages received so far.
+
+        Args:
+            max_messages (int): most messages to read.
+        Returns:
+            list(google.cloud.pubsub_v1.subscriber.message.Message): the
+            messages read.
+        """
+        messages = []
+        try:
+            messages.append(self._received.get(timeout=self.WAIT_SEC))
+            while len(messages) < max_messages:
+                messages.append(self._received.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+
+def _get_or_create_streaming_pull(client, sub_name, options, logger):
+    with _LOCK:
+        streaming_pull = _STREAMING_PULLS.get(sub_name)
+        if streaming_pull is not None and streaming_pull.future.done():
+            # the stream failed; messages it received but didn't read are
+            # redelivered once their lease expires
+            logger.warning(
+                "Restarting streaming pull from %s after error: %s",
+                sub_name,
+                streaming_pull.future.exception(),
+            )
+            streaming_pull = None
+        if streaming_pull is None:
+            max_messages = options.pubsub_max_outstanding_messages
+            if max_messages is None:
+                max_messages = multiprocessing.cpu_count()
+            streaming_pull = _StreamingPull(
+                client,
+                sub_name,
+                max_messages,
+                options.pubsub_max_outstanding_bytes,
+            )
+            _STREAMING_PULLS[sub_name] = streaming_pull
+    return streaming_pull
+
+
+class _WaterMarks(object):
+    """Pauses reading while too many messages are in progress.
+
+    Reading stops once the messages in progress, or their bytes, reach
+    their high water mark, and resumes once both are below their low water
+    mark. A mark of ``None`` doesn't limit.
+
+    Args:
+        high (int): high water mark of messages.
+        low (int): low water mark of messages. Defaults to half of
+            ``high``, but at least 1.
+        high_bytes (int): high water mark of bytes.
+        low_bytes (int): low water mark of bytes. Defaults to half of
+            ``high_bytes``, but at least 1.
+    Raises:
+        ValueError: if a low water mark is below 1 or above its high
+            water mark.
+    """
+
+    def __init__(self, high=None, low=None, high_bytes=None, low_bytes=None):
+        self.high, self.low = self._marks(high, low)
+        self.high_bytes, self.low_bytes = self._marks(high_bytes, low_bytes)
+        self.paused = False
+
+    @staticmethod
+    def _marks(high, low):
+        if high is None:
+            return None, None
+        if low is None:
+            low = max(high // 2, 1)
+        if low < 1:
+            # nothing in progress is never below a mark of 0, so reading
+            # would never resume
+            raise ValueError("Low water mark {} is below 1.".format(low))
+        if low > high:
+            raise ValueError(
+                "Low water mark {} is above high water mark {}.".format(
+                    low, high
+                )
+            )
+        return high, low
+
+    @staticmethod
+    def _reached(count, mark):
+        return mark is not None and count >= mark
+
+    def update(self, in_flight, in_flight_bytes):
+        """Pause or resume reading.
+
+        Args:
+            in_flight (int): messages in progress.
+            in_flight_bytes (int): bytes of messages in progress.
+        Returns:
+            bool: whether reading is paused.
+        """
+        if self.paused:
+            marks = self.low, self.low_bytes
+        else:
+            marks = self.high, self.high_bytes
+        self.paused = self._reached(in_flight, marks[0]) or self._reached(
+            in_flight_bytes, marks[1]
+        )
+        return self.paused
+
+    def room(self, in_flight):
+        """Messages that can be read before reaching the high water mark.
+
+        Args:
+            in_flight (int): messages in progress.
+        Returns:
+            int: messages, or ``None`` if not limited.
+        """
+        if self.high is None:
+            return None
+        return max(self.high - in_flight, 0)
+
+
+def _get_or_create_water_marks(sub_name, options):
+    with _LOCK:
+        water_marks = _WATER_MARKS.get(sub_name)
+        if water_marks is None:
+            water_marks = _WaterMarks(
+                options.pubsub_high_water_mark,
+                options.pubsub_low_water_mark,
+                options.pubsub_high_water_mark_bytes,
+                options.pubsub_low_water_mark_bytes,
+            )
+            _WATER_MARKS[sub_name] = water_marks
+    return water_marks
+
+
 class KlioPubSubReadEvaluator(transform_evaluator._PubSubReadEvaluator):
     """PubSubReadEvaluator for Klio's GkeDirectRunner.
 
     Behaves in the same way as _PubSubReadEvaluator, except for the fact
     that it acknowledges PubSub messages after they are done processing.
+
+    Reads up to ``pubsub_max_messages`` at a time (see
+    :class:`KlioPubSubReadOptions`), either by pulling them or, with
+    ``pubsub_streaming_pull``, from a streaming pull. The subscriber client
+    and its channel are kept open across reads.
+
+    Reading pauses while the messages in progress reach
+    ``pubsub_high_water_mark`` (or their bytes reach
+    ``pubsub_high_water_mark_bytes``), until they're back below the low
+    water marks.
     """
 
+    # how long a paused read waits before returning
+    PAUSE_SEC = 0.1
+
     def __init__(self, *args, **kwargs):
         super(KlioPubSubReadEvaluator, self).__init__(*args, **kwargs)
         # Heads up: self._sub_name is from init'ing parent class
-        self.sub_client = g_pubsub.SubscriberClient()
-        self.message_manager = pmsg_mgr.MessageManager(self._sub_name)
+        self.sub_client = _get_or_create_subscriber_client()
+        self.message_manager = _get_or_create_message_manager(self._sub_name)
         self.logger = logging.getLogger("klio.pubsub_read_evaluator")
+        options = getattr(self._evaluation_context, "pipeline_options", None)
+        if options is None:
+            options = pipeline_options.PipelineOptions([])
+        self.options = options.view_as(KlioPubSubReadOptions)
+        self.water_marks = _get_or_create_water_marks(
+            self._sub_name, self.options
+        )
+
+    def _max_messages(self):
+        """Messages to read now, or 0 while reading is paused."""
+        manager = self.message_manager
+        was_paused = self.water_marks.paused
+        paused = self.water_marks.update(
+            manager.in_flight, manager.in_flight_bytes
+        )
+        if paused != was_paused:
+            self.logger.info(
+                "%s reading from %s with %d messages (%d bytes) in progress.",
+                "Paused" if paused else "Resumed",
+                self._sub_name,
+                manager.in_flight,
+                manager.in_flight_bytes,
+            )
+        if paused:
+            return 0
+        room = self.water_marks.room(manager.in_flight)
+        if room is None:
+            return self.options.pubsub_max_messages
+        return max(min(self.options.pubsub_max_messages, room), 1)
 
     def _read_from_pubsub(self, timestamp_attribute):
         # Klio maintainer note: This code is the eact same logic in
@@ -50,8 +375,12 @@ class KlioPubSubReadEvaluator(transform_evaluator._PubSubReadEvaluator):
         # 3. The functionalty we needed to override, which skips auto-acking
         #    consumed pubsub messages, and adds them to the MessageManager
         #    to handle deadline extension and acking once done.
+        # 4. Reading from a streaming pull, and keeping the subscriber
+        #    client's channel open.
+        # 5. Pausing reads while too many messages are in progress.
+        # 6. Attaching the token of each delivery to the message.
 
-        def _get_element(ack_id, message):
+        def _get_element(message):
             parsed_message = beam_pubsub.PubsubMessage._from_message(message)
             if (
                 timestamp_attribute
@@ -71,25 +400,46 @@ class KlioPubSubReadEvaluator(transform_evaluator._PubSubReadEvaluator):
                         )
                     except ValueError as e:
                         raise ValueError("Bad timestamp value: %s" % e)
+            elif isinstance(message.publish_time, datetime.datetime):
+                # received over a streaming pull
+                timestamp = beam_timestamp.Timestamp.from_utc_datetime(
+                    message.publish_time
+                )
             else:
                 timestamp = beam_timestamp.Timestamp(
                     message.publish_time.seconds,
                     message.publish_time.nanos // 1000,
                 )
 
-            self.message_manager.add(ack_id, parsed_message)
-
             return timestamp, parsed_message
 
+        max_messages = self._max_messages()
+        if not max_messages:
+            # not returning right away, so paused reads don't spin
+            time.sleep(self.PAUSE_SEC)
+            return []
+
+        if self.options.pubsub_streaming_pull:
+            return self._read_from_streaming_pull(_get_element, max_messages)
+
         results = None
         try:
             response = self.sub_client.pull(
-                self._sub_name, max_messages=1, return_immediately=True
+                self._sub_name,
+                max_messages=max_messages,
+                return_immediately=True,
             )
-            results = [
-                _get_element(rm.ack_id, rm.message)
-                for rm in response.received_messages
-            ]
+            results = []
+            for rm in response.received_messages:
+                timestamp, parsed_message = _get_element(rm.message)
+                token = self.message_manager.add(
+                    rm.ack_id,
+                    parsed_message,
+                    message_id=rm.message.message_id,
+                )
+                results.append(
+                    (timestamp, self._with_token(parsed_message, token))
+                )
 
         # only catching/ignoring this for now - if new exceptions raise, we'll
         # figure it out as they come on how to handle them
@@ -98,11 +448,36 @@ class KlioPubSubReadEvaluator(transform_evaluator._PubSubReadEvaluator):
             # between messages
             self.logger.debug(e)
 
-        finally:
-            self.sub_client.api.transport.channel.close()
+        return results
 
+    def _read_from_streaming_pull(self, get_element, max_messages):
+        streaming_pull = _get_or_create_streaming_pull(
+            self.sub_client, self._sub_name, self.options, self.logger
+        )
+        results = []
+        for message in streaming_pull.read(max_messages):
+            timestamp, parsed_message = get_element(message)
+            # acknowledged through the streaming pull, which releases its
+            # flow control
+            token = self.message_manager.add(
+                message.ack_id,
+                parsed_message,
+                lease=message,
+                message_id=message.message_id,
+            )
+            results.append(
+                (timestamp, self._with_token(parsed_message, token))
+            )
         return results
 
+    @staticmethod
+    def _with_token(parsed_message, token):
+        # the token of the delivery is carried along with the message, so
+        # marking it as done finds it without parsing it again
+        tokenized = copy.copy(parsed_message)
+        tokenized.data = pmsg_mgr.attach_token(parsed_message.data, token)
+        return tokenized
+
 
 class KlioTransformEvaluatorRegistry(
     transform_evaluator.TransformEvaluatorRegistry
@@ -106,6 +106,10 @@ def _config():
     mock_job_config.events.outputs = [mock_output]
     mock_job_config.data.inputs = [mock_input]
     mock_job_config.data.outputs = [mock_output]
+    mock_job_config.parse_klio_message_once = False
+    mock_job_config.fused_ingress = False
+    mock_job_config.payload_store_threshold = 0
+    mock_job_config.dedup = {}
 
     mock_pipeline_options = mock.Mock()
 
@@ -815,3 +819,164 @@ def test_run_pipeline_raises(
     mock_pipeline.return_value.run.assert_called_once_with()
     assert 1 == len(caplog.records)
     assert "ERROR" == caplog.records[0].levelname
+
+
+@pytest.mark.parametrize("has_data_in", (True, False))
+@pytest.mark.parametrize("has_data_out", (True, False))
+@pytest.mark.parametrize("skip_check", (True, False))
+def test_setup_ingress(
+    skip_check, has_data_out, has_data_in, config, mocker, monkeypatch
+):
+    mock_ingress = mocker.Mock(return_value=mocker.MagicMock())
+    monkeypatch.setattr(run.helpers, "KlioIngress", mock_ingress)
+    data_in = config.job_config.data.inputs[0]
+    data_out = config.job_config.data.outputs[0]
+    data_in.skip_klio_existence_check = skip_check
+    data_out.skip_klio_existence_check = skip_check
+    config.job_config.data.inputs = [data_in] if has_data_in else []
+    config.job_config.data.outputs = [data_out] if has_data_out else []
+    in_pcol = mocker.MagicMock()
+    ingress = in_pcol.__or__.return_value
+
+    kpipe = run.KlioPipeline("my-job", config, mocker.Mock())
+    to_process, to_pass_thru = kpipe._setup_ingress(in_pcol)
+
+    mock_ingress.assert_called_once_with(
+        filter_ping=has_data_in,
+        check_output_exists=has_data_out and not skip_check,
+        check_input_exists=has_data_in and not skip_check,
+    )
+    assert ingress.process == to_process
+    if has_data_in or (has_data_out and not skip_check):
+        assert ingress.pass_thru == to_pass_thru
+    else:
+        assert to_pass_thru is None
+
+
+@pytest.mark.parametrize("runner", ("DirectGKERunner", "DataflowRunner"))
+def test_setup_dedup(runner, config, mocker, monkeypatch):
+    mock_dedup = mocker.Mock(return_value=mocker.MagicMock())
+    monkeypatch.setattr(run.helpers, "KlioDeduplicate", mock_dedup)
+    mock_ack_dup = mocker.Mock()
+    monkeypatch.setattr(run.helpers, "KlioAckDuplicateMessage", mock_ack_dup)
+    mock_par_do = mocker.Mock(return_value=mocker.MagicMock())
+    monkeypatch.setattr(run.beam, "ParDo", mock_par_do)
+    config.pipeline_options.runner = runner
+    in_pcol = mocker.MagicMock()
+    dedup = in_pcol.__or__.return_value
+
+    kpipe = run.KlioPipeline("my-job", config, mocker.Mock())
+    to_process = kpipe._setup_dedup(in_pcol)
+
+    mock_dedup.assert_called_once_with()
+    assert dedup.process == to_process
+    if runner == "DirectGKERunner":
+        mock_par_do.assert_called_once_with(mock_ack_dup.return_value)
+    else:
+        mock_par_do.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "input_name,dedup,exp_dedup",
+    (
+        ("pubsub", {"ttl_sec": 60}, True),
+        ("pubsub", {}, False),
+        ("file", {"ttl_sec": 60}, False),
+    ),
+)
+def test_generate_pcoll_dedup(
+    input_name, dedup, exp_dedup, config, mocker, monkeypatch
+):
+    mock_setup_dedup = mocker.Mock()
+    monkeypatch.setattr(run.KlioPipeline, "_setup_dedup", mock_setup_dedup)
+    mock_setup_ingress = mocker.Mock()
+    monkeypatch.setattr(run.KlioPipeline, "_setup_ingress", mock_setup_ingress)
+    config.job_config.dedup = dedup
+    config.job_config.fused_ingress = True
+    input_config = mocker.Mock(skip_klio_read=False)
+    input_config.name = input_name
+    input_config.to_io_kwargs.return_value = {}
+    pipeline = mocker.MagicMock()
+    in_pcol = pipeline.__or__.return_value
+
+    kpipe = run.KlioPipeline("my-job", config, mocker.Mock())
+    monkeypatch.setattr(
+        kpipe,
+        "_io_mapper",
+        mocker.Mock(
+            input={input_name: mocker.Mock(return_value=mocker.MagicMock())}
+        ),
+    )
+    kpipe._generate_pcoll(pipeline, input_config)
+
+    if exp_dedup:
+        mock_setup_dedup.assert_called_once_with(in_pcol, None)
+        mock_setup_ingress.assert_called_once_with(
+            mock_setup_dedup.return_value, None
+        )
+    else:
+        mock_setup_dedup.assert_not_called()
+        mock_setup_ingress.assert_called_once_with(in_pcol, None)
+
+
+@pytest.mark.parametrize("parse_once", (True, False))
+@pytest.mark.parametrize("fused_ingress", (True, False))
+def test_generate_pcoll_ingress(
+    fused_ingress, parse_once, config, mocker, monkeypatch
+):
+    mock_setup_ingress = mocker.Mock()
+    monkeypatch.setattr(run.KlioPipeline, "_setup_ingress", mock_setup_ingress)
+    mock_recipients = mocker.Mock()
+    monkeypatch.setattr(
+        run.KlioPipeline, "_filter_intended_recipients", mock_recipients
+    )
+    mock_audit_log = mocker.Mock()
+    monkeypatch.setattr(run.KlioPipeline, "_update_audit_log", mock_audit_log)
+    mock_filters = mocker.Mock(return_value=("to-process", "to-pass-thru"))
+    monkeypatch.setattr(
+        run.KlioPipeline, "_setup_data_io_filters", mock_filters
+    )
+    mock_serialize = mocker.Mock(return_value=("ser-process", "ser-pass"))
+    monkeypatch.setattr(
+        run.KlioPipeline, "_serialize_parsed_messages", mock_serialize
+    )
+    config.job_config.fused_ingress = fused_ingress
+    config.job_config.parse_klio_message_once = parse_once
+    input_config = mocker.Mock(skip_klio_read=False)
+    input_config.name = "file"
+    input_config.to_io_kwargs.return_value = {}
+    pipeline = mocker.MagicMock()
+    in_pcol = pipeline.__or__.return_value
+
+    kpipe = run.KlioPipeline("my-job", config, mocker.Mock())
+    monkeypatch.setattr(
+        kpipe,
+        "_io_mapper",
+        mocker.Mock(
+            input={"file": mocker.Mock(return_value=mocker.MagicMock())}
+        ),
+    )
+    actual = kpipe._generate_pcoll(pipeline, input_config)
+
+    if fused_ingress:
+        # KlioIngress parses each message once regardless
+        mock_setup_ingress.assert_called_once_with(in_pcol, None)
+        assert mock_setup_ingress.return_value == actual
+        mock_recipients.assert_not_called()
+        mock_serialize.assert_not_called()
+        return
+
+    # the transforms (and their labels) are the same as without
+    # KlioIngress, so that running jobs can still be updated
+    mock_setup_ingress.assert_not_called()
+    mock_recipients.assert_called_once_with(in_pcol, None)
+    mock_audit_log.assert_called_once_with(mock_recipients.return_value, None)
+    mock_filters.assert_called_once_with(mock_audit_log.return_value, None)
+    if parse_once:
+        mock_serialize.assert_called_once_with(
+            "to-process", "to-pass-thru", None
+        )
+        assert ("ser-process", "ser-pass") == actual
+    else:
+        mock_serialize.assert_not_called()
+        assert ("to-process", "to-pass-thru") == actual
@@ -22,10 +22,13 @@ These validate that the original expected behavior from _PubSubReadEvaluator
 was kept, as well checking that:
     * Responses are not auto-acked
     * MessageManager daemon threads started
-    * Messages added to MessageManager
-    * Messages handled one at a time, instead of 10 at a time
+    * Messages added to MessageManager, and their tokens attached
+    * Messages handled one at a time by default, instead of 10 at a time
+    * The subscriber client's channel is kept open
 """
 
+import datetime
+
 import pytest
 
 from apache_beam import transforms as beam_transforms
@@ -44,13 +47,28 @@ from klio_core.proto import klio_pb2
 from klio_exec.runners import evaluators
 
 
+@pytest.fixture(autouse=True)
+def clear_caches(monkeypatch):
+    monkeypatch.setattr(evaluators, "_SUBSCRIBER_CLIENT", None)
+    monkeypatch.setattr(evaluators, "_MESSAGE_MANAGERS", {})
+    monkeypatch.setattr(evaluators, "_STREAMING_PULLS", {})
+    monkeypatch.setattr(evaluators, "_WATER_MARKS", {})
+
+
 @pytest.fixture
 def patch_msg_manager(mocker, monkeypatch):
     p = mocker.Mock(name="patch_msg_manager")
+    p.return_value.add.return_value = 1
     monkeypatch.setattr(pmm, "MessageManager", p)
     return p
 
 
+def _with_token(pmsg, token=1):
+    return b_pubsub.PubsubMessage(
+        pmm.attach_token(pmsg.data, token), pmsg.attributes
+    )
+
+
 @pytest.fixture
 def patch_sub_client(mocker, monkeypatch):
     # patch out network calls in SubscriberClient instantiation
@@ -108,7 +126,7 @@ def test_klio_pubsub_read_eval_read_messages_success(
     pmsg = b_pubsub.PubsubMessage(data, attributes)
     expected_elements = [
         beam_testing_util.TestWindowedValue(
-            pmsg,
+            _with_token(pmsg),
             beam_utils.timestamp.Timestamp(1520861821.234567),
             [beam_transforms.window.GlobalWindow()],
         )
@@ -135,14 +153,16 @@ def test_klio_pubsub_read_eval_read_messages_success(
         patch_sub_client.subscription_path()
     )
     # 3. Check that messages were added to the MessageManager
-    patch_msg_manager.return_value.add.assert_called_once_with(ack_id, pmsg)
+    patch_msg_manager.return_value.add.assert_called_once_with(
+        ack_id, pmsg, message_id=mocker.ANY
+    )
     # 4. Check that one message is handled at a time, instead of the
     #    original 10
     patch_sub_client.pull.assert_called_once_with(
         mocker.ANY, max_messages=1, return_immediately=True
     )
 
-    patch_sub_client.api.transport.channel.close.assert_called_once_with()
+    patch_sub_client.api.transport.channel.close.assert_not_called()
 
 
 def test_read_messages_timestamp_attribute_milli_success(
@@ -167,7 +187,7 @@ def test_read_messages_timestamp_attribute_milli_success(
     pmsg = b_pubsub.PubsubMessage(data, attributes)
     expected_elements = [
         beam_testing_util.TestWindowedValue(
-            pmsg,
+            _with_token(pmsg),
             beam_utils.timestamp.Timestamp(
                 micros=int(attributes["time"]) * 1000
             ),
@@ -201,14 +221,16 @@ def test_read_messages_timestamp_attribute_milli_success(
         patch_sub_client.subscription_path()
     )
     # 3. Check that messages were added to the MessageManager
-    patch_msg_manager.return_value.add.assert_called_once_with(ack_id, pmsg)
+    patch_msg_manager.return_value.add.assert_called_once_with(
+        ack_id, pmsg, message_id=mocker.ANY
+    )
     # 4. Check that one message is handled at a time, instead of the
     #    original 10
     patch_sub_client.pull.assert_called_once_with(
         mocker.ANY, max_messages=1, return_immediately=True
     )
 
-    patch_sub_client.api.transport.channel.close.assert_called_once_with()
+    patch_sub_client.api.transport.channel.close.assert_not_called()
 
 
 def test_read_messages_timestamp_attribute_rfc3339_success(
@@ -232,7 +254,7 @@ def test_read_messages_timestamp_attribute_rfc3339_success(
     pmsg = b_pubsub.PubsubMessage(data, attributes)
     expected_elements = [
         beam_testing_util.TestWindowedValue(
-            pmsg,
+            _with_token(pmsg),
             beam_utils.timestamp.Timestamp.from_rfc3339(attributes["time"]),
             [beam_transforms.window.GlobalWindow()],
         ),
@@ -264,14 +286,16 @@ def test_read_messages_timestamp_attribute_rfc3339_success(
         patch_sub_client.subscription_path()
     )
     # 3. Check that messages were added to the MessageManager
-    patch_msg_manager.return_value.add.assert_called_once_with(ack_id, pmsg)
+    patch_msg_manager.return_value.add.assert_called_once_with(
+        ack_id, pmsg, message_id=mocker.ANY
+    )
     # 4. Check that one message is handled at a time, instead of the
     #    original 10
     patch_sub_client.pull.assert_called_once_with(
         mocker.ANY, max_messages=1, return_immediately=True
     )
 
-    patch_sub_client.api.transport.channel.close.assert_called_once_with()
+    patch_sub_client.api.transport.channel.close.assert_not_called()
 
 
 def test_read_messages_timestamp_attribute_missing(
@@ -297,7 +321,7 @@ def test_read_messages_timestamp_attribute_missing(
     pmsg = b_pubsub.PubsubMessage(data, attributes)
     expected_elements = [
         beam_testing_util.TestWindowedValue(
-            pmsg,
+            _with_token(pmsg),
             beam_utils.timestamp.Timestamp.from_rfc3339(publish_time),
             [beam_transforms.window.GlobalWindow()],
         ),
@@ -329,14 +353,16 @@ def test_read_messages_timestamp_attribute_missing(
         patch_sub_client.subscription_path()
     )
     # 3. Check that messages were added to the MessageManager
-    patch_msg_manager.return_value.add.assert_called_once_with(ack_id, pmsg)
+    patch_msg_manager.return_value.add.assert_called_once_with(
+        ack_id, pmsg, message_id=mocker.ANY
+    )
     # 4. Check that one message is handled at a time, instead of the
     #    original 10
     patch_sub_client.pull.assert_called_once_with(
         mocker.ANY, max_messages=1, return_immediately=True
     )
 
-    patch_sub_client.api.transport.channel.close.assert_called_once_with()
+    patch_sub_client.api.transport.channel.close.assert_not_called()
 
 
 def test_read_messages_timestamp_attribute_fail_parse(patch_sub_client):
@@ -372,4 +398,213 @@ def test_read_messages_timestamp_attribute_fail_parse(patch_sub_client):
         p.run()
 
     patch_sub_client.acknowledge.assert_not_called()
-    patch_sub_client.api.transport.channel.close.assert_called_with()
+    patch_sub_client.api.transport.channel.close.assert_not_called()
+
+
+def test_read_options():
+    options = pipeline_options.PipelineOptions.from_dictionary(
+        {
+            "pubsub_max_messages": 10,
+            "pubsub_streaming_pull": True,
+            "pubsub_max_outstanding_bytes": 1024,
+        }
+    )
+
+    actual = options.view_as(evaluators.KlioPubSubReadOptions)
+
+    assert 10 == actual.pubsub_max_messages
+    assert actual.pubsub_streaming_pull is True
+    assert actual.pubsub_max_outstanding_messages is None
+    assert 1024 == actual.pubsub_max_outstanding_bytes
+    assert actual.pubsub_high_water_mark is None
+    assert actual.pubsub_low_water_mark is None
+
+
+def test_get_or_create_subscriber_client(patch_sub_client):
+    client = evaluators._get_or_create_subscriber_client()
+
+    assert patch_sub_client is client
+    assert client is evaluators._get_or_create_subscriber_client()
+
+
+class FakeStreamingClient(object):
+    """Delivers `messages` to the callback of every streaming pull."""
+
+    def __init__(self, mocker, messages):
+        self.mocker = mocker
+        self.messages = messages
+        self.subscribed = []
+
+    def subscribe(self, subscription, callback, flow_control):
+        self.subscribed.append(flow_control)
+        for message in self.messages:
+            callback(message)
+        future = self.mocker.Mock()
+        future.done.return_value = False
+        return future
+
+
+def test_streaming_pull(mocker):
+    client = FakeStreamingClient(mocker, list(range(5)))
+    streaming_pull = evaluators._StreamingPull(client, "a-sub", 10, 1024)
+
+    assert [0, 1, 2] == streaming_pull.read(3)
+    assert [3, 4] == streaming_pull.read(3)
+    assert [] == streaming_pull.read(3)
+    assert 10 == client.subscribed[0].max_messages
+    assert 1024 == client.subscribed[0].max_bytes
+
+
+def test_get_or_create_streaming_pull(mocker, monkeypatch):
+    monkeypatch.setattr(evaluators.multiprocessing, "cpu_count", lambda: 4)
+    client = FakeStreamingClient(mocker, [])
+    options = pipeline_options.PipelineOptions([]).view_as(
+        evaluators.KlioPubSubReadOptions
+    )
+    logger = mocker.Mock()
+
+    streaming_pull = evaluators._get_or_create_streaming_pull(
+        client, "a-sub", options, logger
+    )
+    assert streaming_pull is evaluators._get_or_create_streaming_pull(
+        client, "a-sub", options, logger
+    )
+    # as many outstanding messages as threads processing them by default
+    assert 4 == client.subscribed[0].max_messages
+
+    # restarted once the stream fails
+    streaming_pull.future.done.return_value = True
+    restarted = evaluators._get_or_create_streaming_pull(
+        client, "a-sub", options, logger
+    )
+    assert restarted is not streaming_pull
+    assert 2 == len(client.subscribed)
+    logger.warning.assert_called_once_with(
+        mocker.ANY, "a-sub", streaming_pull.future.exception.return_value
+    )
+
+
+def _get_evaluator(mocker, client, message_manager, options):
+    # skips setting up the parent evaluator
+    evaluator = evaluators.KlioPubSubReadEvaluator.__new__(
+        evaluators.KlioPubSubReadEvaluator
+    )
+    evaluator._sub_name = "a-sub"
+    evaluator.sub_client = client
+    evaluator.message_manager = message_manager
+    evaluator.logger = mocker.Mock()
+    evaluator.options = pipeline_options.PipelineOptions.from_dictionary(
+        options
+    ).view_as(evaluators.KlioPubSubReadOptions)
+    evaluator.water_marks = evaluators._get_or_create_water_marks(
+        "a-sub", evaluator.options
+    )
+    return evaluator
+
+
+def test_read_from_streaming_pull(mocker, patch_msg_manager):
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.data.element = b"entity_id"
+    message = mocker.Mock(
+        ack_id="ack_id",
+        data=kmsg.SerializeToString(),
+        attributes={"key": "value"},
+        publish_time=datetime.datetime(
+            2018, 3, 12, 13, 37, 1, 234567, tzinfo=datetime.timezone.utc
+        ),
+    )
+    client = FakeStreamingClient(mocker, [message])
+    evaluators._STREAMING_PULLS["a-sub"] = evaluators._StreamingPull(
+        client, "a-sub", 10, 1024
+    )
+    evaluator = _get_evaluator(
+        mocker,
+        client,
+        patch_msg_manager.return_value,
+        {"pubsub_streaming_pull": True, "pubsub_max_messages": 5},
+    )
+
+    actual = evaluator._read_from_pubsub(None)
+
+    pmsg = b_pubsub.PubsubMessage(message.data, message.attributes)
+    timestamp = beam_utils.timestamp.Timestamp.from_rfc3339(
+        "2018-03-12T13:37:01.234567Z"
+    )
+    assert [(timestamp, _with_token(pmsg))] == actual
+    patch_msg_manager.return_value.add.assert_called_once_with(
+        "ack_id", pmsg, lease=message, message_id=message.message_id
+    )
+    assert 1 == len(client.subscribed)
+
+
+def test_water_marks():
+    water_marks = evaluators._WaterMarks(high=10, high_bytes=100)
+
+    assert 5 == water_marks.low
+    assert 50 == water_marks.low_bytes
+    assert water_marks.update(9, 99) is False
+    assert water_marks.update(10, 0) is True
+    # paused until both are below their low water mark
+    assert water_marks.update(5, 0) is True
+    assert water_marks.update(4, 50) is True
+    assert water_marks.update(4, 49) is False
+    assert water_marks.update(0, 100) is True
+    assert 10 == water_marks.room(0)
+    assert 0 == water_marks.room(12)
+
+
+def test_water_marks_unlimited():
+    water_marks = evaluators._WaterMarks()
+
+    assert water_marks.update(10 ** 6, 10 ** 12) is False
+    assert water_marks.room(10 ** 6) is None
+
+
+def test_water_marks_single_message():
+    water_marks = evaluators._WaterMarks(high=1, high_bytes=1)
+
+    assert (1, 1) == (water_marks.low, water_marks.low_bytes)
+    assert water_marks.update(0, 0) is False
+    # pause, then resume once everything in progress has drained
+    assert water_marks.update(1, 1) is True
+    assert water_marks.update(1, 0) is True
+    assert water_marks.update(0, 0) is False
+
+
+@pytest.mark.parametrize(
+    "low,match", ((11, "above high water mark"), (0, "below 1"))
+)
+def test_water_marks_raises(low, match):
+    with pytest.raises(ValueError, match=match):
+        evaluators._WaterMarks(high=10, low=low)
+
+
+@pytest.mark.parametrize(
+    "in_flight,exp_max_messages", ((0, 5), (8, 2), (9, 1), (10, 0))
+)
+def test_read_water_marks(
+    in_flight, exp_max_messages, mocker, monkeypatch, patch_sub_client
+):
+    monkeypatch.setattr(evaluators.time, "sleep", mocker.Mock())
+    message_manager = mocker.Mock(in_flight=in_flight, in_flight_bytes=0)
+    patch_sub_client.pull.return_value.received_messages = []
+    evaluator = _get_evaluator(
+        mocker,
+        patch_sub_client,
+        message_manager,
+        {"pubsub_max_messages": 5, "pubsub_high_water_mark": 10},
+    )
+
+    assert [] == evaluator._read_from_pubsub(None)
+
+    if exp_max_messages:
+        patch_sub_client.pull.assert_called_once_with(
+            "a-sub", max_messages=exp_max_messages, return_immediately=True
+        )
+        evaluators.time.sleep.assert_not_called()
+    else:
+        patch_sub_client.pull.assert_not_called()
+        evaluators.time.sleep.assert_called_once_with(evaluator.PAUSE_SEC)
+        evaluator.logger.info.assert_called_once_with(
+            mocker.ANY, "Paused", "a-sub", 10, 0
+        )
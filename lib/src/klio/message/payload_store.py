@@ -0,0 +1,260 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Worker-local store for large :ref:`KlioMessage <klio-message>` payloads.
+
+When ``job_config.payload_store_threshold`` is set, payloads larger than
+the threshold are kept in a :class:`PayloadStore` and only a small handle
+is written into ``KlioMessage.data.payload``. The payload bytes are then
+no longer copied every time a message is serialized, parsed, or handed
+between transforms; they are resolved from the store when a transform
+parses the message with :func:`klio.message.serializer.to_klio_message`.
+
+Stored payloads are evicted once their message is acknowledged or
+dropped, and no other message with the same element is in progress (see
+:func:`hold`). Handles are only valid within the worker process that created
+them, so the store is only used with the ``DirectGKERunner``, where a
+message is processed from start to finish within one process.
+"""
+
+import threading
+import uuid
+
+from klio.message import exceptions
+
+
+HANDLE_PREFIX = b"klio-payload-ref:v1:"
+_HANDLE_PREFIX_LEN = len(HANDLE_PREFIX)
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+# element -> number of its messages in progress; see `hold`
+_HELD = {}
+_HELD_LOCK = threading.Lock()
+
+
+def is_handle(payload):
+    """Return whether ``payload`` is a reference to a stored payload.
+
+    Args:
+        payload (bytes): a ``KlioMessage.data.payload`` value.
+    Returns:
+        bool: whether ``payload`` is a payload store handle.
+    """
+    return isinstance(payload, bytes) and payload.startswith(HANDLE_PREFIX)
+
+
+class _Entry(object):
+    __slots__ = ("payload", "owner", "refcount")
+
+    def __init__(self, payload, owner):
+        self.payload = payload
+        self.owner = owner
+        self.refcount = 1
+
+
+class PayloadStore(object):
+    """Thread-safe, in-process store of large payloads.
+
+    Payloads are held by reference, so storing and resolving a payload
+    never copies its bytes. Each stored payload is reference counted and
+    belongs to the ``KlioMessage.data.element`` of the message that
+    carries it.
+
+    Args:
+        threshold (int): size in bytes above which payloads are stored.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._entries = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def size(self):
+        """int: Total size in bytes of the stored payloads."""
+        with self._lock:
+            return sum(len(e.payload) for e in self._entries.values())
+
+    def should_store(self, payload):
+        """Return whether ``payload`` is large enough to be stored.
+
+        Args:
+            payload (bytes): a payload.
+        Returns:
+            bool: whether ``payload`` is larger than the store's threshold.
+        """
+        return len(payload) > self.threshold
+
+    def put(self, payload, owner):
+        """Store ``payload`` and return its handle.
+
+        Storing the same payload object that its owner already has in
+        the store (for instance, when a transform returns the payload it
+        received) returns the existing handle and increments its
+        reference count. Payloads are compared by identity, so an equal
+        copy of a stored payload is stored again.
+
+        Args:
+            payload (bytes): the payload to store.
+            owner (bytes): ``KlioMessage.data.element`` of the message
+                carrying the payload.
+        Returns:
+            bytes: handle to set as ``KlioMessage.data.payload``.
+        """
+        with self._lock:
+            for key in self._owners.get(owner, ()):
+                entry = self._entries[key]
+                if entry.payload is payload:
+                    entry.refcount += 1
+                    return HANDLE_PREFIX + key
+
+            key = uuid.uuid4().hex.encode("utf-8")
+            self._entries[key] = _Entry(payload, owner)
+            self._owners.setdefault(owner, set()).add(key)
+        return HANDLE_PREFIX + key
+
+    def get(self, handle):
+        """Return the payload referenced by ``handle``.
+
+        Args:
+            handle (bytes): a handle returned by :meth:`put`.
+        Returns:
+            bytes: the stored payload.
+        Raises:
+            klio.message.exceptions.KlioMessagePayloadException: the
+                payload is not (or no longer) in the store.
+        """
+        key = handle[_HANDLE_PREFIX_LEN:]
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            msg = (
+                "Payload referenced by '{}' not found in the payload store. "
+                "It may have been evicted after its message was "
+                "acknowledged or dropped, or it was stored by a different "
+                "worker process.".format(handle.decode("utf-8", "replace"))
+            )
+            raise exceptions.KlioMessagePayloadException(msg)
+        return entry.payload
+
+    def release(self, handle):
+        """Decrement the reference count of a stored payload.
+
+        The payload is evicted once it's no longer referenced.
+
+        Args:
+            handle (bytes): a handle returned by :meth:`put`.
+        """
+        key = handle[_HANDLE_PREFIX_LEN:]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount -= 1
+            if entry.refcount <= 0:
+                self._remove(key)
+
+    def evict(self, owner):
+        """Evict all payloads belonging to a message.
+
+        Called when the message is acknowledged or dropped.
+
+        Args:
+            owner (bytes): ``KlioMessage.data.element`` of the message.
+        """
+        with self._lock:
+            for key in list(self._owners.get(owner, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        keys = self._owners.get(entry.owner)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self._owners.pop(entry.owner)
+
+
+def get_store(kconfig=None):
+    """Get the worker's payload store.
+
+    Args:
+        kconfig (klio_core.config.KlioConfig): the current job's
+            configuration. If not given, the payload store is only
+            returned if one has already been created.
+    Returns:
+        PayloadStore: the worker's payload store, or ``None`` if the job
+            doesn't use one.
+    """
+    global _STORE
+    if kconfig is None:
+        return _STORE
+
+    threshold = kconfig.job_config.payload_store_threshold
+    if not threshold:
+        return None
+
+    # TODO: update me to `var.KlioRunner.DIRECT_GKE_RUNNER` once
+    #       direct_on_gke_runner_clean is merged
+    if kconfig.pipeline_options.runner != "DirectGKERunner":
+        return None
+
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = PayloadStore(threshold)
+    return _STORE
+
+
+def hold(element):
+    """Keep the stored payloads of a message's element until it's done.
+
+    Payloads are stored per element, and the same element can be in
+    progress in several messages at once (e.g. published twice). The
+    payloads are only evicted once :func:`evict` has been called for each
+    message that was held.
+
+    Args:
+        element (bytes): ``KlioMessage.data.element`` of the message.
+    """
+    with _HELD_LOCK:
+        _HELD[element] = _HELD.get(element, 0) + 1
+
+
+def evict(element, held=True):
+    """Evict the stored payloads of an acknowledged or dropped message.
+
+    Payloads are kept while another message with the same element is
+    still held (see :func:`hold`).
+
+    Args:
+        element (bytes): ``KlioMessage.data.element`` of the message.
+        held (bool): whether the message was held with :func:`hold`.
+            Default: ``True``.
+    """
+    with _HELD_LOCK:
+        remaining = _HELD.pop(element, 0) - held
+        if remaining > 0:
+            _HELD[element] = remaining
+            return
+        # evicted while still holding the lock, so that no other message
+        # of the element can be held in the meantime
+        if _STORE is not None:
+            _STORE.evict(element)
@@ -13,61 +13,552 @@
 # limitations under the License.
 #
 
+import collections
+import heapq
+import itertools
 import logging
 import threading
 import time
 
-from concurrent import futures
-
+from google.api_core import exceptions as g_exceptions
 from google.cloud import pubsub as g_pubsub
 
+try:
+    from google.protobuf import unknown_fields as pb_unknown_fields
+except ImportError:  # pragma: no cover
+    # protobuf < 4.21, where messages have an `UnknownFields` method instead
+    pb_unknown_fields = None
+
 from klio_core.proto import klio_pb2
 
+from klio.message import payload_store
+from klio.message import view
+from klio.metrics import prometheus
+
+
+# Field number of the token identifying a delivery of a message while it's
+# in progress. It's appended to the serialized KlioMessage the delivery is
+# read as; not being part of the KlioMessage proto, it's carried along as an
+# unknown field while the message is processed, and detached (see
+# `detach_token`) before the message leaves the job.
+TOKEN_FIELD = 15
+IN_FLIGHT_STRIPES = 16
+_TOKEN_TAG = view._encode_varint((TOKEN_FIELD << 3) | view._VARINT)
+_TOKENS = itertools.count(1)
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+# A deadline extension or acknowledgement waiting to be sent: the message,
+# its ack IDs, and whether they're only of duplicate deliveries.
+_PendingAck = collections.namedtuple(
+    "_PendingAck", ["message", "ack_ids", "duplicate"]
+)
 
-ENTITY_ID_TO_ACK_ID = {}
-MESSAGE_LOCK = threading.Lock()
-_CACHED_THREADPOOL_EXEC = None
 
+class _Scheduler(object):
+    """Runs the checks of all in-progress messages on a single thread.
+
+    Each message has one entry in a min-heap of when it's next due to be
+    checked (see :meth:`MessageManager.manage`), so that scheduling a
+    check is O(log n) in the number of in-progress messages. Rescheduled
+    entries are marked as cancelled and skipped once they come up.
+
+    Managers with deadline extensions or acknowledgements waiting to be
+    sent are flushed once no check is due before the earliest flush time
+    asked for, so checks due around the same time share requests.
+    """
 
-def _get_or_create_executor():
-    # We create one threadpool executor since the MessageManager does
-    # get initialized more than once (pretty frequently, actually). So
-    # let's reuse our executor rather than re-create it.
-    global _CACHED_THREADPOOL_EXEC
-    if _CACHED_THREADPOOL_EXEC is None:
-        # max_workers is equal to the number of threads we want to run in
-        # the background - 1 message maanger, and 1 heartbeat
-        _CACHED_THREADPOOL_EXEC = futures.ThreadPoolExecutor(
-            thread_name_prefix="KlioMessageManager", max_workers=2
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        # entries: [due, sequence number, manager or None if cancelled,
+        # message]
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._flushes = set()
+        self._flush_due = None
+        self._thread = None
+        self.logger = logging.getLogger(
+            "klio.gke_direct_runner.message_manager"
         )
 
-    return _CACHED_THREADPOOL_EXEC
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, manager, message, due):
+        previous = self._entries.get(message)
+        if previous is not None:
+            previous[2] = None
+        entry = [due, next(self._counter), manager, message]
+        self._entries[message] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._cond.notify()
+        self._start()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="KlioMessageManager", daemon=True
+            )
+            self._thread.start()
+
+    def schedule(self, manager, message, due):
+        """Schedule the next check of a message.
+
+        Args:
+            manager (MessageManager): manager of the message.
+            message (PubSubKlioMessage): message to check.
+            due (float): :func:`time.monotonic` time to check it at.
+        """
+        with self._cond:
+            self._push(manager, message, due)
+
+    def flush_later(self, manager, due):
+        """Schedule a call of a manager's :meth:`MessageManager.flush`.
+
+        Args:
+            manager (MessageManager): manager to flush.
+            due (float): latest :func:`time.monotonic` time to flush it at.
+        """
+        with self._cond:
+            self._flushes.add(manager)
+            if self._flush_due is None or due < self._flush_due:
+                self._flush_due = due
+                self._cond.notify()
+            self._start()
+
+    def wake(self, message):
+        """Check a scheduled message as soon as possible.
+
+        Args:
+            message (PubSubKlioMessage): message to check.
+        """
+        with self._cond:
+            entry = self._entries.get(message)
+            if entry is not None:
+                self._push(entry[2], message, time.monotonic())
+
+    def _next_task(self):
+        # Returns the next due entry, or else the managers to flush
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap), None
+                if self._flush_due is not None and self._flush_due <= now:
+                    managers, self._flushes = self._flushes, set()
+                    self._flush_due = None
+                    return None, managers
+
+                timeouts = [
+                    due - now
+                    for due in (
+                        self._heap[0][0] if self._heap else None,
+                        self._flush_due,
+                    )
+                    if due is not None
+                ]
+                self._cond.wait(min(timeouts) if timeouts else None)
+
+    def _flush(self, managers):
+        for manager in managers:
+            try:
+                manager.flush()
+            except Exception as e:
+                self.logger.error(
+                    f"Error encountered when sending Pub/Sub deadline "
+                    f"extensions & acknowledgements: {e}",
+                    exc_info=True,
+                )
+
+    def _run(self):
+        while True:
+            entry, managers = self._next_task()
+            if entry is None:
+                self._flush(managers)
+                continue
+
+            _, _, manager, message = entry
+            try:
+                due = manager.manage(message)
+            except Exception as e:
+                self.logger.error(
+                    f"Error encountered when checking {message}: {e}",
+                    exc_info=True,
+                )
+                due = time.monotonic() + manager.manager_sleep
+
+            with self._cond:
+                current = self._entries.get(message)
+                if due is None:
+                    if current is not None:
+                        current[2] = None
+                        del self._entries[message]
+                # otherwise the message was woken up in the meantime, and
+                # is already due again
+                elif current is entry:
+                    self._push(manager, message, due)
+
+
+def _get_or_create_scheduler():
+    # The MessageManager gets initialized more than once (pretty
+    # frequently, actually), so all instances share one scheduler thread.
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = _Scheduler()
+    return _SCHEDULER
+
+
+def _find_tokens(serialized_message):
+    # Returns the (start, end, token) of every token field of a serialized
+    # KlioMessage, only reading its top-level fields.
+    buf = memoryview(serialized_message)
+    found = []
+    token = None
+    for offset, number, wire_type, value in view._iter_field_offsets(
+        buf, 0, len(buf)
+    ):
+        if token is not None:
+            found.append(token + (offset,))
+            token = None
+        if number == TOKEN_FIELD and wire_type == view._VARINT:
+            token = (offset, value)
+    if token is not None:
+        found.append(token + (len(buf),))
+    return [(start, end, value) for start, value, end in found]
+
+
+def attach_token(serialized_message, token):
+    """Attach the token of a delivery to a serialized KlioMessage.
+
+    Replaces any token attached before, e.g. by the job that published the
+    message.
+
+    Args:
+        serialized_message (bytes): a serialized KlioMessage.
+        token (int): token of the delivery, as returned by
+            :meth:`MessageManager.add`.
+    Returns:
+        bytes: the serialized KlioMessage with the token.
+    """
+    return b"".join(
+        [
+            detach_token(serialized_message),
+            _TOKEN_TAG,
+            view._encode_varint(token),
+        ]
+    )
+
+
+def detach_token(serialized_message):
+    """Remove the token of a delivery from a serialized KlioMessage.
+
+    Tokens are only meaningful within the worker that read the message, so
+    they're removed before a message is written out of the job, e.g. to
+    its event output or an upstream job's topic.
+
+    Args:
+        serialized_message (bytes): a serialized KlioMessage.
+    Returns:
+        bytes: the serialized KlioMessage without a token; the same object
+        if it didn't have one.
+    """
+    tokens = _find_tokens(serialized_message)
+    if not tokens:
+        return serialized_message
+    parts = []
+    pos = 0
+    for start, end, _ in tokens:
+        parts.append(serialized_message[pos:start])
+        pos = end
+    parts.append(serialized_message[pos:])
+    return b"".join(parts)
+
+
+def read_token(kmsg_or_bytes):
+    """Read the token of a delivery attached to a KlioMessage.
+
+    Serialized messages are read without being parsed, and parsed ones
+    without being serialized.
+
+    Args:
+        kmsg_or_bytes (klio_pb2.KlioMessage, view.KlioMessageView or
+            bytes): the KlioMessage (or a KlioMessage that has been
+            serialized to bytes).
+    Returns:
+        int: the token, or ``None`` if the message doesn't have one.
+    """
+    if isinstance(kmsg_or_bytes, klio_pb2.KlioMessage):
+        return _read_unknown_token(kmsg_or_bytes)
+    serialized = kmsg_or_bytes
+    if isinstance(kmsg_or_bytes, view.KlioMessageView):
+        serialized = kmsg_or_bytes._serialized
+    tokens = _find_tokens(serialized)
+    if not tokens:
+        return None
+    return tokens[-1][2]
+
+
+def _read_unknown_token(kmsg):
+    # The token is kept among a parsed KlioMessage's unknown fields, so it's
+    # read from there rather than by serializing the whole message, payload
+    # included.
+    if pb_unknown_fields is not None:
+        fields = pb_unknown_fields.UnknownFieldSet(kmsg)
+    else:
+        fields = kmsg.UnknownFields()
+    token = None
+    for field in fields:
+        if field.field_number == TOKEN_FIELD and (
+            field.wire_type == view._VARINT
+        ):
+            token = field.data
+    return token
 
 
 class PubSubKlioMessage:
     """Contains state needed to manage ACKs for a KlioMessage"""
 
-    def __init__(self, ack_id, kmsg_id):
+    def __init__(self, ack_id, kmsg_id, size=0, key=None):
         self.ack_id = ack_id
         self.kmsg_id = kmsg_id
+        # bytes of the Pub/Sub message's data
+        self.size = size
+        # identifies deliveries of the same message: its Pub/Sub message
+        # ID, or its element if not known
+        self.key = kmsg_id if key is None else key
+        # guards the message's deliveries
+        self.lock = threading.Lock()
+        self.done = False
+        # token -> ack ID of each delivery
+        self.tokens = {}
         self.last_extended = None
         self.ext_duration = None
+        self.last_heartbeat = None
         self.event = threading.Event()
+        # ack IDs of further deliveries of the same message received while
+        # it's still in progress
+        self.duplicate_ack_ids = []
+        # ack IDs of duplicate deliveries that can be acknowledged already
+        self.done_duplicate_ack_ids = []
+        # ack ID -> message received over a streaming pull, acknowledged
+        # through it rather than with a request
+        self.leases = {}
+
+    @property
+    def ack_ids(self):
+        """list: Ack IDs of all deliveries of this message in progress."""
+        return (
+            [self.ack_id]
+            + self.duplicate_ack_ids
+            + self.done_duplicate_ack_ids
+        )
 
     def extend(self, duration):
         self.last_extended = time.monotonic()
         self.ext_duration = duration
 
+    def ack_duplicate(self, token=None):
+        """Mark one of several deliveries in progress as done.
+
+        Args:
+            token (int): token of the delivery. If not known, any
+                duplicate delivery is marked as done.
+        Returns:
+            bool: whether another delivery is still in progress. If not,
+            nothing is marked as done.
+        """
+        with self.lock:
+            if self.done or not self.duplicate_ack_ids:
+                return False
+            in_progress = [self.ack_id] + self.duplicate_ack_ids
+            ack_id = self.tokens.pop(token, None)
+            if ack_id not in in_progress:
+                ack_id = in_progress[-1]
+            in_progress.remove(ack_id)
+            self.ack_id = in_progress[0]
+            self.duplicate_ack_ids = in_progress[1:]
+            self.done_duplicate_ack_ids.append(ack_id)
+            return True
+
     def __repr__(self):
         return f"PubSubKlioMessage(kmsg_id={self.kmsg_id})"
 
 
+class _StripedDict(object):
+    """Dict split into stripes, each guarded by its own lock."""
+
+    def __init__(self, stripes):
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def __len__(self):
+        return sum(len(items) for items, _ in self._stripes)
+
+    def get(self, key):
+        items, _ = self._stripe(key)
+        return items.get(key)
+
+    def set(self, key, value):
+        items, lock = self._stripe(key)
+        with lock:
+            items[key] = value
+
+    def setdefault(self, key, value):
+        items, lock = self._stripe(key)
+        with lock:
+            return items.setdefault(key, value)
+
+    def discard(self, key, value=None):
+        """Remove a key, if set to ``value`` when given."""
+        items, lock = self._stripe(key)
+        with lock:
+            if value is None or items.get(key) is value:
+                items.pop(key, None)
+
+    def append(self, key, value):
+        """Append a value to the list of a key."""
+        items, lock = self._stripe(key)
+        with lock:
+            items.setdefault(key, []).append(value)
+
+    def first(self, key):
+        """Return the first value of the list of a key, if any."""
+        items, lock = self._stripe(key)
+        with lock:
+            values = items.get(key)
+            return values[0] if values else None
+
+    def remove(self, key, value):
+        """Remove a value from the list of a key."""
+        items, lock = self._stripe(key)
+        with lock:
+            values = items.get(key, [])
+            for index, other in enumerate(values):
+                if other is value:
+                    del values[index]
+                    break
+            if not values:
+                items.pop(key, None)
+
+
+class _InFlightRegistry(object):
+    """In-progress messages, looked up by the tokens of their deliveries.
+
+    Messages are also looked up by their key, to tell redeliveries, and by
+    their element, for KlioMessages that lost their token on the way.
+
+    Lookups are striped, so that reading messages and marking them as done
+    on different threads rarely contend for a lock.
+
+    Args:
+        stripes (int): number of stripes of each lookup.
+    """
+
+    def __init__(self, stripes=IN_FLIGHT_STRIPES):
+        self._by_token = _StripedDict(stripes)
+        self._by_key = _StripedDict(stripes)
+        self._by_element = _StripedDict(stripes)
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def add(self, message, token):
+        """Add a delivery of a message.
+
+        Args:
+            message (PubSubKlioMessage): message of the delivery.
+            token (int): token of the delivery.
+        Returns:
+            PubSubKlioMessage: the message the delivery was added to as a
+            duplicate, if the same message is already in progress,
+            otherwise ``None``.
+        """
+        while True:
+            in_progress = self._by_key.setdefault(message.key, message)
+            if in_progress is message:
+                break
+            with in_progress.lock:
+                if not in_progress.done:
+                    in_progress.duplicate_ack_ids.append(message.ack_id)
+                    in_progress.leases.update(message.leases)
+                    in_progress.tokens[token] = message.ack_id
+                    self._by_token.set(token, in_progress)
+                    return in_progress
+            # done in the meantime
+            self._by_key.discard(message.key, in_progress)
+
+        message.tokens[token] = message.ack_id
+        self._by_token.set(token, message)
+        self._by_element.append(message.kmsg_id, message)
+        return None
+
+    def get(self, token):
+        """Return the message of a delivery, if in progress."""
+        return self._by_token.get(token)
+
+    def find(self, kmsg_id):
+        """Return the oldest in-progress message of an element, if any."""
+        return self._by_element.first(kmsg_id)
+
+    def ack_duplicate(self, message, token=None):
+        """Mark one of several deliveries of a message as done.
+
+        See :meth:`PubSubKlioMessage.ack_duplicate`.
+        """
+        if not message.ack_duplicate(token):
+            return False
+        if token is not None:
+            self._by_token.discard(token, message)
+        return True
+
+    def finish(self, message):
+        """Mark a message, and all its deliveries, as done.
+
+        Args:
+            message (PubSubKlioMessage): the message.
+        Returns:
+            bool: whether the message was in progress.
+        """
+        with message.lock:
+            if message.done:
+                return False
+            message.done = True
+            tokens = list(message.tokens)
+        self._by_key.discard(message.key, message)
+        self._by_element.remove(message.kmsg_id, message)
+        for token in tokens:
+            self._by_token.discard(token, message)
+        return True
+
+
+IN_FLIGHT = _InFlightRegistry()
+
+
 class MessageManager:
     """Manages the ack deadline for in-progress KlioMessages.
 
     Extends the ack deadline while the KlioMessage is still processing, and
     stops extending them when the message is done.
 
+    All in-progress messages are checked from a single background thread,
+    in order of when their deadline is next due to be extended (or a
+    heartbeat is due to be logged). Messages marked as done are checked
+    right away.
+
+    Deadline extensions and acknowledgements are collected and sent in
+    batches of up to ``MAX_BATCH_SIZE`` ack IDs, at most
+    ``FLUSH_INTERVAL_SEC`` after they're made.
+
+    How many messages, and bytes of them, are in progress is kept in
+    :attr:`in_flight` and :attr:`in_flight_bytes`, for readers to stop
+    pulling while too much is in progress.
+
     This class is used by ``KlioPubSubReadEvaluator`` to manage message
     acknowledgement.
 
@@ -82,6 +573,13 @@ class MessageManager:
     """
 
     DEFAULT_DEADLINE_EXTENSION = 30
+    # most ack IDs Pub/Sub accepts in one request
+    MAX_BATCH_SIZE = 2500
+    FLUSH_INTERVAL_SEC = 0.1
+    # most seconds to wait for Pub/Sub to respond to a request
+    REQUEST_TIMEOUT_SEC = 10
+    # most requests to retry a batch with after it's rejected as invalid
+    MAX_RETRY_REQUESTS = 64
 
     def __init__(self, sub_name, heartbeat_sleep=10, manager_sleep=3):
         """Initialize a MessageManager instance.
@@ -89,9 +587,10 @@ class MessageManager:
         Args:
              sub_name(str): PubSub subscription name to listen on.
              heartbeat_sleep(float):
-                Seconds to sleep between heartbeat messages.
+                Seconds between heartbeat messages.
              manager_sleep(float):
-                Seconds to sleep between deadline extension checks.
+                Seconds to wait before checking a message again after
+                an error.
         """
         self._client = g_pubsub.SubscriberClient()
         self._sub_name = sub_name
@@ -102,43 +601,78 @@ class MessageManager:
             "klio.gke_direct_runner.message_manager"
         )
         self.hrt_logger = logging.getLogger("klio.gke_direct_runner.heartbeat")
-        self.executor = _get_or_create_executor()
+        self.scheduler = _get_or_create_scheduler()
+        self._batch_lock = threading.Lock()
+        # deadline in seconds -> pending extensions
+        self._extensions = collections.defaultdict(list)
+        self._acks = []
+        self._pending_ack_ids = 0
+        self._in_flight_lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_bytes = 0
+        # ack queue depth, served if the Prometheus metrics client is used
+        prometheus.register_gauge(
+            "klio-pubsub-messages-in-progress",
+            lambda: len(IN_FLIGHT),
+            subscription=sub_name,
+        )
+        prometheus.register_gauge(
+            "klio-pubsub-bytes-in-progress",
+            lambda: self._in_flight_bytes,
+            subscription=sub_name,
+        )
+
+    @property
+    def in_flight(self):
+        """int: Messages added and not yet removed."""
+        return self._in_flight
+
+    @property
+    def in_flight_bytes(self):
+        """int: Bytes of data of the messages added and not yet removed."""
+        return self._in_flight_bytes
 
     def manage(self, message):
-        """Continuously track in-progress messages and extends their deadlines.
+        """Check an in-progress message.
+
+        Extends the message's deadline and logs a heartbeat when they're
+        due, and acknowledges the message once it's done.
 
         Args:
-            to_sleep(float): Seconds to sleep between checks.
+            message(PubSubKlioMessage): In-progress message to check.
+        Returns:
+            float: :func:`time.monotonic` time the message is next due to
+            be checked, or ``None`` if it's done.
         """
-        while True:
-            with MESSAGE_LOCK:
-                msg_is_active = message.kmsg_id in ENTITY_ID_TO_ACK_ID
-            if msg_is_active:
-                self._maybe_extend(message)
-                time.sleep(self.manager_sleep)
-            else:
-                self.remove(message)
-                break
+        if message.done:
+            self.hrt_logger.debug(
+                f"Job is no longer processing {message.kmsg_id}."
+            )
+            self.remove(message)
+            return None
+
+        self._ack_done_duplicates(message)
+        self._maybe_extend(message)
+        now = time.monotonic()
+        if (
+            message.last_heartbeat is None
+            or now - message.last_heartbeat >= self.heartbeat_sleep
+        ):
+            self.heartbeat(message)
+
+        return min(
+            message.last_extended + message.ext_duration * 0.8,
+            message.last_heartbeat + self.heartbeat_sleep,
+        )
 
     def heartbeat(self, message):
-        """Continuously log heartbeats for in-progress messages.
+        """Log a heartbeat for an in-progress message.
 
         Args:
-            to_sleep(float): Second to sleep between log messages.
+            message(PubSubKlioMessage): In-progress message.
         """
-        while True:
-            with MESSAGE_LOCK:
-                msg_is_active = message.kmsg_id in ENTITY_ID_TO_ACK_ID
-            if msg_is_active:
-                self.hrt_logger.info(
-                    f"Job is still processing {message.kmsg_id}..."
-                )
-                time.sleep(self.heartbeat_sleep)
-            else:
-                self.hrt_logger.debug(
-                    f"Job is no longer processing {message.kmsg_id}."
-                )
-                break
+        self.hrt_logger.info(f"Job is still processing {message.kmsg_id}...")
+        message.last_heartbeat = time.monotonic()
 
     def _maybe_extend(self, message):
         """Check to see if message is done and extends deadline if not.
@@ -168,6 +702,10 @@ class MessageManager:
     def extend_deadline(self, message, duration=None):
         """Extend deadline for a PubSubKlioMessage.
 
+        The extension is sent along with others by :meth:`flush`.
+        Deliveries received over a streaming pull are left out, since the
+        streaming pull's own lease management extends their deadlines.
+
         Args:
             message(PubSubKlioMessage): The message to extend the deadline for.
             duration(float): Seconds. If not specified, defaults to
@@ -175,30 +713,190 @@ class MessageManager:
         """
         if duration is None:
             duration = self.DEFAULT_DEADLINE_EXTENSION
-        request = {
-            "subscription": self._sub_name,
-            "ack_ids": [message.ack_id],
-            "ack_deadline_seconds": duration,  # seconds
-        }
+        ack_ids = [a for a in message.ack_ids if a not in message.leases]
+        if ack_ids:
+            self._enqueue(_PendingAck(message, ack_ids, False), duration)
+        message.extend(duration)
+
+    def _enqueue(self, pending_ack, duration=None):
+        # an extension by `duration` seconds, or an acknowledgement; looked
+        # up while holding the lock, since `flush` swaps them out
+        with self._batch_lock:
+            if duration is None:
+                pending = self._acks
+            else:
+                pending = self._extensions[duration]
+            pending.append(pending_ack)
+            self._pending_ack_ids += len(pending_ack.ack_ids)
+            is_full = self._pending_ack_ids >= self.MAX_BATCH_SIZE
+        if is_full:
+            self.flush()
+        else:
+            self.scheduler.flush_later(
+                self, time.monotonic() + self.FLUSH_INTERVAL_SEC
+            )
+
+    def _batches(self, pending):
+        batch, size = [], 0
+        for pending_ack in pending:
+            if batch and size + len(pending_ack.ack_ids) > self.MAX_BATCH_SIZE:
+                yield batch
+                batch, size = [], 0
+            batch.append(pending_ack)
+            size += len(pending_ack.ack_ids)
+        if batch:
+            yield batch
+
+    def _send(self, request, batch):
+        """Send a request for the ack IDs of a batch.
+
+        If Pub/Sub rejects the request as invalid, which a single expired
+        ack ID is enough for, each half of the batch is retried on its
+        own, until the invalid ack IDs are found. At most
+        ``MAX_RETRY_REQUESTS`` are retried; the ack IDs left when they run
+        out fail.
+
+        Args:
+            request(callable): sends a request for a list of ack IDs.
+            batch(list(_PendingAck)): deadline extensions or
+                acknowledgements to send.
+        Returns:
+            list(tuple(_PendingAck, str, Exception)): what failed, with
+            the ack ID that failed (or ``None`` if all of them did), and
+            the error.
+        """
+        ack_ids = [
+            (pending, ack_id)
+            for pending in batch
+            for ack_id in pending.ack_ids
+        ]
         try:
-            # TODO: this method also has `retry` and `timeout` kwargs which
-            # we may be interested in using
-            self._client.modify_ack_deadline(**request)
+            request([ack_id for _, ack_id in ack_ids])
+        except g_exceptions.InvalidArgument as e:
+            if len(ack_ids) == 1:
+                return [(batch[0], None, e)]
+            return self._bisect(request, ack_ids, [self.MAX_RETRY_REQUESTS], e)
         except Exception as e:
+            return [(pending, None, e) for pending in batch]
+        return []
+
+    def _bisect(self, request, ack_ids, budget, error):
+        # Retries each half of a list of (pending, ack ID) tuples rejected
+        # as invalid with `error`, so that a few invalid ack IDs take a few
+        # requests each rather than one request per ack ID. `budget` holds
+        # the number of requests left, shared by all halves.
+        if len(ack_ids) == 1:
+            return [(pending, ack_id, error) for pending, ack_id in ack_ids]
+
+        failed = []
+        middle = len(ack_ids) // 2
+        for half in (ack_ids[:middle], ack_ids[middle:]):
+            if not budget[0]:
+                failed.extend(
+                    (pending, ack_id, error) for pending, ack_id in half
+                )
+                continue
+            budget[0] -= 1
+            try:
+                request([ack_id for _, ack_id in half])
+            except g_exceptions.InvalidArgument as e:
+                failed.extend(self._bisect(request, half, budget, e))
+            except Exception as e:
+                failed.extend((pending, ack_id, e) for pending, ack_id in half)
+        return failed
+
+    def flush(self):
+        """Send all pending deadline extensions and acknowledgements."""
+        with self._batch_lock:
+            extensions = self._extensions
+            acks = self._acks
+            self._extensions = collections.defaultdict(list)
+            self._acks = []
+            self._pending_ack_ids = 0
+
+        for duration, pending in extensions.items():
+            for batch in self._batches(pending):
+                self._send_extensions(batch, duration)
+        for batch in self._batches(acks):
+            self._send_acks(batch)
+
+    def _send_extensions(self, batch, duration):
+        def request(ack_ids):
+            self._client.modify_ack_deadline(
+                subscription=self._sub_name,
+                ack_ids=ack_ids,
+                ack_deadline_seconds=duration,  # seconds
+                timeout=self.REQUEST_TIMEOUT_SEC,
+            )
+
+        failed = self._send(request, batch)
+        for pending, ack_id, e in failed:
+            message = pending.message
             self.mgr_logger.error(
                 f"Error encountered when trying to extend deadline for "
-                f"{message} with ack ID '{message.ack_id}': {e}",
+                f"{message} with ack ID '{ack_id or message.ack_id}': {e}",
                 exc_info=True,
             )
             self.mgr_logger.warning(
                 f"The message {message} may be re-delivered due to Klio's "
                 "inability to extend its deadline."
             )
-        else:
+        if len(failed) < len(batch):
             self.mgr_logger.debug(
-                f"Extended Pub/Sub ack deadline for {message} by {duration}s"
+                f"Extended Pub/Sub ack deadline for "
+                f"{len(batch) - len(failed)} message(s) by {duration}s"
+            )
+
+    def _send_acks(self, batch):
+        def request(ack_ids):
+            self._client.acknowledge(
+                self._sub_name, ack_ids, timeout=self.REQUEST_TIMEOUT_SEC
+            )
+
+        errors = collections.defaultdict(list)
+        for pending, ack_id, e in self._send(request, batch):
+            errors[id(pending)].append((ack_id, e))
+
+        for pending in batch:
+            message = pending.message
+            failed = errors.get(id(pending))
+            if failed and pending.duplicate:
+                ack_ids = [ack_id for ack_id, _ in failed if ack_id]
+                self.mgr_logger.error(
+                    f"Error encountered when trying to acknowledge duplicates "
+                    f"of {message} with ack IDs {ack_ids or pending.ack_ids}"
+                    f": {failed[0][1]}",
+                    exc_info=failed[0][1],
+                )
+            elif failed:
+                # Note: we are just catching & logging any potential error
+                # we encounter. The message is still removed from our
+                # message manager so we no longer try to extend.
+                for ack_id, e in failed:
+                    self.mgr_logger.error(
+                        f"Error encountered when trying to acknowledge "
+                        f"{message} with ack ID '{ack_id or message.ack_id}'"
+                        f": {e}",
+                        exc_info=e,
+                    )
+                self.mgr_logger.warning(
+                    f"The message {message} may be re-delivered due to "
+                    "Klio's inability to acknowledge it."
+                )
+            else:
+                self._log_acked(pending)
+
+    def _log_acked(self, pending):
+        if pending.duplicate:
+            self.mgr_logger.info(
+                f"Acknowledged {len(pending.ack_ids)} duplicate(s) of "
+                f"{pending.message.kmsg_id}."
+            )
+        else:
+            self.mgr_logger.info(
+                f"Acknowledged {pending.message.kmsg_id}. Job is no longer "
+                "processing this message."
             )
-        message.extend(duration)
 
     @staticmethod
     def _convert_raw_pubsub_message(ack_id, pmessage):
@@ -208,71 +906,196 @@ class MessageManager:
         kmsg = klio_pb2.KlioMessage()
         kmsg.ParseFromString(pmessage.data)
         entity_id = kmsg.data.element.decode("utf-8")
-        psk_msg = PubSubKlioMessage(ack_id, entity_id)
+        psk_msg = PubSubKlioMessage(ack_id, entity_id, len(pmessage.data))
         return psk_msg
 
-    def add(self, ack_id, raw_pubsub_message):
+    def add(self, ack_id, raw_pubsub_message, lease=None, message_id=None):
         """Add message to set of in-progress messages.
 
         Messages added via this method will have their deadlines extended
-        until they are finished processing.
+        until they are finished processing, unless received over a
+        streaming pull, which extends them itself.
+
+        The returned token identifies this delivery of the message. Attach
+        it to the message with :func:`attach_token`, so that marking it as
+        done finds it without parsing it again.
 
         Args:
             ack_id (str): Pub/Sub message's ack ID
             raw_pubsub_message (apache_beam.io.gcp.pubsub.PubsubMessage):
                 Pub/Sub message to add.
+            lease (google.cloud.pubsub_v1.subscriber.message.Message):
+                the message as received over a streaming pull, if it was.
+                It's acknowledged through the streaming pull, which then
+                counts it as no longer outstanding for its flow control.
+            message_id (str): Pub/Sub message's ID, which tells
+                redeliveries of the message. If not given, messages with
+                the same element are taken as redeliveries.
+        Returns:
+            int: token of the delivery.
         """
         psk_msg = self._convert_raw_pubsub_message(ack_id, raw_pubsub_message)
+        if message_id:
+            psk_msg.key = message_id
+        if lease is not None:
+            psk_msg.leases[ack_id] = lease
+
+        token = next(_TOKENS)
+        in_progress = IN_FLIGHT.add(psk_msg, token)
+        if in_progress is not None:
+            # Pub/Sub redelivered a message that's still in progress; its
+            # deadline is extended & it's acknowledged along with the first
+            # delivery, unless it's acknowledged as a duplicate beforehand
+            # (see `mark_duplicate`)
+            self.mgr_logger.debug(
+                f"Received {psk_msg.kmsg_id} from Pub/Sub while it's still "
+                "in progress."
+            )
+            self.extend_deadline(in_progress, in_progress.ext_duration)
+            return token
 
         self.mgr_logger.debug(f"Received {psk_msg.kmsg_id} from Pub/Sub.")
+        # keep the element's stored payloads until this message is done,
+        # even if another message of the same element finishes first
+        payload_store.hold(bytes(psk_msg.kmsg_id, "utf-8"))
+        with self._in_flight_lock:
+            self._in_flight += 1
+            self._in_flight_bytes += psk_msg.size
         self.extend_deadline(psk_msg)
-        ENTITY_ID_TO_ACK_ID[psk_msg.kmsg_id] = psk_msg
-        self.executor.submit(self.manage, psk_msg)
-        self.executor.submit(self.heartbeat, psk_msg)
+        # checked right away to log the first heartbeat
+        self.scheduler.schedule(self, psk_msg, time.monotonic())
+        return token
 
     def remove(self, psk_msg):
         """Remove message from set of in-progress messages.
 
-        Messages removed via this method will be acknowledged.
+        Messages removed via this method will be acknowledged, along with
+        others by :meth:`flush`.
 
         Args:
             psk_msg (PubSubKlioMessage): Message to remove.
         """
+        with self._in_flight_lock:
+            self._in_flight -= 1
+            self._in_flight_bytes -= psk_msg.size
+        self._acknowledge(_PendingAck(psk_msg, psk_msg.ack_ids, False))
+
+    def _acknowledge(self, pending):
+        message = pending.message
+        if not message.leases:
+            self._enqueue(pending)
+            return
+
+        ack_ids = []
+        for ack_id in pending.ack_ids:
+            lease = message.leases.pop(ack_id, None)
+            if lease is None:
+                ack_ids.append(ack_id)
+                continue
+            try:
+                lease.ack()
+            except Exception as e:
+                self.mgr_logger.error(
+                    f"Error encountered when trying to acknowledge "
+                    f"{message} with ack ID '{ack_id}': {e}",
+                    exc_info=e,
+                )
+        if ack_ids:
+            self._enqueue(_PendingAck(message, ack_ids, pending.duplicate))
+        else:
+            self._log_acked(pending)
+
+    def _ack_done_duplicates(self, message):
+        """Acknowledge duplicate deliveries of an in-progress message.
+
+        Args:
+            message(PubSubKlioMessage): In-progress message.
+        """
+        with message.lock:
+            ack_ids = message.done_duplicate_ack_ids
+            if not ack_ids:
+                return
+            message.done_duplicate_ack_ids = []
+
+        self._acknowledge(_PendingAck(message, ack_ids, True))
+
+    @staticmethod
+    def _find(kmsg_or_bytes):
+        """Find the in-progress message of a KlioMessage.
+
+        Found by the token attached to the KlioMessage, or, if it doesn't
+        have one, by its element.
+
+        Args:
+            kmsg_or_bytes (klio_pb2.KlioMessage, view.KlioMessageView or
+                bytes): the KlioMessage (or a KlioMessage that has been
+                serialized to bytes).
+        Returns:
+            tuple(int, PubSubKlioMessage, str): the token of the delivery,
+            its message (``None`` if not in progress), and the message's
+            element.
+        """
+        token = read_token(kmsg_or_bytes)
+        if token is not None:
+            msg = IN_FLIGHT.get(token)
+            if msg is not None:
+                return token, msg, msg.kmsg_id
+
+        # TODO: either use klio.message.serializer.to_klio_message, or
+        # figure out how to handle when a parsed_message can't be parsed
+        # into a KlioMessage (will need to somehow get the klio context).
+        kmsg = kmsg_or_bytes
+        if isinstance(kmsg_or_bytes, view.KlioMessageView):
+            kmsg = kmsg_or_bytes.to_klio_message()
+        elif not isinstance(kmsg_or_bytes, klio_pb2.KlioMessage):
+            kmsg = klio_pb2.KlioMessage()
+            kmsg.ParseFromString(kmsg_or_bytes)
+        entity_id = kmsg.data.element.decode("utf-8")
+        return token, IN_FLIGHT.find(entity_id), entity_id
+
+    @staticmethod
+    def mark_duplicate(kmsg_or_bytes):
+        """Mark a duplicate delivery of a KlioMessage as done.
+
+        If another delivery of the same message is still in progress, only
+        the duplicate is acknowledged, and the message otherwise continues
+        to be handled. Otherwise, this is the same as :meth:`mark_done`.
+
+        Args:
+            kmsg_or_bytes (klio_pb2.KlioMessage, view.KlioMessageView or
+                bytes): the duplicate KlioMessage (or a KlioMessage that
+                has been serialized to bytes) to be marked as done.
+        """
         try:
-            # TODO: this method also has `retry`, `timeout` and metadata
-            # kwargs which we may be interested in using
-            self._client.acknowledge(self._sub_name, [psk_msg.ack_id])
+            token, msg, _ = MessageManager._find(kmsg_or_bytes)
+            if msg is not None and IN_FLIGHT.ack_duplicate(msg, token):
+                _get_or_create_scheduler().wake(msg)
+                return
         except Exception as e:
-            # Note: we are just catching & logging any potential error we
-            # encounter. We will still remove the message from our message
-            # manager so we no longer try to extend.
-            self.mgr_logger.error(
-                f"Error encountered when trying to acknowledge {psk_msg} with "
-                f"ack ID '{psk_msg.ack_id}': {e}",
-                exc_info=True,
+            mm_logger = logging.getLogger(
+                "klio.gke_direct_runner.message_manager"
             )
-            self.mgr_logger.warning(
-                f"The message {psk_msg} may be re-delivered due to Klio's "
-                "inability to acknowledge it."
-            )
-        else:
-            self.mgr_logger.info(
-                f"Acknowledged {psk_msg.kmsg_id}. Job is no longer processing "
-                "this message."
+            mm_logger.warning(
+                f"Error occurred while trying to remove duplicate message "
+                f"{kmsg_or_bytes}: {e}",
+                exc_info=True,
             )
+            return
+
+        MessageManager.mark_done(kmsg_or_bytes)
 
     @staticmethod
     def mark_done(kmsg_or_bytes):
         """Mark a KlioMessage as done and to be removed from handling.
 
-        This method just sets the PubSubKlioMessage.event object where then
-        in the next iteration in `MessageManager.manage`, it is then
-        acknowledged and removed from further "babysitting".
+        This method just removes the message from the in-progress messages
+        and wakes up its next check in `MessageManager.manage`, where it's
+        then acknowledged and removed from further "babysitting".
 
         Args:
-            kmsg_or_bytes (klio_pb2.KlioMessage or bytes): the KlioMessage
-                (or a KlioMessage that has been serialzied to bytes) to be
-                marked as done.
+            kmsg_or_bytes (klio_pb2.KlioMessage, view.KlioMessageView or
+                bytes): the KlioMessage (or a KlioMessage that has been
+                serialzied to bytes) to be marked as done.
         """
         kmsg = kmsg_or_bytes
         mm_logger = logging.getLogger("klio.gke_direct_runner.message_manager")
@@ -283,22 +1106,19 @@ class MessageManager:
         # of being unable to pull a message, but at least it's for
         # sanity.
         try:
-            # TODO: either use klio.message.serializer.to_klio_message, or
-            # figure out how to handle when a parsed_message can't be parsed
-            # into a KlioMessage (will need to somehow get the klio context).
-            if not isinstance(kmsg_or_bytes, klio_pb2.KlioMessage):
-                kmsg = klio_pb2.KlioMessage()
-                kmsg.ParseFromString(kmsg_or_bytes)
-
-            entity_id = kmsg.data.element.decode("utf-8")
-
-            # This call to remove the message from the dict ENTITY_ID_TO_ACK_ID
-            # will tell the MessageManager that this message is now ready to
-            # be acknowledged and no longer being worked upon.
-            with MESSAGE_LOCK:
-                msg = ENTITY_ID_TO_ACK_ID.pop(entity_id, None)
-
-            if not msg:
+            _, msg, entity_id = MessageManager._find(kmsg_or_bytes)
+            element = bytes(entity_id, "utf-8")
+
+            # Finishing the message will tell the MessageManager that this
+            # message is now ready to be acknowledged and no longer being
+            # worked upon.
+            if msg is not None and IN_FLIGHT.finish(msg):
+                # the message is done, so its stored payloads can be freed
+                payload_store.evict(element)
+                _get_or_create_scheduler().wake(msg)
+            else:
+                # only freed if no other message of the element is held
+                payload_store.evict(element, held=False)
                 # NOTE: this logger exists as `self.mgr_logger`, but this method
                 # needs to be a staticmethod so we don't need to unnecessarily
                 # init the class in order to just mark a message as done.
@@ -0,0 +1,423 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Lazily-decoded view of a serialized :ref:`KlioMessage <klio-message>`.
+
+Routing transforms (i.e. recipient checks, ping & force filters, data
+existence checks) only need a handful of fields of a ``KlioMessage``. The
+:class:`KlioMessageView` reads those fields straight from the protobuf
+wire format and skips over everything else, only decoding
+``data.payload`` and ``metadata.job_audit_log`` when they're accessed.
+"""
+
+from google.protobuf import message as gproto_message
+
+from klio_core.proto import klio_pb2
+
+
+# Protobuf wire types
+# https://developers.google.com/protocol-buffers/docs/encoding#structure
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+# KlioMessage field numbers
+_KMSG_METADATA = 1
+_KMSG_DATA = 2
+_KMSG_VERSION = 3
+
+# KlioMessage.Metadata field numbers
+_METADATA_DOWNSTREAM = 1
+_METADATA_VISITED = 2
+_METADATA_JOB_AUDIT_LOG = 3
+_METADATA_FORCE = 4
+_METADATA_PING = 5
+_METADATA_INTENDED_RECIPIENTS = 6
+
+# KlioMessage.Data field numbers
+_DATA_ENTITY_ID = 1
+_DATA_PAYLOAD = 2
+_DATA_ELEMENT = 3
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise gproto_message.DecodeError("Truncated message.")
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise gproto_message.DecodeError(
+                "Too many bytes when decoding varint."
+            )
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def _iter_fields(buf, start, end):
+    # Yields (field number, wire type, value) for each field between `start`
+    # and `end`. Varint values are decoded; length-delimited values are
+    # returned as a (start, end) span into `buf` without being copied.
+    for _, field_number, wire_type, value in _iter_field_offsets(
+        buf, start, end
+    ):
+        yield field_number, wire_type, value
+
+
+def _iter_field_offsets(buf, start, end):
+    # Same as `_iter_fields`, but also yields the offset in `buf` at which
+    # each field starts.
+    pos = start
+    while pos < end:
+        offset = pos
+        key, pos = _read_varint(buf, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if field_number == 0:
+            raise gproto_message.DecodeError("Field number 0 is illegal.")
+
+        value = None
+        if wire_type == _VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == _FIXED64:
+            pos += 8
+        elif wire_type == _FIXED32:
+            pos += 4
+        else:
+            # groups are not used by KlioMessages
+            raise gproto_message.DecodeError(
+                "Unsupported wire type {}.".format(wire_type)
+            )
+
+        if pos > end:
+            raise gproto_message.DecodeError("Truncated message.")
+        yield offset, field_number, wire_type, value
+
+
+def _scan(buf, spans, varint_fields=(), repeated_fields=(), last_fields=()):
+    # Collect fields of a (possibly multiple times occurring, and therefore
+    # merged) embedded message. Varints and singular length-delimited fields
+    # follow the "last one wins" rule; repeated fields are concatenated.
+    varints = {}
+    last = {}
+    repeated = {number: [] for number in repeated_fields}
+    for start, end in spans:
+        for number, wire_type, value in _iter_fields(buf, start, end):
+            if wire_type == _VARINT and number in varint_fields:
+                varints[number] = value
+            elif wire_type == _LENGTH_DELIMITED:
+                if number in repeated:
+                    repeated[number].append(value)
+                elif number in last_fields:
+                    last[number] = value
+    return varints, last, repeated
+
+
+class _RepeatedMessageView(object):
+    """Lazily-parsed repeated message field.
+
+    Supports reading like a list, as well as ``append`` & ``extend`` to
+    add new messages without decoding existing ones.
+    """
+
+    def __init__(self, buf, spans, message_cls):
+        self._buf = buf
+        self._spans = spans
+        self._message_cls = message_cls
+        self._parsed = None
+        self._added = []
+
+    def _messages(self):
+        if self._parsed is None:
+            self._parsed = [
+                self._message_cls.FromString(bytes(self._buf[start:end]))
+                for start, end in self._spans
+            ]
+        return self._parsed + self._added
+
+    def append(self, message):
+        self._added.append(message)
+
+    def extend(self, messages):
+        self._added.extend(messages)
+
+    def __len__(self):
+        return len(self._spans) + len(self._added)
+
+    def __iter__(self):
+        return iter(self._messages())
+
+    def __getitem__(self, index):
+        return self._messages()[index]
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+class _MetadataView(object):
+    """Lazily-decoded ``KlioMessage.Metadata``."""
+
+    def __init__(self, buf, spans):
+        self._buf = buf
+        self._spans = spans
+        varints, _, repeated = _scan(
+            buf,
+            spans,
+            varint_fields=(_METADATA_FORCE, _METADATA_PING),
+            repeated_fields=(
+                _METADATA_DOWNSTREAM,
+                _METADATA_VISITED,
+                _METADATA_JOB_AUDIT_LOG,
+                _METADATA_INTENDED_RECIPIENTS,
+            ),
+        )
+        self.force = bool(varints.get(_METADATA_FORCE, 0))
+        self.ping = bool(varints.get(_METADATA_PING, 0))
+        self.downstream = _RepeatedMessageView(
+            buf, repeated[_METADATA_DOWNSTREAM], klio_pb2.KlioJob
+        )
+        self.visited = _RepeatedMessageView(
+            buf, repeated[_METADATA_VISITED], klio_pb2.KlioJob
+        )
+        self.job_audit_log = _RepeatedMessageView(
+            buf,
+            repeated[_METADATA_JOB_AUDIT_LOG],
+            klio_pb2.KlioJobAuditLogItem,
+        )
+        # a singular message field that occurs more than once gets merged,
+        # which is the same as parsing the concatenated occurrences
+        self._recipients_spans = repeated[_METADATA_INTENDED_RECIPIENTS]
+        self._recipients = None
+        self._recipients_serialized = None
+
+    @property
+    def intended_recipients(self):
+        if self._recipients is None:
+            self._recipients_serialized = b"".join(
+                self._buf[start:end] for start, end in self._recipients_spans
+            )
+            self._recipients = klio_pb2.KlioMessage.Metadata.Recipients()
+            self._recipients.ParseFromString(self._recipients_serialized)
+        return self._recipients
+
+    @property
+    def _recipients_changed(self):
+        if self._recipients is None:
+            return False
+        serialized = self._recipients.SerializeToString()
+        return serialized != self._recipients_serialized
+
+
+class _DataView(object):
+    """Lazily-decoded ``KlioMessage.Data``."""
+
+    def __init__(self, buf, spans):
+        self._buf = buf
+        _, last, _ = _scan(
+            buf,
+            spans,
+            last_fields=(_DATA_ENTITY_ID, _DATA_PAYLOAD, _DATA_ELEMENT),
+        )
+        self._entity_id_span = last.get(_DATA_ENTITY_ID)
+        self._payload_span = last.get(_DATA_PAYLOAD)
+        self._element_span = last.get(_DATA_ELEMENT)
+        self._element = None
+
+    def _get(self, span):
+        if span is None:
+            return b""
+        start, end = span
+        return bytes(self._buf[start:end])
+
+    @property
+    def entity_id(self):
+        return self._get(self._entity_id_span).decode("utf-8")
+
+    @property
+    def element(self):
+        if self._element is None:
+            self._element = self._get(self._element_span)
+        return self._element
+
+    @property
+    def payload(self):
+        # only copied out of the serialized message when accessed
+        return self._get(self._payload_span)
+
+    def _payload_startswith(self, prefix):
+        # check the beginning of the payload without copying all of it
+        if self._payload_span is None:
+            return False
+        start, end = self._payload_span
+        prefix_end = start + len(prefix)
+        if prefix_end > end:
+            return False
+        return self._buf[start:prefix_end] == prefix
+
+
+class KlioMessageView(object):
+    """Lazily-decoded view of a serialized ``KlioMessage``.
+
+    Only ``version``, ``data.element``, ``data.entity_id``,
+    ``metadata.ping``, ``metadata.force``, and the location of every other
+    field are read when the view is created. ``data.payload``,
+    ``metadata.intended_recipients``, ``metadata.downstream``,
+    ``metadata.visited``, and ``metadata.job_audit_log`` are decoded when
+    first accessed.
+
+    The view applies the same v1/v2 compatibility handling as
+    :func:`klio.message.serializer.to_klio_message`.
+
+    Only two kinds of changes are supported, and both are included by
+    :meth:`SerializeToString` and :meth:`to_klio_message`:
+
+    * ``metadata.intended_recipients`` may be changed in place (it's a
+      ``KlioMessage.Metadata.Recipients`` message). If it then serializes
+      differently than it was read, the message is fully parsed and
+      serialized again with the new recipients.
+    * Items may be added to ``metadata.job_audit_log`` with ``append``
+      or ``extend``. Unless the message is otherwise changed, they are
+      appended to the original bytes as another occurrence of
+      ``metadata``, which protobuf merges into the first one when
+      parsing, so the original message is not re-encoded.
+
+    Messages changed by the v1/v2 compatibility handling are also fully
+    parsed and serialized again. Any other change, such as assigning to
+    ``force`` or ``data.payload``, adding to ``metadata.downstream`` or
+    ``metadata.visited``, or changing an item read from a repeated
+    field, is not serialized. Use :meth:`to_klio_message` for a
+    fully-parsed, mutable ``KlioMessage``.
+
+    Args:
+        serialized_message (bytes): a serialized ``KlioMessage``.
+    Raises:
+        google.protobuf.message.DecodeError: if the top-level structure of
+            the message can not be decoded. Embedded messages that aren't
+            accessed are not validated.
+    """
+
+    def __init__(self, serialized_message):
+        self._serialized = serialized_message
+        buf = memoryview(serialized_message)
+        metadata_spans, data_spans = [], []
+        version = klio_pb2.Version.UNKNOWN
+        for number, wire_type, value in _iter_fields(buf, 0, len(buf)):
+            if number == _KMSG_METADATA and wire_type == _LENGTH_DELIMITED:
+                metadata_spans.append(value)
+            elif number == _KMSG_DATA and wire_type == _LENGTH_DELIMITED:
+                data_spans.append(value)
+            elif number == _KMSG_VERSION and wire_type == _VARINT:
+                version = value
+
+        self.metadata = _MetadataView(buf, metadata_spans)
+        self.data = _DataView(buf, data_spans)
+        self.version = version
+        self._compat_changed = self._handle_msg_compat()
+
+    def _handle_msg_compat(self):
+        # mirrors klio.message.serializer._handle_msg_compat; returns whether
+        # the message was changed
+        if self.version == klio_pb2.Version.V2:
+            return False
+
+        entity_id = self.data.entity_id
+        element = self.data.element
+        if self.version == klio_pb2.Version.V1:
+            if entity_id and not element:
+                self.data._element = bytes(entity_id, "utf-8")
+                return True
+            return False
+
+        if entity_id and not element:
+            self.version = klio_pb2.Version.V1
+            self.data._element = bytes(entity_id, "utf-8")
+        elif not entity_id and not element:
+            self.version = klio_pb2.Version.V1
+        elif element and not entity_id:
+            self.version = klio_pb2.Version.V2
+        return self.version != klio_pb2.Version.UNKNOWN
+
+    def to_klio_message(self):
+        """Fully parse the viewed message.
+
+        Returns:
+            klio_core.proto.klio_pb2.KlioMessage: a newly parsed message,
+                including any changes made through the view.
+        """
+        kmsg = klio_pb2.KlioMessage()
+        kmsg.ParseFromString(self._serialized)
+        if self._compat_changed:
+            kmsg.version = self.version
+            if kmsg.data.element != self.data.element:
+                kmsg.data.element = self.data.element
+        if self.metadata._recipients_changed:
+            kmsg.metadata.intended_recipients.CopyFrom(
+                self.metadata.intended_recipients
+            )
+        added_audit_log = self.metadata.job_audit_log._added
+        if added_audit_log:
+            kmsg.metadata.job_audit_log.extend(added_audit_log)
+        return kmsg
+
+    def SerializeToString(self):
+        """Serialize the viewed message.
+
+        Returns the original serialized message unless it was changed
+        through the view. Added ``metadata.job_audit_log`` items are
+        appended to the original message without re-encoding it.
+
+        Returns:
+            bytes: the serialized ``KlioMessage``.
+        """
+        if self._compat_changed or self.metadata._recipients_changed:
+            return self.to_klio_message().SerializeToString()
+
+        added_audit_log = self.metadata.job_audit_log._added
+        if not added_audit_log:
+            return self._serialized
+
+        # Appending an occurrence of an embedded message field merges it
+        # into the existing one, and repeated fields are concatenated
+        metadata = klio_pb2.KlioMessage.Metadata()
+        metadata.job_audit_log.extend(added_audit_log)
+        serialized_metadata = metadata.SerializeToString()
+        tag = _encode_varint((_KMSG_METADATA << 3) | _LENGTH_DELIMITED)
+        return b"".join(
+            [
+                self._serialized,
+                tag,
+                _encode_varint(len(serialized_metadata)),
+                serialized_metadata,
+            ]
+        )
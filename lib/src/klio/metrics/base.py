@@ -18,7 +18,8 @@ will need to implement.
 
 New consumers are required to implement the :class:`AbstractRelayClient`, and
 three metrics objects based off of :class:`BaseMetric`: a counter, a gauge, and
-a timer.
+a timer. Consumers may also support histograms by implementing
+:meth:`AbstractRelayClient.histogram`.
 """
 import abc
 
@@ -116,10 +117,15 @@ class AbstractRelayClient(six.with_metaclass(_ABCBaseMeta)):
     Attributes:
         RELAY_CLIENT_NAME (str): must match the key in ``klio-job.yaml``
             under ``job_config.metrics``.
+        SYNCHRONOUS (bool): whether the client's metric objects do all
+            their work in ``update`` and are cheap to update, so they're
+            always updated directly on the thread recording the metric,
+            and ``emit`` is never called for them. Defaults to ``False``.
 
     """
 
     RELAY_CLIENT_NAME = abstract_attr()
+    SYNCHRONOUS = False
 
     def __init__(self, klio_config):
         self.klio_config = klio_config
@@ -168,6 +174,30 @@ class AbstractRelayClient(six.with_metaclass(_ABCBaseMeta)):
         """
         pass
 
+    def histogram(self, name, transform=None, **kwargs):
+        """Return a newly instantiated histogram-type metric specific for
+        the particular consumer, or ``None`` if the consumer doesn't
+        support histograms.
+
+        The returned object's ``update`` method is called with a
+        :class:`klio.metrics.histogram.HistogramSnapshot` summarizing the
+        values recorded since the previous update, before being passed to
+        ``emit``. If the object also has a ``record`` method, it is called
+        with every recorded value.
+
+        Callers to the ``histogram`` method will store new histogram
+        objects returned in memory for simple caching.
+        """
+        return None
+
+    def flush(self):
+        """Emit any metrics buffered by the client itself.
+
+        Called by :func:`klio.metrics.dispatcher.shutdown` once all
+        dispatchers have emitted their remaining metrics.
+        """
+        pass
+
 
 class BaseMetric(object):
     """Base class for all metric types.
@@ -47,11 +47,29 @@ class MetricsRegistry(object):
     Args:
         relay_clients (list(klio.metrics.base.AbstractRelayClient)):
             configured relay clients.
+        transform_name (str): default transform of created metrics.
+        flush_interval_sec (float): seconds between emitting summaries of
+            histograms and aggregated updates. Defaults to
+            :attr:`dispatcher.BaseMetricDispatcher.DEFAULT_FLUSH_INTERVAL_SEC`.
+        aggregate (bool): whether counters, gauges and timers aggregate
+            their updates and emit them every ``flush_interval_sec``
+            instead of emitting every update.
     """
 
-    def __init__(self, relay_clients, transform_name):
+    def __init__(
+        self,
+        relay_clients,
+        transform_name,
+        flush_interval_sec=None,
+        aggregate=False,
+    ):
         self._relays = relay_clients
         self._transform_name = transform_name
+        self._flush_interval_sec = (
+            flush_interval_sec
+            or dispatcher.BaseMetricDispatcher.DEFAULT_FLUSH_INTERVAL_SEC
+        )
+        self._aggregate = aggregate
         self._registry = {}
 
     def counter(self, name, value=0, **kwargs):
@@ -75,6 +93,8 @@ class MetricsRegistry(object):
         if key in self._registry:
             return self._registry[key]
 
+        kwargs.setdefault("aggregate", self._aggregate)
+        kwargs.setdefault("flush_interval_sec", self._flush_interval_sec)
         counter = dispatcher.CounterDispatcher(
             relay_clients=self._relays,
             name=name,
@@ -106,6 +126,8 @@ class MetricsRegistry(object):
         if key in self._registry:
             return self._registry[key]
 
+        kwargs.setdefault("aggregate", self._aggregate)
+        kwargs.setdefault("flush_interval_sec", self._flush_interval_sec)
         gauge = dispatcher.GaugeDispatcher(
             relay_clients=self._relays,
             name=name,
@@ -138,6 +160,8 @@ class MetricsRegistry(object):
         if key in self._registry:
             return self._registry[key]
 
+        kwargs.setdefault("aggregate", self._aggregate)
+        kwargs.setdefault("flush_interval_sec", self._flush_interval_sec)
         timer = dispatcher.TimerDispatcher(
             relay_clients=self._relays,
             name=name,
@@ -149,6 +173,43 @@ class MetricsRegistry(object):
         self._registry[key] = timer
         return timer
 
+    def histogram(self, name, value=0, timer_unit="ns", **kwargs):
+        """Get or create a histogram.
+
+        Creates a new histogram if one is not found with a key of
+        "histogram_{name}_{transform}".
+
+        New histograms will be stored in memory for simple caching.
+
+        Args:
+            name (str): name of histogram
+            value (int): starting value of histogram; defaults to 0
+            timer_unit (str): unit of time when used as a timer; defaults
+                to ns
+            kwargs (dict): keyword arguments passed to each configured
+                relay clients' histogram object. ``percentiles`` sets the
+                percentiles to emit.
+        Returns:
+            dispatcher.HistogramDispatcher: instance of a histogram
+            dispatcher
+        """
+        transform_name = kwargs.pop("transform", self._transform_name)
+        key = "histogram_{}_{}".format(name, transform_name)
+        if key in self._registry:
+            return self._registry[key]
+
+        kwargs.setdefault("flush_interval_sec", self._flush_interval_sec)
+        histogram = dispatcher.HistogramDispatcher(
+            relay_clients=self._relays,
+            name=name,
+            value=value,
+            transform=transform_name,
+            timer_unit=timer_unit,
+            **kwargs
+        )
+        self._registry[key] = histogram
+        return histogram
+
     def marshal(self, metric):
         """Create a dictionary-representation of a given metric.
 
@@ -173,7 +234,7 @@ class MetricsRegistry(object):
         """Create a metric instance based off of a dictionary.
 
         If "type" is not specified or is not one of "counter", "gauge",
-        or "timer", it defaults to a gauge-type metric.
+        "timer", or "histogram", it defaults to a gauge-type metric.
 
         Used when metrics objects need to be unpickled.
 
@@ -194,6 +255,7 @@ class MetricsRegistry(object):
             "counter": self.counter,
             "gauge": self.gauge,
             "timer": self.timer,
+            "histogram": self.histogram,
         }.get(metric_type)
 
         if not metric_method:
@@ -32,28 +32,372 @@ instances, each specific to each of the relay clients configured.
 Calling ``inc()`` on ``my_counter`` will then call ``emit`` on each relay
 counter instance where each relay client will take care of its own
 emit logic.
+
+Metrics of relay clients that are
+:attr:`SYNCHRONOUS <klio.metrics.base.AbstractRelayClient.SYNCHRONOUS>`,
+like the native client, are only updated, directly on the calling
+thread, and never emitted. Other metrics are emitted by background
+threads, via a process-wide queue of
+at most ``max_queue_size`` pending metrics (see :func:`configure_emitter`).
+If relay clients can't keep up, e.g. because a metrics endpoint is slow,
+the ``overflow_policy`` decides which metrics are dropped rather than
+letting the queue grow without limit: the oldest pending metric
+(``drop_oldest``, the default), the new one (``drop_newest``), or, with
+``coalesce``, the new metric is merged into a pending one with the same
+metric key (summing counter increments and keeping the latest value of
+other metrics), falling back to dropping the oldest. The depth of the
+queue and the number of dropped metrics are reported as the
+``klio-metrics-queue-depth`` and ``klio-metrics-dropped`` gauges.
+
+Dispatchers created with ``aggregate=True`` don't emit on every update.
+Instead, updates are accumulated in per-thread buffers, and a single
+background thread emits the aggregated updates of all dispatchers every
+``flush_interval_sec``: the sum of counter increments, the latest gauge
+value, and the mean duration of timers. Synchronous relay clients are
+still updated directly. Aggregated updates that haven't been emitted
+yet are flushed by :func:`shutdown`, which is called when the Python
+interpreter exits.
 """
 
+import atexit
+import collections
 import logging
 import threading
+import time
 import timeit
+import weakref
+
+from klio.metrics import histogram as histogram_
+
+
+DEFAULT_MAX_QUEUE_SIZE = 10000
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_POLICIES = (
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_COALESCE,
+)
+
+# how long to wait for queued metrics to be emitted on shutdown
+SHUTDOWN_TIMEOUT_SEC = 5
+
+_EMITTER = None
+_EMITTER_CONFIG = {
+    "max_size": DEFAULT_MAX_QUEUE_SIZE,
+    "overflow": OVERFLOW_DROP_OLDEST,
+}
+_HISTOGRAM_DISPATCHERS = weakref.WeakSet()
+_RELAY_CLIENTS = weakref.WeakSet()
+_FLUSHER = None
+_FLUSHER_LOCK = threading.Lock()
+
+
+class _QueuedMetric(object):
+    # A metric waiting to be emitted. `value` is the metric's value when
+    # it was submitted, and is set back on the metric before emitting if
+    # other updates were coalesced into it.
+    __slots__ = ("emit", "metric", "metric_key", "value", "coalesced")
+
+    def __init__(self, emit, metric, metric_key, value):
+        self.emit = emit
+        self.metric = metric
+        self.metric_key = metric_key
+        self.value = value
+        self.coalesced = False
 
-from concurrent import futures
+    @property
+    def key(self):
+        return (self.metric_key, self.emit)
+
+
+class _BoundedEmitter(object):
+    """Bounded queue of metrics, emitted by background threads.
+
+    Args:
+        num_workers (int): number of threads emitting metrics.
+        max_size (int): maximum number of metrics waiting to be emitted.
+        overflow (str): what to do with a new metric when the queue is
+            full; one of :data:`OVERFLOW_POLICIES`.
+        relay_clients (list(klio.metrics.base.AbstractRelayClient)):
+            relay clients to report the queue's own gauges to.
+        report_interval_sec (float): seconds between reporting the
+            queue's gauges.
+    """
 
+    QUEUE_DEPTH_GAUGE = "klio-metrics-queue-depth"
+    DROPPED_GAUGE = "klio-metrics-dropped"
 
-_CACHED_THREADPOOL_EXEC = None
+    def __init__(
+        self,
+        num_workers,
+        max_size=DEFAULT_MAX_QUEUE_SIZE,
+        overflow=OVERFLOW_DROP_OLDEST,
+        relay_clients=None,
+        report_interval_sec=60,
+    ):
+        self.max_size = max_size
+        self.overflow = overflow
+        self.dropped = 0
+        self.coalesced = 0
+        self._queue = collections.deque()
+        # latest queued metric per key, to coalesce updates into
+        self._pending = {}
+        self._active = 0
+        self._cond = threading.Condition(threading.Lock())
+
+        self._relay_clients = relay_clients
+        self._gauges = None
+        self.report_interval_sec = report_interval_sec
+        self._next_report = time.monotonic() + report_interval_sec
+
+        self._threads = []
+        for i in range(max(1, num_workers)):
+            thread = threading.Thread(
+                target=self._run,
+                name="KlioMetricsDispatcher_{}".format(i),
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
 
+    @property
+    def logger(self):
+        return logging.getLogger("klio.metrics.dispatcher")
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _unqueued(self, queued):
+        # Forget `queued` as the one to coalesce updates into.
+        if self._pending.get(queued.key) is queued:
+            del self._pending[queued.key]
+
+    def _overflow(self, queued, merge):
+        # Make room for `queued`, returning whether it should be queued.
+        if self.overflow == OVERFLOW_DROP_NEWEST:
+            self.dropped += 1
+            return False
+
+        if self.overflow == OVERFLOW_COALESCE:
+            pending = self._pending.get(queued.key)
+            if pending is not None:
+                pending.value = merge(pending.value, queued.value)
+                pending.coalesced = True
+                self.coalesced += 1
+                return False
+
+        oldest = self._queue.popleft()
+        self._unqueued(oldest)
+        self.dropped += 1
+        return True
+
+    def submit(self, emit, metric, metric_key, merge):
+        """Queue a metric to be emitted.
 
-def _get_or_create_executor(num_clients):
-    # We create one threadpool executor in case the dispatcher gets
-    # init'ed more than once (which seems to be the case on direct runner)
-    global _CACHED_THREADPOOL_EXEC
-    if _CACHED_THREADPOOL_EXEC is None:
-        _CACHED_THREADPOOL_EXEC = futures.ThreadPoolExecutor(
-            thread_name_prefix="KlioMetricsDispatcher", max_workers=num_clients
+        Args:
+            emit (callable): relay client's function emitting the metric.
+            metric (klio.metrics.base.BaseMetric): the relay client's
+                metric object.
+            metric_key (str): key identifying the metric.
+            merge (callable): function merging the value of a pending
+                metric with a new one when coalescing them.
+        """
+        queued = _QueuedMetric(
+            emit, metric, metric_key, getattr(metric, "value", None)
         )
+        with self._cond:
+            if len(self._queue) < self.max_size or self._overflow(
+                queued, merge
+            ):
+                self._queue.append(queued)
+                self._pending[queued.key] = queued
+                self._cond.notify()
+
+        now = time.monotonic()
+        if now >= self._next_report:
+            # updated first, as reporting submits metrics itself
+            self._next_report = now + self.report_interval_sec
+            self._report()
+
+    def _report(self):
+        if not self._relay_clients:
+            return
+        if self._gauges is None:
+            self._gauges = (
+                GaugeDispatcher(self._relay_clients, self.QUEUE_DEPTH_GAUGE),
+                GaugeDispatcher(self._relay_clients, self.DROPPED_GAUGE),
+            )
+        depth_gauge, dropped_gauge = self._gauges
+        depth_gauge.set(len(self))
+        dropped_gauge.set(self.dropped)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                queued = self._queue.popleft()
+                self._unqueued(queued)
+                self._active += 1
+
+            try:
+                if queued.coalesced:
+                    queued.metric.value = queued.value
+                queued.emit(queued.metric)
+            except Exception as e:
+                self.logger.warning(
+                    "Error emitting metric '{}': {}".format(
+                        queued.metric_key, e
+                    )
+                )
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until all queued metrics are emitted.
+
+        Args:
+            timeout (float): maximum seconds to wait.
+        Returns:
+            bool: whether all queued metrics were emitted.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._active, timeout
+            )
+
+
+def configure_emitter(max_queue_size=None, overflow_policy=None):
+    """Configure the queue of metrics waiting to be emitted.
+
+    Only takes effect if called before the first dispatcher is created.
+    Invalid values are logged and the defaults used instead.
+
+    Args:
+        max_queue_size (int): maximum number of metrics waiting to be
+            emitted. Defaults to ``10000``.
+        overflow_policy (str): which metrics to drop when the queue is
+            full; one of ``drop_oldest`` (default), ``drop_newest`` or
+            ``coalesce``.
+    """
+    logger = logging.getLogger("klio.metrics.dispatcher")
+    if max_queue_size is not None:
+        if isinstance(max_queue_size, int) and max_queue_size > 0:
+            _EMITTER_CONFIG["max_size"] = max_queue_size
+        else:
+            logger.warning(
+                "Invalid metrics max_queue_size {!r}, using the default of "
+                "{}.".format(max_queue_size, DEFAULT_MAX_QUEUE_SIZE)
+            )
+    if overflow_policy is not None:
+        if overflow_policy in OVERFLOW_POLICIES:
+            _EMITTER_CONFIG["overflow"] = overflow_policy
+        else:
+            logger.warning(
+                "Invalid metrics overflow_policy {!r}, using the default "
+                "'{}'. Available policies: {}.".format(
+                    overflow_policy,
+                    OVERFLOW_DROP_OLDEST,
+                    ", ".join(OVERFLOW_POLICIES),
+                )
+            )
+
+
+def _get_or_create_emitter(relay_clients):
+    # We create one emitter in case the dispatcher gets init'ed more than
+    # once (which seems to be the case on direct runner)
+    global _EMITTER
+    if _EMITTER is None:
+        _EMITTER = _BoundedEmitter(
+            num_workers=len(relay_clients),
+            relay_clients=list(relay_clients),
+            **_EMITTER_CONFIG
+        )
+
+    return _EMITTER
+
+
+class _Accumulator(object):
+    # Running totals of one dispatcher's updates from one thread. Only the
+    # owning thread writes `totals`, and only the flusher writes `flushed`.
+    # Both are (count, total) tuples replaced as a whole, so the flusher
+    # never sees a count without its total, and no locking is needed.
+    __slots__ = ("totals", "flushed")
+
+    def __init__(self):
+        self.totals = (0, 0)
+        self.flushed = (0, 0)
 
-    return _CACHED_THREADPOOL_EXEC
+    def add(self, value):
+        count, total = self.totals
+        self.totals = (count + 1, total + value)
+
+    def take(self):
+        # Return the count & total accumulated since the last call.
+        count, total = totals = self.totals
+        flushed_count, flushed_total = self.flushed
+        self.flushed = totals
+        return count - flushed_count, total - flushed_total
+
+
+class _Flusher(object):
+    """Background thread periodically flushing aggregating dispatchers."""
+
+    def __init__(self, interval_sec):
+        self.interval_sec = interval_sec
+        self._dispatchers = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="KlioMetricsFlusher", daemon=True
+        )
+        self._thread.start()
+
+    def register(self, dispatcher):
+        self._dispatchers.add(dispatcher)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_sec):
+            self.flush()
+
+    def flush(self):
+        # flushes never overlap, so each update is emitted exactly once
+        with self._lock:
+            for dispatcher in list(self._dispatchers):
+                try:
+                    dispatcher._flush()
+                except Exception as e:
+                    dispatcher.logger.warning(
+                        "Error flushing metric '{}': {}".format(
+                            dispatcher.metric_key, e
+                        )
+                    )
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+
+def _get_or_create_flusher(interval_sec):
+    global _FLUSHER
+    if _FLUSHER is None:
+        with _FLUSHER_LOCK:
+            if _FLUSHER is None:
+                _FLUSHER = _Flusher(interval_sec)
+    return _FLUSHER
+
+
+def flush():
+    """Emit the aggregated updates of all aggregating dispatchers now."""
+    if _FLUSHER is not None:
+        _FLUSHER.flush()
 
 
 # not making it an ABC because there shouldn't be a need to create custom
@@ -61,21 +405,63 @@ def _get_or_create_executor(num_clients):
 class BaseMetricDispatcher(object):
     """Base class for metric-specific dispatching.
 
-    Each type of metric (counter, gauge, timer) requires a dispatcher
-    implementation.
+    Each type of metric (counter, gauge, timer, histogram) requires a
+    dispatcher implementation.
+
+    Args:
+        relay_clients (list(klio.metrics.base.AbstractRelayClient)):
+            configured relay clients.
+        name (str): name of the metric.
+        value (int): initial value of the metric.
+        transform (str): transform the metric is associated with.
+        aggregate (bool): whether to aggregate updates and emit them
+            periodically from a background thread, rather than emitting
+            every update.
+        flush_interval_sec (float): seconds between emitting aggregated
+            updates.
+        kwargs (dict): keyword arguments passed to each relay client's
+            metric object.
     """
 
     METRIC_TYPE = None
+    DEFAULT_FLUSH_INTERVAL_SEC = 60
     _thread_local = threading.local()
 
-    def __init__(self, relay_clients, name, value=0, transform=None, **kwargs):
+    def __init__(
+        self,
+        relay_clients,
+        name,
+        value=0,
+        transform=None,
+        aggregate=False,
+        flush_interval_sec=DEFAULT_FLUSH_INTERVAL_SEC,
+        **kwargs
+    ):
         self.name = name
         self.value = value
         self.transform = transform
         self.metric_key = self._setup_metric_key()
         self.kwargs = kwargs
         self.relay_to_metric = self._setup_metric_relay(relay_clients)
-        self._thread_pool = _get_or_create_executor(len(relay_clients))
+        self._emitter = _get_or_create_emitter(relay_clients)
+        _RELAY_CLIENTS.update(relay_clients)
+
+        self.aggregate = aggregate
+        self.flush_interval_sec = flush_interval_sec
+        # metrics of synchronous relays are always updated directly, and
+        # never handed off to the emitter
+        self._sync_metrics = []
+        self._async_relay_to_metric = []
+        for relay, metric in self.relay_to_metric or ():
+            if getattr(relay, "SYNCHRONOUS", False) is True:
+                self._sync_metrics.append(metric)
+            else:
+                self._async_relay_to_metric.append((relay, metric))
+        self._local = threading.local()
+        self._accumulators = []
+        self._accumulators_lock = threading.Lock()
+        if aggregate:
+            _get_or_create_flusher(flush_interval_sec).register(self)
 
     def _setup_metric_relay(self, relay_clients):
         raise NotImplementedError()
@@ -97,20 +483,51 @@ class BaseMetricDispatcher(object):
             self._thread_local.klio_metrics_dispatcher_logger = logger
         return self._thread_local.klio_metrics_dispatcher_logger
 
-    def _submit_callback(self, fut):
+    def _merge(self, pending_value, value):
+        # How a coalesced update is merged into a pending one.
+        return value
+
+    def submit(self, emit, metric):
+        """Emit metrics via the background emitter's bounded queue."""
+        self._emitter.submit(emit, metric, self.metric_key, self._merge)
+
+    def _emit_sync(self, emit, metric):
         try:
-            fut.result()
-            # no need to do anything if successful
+            emit(metric)
         except Exception as e:
-            msg = "Error emitting metric '{}': {}".format(fut.metric_key, e)
+            msg = "Error emitting metric '{}': {}".format(self.metric_key, e)
             self.logger.warning(msg)
 
-    def submit(self, emit, metric):
-        """Emit metrics via a threadpool."""
-        fut = self._thread_pool.submit(emit, metric)
+    def _accumulator(self):
+        # Get the calling thread's accumulator for this dispatcher.
+        accumulator = getattr(self._local, "accumulator", None)
+        if accumulator is None:
+            accumulator = self._local.accumulator = _Accumulator()
+            # only taken once per thread
+            with self._accumulators_lock:
+                self._accumulators.append(accumulator)
+        return accumulator
+
+    def _take(self):
+        # Return the count & total accumulated by all threads since the
+        # last flush.
+        count, total = 0, 0
+        with self._accumulators_lock:
+            accumulators = list(self._accumulators)
+        for accumulator in accumulators:
+            delta_count, delta_total = accumulator.take()
+            count += delta_count
+            total += delta_total
+        return count, total
+
+    def _flush(self):
+        # Emit aggregated updates; called by the background flusher.
+        raise NotImplementedError()
 
-        fut.metric_key = self.metric_key  # for easy identifying
-        fut.add_done_callback(self._submit_callback)
+    def _emit_aggregate(self, value):
+        for relay, metric in self._async_relay_to_metric:
+            metric.update(value)
+            self._emit_sync(relay.emit, metric)
 
 
 class CounterDispatcher(BaseMetricDispatcher):
@@ -118,6 +535,9 @@ class CounterDispatcher(BaseMetricDispatcher):
 
     METRIC_TYPE = "counter"
 
+    def _merge(self, pending_value, value):
+        return pending_value + value
+
     def _setup_metric_relay(self, relay_clients):
         return [
             (
@@ -142,11 +562,22 @@ class CounterDispatcher(BaseMetricDispatcher):
                 default is 1.
         """
         self.value = value
+        for counter in self._sync_metrics:
+            counter.update(value)
+
+        if self.aggregate:
+            self._accumulator().add(value)
+            return
 
-        for relay, counter in self.relay_to_metric:
-            counter.update(self.value)
+        for relay, counter in self._async_relay_to_metric:
+            counter.update(value)
             self.submit(relay.emit, counter)
 
+    def _flush(self):
+        count, total = self._take()
+        if count:
+            self._emit_aggregate(total)
+
 
 class GaugeDispatcher(BaseMetricDispatcher):
     """Gauge-like object that will emit via all configured clients."""
@@ -176,11 +607,26 @@ class GaugeDispatcher(BaseMetricDispatcher):
             value (int): value with which to set the gauge.
         """
         self.value = value
+        for gauge in self._sync_metrics:
+            gauge.update(value)
 
-        for relay, gauge in self.relay_to_metric:
-            gauge.update(self.value)
+        if self.aggregate:
+            # a new tuple per update, so the flusher can tell whether the
+            # gauge was set since the last flush without locking
+            self._latest = (value,)
+            return
+
+        for relay, gauge in self._async_relay_to_metric:
+            gauge.update(value)
             self.submit(relay.emit, gauge)
 
+    def _flush(self):
+        latest = getattr(self, "_latest", None)
+        if latest is None or latest is getattr(self, "_flushed", None):
+            return
+        self._flushed = latest
+        self._emit_aggregate(latest[0])
+
 
 class TimerDispatcher(BaseMetricDispatcher):
     """Timer-like object that will emit via all configured clients.
@@ -266,13 +712,214 @@ class TimerDispatcher(BaseMetricDispatcher):
             self.timer_unit, 1e9
         )
 
-        for relay, timer in self.relay_to_metric:
+        for timer in self._sync_metrics:
+            timer.update(self.value)
+
+        if self.aggregate:
+            self._accumulator().add(self.value)
+            return
+
+        for relay, timer in self._async_relay_to_metric:
             timer.update(self.value)
             self.submit(relay.emit, timer)
 
+    def _flush(self):
+        # emits the mean duration; use a histogram for percentiles
+        count, total = self._take()
+        if count:
+            self._emit_aggregate(total / count)
+
     def __enter__(self):
         self.start()
         return self
 
     def __exit__(self, *args):
         self.stop()
+
+
+class HistogramDispatcher(BaseMetricDispatcher):
+    """Histogram-like object that will emit via all configured clients.
+
+    Recorded values are accumulated locally in a
+    :class:`klio.metrics.histogram.Histogram`. Once every
+    ``flush_interval_sec``, a summary of the values recorded since the
+    previous flush (count, min, max, mean and percentiles) is emitted via
+    configured clients, instead of every value: by the next call to
+    :meth:`record`, or by the background flusher if no value is recorded
+    in the meantime. Any remaining values are flushed when the Python
+    interpreter exits.
+
+    It can also be used to time code like a :class:`TimerDispatcher`,
+    recording the elapsed time in ``timer_unit``. Timing is tracked per
+    thread, so one histogram may time code running in multiple threads:
+
+    .. code-block:: python
+
+        histogram = HistogramDispatcher(relay_clients, name)
+        with histogram:
+            # code to time
+    """
+
+    METRIC_TYPE = "histogram"
+
+    def __init__(
+        self,
+        relay_clients,
+        name,
+        value=0,
+        transform=None,
+        timer_unit="ns",
+        percentiles=histogram_.DEFAULT_PERCENTILES,
+        flush_interval_sec=BaseMetricDispatcher.DEFAULT_FLUSH_INTERVAL_SEC,
+        **kwargs
+    ):
+        # histograms are always aggregated
+        kwargs.pop("aggregate", None)
+        super(HistogramDispatcher, self).__init__(
+            relay_clients=relay_clients,
+            name=name,
+            value=value,
+            transform=transform,
+            flush_interval_sec=flush_interval_sec,
+            timer_unit=timer_unit,
+            **kwargs
+        )
+        self.timer_unit = timer_unit
+        self.percentiles = tuple(percentiles)
+        self._histogram = histogram_.Histogram()
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._next_flush = timeit.default_timer() + flush_interval_sec
+        # some relays (i.e. native) aggregate values themselves, so they're
+        # given every value rather than a summary
+        self._sample_metrics = [
+            metric
+            for _, metric in self.relay_to_metric
+            if hasattr(metric, "record")
+        ]
+        _HISTOGRAM_DISPATCHERS.add(self)
+        # flushes values recorded before the transform goes idle
+        _get_or_create_flusher(flush_interval_sec).register(self)
+
+    def _setup_metric_relay(self, relay_clients):
+        relay_to_metric = []
+        for relay in relay_clients:
+            # relays that don't support histograms return ``None``
+            metric = relay.histogram(
+                name=self.name,
+                value=self.value,
+                transform=self.transform,
+                **self.kwargs
+            )
+            if metric is not None:
+                relay_to_metric.append((relay, metric))
+        return relay_to_metric
+
+    def record(self, value):
+        """Record a value.
+
+        Calling this method will emit a summary of the recorded values
+        via configured clients if ``flush_interval_sec`` has passed since
+        the last flush.
+
+        Args:
+            value (int or float): value to record.
+        """
+        self.value = value
+        self._histogram.record(value)
+        for metric in self._sample_metrics:
+            metric.record(value)
+
+        if timeit.default_timer() >= self._next_flush:
+            self.flush()
+
+    def _flush(self):
+        # called by the background flusher, which emits synchronously
+        if timeit.default_timer() >= self._next_flush:
+            self.flush(sync=True)
+
+    def flush(self, sync=False):
+        """Emit a summary of the values recorded since the last flush.
+
+        Nothing is emitted if no values were recorded.
+
+        Args:
+            sync (bool): emit on the calling thread rather than via the
+                background emitter.
+        """
+        with self._flush_lock:
+            self._next_flush = timeit.default_timer() + self.flush_interval_sec
+            snapshot = self._histogram.snapshot(self.percentiles, reset=True)
+        if not snapshot.count:
+            return
+
+        for histogram in self._sync_metrics:
+            histogram.update(snapshot)
+        for relay, histogram in self._async_relay_to_metric:
+            histogram.update(snapshot)
+            if sync:
+                self._emit_sync(relay.emit, histogram)
+            else:
+                self.submit(relay.emit, histogram)
+
+    def start(self):
+        """Start timing on the current thread."""
+        starts = getattr(self._local, "starts", None)
+        if starts is None:
+            starts = self._local.starts = []
+        starts.append(timeit.default_timer())
+
+    def stop(self):
+        """Stop timing on the current thread and record the elapsed time."""
+        starts = getattr(self._local, "starts", None)
+        if not starts:
+            self.logger.warning(
+                "Timer {} cannot be stopped before started.".format(
+                    self.metric_key
+                )
+            )
+            return
+
+        time_elapsed = timeit.default_timer() - starts.pop()
+        self.record(
+            time_elapsed
+            * TimerDispatcher.TIMER_UNIT_TO_NUMBER.get(self.timer_unit, 1e9)
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+@atexit.register
+def shutdown():
+    """Flush all aggregated metrics and stop the background flusher.
+
+    Emits all aggregated updates and recorded histogram values that
+    haven't been emitted yet, on the calling thread, then waits up to
+    ``SHUTDOWN_TIMEOUT_SEC`` for queued metrics to be emitted and flushes
+    relay clients. Called when the Python interpreter exits; call it
+    directly to flush metrics before a worker is torn down some other way.
+    """
+    global _FLUSHER
+    with _FLUSHER_LOCK:
+        flusher, _FLUSHER = _FLUSHER, None
+    if flusher is not None:
+        flusher.shutdown()
+    # the emitter's threads don't outlive the interpreter, so the last
+    # values are emitted synchronously
+    for dispatcher in list(_HISTOGRAM_DISPATCHERS):
+        dispatcher.flush(sync=True)
+    if _EMITTER is not None:
+        _EMITTER.join(timeout=SHUTDOWN_TIMEOUT_SEC)
+    # relay clients may buffer metrics themselves
+    for relay in list(_RELAY_CLIENTS):
+        try:
+            relay.flush()
+        except Exception as e:
+            logging.getLogger("klio.metrics.dispatcher").warning(
+                "Error flushing relay client {}: {}".format(relay, e)
+            )
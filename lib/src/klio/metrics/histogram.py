@@ -0,0 +1,186 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Local accumulation of value distributions for histogram-type metrics.
+
+Values are counted in log-linear buckets, similar to an `HDR histogram
+<http://hdrhistogram.org/>`_: each power of two is split into a fixed
+number of equally sized sub-buckets. Recording a value only increments
+one bucket, memory only grows with the number of distinct buckets hit,
+and percentiles are accurate to within the width of a sub-bucket
+(less than 1% of the value with the default of 128 sub-buckets).
+"""
+
+import collections
+import math
+import threading
+
+
+DEFAULT_SUB_BUCKETS = 128
+DEFAULT_PERCENTILES = (50, 75, 95, 99)
+
+
+class HistogramSnapshot(object):
+    """Summary of the values recorded by a :class:`Histogram`.
+
+    Attributes:
+        count (int): number of recorded values.
+        sum (float): sum of the recorded values.
+        min (float): smallest recorded value.
+        max (float): largest recorded value.
+        percentiles (dict(float, float)): estimated value of each
+            requested percentile.
+    """
+
+    __slots__ = ("count", "sum", "min", "max", "percentiles")
+
+    def __init__(self, count, sum, min, max, percentiles):
+        self.count = count
+        self.sum = sum
+        self.min = min
+        self.max = max
+        self.percentiles = percentiles
+
+    @property
+    def mean(self):
+        """float: Mean of the recorded values."""
+        if not self.count:
+            return 0
+        return self.sum / self.count
+
+    def summary(self):
+        """Return the snapshot's statistics keyed by name.
+
+        Percentiles are keyed like ``p50`` or ``p99.9``.
+
+        Returns:
+            collections.OrderedDict(str, float): the statistics.
+        """
+        summary = collections.OrderedDict(
+            (
+                ("count", self.count),
+                ("min", self.min),
+                ("max", self.max),
+                ("mean", self.mean),
+            )
+        )
+        for percentile, value in self.percentiles.items():
+            summary["p{:g}".format(percentile)] = value
+        return summary
+
+    def __repr__(self):
+        return "HistogramSnapshot({})".format(
+            ", ".join("{}={}".format(k, v) for k, v in self.summary().items())
+        )
+
+
+class Histogram(object):
+    """Thread-safe histogram of recorded values.
+
+    Args:
+        sub_buckets (int): number of buckets each power of two is split
+            into. More buckets give more accurate percentiles.
+    """
+
+    def __init__(self, sub_buckets=DEFAULT_SUB_BUCKETS):
+        self.sub_buckets = sub_buckets
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._buckets = {}
+        self._zero_count = 0
+        self._count = 0
+        self._sum = 0
+        self._min = None
+        self._max = None
+
+    def _bucket(self, value):
+        # value == mantissa * 2 ** exponent, with 0.5 <= mantissa < 1
+        mantissa, exponent = math.frexp(value)
+        sub_bucket = int((mantissa - 0.5) * 2 * self.sub_buckets)
+        return exponent * self.sub_buckets + sub_bucket
+
+    def _bucket_midpoint(self, bucket):
+        exponent, sub_bucket = divmod(bucket, self.sub_buckets)
+        mantissa = 0.5 + (sub_bucket + 0.5) / (2 * self.sub_buckets)
+        return math.ldexp(mantissa, exponent)
+
+    def record(self, value):
+        """Record a value.
+
+        Args:
+            value (int or float): value to record. Values of ``0`` or less
+                are counted together.
+        """
+        with self._lock:
+            if value > 0:
+                bucket = self._bucket(value)
+                self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            else:
+                self._zero_count += 1
+            self._count += 1
+            self._sum += value
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def _percentiles(self, percentiles):
+        buckets = sorted(self._buckets.items())
+        result = collections.OrderedDict()
+        for percentile in sorted(percentiles):
+            rank = max(1, math.ceil(percentile / 100.0 * self._count))
+            seen = self._zero_count
+            value = self._min
+            for bucket, count in buckets:
+                if seen >= rank:
+                    break
+                seen += count
+                value = self._bucket_midpoint(bucket)
+            # the midpoint of the first or last bucket may be beyond the
+            # actual values
+            result[percentile] = min(max(value, self._min), self._max)
+        return result
+
+    def snapshot(self, percentiles=DEFAULT_PERCENTILES, reset=False):
+        """Summarize the recorded values.
+
+        Args:
+            percentiles (tuple(float)): percentiles to estimate, between
+                ``0`` and ``100``.
+            reset (bool): whether to clear the recorded values, so that
+                the next snapshot only covers values recorded after this
+                one.
+        Returns:
+            HistogramSnapshot: summary of the recorded values.
+        """
+        with self._lock:
+            if self._count:
+                snapshot = HistogramSnapshot(
+                    self._count,
+                    self._sum,
+                    self._min,
+                    self._max,
+                    self._percentiles(percentiles),
+                )
+            else:
+                snapshot = HistogramSnapshot(0, 0, None, None, {})
+            if reset:
+                self._reset()
+        return snapshot
@@ -33,6 +33,9 @@ The default configuration in ``klio-info.yaml`` can be overwritten:
                 # options include `s` or `seconds`, `ms` or `milliseconds`,
                 # `us` or `microseconds`, and `ns` or `nanoseconds`.
                 timer_unit: s
+                # Log one JSON line per `job_config.metrics.flush_interval_sec`
+                # with all metrics aggregated, instead of a line per update.
+                batch: true
 
 To turn off logging-based metrics:
 
@@ -41,10 +44,29 @@ To turn off logging-based metrics:
     job_config
         metrics:
             logger: false
+
+Nothing is formatted when the configured level is disabled for the
+``klio.metrics`` logger.
+
+In batch mode, all updates logged within a flush interval are aggregated:
+counter increments are summed, the latest value of gauges and histograms
+is kept, and timers are summarized by their count, min, max and mean.
+Each metric is logged as an entry of the JSON line's ``metrics`` list,
+e.g.:
+
+.. code-block:: json
+
+    {"metrics": [{"name": "kmsg-received", "transform": "MyTransform",
+    "tags": {"metric_type": "counter"}, "value": 42}]}
+
+The batch is logged by the first update after the interval has passed,
+and when the worker's Python process exits.
 """
 
+import json
 import logging
 import threading
+import time
 
 from klio.metrics import base
 
@@ -61,6 +83,110 @@ TIMER_UNIT_MAP = {
 }
 """Map of supported measurement units to shorthand for :class:`LoggerTimer`.
 """
+DEFAULT_FLUSH_INTERVAL_SEC = 60
+
+_BATCH = None
+_BATCH_LOCK = threading.Lock()
+
+
+class _BatchEntry(object):
+    # Aggregated updates of one metric within a batch.
+    __slots__ = (
+        "name",
+        "transform",
+        "tags",
+        "metric_type",
+        "count",
+        "total",
+        "min",
+        "max",
+        "value",
+    )
+
+    def __init__(self, metric):
+        self.name = metric.name
+        self.transform = metric.transform
+        self.tags = dict(metric.tags)
+        self.metric_type = metric.tags.get("metric_type")
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.value = None
+
+    def add(self, value):
+        self.count += 1
+        if self.metric_type == "counter":
+            self.total += value
+            self.value = self.total
+        elif self.metric_type == "timer":
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            self.value = {
+                "count": self.count,
+                "min": self.min,
+                "max": self.max,
+                "mean": self.total / self.count,
+            }
+        else:
+            self.value = value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "transform": self.transform,
+            "tags": self.tags,
+            "value": self.value,
+        }
+
+
+class _MetricsBatch(object):
+    """Updates of all batching clients' metrics within a flush interval."""
+
+    def __init__(self, interval_sec):
+        self.interval_sec = interval_sec
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._next_flush = time.monotonic() + interval_sec
+
+    def add(self, metric):
+        """Add a metric update, returning the batch's line if it's due."""
+        key = (metric.tags.get("metric_type"), metric.name, metric.transform)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _BatchEntry(metric)
+            entry.add(metric.value)
+            if time.monotonic() < self._next_flush:
+                return None
+            return self._take()
+
+    def flush(self):
+        """Return the batch's line, or ``None`` if there were no updates."""
+        with self._lock:
+            return self._take()
+
+    def _take(self):
+        self._next_flush = time.monotonic() + self.interval_sec
+        entries, self._entries = self._entries, {}
+        if not entries:
+            return None
+        return json.dumps(
+            {"metrics": [entry.to_dict() for entry in entries.values()]},
+            default=str,
+        )
+
+
+def _get_or_create_batch(interval_sec):
+    # All clients share one batch, so that it's logged as a single line
+    # per interval.
+    global _BATCH
+    if _BATCH is None:
+        with _BATCH_LOCK:
+            if _BATCH is None:
+                _BATCH = _MetricsBatch(interval_sec)
+    return _BATCH
 
 
 class MetricsLoggerClient(base.AbstractRelayClient):
@@ -89,6 +215,15 @@ class MetricsLoggerClient(base.AbstractRelayClient):
         self.disabled = disabled
         self.log_level = self._set_log_level()
         self.timer_unit = self._set_timer_unit()
+        self._batch = None
+        if isinstance(self.logger_config, dict):
+            if self.logger_config.get("batch") is True:
+                interval_sec = self.klio_config.job_config.metrics.get(
+                    "flush_interval_sec"
+                )
+                self._batch = _get_or_create_batch(
+                    interval_sec or DEFAULT_FLUSH_INTERVAL_SEC
+                )
 
     def _set_log_level(self):
         log_level = MetricsLoggerClient.DEFAULT_LEVEL
@@ -135,17 +270,41 @@ class MetricsLoggerClient(base.AbstractRelayClient):
             "tags": metric.tags,
         }
 
+    def _enabled(self):
+        logger = self.logger
+        return not logger.disabled and logger.isEnabledFor(self.log_level)
+
     def emit(self, metric):
         """Log a given metric.
 
+        In batch mode, the metric is added to the current batch, which
+        is logged once the flush interval has passed.
+
         Args:
             metric (LoggerMetric): logger-specific metrics object
         """
+        if not self._enabled():
+            return
+
+        if self._batch is not None:
+            line = self._batch.add(metric)
+            if line is not None:
+                self.logger.log(self.log_level, line)
+            return
+
         metric_data = self.unmarshal(metric)
         self.logger.log(
             self.log_level, metric.DEFAULT_LOG_FORMAT.format(**metric_data)
         )
 
+    def flush(self):
+        """Log the current batch, in batch mode."""
+        if self._batch is None:
+            return
+        line = self._batch.flush()
+        if line is not None and self._enabled():
+            self.logger.log(self.log_level, line)
+
     def counter(self, name, value=0, transform=None, tags=None, **kwargs):
         """Create a :class:`LoggerCounter` object.
 
@@ -219,6 +378,43 @@ class MetricsLoggerClient(base.AbstractRelayClient):
             timer_unit=timer_unit,
         )
 
+    def histogram(
+        self,
+        name,
+        value=0,
+        transform=None,
+        tags=None,
+        timer_unit=None,
+        **kwargs
+    ):
+        """Create a :class:`LoggerHistogram` object.
+
+        Args:
+            name (str): name of histogram
+            value (int): starting value of histogram; defaults to 0
+            transform (str): transform the histogram is associated with
+            tags (dict): any tags of additional contextual information
+                to associate with the histogram
+            timer_unit (str): timer unit when the histogram is used as a
+                timer; defaults to configured value in `klio-job.yaml`, or
+                "ns". See module-level docs of `klio.metrics.logger` for
+                supported values.
+
+        Returns:
+            LoggerHistogram: a log-based histogram
+        """
+        if timer_unit:
+            timer_unit = TIMER_UNIT_MAP.get(timer_unit, self.timer_unit)
+        else:
+            timer_unit = self.timer_unit
+        return LoggerHistogram(
+            name=name,
+            value=value,
+            transform=transform,
+            tags=tags,
+            timer_unit=timer_unit,
+        )
+
 
 class LoggerMetric(base.BaseMetric):
     """Base metric type for loggers.
@@ -294,3 +490,36 @@ class LoggerTimer(LoggerMetric):
             name, value=value, transform=transform, tags=tags
         )
         self.timer_unit = timer_unit
+
+
+class LoggerHistogram(LoggerMetric):
+    """Log-based histogram metric.
+
+    Logged with a summary of the values recorded since it was last
+    logged, e.g. ``{'count': 10, 'min': 1.0, 'max': 9.0, 'mean': 5.0,
+    'p50': 5.0, ...}``.
+
+    Args:
+        name (str): name of histogram
+        value (int): initial value. Default: ``0``.
+        transform (str): Name of transform associated with histogram, if
+            any.
+        tags (dict): Tags to associate with histogram. Note:
+            ``{"metric_type": "histogram"}`` will always be an included tag.
+        timer_unit (str): Unit of measurement when used as a timer.
+            Options: :attr:`TIMER_UNIT_MAP`. Default: ``ns`` (nanoseconds).
+    """
+
+    LOGGER_METRIC_TAGS = {"metric_type": "histogram"}
+
+    def __init__(
+        self, name, value=0, transform=None, tags=None, timer_unit="ns"
+    ):
+        super(LoggerHistogram, self).__init__(
+            name, value=value, transform=transform, tags=tags
+        )
+        self.tags["unit"] = timer_unit
+        self.timer_unit = timer_unit
+
+    def update(self, snapshot):
+        self.value = dict(snapshot.summary())
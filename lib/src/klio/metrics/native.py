@@ -95,6 +95,9 @@ class NativeMetricsClient(base.AbstractRelayClient):
     """
 
     RELAY_CLIENT_NAME = "beam"
+    # Beam aggregates its metrics itself, and only records updates made
+    # from the thread processing an element
+    SYNCHRONOUS = True
     # Since these metrics show up on the right sidebar of the Dataflow UI,
     # let's default to seconds since the usual default of nanoseconds is
     # a bit unreadable (@lynn).
@@ -192,6 +195,30 @@ class NativeMetricsClient(base.AbstractRelayClient):
             timer_unit = self.timer_unit
         return NativeTimer(name, namespace=namespace, timer_unit=timer_unit)
 
+    def histogram(self, name, transform=None, timer_unit=None, **kwargs):
+        """Create a :class:`NativeHistogram` object.
+
+        Args:
+            name (str): name of histogram
+            transform (str): transform the histogram is associated with.
+                Defaults to the job's name.
+            timer_unit (str): timer unit when the histogram is used as a
+                timer; defaults to configured value in `klio-job.yaml`, or
+                :attr:`NativeMetricsClient.DEFAULT_TIME_UNIT`. Options:
+                :attr:`TIMER_UNIT_MAP`.
+
+        Returns:
+            NativeHistogram: a native histogram instance
+        """
+        namespace = transform or self.job_name
+        if timer_unit:
+            timer_unit = TIMER_UNIT_MAP.get(timer_unit, self.timer_unit)
+        else:
+            timer_unit = self.timer_unit
+        return NativeHistogram(
+            name, namespace=namespace, timer_unit=timer_unit
+        )
+
 
 class NativeCounter(base.BaseMetric):
     """Counter metric using Beam's `counter-type metric
@@ -250,3 +277,45 @@ class NativeTimer(base.BaseMetric):
     def update(self, value):
         # TODO: how is timer unit(s) handled?
         self._timer.update(value)
+
+
+class NativeHistogram(base.BaseMetric):
+    """Histogram metric using Beam's `distribution-type metric
+    <https://beam.apache.org/documentation/programming-guide/
+    #types-of-metrics>`_ and `gauge-type metrics
+    <https://beam.apache.org/documentation/programming-guide/
+    #types-of-metrics>`_.
+
+    Every recorded value updates the distribution (count, sum, min and
+    max). Percentiles are set as gauges named ``<name>-p<percentile>``
+    (e.g. ``kmsg-timer-p99``) whenever the histogram is flushed. Note that
+    gauges are not reported to Dataflow's monitoring.
+
+    Args:
+        name (str): name of histogram
+        namespace (str): Name of namespace the histogram belongs to (e.g.
+            the histogram's transform).
+        timer_unit (str): Unit of measurement when used as a timer.
+            Options: :attr:`TIMER_UNIT_MAP`.
+            Default: ``ns`` (nanoseconds).
+    """
+
+    def __init__(self, name, namespace, timer_unit="ns"):
+        self.name = name
+        self.namespace = namespace
+        self._distribution = beam_metrics.Metrics.distribution(namespace, name)
+        self._percentile_gauges = {}
+        self.timer_unit = timer_unit
+
+    def record(self, value):
+        self._distribution.update(value)
+
+    def update(self, snapshot):
+        for percentile, value in snapshot.percentiles.items():
+            gauge = self._percentile_gauges.get(percentile)
+            if gauge is None:
+                gauge = beam_metrics.Metrics.gauge(
+                    self.namespace, "{}-p{:g}".format(self.name, percentile)
+                )
+                self._percentile_gauges[percentile] = gauge
+            gauge.set(value)
@@ -0,0 +1,586 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Klio can serve metrics in the `Prometheus text format
+<https://prometheus.io/docs/instrumenting/exposition_formats/>`_ from an
+HTTP endpoint within the worker process via
+:class:`PrometheusMetricsClient`, so they can be scraped by Prometheus or
+read by a Kubernetes HorizontalPodAutoscaler through a metrics adapter.
+
+This client is not enabled by default. To turn it on with its defaults,
+set ``prometheus`` to ``true`` in ``klio-job.yaml``, or configure it:
+
+.. code-block:: yaml
+
+    job_config:
+      metrics:
+        prometheus:
+          # Port to serve metrics on, at the `/metrics` path.
+          port: 9090
+          # Upper bounds of histogram buckets, in the unit the histogram
+          # records values in (the job's timer unit for Klio's own
+          # histograms, seconds by default).
+          buckets: [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+Metrics are kept in memory, and aggregated over all threads of the worker
+process. Metric names are converted to valid Prometheus names by
+replacing any unsupported characters with ``_`` (e.g. ``kmsg-received``
+becomes ``kmsg_received``), and are labelled with ``job_name``,
+``transform`` and any tags of the metric. Counters are exposed as
+Prometheus counters with a ``_total`` suffix, gauges as gauges, timers as
+summaries (their ``_count`` and ``_sum``), and histograms as histograms.
+
+The same HTTP server also serves the transform statistics of
+``job_config.metrics.stats_port`` (see :mod:`klio.transforms._stats`), so a
+worker runs at most one such server.
+
+When running with Klio's DirectGKERunner, ``klio job run`` declares the
+port on the job's Kubernetes deployment, together with the
+``prometheus.io/scrape``, ``prometheus.io/port`` and
+``prometheus.io/path`` pod annotations.
+"""
+import bisect
+import http.server
+import logging
+import re
+import threading
+
+from klio.metrics import base
+
+
+DEFAULT_PORT = 9090
+METRICS_PATH = "/metrics"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""Default upper bounds of histogram buckets."""
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+_INVALID_LABEL_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+_SERVER = None
+_SERVER_LOCK = threading.Lock()
+# path -> (content type, callable returning the response body)
+_ROUTES = {}
+
+
+def _metric_name(name):
+    name = _INVALID_NAME_CHARS.sub("_", name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return name
+
+
+def _label_name(name):
+    name = _INVALID_LABEL_CHARS.sub("_", str(name))
+    if name[:1].isdigit():
+        name = "_" + name
+    return name
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+    )
+
+
+class _Sample(object):
+    # Current value of one labelled counter or gauge.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def lines(self, name, labels):
+        yield "{}{} {}".format(
+            name, _format_labels(labels), _format_value(self.value)
+        )
+
+
+class _SummarySample(object):
+    # Count and sum of the values of one labelled timer.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+
+    def lines(self, name, labels):
+        with self.lock:
+            count, total = self.count, self.sum
+        label_str = _format_labels(labels)
+        yield "{}_sum{} {}".format(name, label_str, _format_value(total))
+        yield "{}_count{} {}".format(name, label_str, count)
+
+
+class _HistogramSample(_SummarySample):
+    # Bucketed counts of the values of one labelled histogram.
+
+    def __init__(self, buckets):
+        super(_HistogramSample, self).__init__()
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+
+    def observe(self, value):
+        # a value equal to a bucket's upper bound falls into that bucket
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.bucket_counts):
+                self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def lines(self, name, labels):
+        with self.lock:
+            bucket_counts = list(self.bucket_counts)
+            count, total = self.count, self.sum
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            yield "{}_bucket{} {}".format(
+                name,
+                _format_labels(labels, (("le", _format_value(bound)),)),
+                cumulative,
+            )
+        yield "{}_bucket{} {}".format(
+            name, _format_labels(labels, (("le", "+Inf"),)), count
+        )
+        label_str = _format_labels(labels)
+        yield "{}_sum{} {}".format(name, label_str, _format_value(total))
+        yield "{}_count{} {}".format(name, label_str, count)
+
+
+class _CallbackSample(object):
+    # Gauge whose value is read when rendered.
+
+    def __init__(self, func):
+        self.func = func
+
+    def lines(self, name, labels):
+        try:
+            value = self.func()
+        except Exception as e:
+            logging.getLogger("klio.metrics").warning(
+                "Error reading gauge '{}': {}".format(name, e)
+            )
+            return
+        yield "{}{} {}".format(
+            name, _format_labels(labels), _format_value(value)
+        )
+
+
+class _Registry(object):
+    """All Prometheus metrics of the process, by name and labels.
+
+    Every thread of a worker has its own metrics registry and relay
+    clients, so metric objects of the same name and labels share one
+    sample from this registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, {labels: sample}), in order of creation
+        self._families = {}
+
+    def get_or_create(self, name, metric_type, labels, factory):
+        """Return the sample of a metric, creating it if needed.
+
+        Args:
+            name (str): Prometheus name of the metric.
+            metric_type (str): Prometheus type of the metric.
+            labels (tuple(tuple(str, str))): sorted label pairs.
+            factory (callable): creates the sample if it doesn't exist.
+        Returns:
+            the metric's sample.
+        """
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (metric_type, {})
+            elif family[0] != metric_type:
+                raise ValueError(
+                    "Metric '{}' is already registered as a {}.".format(
+                        name, family[0]
+                    )
+                )
+            sample = family[1].get(labels)
+            if sample is None:
+                sample = family[1][labels] = factory()
+        return sample
+
+    def register_gauge(self, name, func, labels):
+        with self._lock:
+            family = self._families.setdefault(name, ("gauge", {}))
+            family[1][labels] = _CallbackSample(func)
+
+    def clear(self):
+        with self._lock:
+            self._families.clear()
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        with self._lock:
+            families = [
+                (name, metric_type, list(samples.items()))
+                for name, (metric_type, samples) in self._families.items()
+            ]
+        lines = []
+        for name, metric_type, samples in families:
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, sample in samples:
+                lines.extend(sample.lines(name, labels))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = _Registry()
+"""Metrics of the worker process served by the HTTP endpoint."""
+
+
+def register_gauge(name, func, **labels):
+    """Register a gauge whose value is read whenever metrics are served.
+
+    Useful for exposing the size of queues or caches without updating
+    a gauge on every change. Registering a gauge with the same name and
+    labels again replaces it.
+
+    Args:
+        name (str): name of the gauge.
+        func (callable): returns the gauge's current value.
+        labels (dict): labels of the gauge.
+    """
+    label_pairs = tuple(
+        sorted((_label_name(k), str(v)) for k, v in labels.items())
+    )
+    REGISTRY.register_gauge(_metric_name(name), func, label_pairs)
+
+
+def add_route(path, content_type, render):
+    """Serve another resource from the metrics HTTP server.
+
+    Args:
+        path (str): path to serve the resource at, e.g. ``"/stats"``.
+        content_type (str): value of the response's ``Content-Type``
+            header.
+        render (callable): returns the response body as ``bytes``.
+    """
+    _ROUTES[path] = (content_type, render)
+
+
+def _render_metrics():
+    return REGISTRY.render().encode("utf-8")
+
+
+add_route(METRICS_PATH, CONTENT_TYPE, _render_metrics)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = _ROUTES.get(self.path.split("?", 1)[0])
+        if route is None:
+            self.send_error(404)
+            return
+        content_type, render = route
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes aren't worth logging
+        pass
+
+
+def start_server(port, host=""):
+    """Serve all metrics in the Prometheus text format over HTTP.
+
+    Metrics are served at ``/metrics``, along with any resources added
+    with :func:`add_route`. Only one server is started per process; later
+    calls return it, whichever port they ask for.
+
+    Args:
+        port (int): port to listen on. ``0`` picks a free port.
+        host (str): address to listen on. Defaults to all interfaces.
+    Returns:
+        http.server.ThreadingHTTPServer: the server, or ``None`` if it
+        couldn't be started.
+    """
+    global _SERVER
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            try:
+                server = http.server.ThreadingHTTPServer(
+                    (host, port), _MetricsHandler
+                )
+            except OSError as e:
+                logging.getLogger("klio.metrics").warning(
+                    "Could not serve metrics on port {}: {}".format(port, e)
+                )
+                return None
+            server.daemon_threads = True
+            thread = threading.Thread(
+                target=server.serve_forever,
+                name="KlioPrometheusServer",
+                daemon=True,
+            )
+            thread.start()
+            _SERVER = server
+        elif port and port != _SERVER.server_address[1]:
+            logging.getLogger("klio.metrics").info(
+                "Already serving metrics on port {}, not on port {}.".format(
+                    _SERVER.server_address[1], port
+                )
+            )
+    return _SERVER
+
+
+class PrometheusMetricsClient(base.AbstractRelayClient):
+    """Metrics client serving metrics in the Prometheus text format.
+
+    Intended to be instantiated by :class:`klio.metrics.client.MetricsRegistry`
+    and not by itself. Starts the HTTP endpoint when first instantiated.
+
+    Args:
+        klio_config (klio_core.config.KlioConfig): the job's configuration.
+    """
+
+    RELAY_CLIENT_NAME = "prometheus"
+    # updating a metric only takes a lock & an addition
+    SYNCHRONOUS = True
+
+    def __init__(self, klio_config):
+        super(PrometheusMetricsClient, self).__init__(klio_config)
+        self.job_name = klio_config.job_name
+        prometheus_config = self.klio_config.job_config.metrics.get(
+            "prometheus", {}
+        )
+        if not isinstance(prometheus_config, dict):
+            prometheus_config = {}
+        self.port = prometheus_config.get("port", DEFAULT_PORT)
+        self.buckets = tuple(
+            sorted(prometheus_config.get("buckets", DEFAULT_BUCKETS))
+        )
+        start_server(self.port)
+
+    def unmarshal(self, metric):
+        """Return a dict-representation of a given metric.
+
+        Args:
+            metric (BasePrometheusMetric): Prometheus-specific metrics object
+        Returns:
+            dict(str, str): metric data
+        """
+        return {
+            "name": metric.name,
+            "value": metric.value,
+            "labels": dict(metric.labels),
+        }
+
+    def emit(self, metric):
+        # Metrics are updated in place and served on request, so there's
+        # nothing to emit. The method still needs implementation otherwise
+        # we'll get a TypeError when this class gets instantiated.
+        pass
+
+    def _labels(self, transform, tags):
+        labels = {"job_name": self.job_name}
+        if transform:
+            labels["transform"] = transform
+        for key, value in (tags or {}).items():
+            labels[_label_name(key)] = str(value)
+        return tuple(sorted(labels.items()))
+
+    def counter(self, name, value=0, transform=None, tags=None, **kwargs):
+        """Create a :class:`PrometheusCounter` object.
+
+        Args:
+            name (str): name of counter
+            value (int): starting value of counter; defaults to 0
+            transform (str): transform the counter is associated with
+            tags (dict): any tags of additional contextual information
+                to associate with the counter
+
+        Returns:
+            PrometheusCounter: a Prometheus counter
+        """
+        return PrometheusCounter(
+            name, self._labels(transform, tags), value=value
+        )
+
+    def gauge(self, name, value=0, transform=None, tags=None, **kwargs):
+        """Create a :class:`PrometheusGauge` object.
+
+        Args:
+            name (str): name of gauge
+            value (int): starting value of gauge; defaults to 0
+            transform (str): transform the gauge is associated with
+            tags (dict): any tags of additional contextual information
+                to associate with the gauge
+
+        Returns:
+            PrometheusGauge: a Prometheus gauge
+        """
+        return PrometheusGauge(
+            name, self._labels(transform, tags), value=value
+        )
+
+    def timer(self, name, value=0, transform=None, tags=None, **kwargs):
+        """Create a :class:`PrometheusTimer` object.
+
+        Args:
+            name (str): name of timer
+            value (int): starting value of timer; defaults to 0
+            transform (str): transform the timer is associated with
+            tags (dict): any tags of additional contextual information
+                to associate with the timer
+
+        Returns:
+            PrometheusTimer: a Prometheus summary
+        """
+        return PrometheusTimer(
+            name, self._labels(transform, tags), value=value
+        )
+
+    def histogram(self, name, value=0, transform=None, tags=None, **kwargs):
+        """Create a :class:`PrometheusHistogram` object.
+
+        Args:
+            name (str): name of histogram
+            value (int): starting value of histogram; defaults to 0
+            transform (str): transform the histogram is associated with
+            tags (dict): any tags of additional contextual information
+                to associate with the histogram
+
+        Returns:
+            PrometheusHistogram: a Prometheus histogram
+        """
+        return PrometheusHistogram(
+            name, self._labels(transform, tags), self.buckets, value=value
+        )
+
+
+class BasePrometheusMetric(base.BaseMetric):
+    """Base class for all Prometheus-specific metrics.
+
+    Args:
+        name (str): name of the metric
+        labels (tuple(tuple(str, str))): sorted label pairs of the metric
+        value (int): starting value of the metric; defaults to 0
+    """
+
+    METRIC_TYPE = None
+    SUFFIX = ""
+
+    def __init__(self, name, labels, value=0):
+        super(BasePrometheusMetric, self).__init__(name, value=value)
+        self.labels = labels
+        self._sample = REGISTRY.get_or_create(
+            _metric_name(name) + self.SUFFIX,
+            self.METRIC_TYPE,
+            labels,
+            self._create_sample,
+        )
+
+    def _create_sample(self):
+        return _Sample()
+
+
+class PrometheusCounter(BasePrometheusMetric):
+    """Prometheus counter, incremented by every update."""
+
+    METRIC_TYPE = "counter"
+    SUFFIX = "_total"
+
+    def update(self, value):
+        self.value = value
+        with self._sample.lock:
+            self._sample.value += value
+
+
+class PrometheusGauge(BasePrometheusMetric):
+    """Prometheus gauge, set by every update."""
+
+    METRIC_TYPE = "gauge"
+
+    def update(self, value):
+        self.value = value
+        self._sample.value = value
+
+
+class PrometheusTimer(BasePrometheusMetric):
+    """Prometheus summary of the count and sum of timed durations."""
+
+    METRIC_TYPE = "summary"
+
+    def _create_sample(self):
+        return _SummarySample()
+
+    def update(self, value):
+        self.value = value
+        self._sample.observe(value)
+
+
+class PrometheusHistogram(BasePrometheusMetric):
+    """Prometheus histogram, counting recorded values into buckets.
+
+    Args:
+        name (str): name of the histogram
+        labels (tuple(tuple(str, str))): sorted label pairs of the
+            histogram
+        buckets (tuple(float)): sorted upper bounds of the buckets
+        value (int): starting value of the histogram; defaults to 0
+    """
+
+    METRIC_TYPE = "histogram"
+
+    def __init__(self, name, labels, buckets, value=0):
+        self.buckets = buckets
+        super(PrometheusHistogram, self).__init__(name, labels, value=value)
+
+    def _create_sample(self):
+        return _HistogramSample(self.buckets)
+
+    def record(self, value):
+        self._sample.observe(value)
+
+    def update(self, snapshot):
+        # every value is already recorded, so there's nothing to do with
+        # the summary of recent values
+        self.value = snapshot
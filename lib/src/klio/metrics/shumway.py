@@ -40,6 +40,28 @@ of measure for timers objects in ``klio-job.yaml``:
           # options include `s` or `seconds`, `ms` or `milliseconds`,
           # `us` or `microseconds`, and `ns` or `nanoseconds`.
           timer_unit: seconds
+          # Address & port of the FFWD agent.
+          ffwd_addr: 127.0.0.1
+          ffwd_port: 19000
+          # Buffer points & send them packed into datagrams, see below.
+          batch:
+            flush_interval_sec: 10
+            max_packet_size: 1472
+
+All shumway clients of a worker process emitting to the same FFWD agent
+share one UDP socket.
+
+By default, every metric update is sent as its own datagram. With
+``batch`` set (either to ``true`` for the defaults above, or to a
+dictionary), points are buffered for up to ``flush_interval_sec``
+seconds, and repeated points of the same metric with the same attributes
+are coalesced: counter increments are summed, and the latest value of
+other metrics is kept. Buffered points are then sent as newline-delimited
+JSON, packing as many points into each datagram as fit in
+``max_packet_size`` bytes (by default the payload of a 1500 byte Ethernet
+MTU), so the FFWD agent's JSON input must accept newline-delimited
+points. Buffered points are also sent when the worker's Python process
+exits.
 
 To configure a different unit of measure than the default for specific timers,
 pass in the desired unit when instantiating. For example:
@@ -52,6 +74,11 @@ pass in the desired unit when instantiating. For example:
                 name="my-timer", timer_unit="ns"
             )
 """
+import json
+import socket
+import threading
+import time
+
 import shumway
 
 from klio.metrics import base
@@ -71,6 +98,118 @@ TIMER_UNIT_MAP = {
 """
 Map of supported measurement units to shorthand for :class:`ShumwayTimer`.
 """
+DEFAULT_FLUSH_INTERVAL_SEC = 10
+DEFAULT_MAX_PACKET_SIZE = 1472  # 1500 byte MTU - IPv4 & UDP headers
+
+# shared by all clients of the process, keyed by job key & FFWD address
+_RELAYS = {}
+_BATCHERS = {}
+_LOCK = threading.Lock()
+
+
+class _PointBatcher(object):
+    """Coalesces FFWD points and sends them packed into UDP datagrams.
+
+    Args:
+        key (str): key of the points.
+        address (tuple(str, int)): address & port of the FFWD agent.
+        flush_interval_sec (float): maximum seconds points are buffered.
+        max_packet_size (int): maximum size of a datagram in bytes.
+    """
+
+    def __init__(self, key, address, flush_interval_sec, max_packet_size):
+        self.key = key
+        self.address = address
+        self.flush_interval_sec = flush_interval_sec
+        self.max_packet_size = max_packet_size
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._lock = threading.Lock()
+        self._points = {}
+        self._next_flush = time.monotonic() + flush_interval_sec
+
+    def add(self, metric, value, attributes, counter=False):
+        """Buffer a point, sending all buffered points if they're due.
+
+        Args:
+            metric (str): name of the metric.
+            value (int or float): value of the point.
+            attributes (dict): attributes of the point.
+            counter (bool): whether the value is an increment, summed
+                with the buffered value rather than replacing it.
+        """
+        point_key = (metric, json.dumps(attributes, sort_keys=True))
+        with self._lock:
+            point = self._points.get(point_key)
+            if point is not None and counter:
+                point["value"] += value
+            else:
+                # same format as points sent by shumway
+                point_attributes = {"what": metric}
+                point_attributes.update(attributes)
+                self._points[point_key] = {
+                    "key": self.key,
+                    "attributes": point_attributes,
+                    "value": value,
+                    "type": "metric",
+                    "tags": [],
+                    "resources": {},
+                }
+            due = time.monotonic() >= self._next_flush
+        if due:
+            self.flush()
+
+    def _packets(self, points):
+        # Pack newline-delimited points into packets of at most
+        # `max_packet_size` bytes. A point larger than that is sent on
+        # its own.
+        packet = []
+        size = 0
+        for point in points:
+            encoded = json.dumps(point).encode("utf-8")
+            if packet and size + 1 + len(encoded) > self.max_packet_size:
+                yield b"\n".join(packet)
+                packet, size = [], 0
+            size += len(encoded) + (1 if packet else 0)
+            packet.append(encoded)
+        if packet:
+            yield b"\n".join(packet)
+
+    def flush(self):
+        """Send all buffered points."""
+        with self._lock:
+            points, self._points = self._points, {}
+            self._next_flush = time.monotonic() + self.flush_interval_sec
+        for packet in self._packets(points.values()):
+            self._sock.sendto(packet, self.address)
+
+
+def _get_or_create_relay(key, ffwd_addr, ffwd_port):
+    relay_key = (key, ffwd_addr, ffwd_port)
+    with _LOCK:
+        relay = _RELAYS.get(relay_key)
+        if relay is None:
+            relay = _RELAYS[relay_key] = shumway.MetricRelay(
+                key, ffwd_addr, ffwd_port=ffwd_port
+            )
+    return relay
+
+
+def _get_or_create_batcher(key, ffwd_addr, ffwd_port, batch_config):
+    batcher_key = (key, ffwd_addr, ffwd_port)
+    with _LOCK:
+        batcher = _BATCHERS.get(batcher_key)
+        if batcher is None:
+            batcher = _BATCHERS[batcher_key] = _PointBatcher(
+                key,
+                (ffwd_addr, ffwd_port),
+                flush_interval_sec=batch_config.get(
+                    "flush_interval_sec", DEFAULT_FLUSH_INTERVAL_SEC
+                ),
+                max_packet_size=batch_config.get(
+                    "max_packet_size", DEFAULT_MAX_PACKET_SIZE
+                ),
+            )
+    return batcher
 
 
 class ShumwayMetricsClient(base.AbstractRelayClient):
@@ -88,6 +227,7 @@ class ShumwayMetricsClient(base.AbstractRelayClient):
     DEFAULT_TIME_UNIT = "ns"
     DEFAULT_FFWD_ADDR = "127.0.0.1"
     """Default unit of measurement for timer metrics."""
+    DEFAULT_FFWD_PORT = shumway.FFWD_PORT
 
     def __init__(self, klio_config):
         super(ShumwayMetricsClient, self).__init__(klio_config)
@@ -96,6 +236,7 @@ class ShumwayMetricsClient(base.AbstractRelayClient):
             "shumway", {}
         )
         self.timer_unit = self._set_timer_unit()
+        self._batcher = None
         self._shumway_client = self._setup_client()
 
     def _set_timer_unit(self):
@@ -109,12 +250,21 @@ class ShumwayMetricsClient(base.AbstractRelayClient):
     def _setup_client(self):
         key = self.klio_config.job_name
         ffwd_addr = ShumwayMetricsClient.DEFAULT_FFWD_ADDR
+        ffwd_port = ShumwayMetricsClient.DEFAULT_FFWD_PORT
 
         if isinstance(self.shumway_config, dict):
             key = self.shumway_config.get("key", key)
             ffwd_addr = self.shumway_config.get("ffwd_addr", ffwd_addr)
+            ffwd_port = self.shumway_config.get("ffwd_port", ffwd_port)
+            batch_config = self.shumway_config.get("batch", False)
+            if batch_config:
+                if batch_config is True:
+                    batch_config = {}
+                self._batcher = _get_or_create_batcher(
+                    key, ffwd_addr, ffwd_port, batch_config
+                )
 
-        return shumway.MetricRelay(key, ffwd_addr)
+        return _get_or_create_relay(key, ffwd_addr, ffwd_port)
 
     def unmarshal(self, metric):
         """Return a dict-representation of a given metric.
@@ -138,7 +288,33 @@ class ShumwayMetricsClient(base.AbstractRelayClient):
             metric (BaseShumwayMetric): logger-specific metrics object
         """
         metric_data = self.unmarshal(metric)
-        self._shumway_client.emit(**metric_data)
+        if not isinstance(metric, ShumwayHistogram):
+            counter = isinstance(metric, ShumwayCounter)
+            self._emit_point(counter=counter, **metric_data)
+            return
+
+        # FFWD has no histogram type, so each statistic is emitted as its
+        # own point, distinguished by a `stat` attribute
+        for stat, value in metric_data["value"].items():
+            attributes = dict(metric_data["attributes"], stat=stat)
+            self._emit_point(
+                metric=metric_data["metric"],
+                value=value,
+                attributes=attributes,
+            )
+
+    def _emit_point(self, metric, value, attributes, counter=False):
+        if self._batcher is not None:
+            self._batcher.add(metric, value, attributes, counter=counter)
+        else:
+            self._shumway_client.emit(
+                metric=metric, value=value, attributes=attributes
+            )
+
+    def flush(self):
+        """Send buffered points to the FFWD agent, in batch mode."""
+        if self._batcher is not None:
+            self._batcher.flush()
 
     def counter(self, name, value=0, transform=None, tags=None, **kwargs):
         """Create a :class:`ShumwayCounter` object.
@@ -213,6 +389,43 @@ class ShumwayMetricsClient(base.AbstractRelayClient):
             **kwargs
         )
 
+    def histogram(
+        self,
+        name,
+        value=0,
+        transform=None,
+        timer_unit=None,
+        tags=None,
+        **kwargs
+    ):
+        """Create a :class:`ShumwayHistogram` object.
+
+        Args:
+            name (str): name of histogram
+            value (int): starting value of histogram; defaults to 0
+            transform (str): transform the histogram is associated with
+            tags (dict): any tags of additional contextual information
+                to associate with the histogram
+            timer_unit (str): timer unit when the histogram is used as a
+                timer; defaults to configured value in `klio-job.yaml`, or
+                "ns". Options: :attr:`TIMER_UNIT_MAP`.
+
+        Returns:
+            ShumwayHistogram: a shumway-based histogram
+        """
+        if timer_unit:
+            timer_unit = TIMER_UNIT_MAP.get(timer_unit, self.timer_unit)
+        else:
+            timer_unit = self.timer_unit
+        return ShumwayHistogram(
+            name,
+            value=value,
+            transform=transform,
+            timer_unit=timer_unit,
+            tags=tags,
+            **kwargs
+        )
+
 
 class BaseShumwayMetric(base.BaseMetric):
     """Base metric type for shumway.
@@ -285,3 +498,25 @@ class ShumwayTimer(BaseShumwayMetric):
         )
         self.attributes["unit"] = timer_unit
         self.timer_unit = timer_unit
+
+
+class ShumwayHistogram(ShumwayTimer):
+    """Shumway histogram metric.
+
+    Emitted as one point per statistic of the values recorded since it
+    was last emitted (``count``, ``min``, ``max``, ``mean`` and
+    percentiles like ``p99``), each with a ``stat`` attribute naming the
+    statistic.
+
+    Args:
+        name (str): name of histogram
+        value (int): initial value. Default: ``0``.
+        transform (str): Name of transform associated with histogram, if
+            any.
+        timer_unit (str): Unit of measurement when used as a timer.
+            Options: :attr:`TIMER_UNIT_MAP`. Default: ``ns`` (nanoseconds).
+        tags (dict): Tags to associate with histogram.
+    """
+
+    def update(self, snapshot):
+        self.value = snapshot.summary()
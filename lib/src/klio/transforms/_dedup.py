@@ -0,0 +1,356 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Worker-local cache of recently seen messages, used to drop duplicates.
+
+Configured under ``job_config.dedup`` in ``klio-job.yaml``.
+
+Messages in force or ping mode are never deduplicated. Messages that a
+job drops before processing them (e.g. because their input data doesn't
+exist yet) or sends to an upstream job with ``KlioTriggerUpstream`` are
+forgotten with :func:`forget`, so they're processed when they come back.
+This relies on their key not changing in between, so
+``job_config.dedup.key_metadata`` shouldn't include ``job_audit_log``.
+"""
+
+import collections
+import hashlib
+import math
+import threading
+import time
+
+from klio_core.proto import klio_pb2
+
+from klio.transforms import _helpers
+
+
+DEFAULT_TTL_SEC = 600
+DEFAULT_MAX_SIZE = 100000
+DEFAULT_BLOOM_ERROR_RATE = 0.001
+
+DedupConfig = collections.namedtuple(
+    "DedupConfig",
+    [
+        "ttl_sec",
+        "max_size",
+        "key_metadata",
+        "bloom_capacity",
+        "bloom_error_rate",
+    ],
+)
+
+_METADATA_FIELDS = klio_pb2.KlioMessage.Metadata.DESCRIPTOR.fields_by_name
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def parse_config(dedup_conf):
+    """Parse and validate ``job_config.dedup``.
+
+    Args:
+        dedup_conf (dict or bool): ``job_config.dedup``. ``True`` uses the
+            default configuration.
+    Returns:
+        DedupConfig: the parsed configuration.
+    Raises:
+        klio.transforms._helpers.KlioConfigRuntimeError: the configuration
+            is invalid.
+    """
+    if dedup_conf is True:
+        dedup_conf = {}
+    if not isinstance(dedup_conf, dict):
+        raise _helpers.KlioConfigRuntimeError(
+            "Invalid value for `job_config.dedup`: {!r}. Must be a "
+            "dictionary or `true`.".format(dedup_conf)
+        )
+
+    ttl_sec = dedup_conf.get("ttl_sec", DEFAULT_TTL_SEC)
+    max_size = dedup_conf.get("max_size", DEFAULT_MAX_SIZE)
+    for key, value in (("ttl_sec", ttl_sec), ("max_size", max_size)):
+        if not isinstance(value, (int, float)) or value <= 0:
+            raise _helpers.KlioConfigRuntimeError(
+                "Invalid value for `job_config.dedup.{}`: {!r}. Must be a "
+                "positive number.".format(key, value)
+            )
+
+    key_metadata = dedup_conf.get("key_metadata") or []
+    unknown = [f for f in key_metadata if f not in _METADATA_FIELDS]
+    if unknown:
+        raise _helpers.KlioConfigRuntimeError(
+            "Unknown KlioMessage metadata field(s) in "
+            "`job_config.dedup.key_metadata`: {}. Available fields: "
+            "{}.".format(", ".join(unknown), ", ".join(_METADATA_FIELDS))
+        )
+
+    bloom_capacity, bloom_error_rate = None, None
+    bloom_conf = dedup_conf.get("bloom_filter", False)
+    if bloom_conf:
+        if bloom_conf is True:
+            bloom_conf = {}
+        bloom_capacity = bloom_conf.get("capacity", 10 * max_size)
+        bloom_error_rate = bloom_conf.get(
+            "error_rate", DEFAULT_BLOOM_ERROR_RATE
+        )
+        if not 0 < bloom_error_rate < 1:
+            raise _helpers.KlioConfigRuntimeError(
+                "Invalid value for `job_config.dedup.bloom_filter."
+                "error_rate`: {!r}. Must be between 0 and 1.".format(
+                    bloom_error_rate
+                )
+            )
+
+    return DedupConfig(
+        ttl_sec=ttl_sec,
+        max_size=int(max_size),
+        key_metadata=tuple(key_metadata),
+        bloom_capacity=bloom_capacity,
+        bloom_error_rate=bloom_error_rate,
+    )
+
+
+def get_key(klio_message, key_metadata=()):
+    """Get the deduplication key of a message.
+
+    Args:
+        klio_message (KlioMessage or KlioMessageView): the message.
+        key_metadata (tuple(str)): names of ``KlioMessage.metadata``
+            fields to include in the key besides ``data.element``.
+    Returns:
+        bytes: a 16-byte digest identifying the message.
+    """
+    key = hashlib.blake2b(klio_message.data.element, digest_size=16)
+    metadata = klio_message.metadata
+    for field in key_metadata:
+        value = getattr(metadata, field)
+        if isinstance(value, bool):
+            key.update(b"\x01" if value else b"\x00")
+        elif hasattr(value, "SerializeToString"):
+            key.update(value.SerializeToString())
+        else:
+            for item in value:
+                key.update(item.SerializeToString())
+        # separate fields so that different values can't run together
+        key.update(b"\x1f")
+    return key.digest()
+
+
+class _BloomFilter(object):
+    """Fixed-size Bloom filter of 16-byte digests."""
+
+    def __init__(self, capacity, error_rate):
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self._num_bits = max(8, int(math.ceil(num_bits)))
+        self._num_hashes = max(
+            1, int(round(self._num_bits / capacity * math.log(2)))
+        )
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    def _indexes(self, digest):
+        # double hashing: derive all indexes from the two halves of the
+        # digest rather than hashing the key again
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self._num_hashes):
+            yield (h1 + i * h2) % self._num_bits
+
+    def add(self, digest):
+        for index in self._indexes(digest):
+            self._bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, digest):
+        return all(
+            self._bits[index >> 3] & (1 << (index & 7))
+            for index in self._indexes(digest)
+        )
+
+
+class DedupCache(object):
+    """Thread-safe cache of recently seen message keys.
+
+    Keys are remembered for ``ttl_sec`` seconds. At most ``max_size`` keys
+    are kept, evicting the oldest first.
+
+    With ``bloom_capacity`` set, keys evicted from the cache because it's
+    full are added to a Bloom filter, which keeps remembering them for
+    up to the TTL. A key the filter reports as seen is treated as a
+    duplicate, so up to ``bloom_error_rate`` of the messages not found in
+    the cache are wrongly treated as duplicates. Keys can't be removed
+    from the filter, so :meth:`forget` only forgets keys still in the
+    cache.
+
+    Args:
+        ttl_sec (float): how long to remember a key, in seconds.
+        max_size (int): maximum number of keys to remember exactly.
+        key_metadata (tuple(str)): names of ``KlioMessage.metadata``
+            fields included in the keys of messages; see
+            :func:`get_key`.
+        bloom_capacity (int): number of keys the Bloom filter is sized
+            for. ``None`` disables the filter.
+        bloom_error_rate (float): false positive rate of the Bloom
+            filter when holding ``bloom_capacity`` keys.
+    """
+
+    def __init__(
+        self,
+        ttl_sec,
+        max_size,
+        key_metadata=(),
+        bloom_capacity=None,
+        bloom_error_rate=None,
+    ):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.key_metadata = key_metadata
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._bloom_capacity = bloom_capacity
+        self._bloom_error_rate = bloom_error_rate
+        self._blooms = None
+        if bloom_capacity:
+            # keys are added to the newest of two filters, and both are
+            # rotated every half TTL, so a key is remembered for between
+            # half and the full TTL
+            self._blooms = [self._new_bloom(), self._new_bloom()]
+            self._bloom_rotate_at = time.monotonic() + ttl_sec / 2
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _new_bloom(self):
+        return _BloomFilter(self._bloom_capacity, self._bloom_error_rate)
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            _, expires_at = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            entries.popitem(last=False)
+
+        if self._blooms is not None and now >= self._bloom_rotate_at:
+            if now >= self._bloom_rotate_at + self.ttl_sec / 2:
+                # missed a rotation, so both filters are out of date
+                self._blooms = [self._new_bloom(), self._new_bloom()]
+            else:
+                self._blooms = [self._new_bloom(), self._blooms[0]]
+            self._bloom_rotate_at = now + self.ttl_sec / 2
+
+    def seen(self, key):
+        """Record a key, returning whether it was seen before.
+
+        Args:
+            key (bytes): a key from :func:`get_key`.
+        Returns:
+            bool: whether ``key`` was seen within the TTL.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                return True
+
+            seen = False
+            if self._blooms is not None:
+                seen = any(key in bloom for bloom in self._blooms)
+
+            # keys all have the same TTL, so insertion order is also the
+            # order in which they expire
+            self._entries[key] = now + self.ttl_sec
+            if len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                if self._blooms is not None:
+                    self._blooms[0].add(evicted)
+            return seen
+
+    def key(self, klio_message):
+        """Get the key of a message; see :func:`get_key`."""
+        return get_key(klio_message, self.key_metadata)
+
+    def forget(self, key):
+        """Forget a key, so that it's not seen again.
+
+        Args:
+            key (bytes): a key from :func:`get_key`.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def get_cache(dedup_config):
+    """Get the worker's deduplication cache.
+
+    Args:
+        dedup_config (DedupConfig): parsed ``job_config.dedup``.
+    Returns:
+        DedupCache: the worker's deduplication cache.
+    """
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = DedupCache(
+                    dedup_config.ttl_sec,
+                    dedup_config.max_size,
+                    key_metadata=dedup_config.key_metadata,
+                    bloom_capacity=dedup_config.bloom_capacity,
+                    bloom_error_rate=dedup_config.bloom_error_rate,
+                )
+    return _CACHE
+
+
+def skip(klio_message):
+    """Return whether a message is exempt from deduplication.
+
+    Messages in force or ping mode are explicitly requested again, so
+    they're always processed.
+
+    Args:
+        klio_message (KlioMessage or KlioMessageView): the message.
+    Returns:
+        bool: whether the message should not be deduplicated.
+    """
+    metadata = klio_message.metadata
+    return metadata.force or metadata.ping
+
+
+def key(klio_message):
+    """Get the key of a message, if messages are deduplicated.
+
+    Args:
+        klio_message (KlioMessage or KlioMessageView): the message.
+    Returns:
+        bytes: the message's key, or ``None`` if messages aren't
+        deduplicated in this worker.
+    """
+    cache = _CACHE
+    if cache is None:
+        return None
+    return cache.key(klio_message)
+
+
+def forget(key):
+    """Forget a message that wasn't processed.
+
+    Called when a job drops a message before processing it, or sends it
+    to an upstream job, so that the message isn't dropped as a duplicate
+    when it's received again.
+
+    Args:
+        key (bytes): key of the message from :func:`key`, or ``None``.
+    """
+    cache = _CACHE
+    if cache is not None and key is not None:
+        cache.forget(key)
@@ -0,0 +1,274 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Rate-limited logging of messages dropped by Klio's decorators.
+
+When a transform fails for many messages in a row, logging every drop
+with the full message and traceback can cost more than processing the
+messages themselves. Each decorated transform therefore gets a
+:class:`DropLogger` that logs at most ``max_per_interval`` drops per
+``interval_sec`` seconds, optionally samples the drops beyond that, and
+logs how many drops were not logged once the interval is over (or when
+the Python interpreter exits).
+
+Configured under ``job_config.drop_logging`` in ``klio-job.yaml``.
+"""
+
+import atexit
+import logging
+import random
+import threading
+import time
+import weakref
+
+
+DEFAULT_MAX_PER_INTERVAL = 10
+DEFAULT_INTERVAL_SEC = 60
+DEFAULT_SAMPLE_RATE = 0.0
+DEFAULT_MAX_SUMMARY_CHARS = 200
+
+_SUPPRESSED_MSG = (
+    "Dropped %d KlioMessage(s) in '%s' in the last %ds, %d of which were "
+    "not logged. Configure logging of dropped messages with "
+    "`job_config.drop_logging`."
+)
+
+# drop loggers with drops not logged yet, flushed at exit; a drop logger is
+# removed once they're logged
+_DROP_LOGGERS = weakref.WeakSet()
+
+
+def _truncate(value, max_chars):
+    if isinstance(value, (bytes, str)) and len(value) > max_chars:
+        return "{!r}... ({} total)".format(value[:max_chars], len(value))
+    value = repr(value)
+    if len(value) > max_chars:
+        return value[:max_chars] + "..."
+    return value
+
+
+class _MessageSummary(object):
+    """Short description of a dropped message.
+
+    Only rendered when a log record is actually emitted, so creating one
+    for a drop that isn't logged is cheap.
+    """
+
+    __slots__ = ("item", "max_chars")
+
+    def __init__(self, item, max_chars):
+        self.item = item
+        self.max_chars = max_chars
+
+    def __str__(self):
+        # KlioMessage & KlioMessageView
+        data = getattr(self.item, "data", None)
+        if data is None or not hasattr(data, "element"):
+            return _truncate(self.item, self.max_chars)
+
+        return "KlioMessage(element={}, payload={} bytes)".format(
+            _truncate(data.element, self.max_chars), len(data.payload)
+        )
+
+
+class DropLogger(object):
+    """Rate-limited, sampled logging of a transform's dropped messages.
+
+    Args:
+        transform (str): name of the transform dropping messages.
+        max_per_interval (int): number of drops to log per interval. A
+            negative value logs every drop.
+        interval_sec (int): length of an interval in seconds.
+        sample_rate (float): fraction of the drops beyond
+            ``max_per_interval`` that are still logged.
+        max_summary_chars (int): number of characters of a message's
+            element to include in a log line.
+    """
+
+    def __init__(
+        self,
+        transform,
+        max_per_interval=DEFAULT_MAX_PER_INTERVAL,
+        interval_sec=DEFAULT_INTERVAL_SEC,
+        sample_rate=DEFAULT_SAMPLE_RATE,
+        max_summary_chars=DEFAULT_MAX_SUMMARY_CHARS,
+    ):
+        self.transform = transform
+        self.max_per_interval = max_per_interval
+        self.interval_sec = interval_sec
+        self.sample_rate = sample_rate
+        self.max_summary_chars = max_summary_chars
+
+        self._lock = threading.Lock()
+        self._interval_start = time.monotonic()
+        self._dropped = 0
+        self._logged = 0
+        self._logger = None
+        self._timer = None
+
+    @classmethod
+    def from_config(cls, transform, drop_logging_conf):
+        """Create a drop logger from ``job_config.drop_logging``.
+
+        Args:
+            transform (str): name of the transform dropping messages.
+            drop_logging_conf (dict): ``job_config.drop_logging``.
+        Returns:
+            DropLogger: the transform's drop logger.
+        """
+        if not isinstance(drop_logging_conf, dict):
+            drop_logging_conf = {}
+
+        return cls(
+            transform,
+            max_per_interval=drop_logging_conf.get(
+                "max_per_interval", DEFAULT_MAX_PER_INTERVAL
+            ),
+            interval_sec=drop_logging_conf.get(
+                "interval_sec", DEFAULT_INTERVAL_SEC
+            ),
+            sample_rate=drop_logging_conf.get(
+                "sample_rate", DEFAULT_SAMPLE_RATE
+            ),
+            max_summary_chars=drop_logging_conf.get(
+                "max_summary_chars", DEFAULT_MAX_SUMMARY_CHARS
+            ),
+        )
+
+    def summary(self, item):
+        """Lazily summarize a dropped message for a log line.
+
+        Args:
+            item (KlioMessage, KlioMessageView, or bytes): the message.
+        Returns:
+            object: renders a truncated summary of ``item`` when
+                formatted with ``str``.
+        """
+        return _MessageSummary(item, self.max_summary_chars)
+
+    def _end_interval(self, now):
+        # Starts a new interval; returns the number of drops, logged drops,
+        # and seconds of the interval that ended. Must hold the lock.
+        ended = (
+            self._dropped,
+            self._logged,
+            min(now - self._interval_start, self.interval_sec),
+        )
+        self._interval_start = now
+        self._dropped = 0
+        self._logged = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        _DROP_LOGGERS.discard(self)
+        return ended
+
+    def _schedule_flush(self, now):
+        # Summarizes the suppressed drops once the interval is over, even if
+        # nothing else is dropped by then. Must hold the lock.
+        if self._timer is not None:
+            return
+        delay = max(self._interval_start + self.interval_sec - now, 0)
+        self._timer = threading.Timer(delay, self._flush_timer)
+        self._timer.daemon = True
+        self._timer.start()
+        _DROP_LOGGERS.add(self)
+
+    def _flush_timer(self):
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                # the interval was already ended by a drop or a flush
+                return
+            self._timer = None
+        self.flush()
+
+    def _should_log(self):
+        # Returns whether to log the current drop, and the number of drops,
+        # logged drops, and seconds of the interval that just ended (if any).
+        now = time.monotonic()
+        ended = None
+        with self._lock:
+            if now - self._interval_start >= self.interval_sec:
+                ended = self._end_interval(now)
+
+            self._dropped += 1
+            should_log = (
+                self.max_per_interval < 0
+                or self._logged < self.max_per_interval
+                or (
+                    self.sample_rate > 0 and random.random() < self.sample_rate
+                )
+            )
+            if should_log:
+                self._logged += 1
+            else:
+                self._schedule_flush(now)
+        return should_log, ended
+
+    def _log_suppressed(self, logger, ended):
+        dropped, logged, interval_sec = ended
+        if dropped > logged:
+            logger.warning(
+                _SUPPRESSED_MSG,
+                dropped,
+                self.transform,
+                interval_sec,
+                dropped - logged,
+            )
+
+    def flush(self):
+        """Log how many drops weren't logged, and start a new interval.
+
+        Called once an interval with drops that weren't logged is over,
+        and for every drop logger when the Python interpreter exits.
+        """
+        with self._lock:
+            logger = self._logger
+            ended = self._end_interval(time.monotonic())
+        if logger is not None:
+            self._log_suppressed(logger, ended)
+
+    def error(self, logger, msg, *args, exc_info=True):
+        """Log a dropped message at ``ERROR`` level, if not rate limited.
+
+        ``msg`` is only formatted when the record is emitted, so pass
+        message summaries from :meth:`summary` as ``args`` rather than
+        formatting them into ``msg``.
+
+        Args:
+            logger (logging.Logger): logger to log with.
+            msg (str): log message with ``%``-style placeholders.
+            args: values for the placeholders in ``msg``.
+            exc_info (bool): whether to include the exception's traceback.
+        """
+        if not logger.isEnabledFor(logging.ERROR):
+            return
+
+        self._logger = logger
+        should_log, ended = self._should_log()
+        if ended is not None:
+            self._log_suppressed(logger, ended)
+        if should_log:
+            logger.error(msg, *args, exc_info=exc_info)
+
+
+@atexit.register
+def shutdown():
+    """Log how many drops weren't logged for every drop logger.
+
+    Called when the Python interpreter exits, since the timers that
+    otherwise log them at the end of each interval don't outlive it.
+    """
+    for drop_log in list(_DROP_LOGGERS):
+        drop_log.flush()
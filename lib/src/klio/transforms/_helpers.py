@@ -73,10 +73,16 @@ def _wrap_process(meth):
     @functools.wraps(meth)
     def wrapper(self, incoming_item, *args, **kwargs):
         try:
-            kmsg = serializer.to_klio_message(
+            # data existence checks & ping/force filters only need a few
+            # fields, so don't bother decoding the whole message
+            kmsg = serializer.to_klio_message_view(
                 incoming_item, self._klio.config, self._klio.logger
             )
-            yield from meth(self, kmsg, *args, **kwargs)
+            for output in meth(self, kmsg, *args, **kwargs):
+                yield pvalue.TaggedOutput(
+                    output.tag,
+                    serializer._to_incoming_type(output.value, incoming_item),
+                )
 
         except Exception as err:
             self._klio.logger.error(
@@ -306,4 +312,4 @@ class _KlioGcsCheckExistsBase(
         )
 
         # double tag for easier user interface, i.e. pcoll.found vs pcoll.true
-        yield pvalue.TaggedOutput(state.value, kmsg.SerializeToString())
+        yield pvalue.TaggedOutput(state.value, kmsg)
@@ -0,0 +1,379 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Throughput, in-flight and thread limiter wait statistics per transform.
+
+Every transform decorated with ``@handle_klio`` keeps a
+:class:`TransformStats`, tracking how many messages it processed per
+second over a rolling window, how many messages it is processing right
+now, and how long it waited on its thread limiter, along with how many
+threads hold or wait for the limiter and its current limit. They're
+reported through the metrics relay clients as the ``kmsg-per-sec``,
+``kmsg-in-flight``, ``kmsg-thread-limiter-holders``,
+``kmsg-thread-limiter-queue`` and ``kmsg-thread-limiter-limit`` gauges
+and the ``kmsg-thread-limiter-wait`` histogram, and can be served as
+JSON from a local HTTP endpoint by setting
+``job_config.metrics.stats_port``.
+
+The gauges are refreshed every ``REPORT_INTERVAL_SEC`` from a background
+thread, so they stay current while a transform is idle or stalled. The
+JSON endpoint is served by the same HTTP server as Prometheus metrics
+(see :mod:`klio.metrics.prometheus`).
+"""
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from klio.metrics import dispatcher
+from klio.metrics import prometheus
+
+
+DEFAULT_WINDOW_SEC = 60
+REPORT_INTERVAL_SEC = 10
+
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+_REPORTER = None
+_UNIT_SCALES = dispatcher.TimerDispatcher.TIMER_UNIT_TO_NUMBER
+# thread limiter attribute -> metric name suffix
+_LIMITER_GAUGES = (
+    ("holders", "holders"),
+    ("waiting", "queue"),
+    ("limit", "limit"),
+)
+
+
+class TransformStats(object):
+    """Statistics of the messages processed by one transform.
+
+    Used as a context manager around the processing of each message, or
+    :meth:`batch` around the processing of a batch of messages.
+
+    Args:
+        transform (str): name of the transform.
+        rate_gauge (klio.metrics.dispatcher.GaugeDispatcher): gauge
+            reporting messages processed per second.
+        in_flight_gauge (klio.metrics.dispatcher.GaugeDispatcher): gauge
+            reporting messages currently being processed.
+        wait_histogram (klio.metrics.dispatcher.HistogramDispatcher):
+            histogram recording thread limiter wait times.
+        wait_scale (float): factor converting wait times from seconds to
+            the histogram's unit.
+        limiter_gauges (dict(str, klio.metrics.dispatcher.GaugeDispatcher)):
+            gauges reporting the ``holders``, ``waiting`` and ``limit`` of
+            the transform's thread limiter, keyed by attribute name.
+        window_sec (int): length of the rolling window throughput is
+            measured over, in seconds.
+    """
+
+    def __init__(
+        self,
+        transform,
+        rate_gauge=None,
+        in_flight_gauge=None,
+        wait_histogram=None,
+        wait_scale=1,
+        limiter_gauges=None,
+        window_sec=DEFAULT_WINDOW_SEC,
+    ):
+        self.transform = transform
+        self.window_sec = window_sec
+        self._rate_gauge = rate_gauge
+        self._in_flight_gauge = in_flight_gauge
+        self._wait_histogram = wait_histogram
+        self._wait_scale = wait_scale
+        self._limiter_gauges = limiter_gauges or {}
+        self._thread_limiter = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._processed = 0
+        self._wait_count = 0
+        self._wait_sec = 0.0
+        # messages processed per second, for the last `window_sec` whole
+        # seconds plus the current one
+        self._buckets = [0] * (window_sec + 1)
+        self._bucket_secs = [None] * (window_sec + 1)
+
+    def _start(self, count):
+        with self._lock:
+            self._in_flight += count
+
+    def _finish(self, count):
+        now = time.monotonic()
+        second = int(now)
+        index = second % len(self._buckets)
+        with self._lock:
+            self._in_flight -= count
+            self._processed += count
+            if self._bucket_secs[index] != second:
+                self._bucket_secs[index] = second
+                self._buckets[index] = 0
+            self._buckets[index] += count
+
+    def __enter__(self):
+        self._start(1)
+        return self
+
+    def __exit__(self, *args):
+        self._finish(1)
+
+    @contextlib.contextmanager
+    def batch(self, count):
+        """Track the processing of a batch of messages.
+
+        Each message of the batch is counted as in flight, and then as
+        processed, as if it was processed on its own.
+
+        Args:
+            count (int): number of messages in the batch.
+        """
+        self._start(count)
+        try:
+            yield self
+        finally:
+            self._finish(count)
+
+    def track_limiter(self, thread_limiter):
+        """Report the state of the transform's thread limiter.
+
+        Args:
+            thread_limiter (klio.utils.ThreadLimiter): the limiter.
+        """
+        self._thread_limiter = thread_limiter
+
+    def _limiter_state(self):
+        limiter = self._thread_limiter
+        if limiter is None:
+            return {}
+        return {
+            attr: getattr(limiter, attr)
+            for attr in ("holders", "waiting", "limit")
+        }
+
+    def record_wait(self, wait_sec):
+        """Record how long the thread limiter was waited on.
+
+        Args:
+            wait_sec (float): seconds waited.
+        """
+        with self._lock:
+            self._wait_count += 1
+            self._wait_sec += wait_sec
+        if self._wait_histogram is not None:
+            self._wait_histogram.record(wait_sec * self._wait_scale)
+
+    @property
+    def in_flight(self):
+        """int: Messages currently being processed."""
+        return self._in_flight
+
+    def rate(self, now=None):
+        """Messages processed per second over the rolling window.
+
+        Only whole seconds are counted, so the current second isn't.
+
+        Args:
+            now (float): current :func:`time.monotonic` time.
+        Returns:
+            float: messages per second.
+        """
+        if now is None:
+            now = time.monotonic()
+        current = int(now)
+        oldest = current - self.window_sec
+        with self._lock:
+            processed = sum(
+                count
+                for count, second in zip(self._buckets, self._bucket_secs)
+                if second is not None and oldest <= second < current
+            )
+        return processed / self.window_sec
+
+    def report(self):
+        """Set the relay clients' gauges to the current statistics."""
+        if self._rate_gauge is not None:
+            self._rate_gauge.set(self.rate())
+        if self._in_flight_gauge is not None:
+            self._in_flight_gauge.set(self.in_flight)
+        for attr, value in self._limiter_state().items():
+            gauge = self._limiter_gauges.get(attr)
+            # an unlimited limiter has no limit
+            if gauge is not None and value is not None:
+                gauge.set(value)
+
+    def to_dict(self):
+        """Return the statistics as a JSON-serializable dictionary."""
+        rate = self.rate()
+        with self._lock:
+            stats = {
+                "msgs_per_sec": rate,
+                "in_flight": self._in_flight,
+                "processed": self._processed,
+                "thread_limiter_waits": self._wait_count,
+                "thread_limiter_wait_sec": self._wait_sec,
+            }
+        for attr, value in self._limiter_state().items():
+            stats["thread_limiter_{}".format(attr)] = value
+        return stats
+
+
+class WaitTimedLimiter(object):
+    """Thread limiter recording acquire wait times to a transform's stats.
+
+    Args:
+        thread_limiter (klio.utils.ThreadLimiter): the limiter to wrap.
+        stats (TransformStats): stats to record wait times to.
+    """
+
+    def __init__(self, thread_limiter, stats):
+        self.thread_limiter = thread_limiter
+        self.stats = stats
+        stats.track_limiter(thread_limiter)
+
+    def acquire(self, weight=1):
+        start = time.monotonic()
+        self.thread_limiter.acquire(weight)
+        self.stats.record_wait(time.monotonic() - start)
+
+    def release(self, weight=1):
+        self.thread_limiter.release(weight)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def get_stats(transform, metrics=None, timer_unit="ns"):
+    """Get or create the stats of a transform.
+
+    Args:
+        transform (str): name of the transform.
+        metrics (klio.metrics.client.MetricsRegistry): registry to create
+            the stats' metrics with.
+        timer_unit (str): unit of thread limiter wait times.
+    Returns:
+        TransformStats: the transform's stats.
+    """
+    with _STATS_LOCK:
+        stats = _STATS.get(transform)
+        if stats is None:
+            kwargs = {}
+            if metrics is not None:
+                kwargs = {
+                    "rate_gauge": metrics.gauge(
+                        "kmsg-per-sec", transform=transform
+                    ),
+                    "in_flight_gauge": metrics.gauge(
+                        "kmsg-in-flight", transform=transform
+                    ),
+                    "wait_histogram": metrics.histogram(
+                        "kmsg-thread-limiter-wait",
+                        transform=transform,
+                        timer_unit=timer_unit,
+                    ),
+                    "wait_scale": _UNIT_SCALES.get(timer_unit, 1e9),
+                    "limiter_gauges": {
+                        attr: metrics.gauge(
+                            "kmsg-thread-limiter-{}".format(name),
+                            transform=transform,
+                        )
+                        for attr, name in _LIMITER_GAUGES
+                    },
+                }
+            stats = _STATS[transform] = TransformStats(transform, **kwargs)
+            if metrics is not None:
+                _get_or_create_reporter()
+    return stats
+
+
+class _Reporter(object):
+    """Background thread periodically reporting the stats of all transforms.
+
+    Args:
+        interval_sec (float): seconds between reports.
+    """
+
+    def __init__(self, interval_sec=REPORT_INTERVAL_SEC):
+        self.interval_sec = interval_sec
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="KlioTransformStatsReporter", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_sec):
+            self.report()
+
+    def report(self):
+        with _STATS_LOCK:
+            all_stats = list(_STATS.values())
+        for stats in all_stats:
+            try:
+                stats.report()
+            except Exception as e:
+                logging.getLogger("klio.metrics").warning(
+                    "Error reporting stats of '{}': {}".format(
+                        stats.transform, e
+                    )
+                )
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+def _get_or_create_reporter():
+    # only called while holding `_STATS_LOCK`
+    global _REPORTER
+    if _REPORTER is None:
+        _REPORTER = _Reporter()
+    return _REPORTER
+
+
+def snapshot():
+    """Return the stats of all transforms, keyed by transform name."""
+    with _STATS_LOCK:
+        all_stats = list(_STATS.values())
+    return {stats.transform: stats.to_dict() for stats in all_stats}
+
+
+def _render_snapshot():
+    return json.dumps(snapshot()).encode("utf-8")
+
+
+def start_server(port, host=""):
+    """Serve the stats of all transforms as JSON over HTTP.
+
+    The stats are served at ``/`` and ``/stats`` by the worker's metrics
+    HTTP server (see :func:`klio.metrics.prometheus.start_server`), which
+    is started on ``port`` unless it's already running.
+
+    Args:
+        port (int): port to listen on. ``0`` picks a free port.
+        host (str): address to listen on. Defaults to all interfaces.
+    Returns:
+        http.server.ThreadingHTTPServer: the server, or ``None`` if it
+        couldn't be started.
+    """
+    for path in ("/", "/stats"):
+        prometheus.add_route(path, "application/json", _render_snapshot)
+    return prometheus.start_server(port, host=host)
@@ -21,8 +21,10 @@ from klio_core import variables as kvars
 from klio_core.proto import klio_pb2
 
 from klio.metrics import client as metrics_client
+from klio.metrics import dispatcher as metrics_dispatcher
 from klio.metrics import logger as metrics_logger
 from klio.metrics import native as native_metrics
+from klio.metrics import prometheus
 from klio.metrics import shumway
 
 
@@ -115,8 +117,23 @@ class KlioContext(object):
             shumway_client = shumway.ShumwayMetricsClient(self.config)
             clients.append(shumway_client)
 
+        # prometheus is only used when turned on (`True` or a dict of
+        # configured values), regardless of runner
+        use_prometheus = metrics_config.get("prometheus")
+        if use_prometheus is not None and use_prometheus is not False:
+            prometheus_client = prometheus.PrometheusMetricsClient(self.config)
+            clients.append(prometheus_client)
+
+        # must be configured before the registry creates any dispatchers
+        metrics_dispatcher.configure_emitter(
+            max_queue_size=metrics_config.get("max_queue_size"),
+            overflow_policy=metrics_config.get("overflow_policy"),
+        )
         return metrics_client.MetricsRegistry(
-            clients, transform_name=self._transform_name
+            clients,
+            transform_name=self._transform_name,
+            flush_interval_sec=metrics_config.get("flush_interval_sec"),
+            aggregate=metrics_config.get("aggregate") is True,
         )
 
     @property
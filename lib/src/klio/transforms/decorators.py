@@ -19,59 +19,76 @@ import functools
 import inspect
 import os
 import threading
+import time
 import types
 
 import apache_beam as beam
 from apache_beam import pvalue
+from apache_beam.utils import windowed_value
 
 from klio import utils as kutils
 from klio.message import pubsub_message_manager as pmsg_mgr
 from klio.message import serializer
+from klio.transforms import _drop_log
 from klio.transforms import _retry as kretry
+from klio.transforms import _stats
 from klio.transforms import _timeout as ktimeout
 from klio.transforms import _utils as txf_utils
 from klio.transforms import core
 
 
 _ERROR_MSG_KMSG_FROM_BYTES = (
-    "Dropping KlioMessage - exception occurred when serializing '{}' "
+    "Dropping KlioMessage - exception occurred when serializing '%s' "
     "from bytes to a KlioMessage.\n"
-    "Error: {}"
+    "Error: %s"
 )
 _ERROR_MSG_KMSG_TO_BYTES = (
-    "Dropping KlioMessage - exception occurred when deserializing '{}' "
+    "Dropping KlioMessage - exception occurred when deserializing '%s' "
     "from a KlioMessage to bytes.\n"
-    "Error: {}"
+    "Error: %s"
+)
+_ERROR_MSG_USER = (
+    "Dropping KlioMessage - exception occurred when calling '%s' with "
+    "'%s'.\nError: %s%s"
 )
 _CACHED_INSTANCES = collections.defaultdict(set)
 MetricsObjects = collections.namedtuple(
-    "MetricsObjects", ["received", "success", "error", "timer"]
+    "MetricsObjects",
+    ["received", "success", "error", "timer", "drop_log", "stats"],
+)
+_BatchedItem = collections.namedtuple(
+    "_BatchedItem", ["incoming_item", "kmsg", "timestamp", "window"]
 )
 
 
 class ThreadLimitGenerator(object):
     """A Generator that wraps another generator with thread-limiting.  The lock
     is acquired once upon instantiation and held for all items returned by the
-    wrapped generator.  This very specific behavior is only intended to be used
-    in the @handle_klio decorator to wrap generators returned by DoFn process
-    method.
+    wrapped generator.  It's released as soon as the wrapped generator is
+    exhausted or raises, or when this generator is closed (e.g. when Beam
+    abandons it); garbage collection only releases it as a last resort.  This
+    very specific behavior is only intended to be used in the @handle_klio
+    decorator to wrap generators returned by DoFn process method.
     """
 
+    thread_limiter = None
+
     def __init__(self, thread_limiter, inner_generator):
-        self.thread_limiter = thread_limiter
         self.inner_generator = inner_generator
-        self.thread_limiter.acquire()
+        thread_limiter.acquire()
+        # only set once acquired, so it's never released otherwise
+        self.thread_limiter = thread_limiter
 
     def __iter__(self):
         return self
 
     def __del__(self):
-        self._release()
+        self.close()
 
     def _release(self):
-        if self.thread_limiter is not None:
-            self.thread_limiter.release()
-            self.thread_limiter = None
+        thread_limiter, self.thread_limiter = self.thread_limiter, None
+        if thread_limiter is not None:
+            thread_limiter.release()
 
     def __next__(self):
         try:
@@ -82,6 +99,31 @@ class ThreadLimitGenerator(object):
             self._release()
             raise
 
+    def close(self):
+        """Close the wrapped generator and release the thread limiter."""
+        try:
+            close = getattr(self.inner_generator, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+
+class _NoThreadLimit(object):
+    """Stand-in for a thread limiter that's applied elsewhere."""
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
 
 # TODO: This may be nice to make generic and move into the public helpers
 # module since users may want to use something like this.
@@ -135,14 +177,27 @@ def __is_method(obj):
     return False
 
 
-def __is_dofn_process_method(self, meth):
-    if meth.__name__ == "process":
-        if issubclass(self.__class__, beam.DoFn):
-            return True
-    return False
+def __dofn_process_method_checker(meth):
+    # Returns a callable that checks whether `meth` is used as the process
+    # method of a DoFn. The same decorated method may be bound to different
+    # classes, so the result is cached per class.
+    if meth.__name__ != "process":
+        return lambda self: False
 
+    is_dofn_by_class = {}
 
-def __get_user_error_message(err, func_path, kmsg):
+    def is_dofn_process_method(self):
+        cls = self.__class__
+        try:
+            return is_dofn_by_class[cls]
+        except KeyError:
+            is_dofn = is_dofn_by_class[cls] = issubclass(cls, beam.DoFn)
+            return is_dofn
+
+    return is_dofn_process_method
+
+
+def __log_user_error(metrics, logger, err, func_path, kmsg):
     tb, exc_info = "", True
 
     if hasattr(err, "_klio_traceback"):
@@ -153,11 +208,21 @@ def __get_user_error_message(err, func_path, kmsg):
         # no need to include traceback of a timeout error
         exc_info = False
 
-    msg = (
-        "Dropping KlioMessage - exception occurred when calling '%s' with "
-        "'%s'.\nError: %s%s" % (func_path, kmsg, err, tb)
+    drop_log = metrics.drop_log
+    drop_log.error(
+        logger,
+        _ERROR_MSG_USER,
+        func_path,
+        drop_log.summary(kmsg),
+        err,
+        tb,
+        exc_info=exc_info,
     )
-    return msg, exc_info
+
+
+def __log_serialization_error(metrics, logger, msg, item, err):
+    drop_log = metrics.drop_log
+    drop_log.error(logger, msg, drop_log.summary(item), err)
 
 
 def __get_thread_limiter(max_thread_count, thread_limiter, func_name=None):
@@ -210,6 +275,35 @@ def __get_thread_limiter(max_thread_count, thread_limiter, func_name=None):
     return thread_limiter
 
 
+def __release_when_done(generator, thread_limiter, weight):
+    try:
+        yield from generator
+    finally:
+        thread_limiter.release(weight)
+
+
+def __limit_by_cost(func_or_meth, thread_limiter, cost, generator=False):
+    # The cost of a message is only known once it's deserialized, so rather
+    # than around the whole handling of a message, the limiter is held
+    # around the call of the decorated function/method - and, for a DoFn's
+    # process method (`generator=True`), while what it yields is consumed.
+    @functools.wraps(func_or_meth)
+    def wrapper(ctx_or_self, item, *args, **kwargs):
+        weight = cost(item)
+        thread_limiter.acquire(weight)
+        try:
+            ret = func_or_meth(ctx_or_self, item, *args, **kwargs)
+        except BaseException:
+            thread_limiter.release(weight)
+            raise
+        if generator and isinstance(ret, types.GeneratorType):
+            return __release_when_done(ret, thread_limiter, weight)
+        thread_limiter.release(weight)
+        return ret
+
+    return wrapper
+
+
 def __ack_pubsub_if_direct_gke(kmsg_or_bytes, ctx):
     # TODO: update me to `var.KlioRunner.DIRECT_GKE_RUNNER` once
     #       direct_on_gke_runner_clean is merged
@@ -225,11 +319,11 @@ def __ack_pubsub_if_direct_gke(kmsg_or_bytes, ctx):
 # yields)
 def __from_klio_message_generator(metrics, self, kmsg, payload, orig_item):
     try:
-        yield serializer.from_klio_message(kmsg, payload)
+        yield serializer.from_klio_message(kmsg, payload, self._klio.config)
 
     except Exception as err:
-        self._klio.logger.error(
-            _ERROR_MSG_KMSG_TO_BYTES.format(kmsg, err), exc_info=True
+        __log_serialization_error(
+            metrics, self._klio.logger, _ERROR_MSG_KMSG_TO_BYTES, kmsg, err
         )
         metrics.error.inc()
         __ack_pubsub_if_direct_gke(kmsg, self._klio)
@@ -258,15 +352,18 @@ def __serialize_klio_message_generator(
     metrics, self, meth, incoming_item, *args, **kwargs
 ):
     metrics.received.inc()
-    with metrics.timer:
+    with metrics.stats, metrics.timer:
         try:
             kmsg = serializer.to_klio_message(
                 incoming_item, self._klio.config, self._klio.logger
             )
         except Exception as err:
-            self._klio.logger.error(
-                _ERROR_MSG_KMSG_FROM_BYTES.format(incoming_item, err),
-                exc_info=True,
+            __log_serialization_error(
+                metrics,
+                self._klio.logger,
+                _ERROR_MSG_KMSG_FROM_BYTES,
+                incoming_item,
+                err,
             )
             metrics.error.inc()
             __ack_pubsub_if_direct_gke(incoming_item, self._klio)
@@ -286,8 +383,7 @@ def __serialize_klio_message_generator(
 
         except Exception as err:
             func_path = self.__class__.__name__ + "." + meth.__name__
-            log_msg, exc_info = __get_user_error_message(err, func_path, kmsg)
-            self._klio.logger.error(log_msg, exc_info=exc_info)
+            __log_user_error(metrics, self._klio.logger, err, func_path, kmsg)
             metrics.error.inc()
             __ack_pubsub_if_direct_gke(kmsg, self._klio)
             # Since the yielded value in the `try` clause is not tagged, that
@@ -314,10 +410,9 @@ def __serialize_klio_message_generator(
                 # if the pl item is an Exception
                 except Exception as err:
                     func_path = self.__class__.__name__ + "." + meth.__name__
-                    log_msg, exc_info = __get_user_error_message(
-                        err, func_path, kmsg
+                    __log_user_error(
+                        metrics, self._klio.logger, err, func_path, kmsg
                     )
-                    self._klio.logger.error(log_msg, exc_info=exc_info)
                     metrics.error.inc()
                     __ack_pubsub_if_direct_gke(kmsg, self._klio)
                     # This will catch an exception present in the generator
@@ -349,15 +444,18 @@ def __serialize_klio_message(
     if not isinstance(ctx, core.KlioContext):
         ctx = _self._klio
 
-    with metrics.timer:
+    with metrics.stats, metrics.timer:
         try:
             kmsg = serializer.to_klio_message(
                 incoming_item, ctx.config, ctx.logger
             )
         except Exception as err:
-            ctx.logger.error(
-                _ERROR_MSG_KMSG_FROM_BYTES.format(incoming_item, err),
-                exc_info=True,
+            __log_serialization_error(
+                metrics,
+                ctx.logger,
+                _ERROR_MSG_KMSG_FROM_BYTES,
+                incoming_item,
+                err,
             )
             metrics.error.inc()
             __ack_pubsub_if_direct_gke(incoming_item, ctx)
@@ -384,10 +482,7 @@ def __serialize_klio_message(
             raise
 
         except Exception as err:
-            log_msg, exc_info = __get_user_error_message(
-                err, func.__name__, kmsg
-            )
-            ctx.logger.error(log_msg, exc_info=exc_info)
+            __log_user_error(metrics, ctx.logger, err, func.__name__, kmsg)
             metrics.error.inc()
             __ack_pubsub_if_direct_gke(kmsg, ctx)
             # Since the returned value in the `try` clause is not tagged, that
@@ -401,13 +496,13 @@ def __serialize_klio_message(
             return pvalue.TaggedOutput("drop", incoming_item)
 
         try:
-            to_ret = serializer.from_klio_message(kmsg, ret)
+            to_ret = serializer.from_klio_message(kmsg, ret, ctx.config)
             metrics.success.inc()
             return to_ret
 
         except Exception as err:
-            ctx.logger.error(
-                _ERROR_MSG_KMSG_TO_BYTES.format(kmsg, err), exc_info=True
+            __log_serialization_error(
+                metrics, ctx.logger, _ERROR_MSG_KMSG_TO_BYTES, kmsg, err
             )
             metrics.error.inc()
             __ack_pubsub_if_direct_gke(kmsg, ctx)
@@ -464,48 +559,53 @@ def __get_transform_metrics(func_name, kctx=None):
     received_ctr = kctx.metrics.counter("kmsg-received", transform=func_name)
     success_ctr = kctx.metrics.counter("kmsg-success", transform=func_name)
     drop_err_ctr = kctx.metrics.counter("kmsg-drop-error", transform=func_name)
-    msg_timer = kctx.metrics.timer(
+    msg_timer = kctx.metrics.histogram(
         "kmsg-timer", transform=func_name, timer_unit=timer_unit
     )
-    return MetricsObjects(received_ctr, success_ctr, drop_err_ctr, msg_timer)
+    drop_log = _drop_log.DropLogger.from_config(
+        func_name, kctx.config.job_config.drop_logging
+    )
+    stats = _stats.get_stats(func_name, kctx.metrics, timer_unit)
+    if isinstance(metrics_conf, dict):
+        stats_port = metrics_conf.get("stats_port")
+        if stats_port is not None:
+            _stats.start_server(stats_port)
+    return MetricsObjects(
+        received_ctr, success_ctr, drop_err_ctr, msg_timer, drop_log, stats
+    )
 
 
 def _serialize_klio_message(func_or_meth):
     func_name = getattr(func_or_meth, "__qualname__", func_or_meth.__name__)
     metrics_objs = __get_transform_metrics(func_name)
 
+    if not __is_method(func_or_meth):
+
+        @functools.wraps(func_or_meth)
+        def func_wrapper(klio_ns, incoming_item, *args, **kwargs):
+            return __serialize_klio_message(
+                metrics_objs,
+                klio_ns,
+                func_or_meth,
+                incoming_item,
+                *args,
+                **kwargs,
+            )
+
+        return func_wrapper
+
+    is_process_method = __dofn_process_method_checker(func_or_meth)
+
     @functools.wraps(func_or_meth)
     def method_wrapper(self, incoming_item, *args, **kwargs):
         wrapper = __serialize_klio_message
-        wrapper_kwargs = {
-            "ctx": self,
-            "func": func_or_meth,
-            "incoming_item": incoming_item,
-            "metrics": metrics_objs,
-        }
-        if __is_dofn_process_method(self, func_wrapper):
+        if is_process_method(self):
             wrapper = __serialize_klio_message_generator
-            wrapper_kwargs = {
-                "self": self,
-                "meth": func_or_meth,
-                "incoming_item": incoming_item,
-                "metrics": metrics_objs,
-            }
-        return wrapper(*args, **wrapper_kwargs, **kwargs)
-
-    @functools.wraps(func_or_meth)
-    def func_wrapper(klio_ns, incoming_item, *args, **kwargs):
-        wrapper_kwargs = {
-            "ctx": klio_ns,
-            "func": func_or_meth,
-            "incoming_item": incoming_item,
-            "metrics": metrics_objs,
-        }
-        return __serialize_klio_message(*args, **wrapper_kwargs, **kwargs)
+        return wrapper(
+            metrics_objs, self, func_or_meth, incoming_item, *args, **kwargs
+        )
 
-    if __is_method(func_or_meth):
-        return method_wrapper
-    return func_wrapper
+    return method_wrapper
 
 
 def _set_klio_context(method):
@@ -535,7 +635,17 @@ def _inject_klio_context(func_or_meth):
     return func_wrapper
 
 
-def _handle_klio(*args, max_thread_count=None, thread_limiter=None, **kwargs):
+def _handle_klio(
+    *args, max_thread_count=None, thread_limiter=None, cost=None, **kwargs
+):
+    if cost is not None and not callable(cost):
+        # raise a runtime error so it actually crashes klio/beam rather than
+        # just continue processing elements
+        raise RuntimeError(
+            "Invalid type for handle_klio's argument 'cost'. Expected a "
+            "callable returning a number, got `%s`." % type(cost).__name__
+        )
+
     def inner(func_or_meth):
         func_name = getattr(
             func_or_meth, "__qualname__", func_or_meth.__name__
@@ -549,63 +659,83 @@ def _handle_klio(*args, max_thread_count=None, thread_limiter=None, **kwargs):
             kctx = ctx
 
         metrics_objs = __get_transform_metrics(func_name, kctx)
+        thd_limiter = _stats.WaitTimedLimiter(thd_limiter, metrics_objs.stats)
+
+        # With a cost, the limiter is acquired with the cost of each message
+        # by the wrapped function/method itself instead.
+        limited = process_limited = func_or_meth
+        if cost is not None:
+            limited = __limit_by_cost(func_or_meth, thd_limiter, cost)
+            process_limited = __limit_by_cost(
+                func_or_meth, thd_limiter, cost, generator=True
+            )
+            thd_limiter = _NoThreadLimit()
 
-        @functools.wraps(func_or_meth)
-        def method_wrapper(self, *args, **kwargs):
-            setattr(self, "_klio", kctx)
+        # The call shape (function vs method, DoFn.process vs any other
+        # method) is worked out here once rather than for every element.
+        if not __is_method(func_or_meth):
+
+            @functools.wraps(func_or_meth)
+            def func_wrapper(incoming_item, *args, **kwargs):
+                with thd_limiter:
+                    return __serialize_klio_message(
+                        metrics_objs,
+                        kctx,
+                        limited,
+                        incoming_item,
+                        *args,
+                        **kwargs,
+                    )
+
+            return func_wrapper
+
+        # SO. HACKY. We check to see if this method is named "expand"
+        # to designate  if the class is a Composite-type transform
+        # (rather than a DoFn with a "process" method).
+        # A Composite transform handles a pcoll / pipeline,
+        # not the individual elements, and therefore doesn't need
+        # to be given a KlioMessage. It should only need the KlioContext
+        # attached.
+        if func_or_meth.__name__ == "expand":
 
-            # SO. HACKY. We check to see if this method is named "expand"
-            # to designate  if the class is a Composite-type transform
-            # (rather than a DoFn with a "process" method).
-            # A Composite transform handles a pcoll / pipeline,
-            # not the individual elements, and therefore doesn't need
-            # to be given a KlioMessage. It should only need the KlioContext
-            # attached.
-            if func_or_meth.__name__ == "expand":
+            @functools.wraps(func_or_meth)
+            def expand_wrapper(self, *args, **kwargs):
+                setattr(self, "_klio", kctx)
                 return func_or_meth(self, *args, **kwargs)
 
-            incoming_item = args[0]
-            args = args[1:]
-
-            # Only the process method of a DoFn is a generator - otherwise
-            # beam can't pickle a generator
-            if __is_dofn_process_method(self, func_or_meth):
-                wrapper = __serialize_klio_message_generator
-                wrapper_kwargs = {
-                    "self": self,
-                    "meth": func_or_meth,
-                    "incoming_item": incoming_item,
-                    "metrics": metrics_objs,
-                }
-                result = wrapper(*args, **wrapper_kwargs, **kwargs)
-                return ThreadLimitGenerator(thd_limiter, result)
-            else:
-                wrapper = __serialize_klio_message
-                wrapper_kwargs = {
-                    "ctx": self,
-                    "func": func_or_meth,
-                    "incoming_item": incoming_item,
-                    "metrics": metrics_objs,
-                }
-                with thd_limiter:
-                    return wrapper(*args, **wrapper_kwargs, **kwargs)
+            return expand_wrapper
+
+        # Only the process method of a DoFn is a generator - otherwise
+        # beam can't pickle a generator
+        is_process_method = __dofn_process_method_checker(func_or_meth)
 
         @functools.wraps(func_or_meth)
-        def func_wrapper(incoming_item, *args, **kwargs):
+        def method_wrapper(self, incoming_item, *args, **kwargs):
+            if getattr(self, "_klio", None) is not kctx:
+                setattr(self, "_klio", kctx)
+
+            if is_process_method(self):
+                result = __serialize_klio_message_generator(
+                    metrics_objs,
+                    self,
+                    process_limited,
+                    incoming_item,
+                    *args,
+                    **kwargs,
+                )
+                return ThreadLimitGenerator(thd_limiter, result)
+
             with thd_limiter:
-                wrapper_kwargs = {
-                    "ctx": kctx,
-                    "func": func_or_meth,
-                    "incoming_item": incoming_item,
-                    "metrics": metrics_objs,
-                }
                 return __serialize_klio_message(
-                    *args, **wrapper_kwargs, **kwargs
+                    metrics_objs,
+                    self,
+                    limited,
+                    incoming_item,
+                    *args,
+                    **kwargs,
                 )
 
-        if __is_method(func_or_meth):
-            return method_wrapper
-        return func_wrapper
+        return method_wrapper
 
     # allows @handle_klio to be used without parens (i.e. no need to do
     # `@handle_klio()`) when there are no args/kwargs provided
@@ -614,6 +744,261 @@ def _handle_klio(*args, max_thread_count=None, thread_limiter=None, **kwargs):
     return inner
 
 
+class _KlioBatchProcessMethod(object):
+    """Descriptor for a DoFn ``process`` method decorated with
+    ``@handle_klio_batch``.
+
+    Messages buffered by ``process`` that haven't been handed to the user's
+    method yet need to be flushed at the end of a bundle. Since Beam looks
+    up ``start_bundle`` and ``finish_bundle`` on the DoFn class, they're
+    wrapped once the decorated method is bound to its class, and again
+    whenever a subclass overrides them, so that an override not calling
+    ``super()`` doesn't lose the last batch of a bundle.
+    """
+
+    def __init__(self, process, start_batch, flush_batch):
+        self._process = process
+        self._start_batch = start_batch
+        self._flush_batch = flush_batch
+
+    def __set_name__(self, owner, name):
+        if name != "process" or not issubclass(owner, beam.DoFn):
+            # raise a runtime error so it actually crashes klio/beam rather
+            # than just continue processing elements
+            raise RuntimeError(
+                "The `handle_klio_batch` decorator can only be used on the "
+                "`process` method of a `beam.DoFn`, not on '{}.{}'.".format(
+                    owner.__name__, name
+                )
+            )
+
+        self._wrap_bundle_methods(owner, force=True)
+
+        wrap_bundle_methods = self._wrap_bundle_methods
+        init_subclass = owner.__dict__.get("__init_subclass__")
+
+        def __init_subclass__(cls, **kwargs):
+            if init_subclass is not None:
+                init_subclass.__get__(None, cls)(**kwargs)
+            else:
+                super(owner, cls).__init_subclass__(**kwargs)
+            wrap_bundle_methods(cls)
+
+        owner.__init_subclass__ = classmethod(__init_subclass__)
+
+    def _wrap_bundle_methods(self, cls, force=False):
+        # Wraps the bundle methods of `cls`; unless `force`d, only those
+        # `cls` overrides that aren't wrapped already.
+        start_batch = self._start_batch
+        flush_batch = self._flush_batch
+
+        def needs_wrapping(name):
+            if force:
+                return True
+            method = cls.__dict__.get(name)
+            return method is not None and not getattr(
+                method, "_klio_batch_wrapper", False
+            )
+
+        if needs_wrapping("start_bundle"):
+            start_bundle = cls.start_bundle
+
+            @functools.wraps(start_bundle)
+            def start_bundle_wrapper(self):
+                start_batch(self)
+                return start_bundle(self)
+
+            start_bundle_wrapper._klio_batch_wrapper = True
+            cls.start_bundle = start_bundle_wrapper
+
+        if needs_wrapping("finish_bundle"):
+            finish_bundle = cls.finish_bundle
+
+            @functools.wraps(finish_bundle)
+            def finish_bundle_wrapper(self):
+                # a no-op when an override calls the wrapped `super()` one
+                yield from flush_batch(self)
+                outputs = finish_bundle(self)
+                if outputs is not None:
+                    yield from outputs
+
+            finish_bundle_wrapper._klio_batch_wrapper = True
+            cls.finish_bundle = finish_bundle_wrapper
+
+    def __get__(self, instance, owner=None):
+        return self._process.__get__(instance, owner)
+
+
+def __drop_batched_item(metrics, self, item):
+    __ack_pubsub_if_direct_gke(item.kmsg, self._klio)
+    metrics.error.inc()
+    return __window_batched_output(
+        pvalue.TaggedOutput("drop", item.incoming_item), item
+    )
+
+
+def __window_batched_output(output, item):
+    # Outputs of a batch are yielded for the element that was last received
+    # (or from `finish_bundle`), so they need to carry their own timestamp &
+    # window
+    if isinstance(output, pvalue.TaggedOutput):
+        return pvalue.TaggedOutput(
+            output.tag, __window_batched_output(output.value, item)
+        )
+    return windowed_value.WindowedValue(output, item.timestamp, (item.window,))
+
+
+def __process_klio_batch(metrics, thread_limiter, self, meth, batch):
+    func_path = self.__class__.__name__ + "." + meth.__name__
+    # each message of the batch is counted, as on its own with @handle_klio
+    with metrics.stats.batch(len(batch)):
+        try:
+            with metrics.timer:
+                with thread_limiter:
+                    payloads = meth(self, [item.kmsg.data for item in batch])
+                payloads = list(payloads or [])
+            if len(payloads) != len(batch):
+                raise ValueError(
+                    "Expected one result per message, got {} results for {} "
+                    "messages.".format(len(payloads), len(batch))
+                )
+
+        except Exception as err:
+            for item in batch:
+                __log_user_error(
+                    metrics, self._klio.logger, err, func_path, item.kmsg
+                )
+                yield __drop_batched_item(metrics, self, item)
+            return
+
+        for item, payload in zip(batch, payloads):
+            if isinstance(payload, Exception):
+                # the user's method failed for just this message
+                __log_user_error(
+                    metrics, self._klio.logger, payload, func_path, item.kmsg
+                )
+                yield __drop_batched_item(metrics, self, item)
+                continue
+
+            outputs = __from_klio_message_generator(
+                metrics, self, item.kmsg, payload, item.incoming_item
+            )
+            for output in outputs:
+                yield __window_batched_output(output, item)
+
+
+def _handle_klio_batch(
+    *args,
+    max_batch_size=None,
+    max_wait_ms=None,
+    max_thread_count=None,
+    thread_limiter=None,
+    **kwargs
+):
+    if max_batch_size is None:
+        max_batch_size = 100
+
+    if not isinstance(max_batch_size, int) or max_batch_size < 1:
+        # raise a runtime error so it actually crashes klio/beam rather than
+        # just continue processing elements
+        raise RuntimeError(
+            "Invalid value '{}' for 'max_batch_size'. Must be a positive "
+            "integer.".format(max_batch_size)
+        )
+
+    if max_wait_ms is not None and (
+        not isinstance(max_wait_ms, (int, float)) or max_wait_ms < 0
+    ):
+        # raise a runtime error so it actually crashes klio/beam rather than
+        # just continue processing elements
+        raise RuntimeError(
+            "Invalid value '{}' for 'max_wait_ms'. Must be a positive "
+            "number.".format(max_wait_ms)
+        )
+
+    def inner(meth):
+        func_name = getattr(meth, "__qualname__", meth.__name__)
+        thd_limiter = __get_thread_limiter(
+            max_thread_count, thread_limiter, func_name
+        )
+        # grab klio context outside of the method wrappers so the
+        # context manager isn't called for every time an item is processed
+        with _klio_context() as ctx:
+            kctx = ctx
+
+        metrics_objs = __get_transform_metrics(func_name, kctx)
+        thd_limiter = _stats.WaitTimedLimiter(thd_limiter, metrics_objs.stats)
+
+        def start_batch(self):
+            self._klio_batch = []
+            self._klio_batch_started = None
+
+        def flush_batch(self):
+            batch = getattr(self, "_klio_batch", None)
+            start_batch(self)
+            if batch:
+                yield from __process_klio_batch(
+                    metrics_objs, thd_limiter, self, meth, batch
+                )
+
+        def process(
+            self,
+            incoming_item,
+            timestamp=beam.DoFn.TimestampParam,
+            window=beam.DoFn.WindowParam,
+        ):
+            setattr(self, "_klio", kctx)
+            if getattr(self, "_klio_batch", None) is None:
+                start_batch(self)
+
+            metrics_objs.received.inc()
+            try:
+                kmsg = serializer.to_klio_message(
+                    incoming_item, kctx.config, kctx.logger
+                )
+            except Exception as err:
+                __log_serialization_error(
+                    metrics_objs,
+                    kctx.logger,
+                    _ERROR_MSG_KMSG_FROM_BYTES,
+                    incoming_item,
+                    err,
+                )
+                metrics_objs.error.inc()
+                __ack_pubsub_if_direct_gke(incoming_item, kctx)
+                yield pvalue.TaggedOutput("drop", incoming_item)
+                return
+
+            if not self._klio_batch:
+                self._klio_batch_started = time.monotonic()
+            self._klio_batch.append(
+                _BatchedItem(incoming_item, kmsg, timestamp, window)
+            )
+
+            is_full = len(self._klio_batch) >= max_batch_size
+            is_expired = max_wait_ms is not None and (
+                time.monotonic() - self._klio_batch_started
+                >= max_wait_ms / 1000
+            )
+            if is_full or is_expired:
+                yield from flush_batch(self)
+
+        # Not using `functools.wraps` since Beam would then inspect the
+        # signature of the decorated method rather than `process`'s, and
+        # not provide the element's timestamp & window.
+        process.__name__ = meth.__name__
+        process.__qualname__ = func_name
+        process.__doc__ = meth.__doc__
+        process.__module__ = meth.__module__
+        return _KlioBatchProcessMethod(process, start_batch, flush_batch)
+
+    # allows @handle_klio_batch to be used without parens when there are no
+    # args/kwargs provided
+    if args and callable(args[0]):
+        return inner(args[0])
+    return inner
+
+
 def _timeout(seconds=None, exception=None, exception_message=None):
     try:
         seconds = float(seconds)
@@ -802,7 +1187,9 @@ def inject_klio_context(*args, **kwargs):
 
 # TODO: Update docstrings w/ new kwargs & examples
 @txf_utils.experimental()
-def handle_klio(*args, max_thread_count=None, thread_limiter=None, **kwargs):
+def handle_klio(
+    *args, max_thread_count=None, thread_limiter=None, cost=None, **kwargs
+):
     """Serialize & deserialize incoming PCollections as a KlioMessage.
 
     Behind the scenes, this generates :class:`KlioContext
@@ -886,6 +1273,12 @@ def handle_klio(*args, max_thread_count=None, thread_limiter=None, **kwargs):
         def second_map_func(ctx, item):
             ...
 
+        # Limit the total cost of the messages processed at once rather
+        # than their number, e.g. to 2 hours of audio
+        @handle_klio(max_thread_count=7200, cost=get_duration_sec)
+        def my_map_func(ctx, item):
+            ...
+
     Args:
         max_thread_count (int, callable, klio.utils.ThreadLimit): number of
             threads to make available to the decorated function, or a
@@ -899,11 +1292,89 @@ def handle_klio(*args, max_thread_count=None, thread_limiter=None, **kwargs):
             instance that the decorator should use instead of creating its own.
             Defaults to ``None``. **Mutually exclusive** with
             ``max_thread_count``.
+
+        cost (callable): function given the data of a KlioMessage (the
+            ``item`` the decorated function receives) and returning the
+            cost of processing it, as a number. Each message then takes
+            up its cost rather than one of the thread limit, so the limit
+            caps the total cost of the messages processed at once. A
+            message costing more than the whole limit is processed alone.
+            Defaults to ``None``, where every message costs ``1``.
     """
     return _handle_klio(
         *args,
         max_thread_count=max_thread_count,
         thread_limiter=thread_limiter,
+        cost=cost,
+        **kwargs,
+    )
+
+
+@txf_utils.experimental()
+def handle_klio_batch(
+    *args,
+    max_batch_size=None,
+    max_wait_ms=None,
+    max_thread_count=None,
+    thread_limiter=None,
+    **kwargs
+):
+    """Hand a DoFn's ``process`` method a batch of KlioMessages at once.
+
+    Like :func:`@handle_klio <handle_klio>`, but the incoming messages of a
+    bundle are grouped into batches of up to ``max_batch_size`` messages,
+    and the decorated method is called with a ``list`` of
+    ``KlioMessage.data`` objects, e.g. to run vectorized operations or
+    batched model inference.
+
+    The decorated method must return one result per message, in the same
+    order. Each result is treated like the return value of a method
+    decorated with ``@handle_klio``: it is set as the message's payload
+    (or, if a ``pvalue.TaggedOutput``, emitted to the given tag). A message
+    for which an ``Exception`` instance is returned is dropped. If the
+    decorated method raises, all messages of the batch are dropped.
+
+    A batch is handed to the decorated method once it is full, once its
+    first message has waited ``max_wait_ms`` when the next message arrives,
+    or at the end of the bundle, even if the DoFn overrides
+    ``finish_bundle`` without calling ``super()``. Beam only lets a DoFn
+    output elements while processing an element or finishing a bundle, so
+    a batch isn't handed over while no messages arrive.
+
+    The ``kmsg-received``, ``kmsg-success`` and ``kmsg-drop-error`` metrics
+    are collected per message; ``kmsg-timer`` is collected per batch.
+
+    Can only be used on the ``process`` method of a ``beam.DoFn``.
+
+    .. code-block:: python
+
+        class MyDoFn(beam.DoFn):
+            @handle_klio_batch(max_batch_size=32, max_wait_ms=500)
+            def process(self, items):
+                images = np.stack([load(item.element) for item in items])
+                predictions = self.model.predict(images)
+                return [pred.tobytes() for pred in predictions]
+
+    Args:
+        max_batch_size (int): maximum number of messages in a batch.
+            Default: ``100``.
+        max_wait_ms (int or float): maximum time in milliseconds a message
+            waits for its batch to fill up, checked when the next message
+            arrives. Default: ``None`` (wait until the end of the bundle).
+        max_thread_count (int, callable, klio.utils.ThreadLimit): number of
+            threads to make available to the decorated method. See
+            :func:`handle_klio`. **Mutually exclusive** with
+            ``thread_limiter`` argument.
+        thread_limiter (klio.utils.ThreadLimiter): the ``ThreadLimiter``
+            instance that the decorator should use instead of creating its own.
+            **Mutually exclusive** with ``max_thread_count``.
+    """
+    return _handle_klio_batch(
+        *args,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        max_thread_count=max_thread_count,
+        thread_limiter=thread_limiter,
         **kwargs,
     )
 
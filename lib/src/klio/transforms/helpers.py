@@ -24,6 +24,7 @@ from klio_core.proto import klio_pb2
 from klio import utils as kutils
 from klio.message import pubsub_message_manager as ps_mgr
 from klio.message import serializer
+from klio.transforms import _dedup
 from klio.transforms import _helpers
 from klio.transforms import decorators
 from klio.transforms import io as io_transforms
@@ -151,7 +152,7 @@ class KlioFilterPing(
             self.process_ctr.inc()
             tagged_state = _helpers.TaggedStates.PROCESS
 
-        yield pvalue.TaggedOutput(tagged_state.value, kmsg.SerializeToString())
+        yield pvalue.TaggedOutput(tagged_state.value, kmsg)
 
 
 class KlioFilterForce(
@@ -208,7 +209,7 @@ class KlioFilterForce(
             self.process_ctr.inc()
             tagged_state = _helpers.TaggedStates.PROCESS
 
-        yield pvalue.TaggedOutput(tagged_state.value, kmsg.SerializeToString())
+        yield pvalue.TaggedOutput(tagged_state.value, kmsg)
 
 
 class KlioWriteToEventOutput(beam.PTransform):
@@ -297,15 +298,26 @@ class _KlioTagMessageVersion(
         # pickleable when it's in its own transform.
         # TODO: maybe create a read/write klio pub/sub transform to do
         # this for us.
-        if not isinstance(klio_message, klio_pb2.KlioMessage):
+        # (Both `to_klio_message` and `to_klio_message_view` return
+        # KlioMessages as-is.)
+
+        # Only keep the parsed message around if the job is configured to
+        # parse incoming messages once; otherwise downstream expects bytes
+        # and only the version is needed here
+        if self._klio.config.job_config.parse_klio_message_once:
             klio_message = serializer.to_klio_message(
                 klio_message, self._klio.config, self._klio.logger
             )
-
+            output = klio_message
+        else:
+            klio_message = serializer.to_klio_message_view(
+                klio_message, self._klio.config, self._klio.logger
+            )
+            output = klio_message.SerializeToString()
         if klio_message.version == klio_pb2.Version.V2:
-            yield pvalue.TaggedOutput("v2", klio_message.SerializeToString())
+            yield pvalue.TaggedOutput("v2", output)
         else:
-            yield pvalue.TaggedOutput("v1", klio_message.SerializeToString())
+            yield pvalue.TaggedOutput("v1", output)
 
 
 # TODO: this should only be temporary and removed once v2 migration is done
@@ -338,7 +350,7 @@ class _KlioV1CheckRecipients(
 
     @decorators._set_klio_context
     def process(self, raw_message):
-        klio_message = serializer.to_klio_message(
+        klio_message = serializer.to_klio_message_view(
             raw_message, self._klio.config, self._klio.logger
         )
         if self._should_process(klio_message):
@@ -413,13 +425,15 @@ class KlioCheckRecipients(
 
     @decorators._set_klio_context
     def process(self, raw_message):
-        klio_message = serializer.to_klio_message(
+        klio_message = serializer.to_klio_message_view(
             raw_message, self._klio.config, self._klio.logger
         )
         if self._should_process(klio_message):
             # the message could have updated, so let's re-serialize to a new
-            # raw message
-            raw_message = klio_message.SerializeToString()
+            # raw message (or pass the updated message object along)
+            raw_message = serializer._to_incoming_type(
+                klio_message, raw_message
+            )
             yield pvalue.TaggedOutput(
                 _helpers.TaggedStates.PROCESS.value, raw_message
             )
@@ -450,13 +464,14 @@ class KlioUpdateAuditLog(beam.DoFn, metaclass=_helpers._KlioBaseDoFnMetaclass):
         return audit_log_item
 
     @decorators._set_klio_context
-    def process(self, raw_message):
-        klio_message = serializer.to_klio_message(
-            raw_message, self._klio.config, self._klio.logger
-        )
+    def _update_audit_log(self, klio_message):
         audit_log_item = self._create_audit_item()
         klio_message.metadata.job_audit_log.extend([audit_log_item])
 
+        # avoid decoding the full audit log just to not log it
+        if not self._klio.logger.isEnabledFor(logging.DEBUG):
+            return
+
         audit_log = klio_message.metadata.job_audit_log
         traversed_dag = " -> ".join(
             "{}::{}".format(
@@ -471,7 +486,246 @@ class KlioUpdateAuditLog(beam.DoFn, metaclass=_helpers._KlioBaseDoFnMetaclass):
             base_log_msg, klio_message.data.entity_id, traversed_dag
         )
         self._klio.logger.debug(log_msg)
-        yield klio_message.SerializeToString()
+
+    @decorators._set_klio_context
+    def process(self, raw_message):
+        klio_message = serializer.to_klio_message_view(
+            raw_message, self._klio.config, self._klio.logger
+        )
+        self._update_audit_log(klio_message)
+        yield serializer._to_incoming_type(klio_message, raw_message)
+
+
+def _new_dofn(dofn_cls, *args, **kwargs):
+    # Instantiate a DoFn without `_KlioBaseDoFnMetaclass` wrapping it in a
+    # `beam.ParDo` so its logic can be reused within another DoFn
+    return type.__call__(dofn_cls, *args, **kwargs)
+
+
+class KlioIngress(beam.DoFn, metaclass=_helpers._KlioBaseDoFnMetaclass):
+    """Klio pre-processing of incoming messages in a single transform.
+
+    Tags each incoming message as ``process``, ``pass_thru``, or ``drop``
+    in one pass, with the same results (including logs and metrics) as
+    chaining ``_KlioTagMessageVersion``, ``KlioCheckRecipients``,
+    ``KlioUpdateAuditLog``, ``KlioFilterPing``,
+    ``KlioGcsCheckOutputExists``, ``KlioFilterForce``, and
+    ``KlioGcsCheckInputExists``. Messages are parsed only once, and Beam
+    doesn't need to schedule and hand off elements between each step.
+
+    Messages not intended for the current job and messages with no input
+    data found are tagged as ``drop``.
+
+    .. code-block:: python
+
+        ingress = in_pcol | KlioIngress(filter_ping=True)
+        to_process = ingress.process
+        to_pass_thru = ingress.pass_thru
+        _ = ingress.drop | KlioDrop()
+
+    Args:
+        filter_ping (bool): whether to tag messages in ping mode as
+            ``pass_thru``. Requires ``job_config.data.inputs``.
+        check_output_exists (bool): whether to tag messages with output data
+            found as ``pass_thru``, unless in force mode. Requires
+            ``job_config.data.outputs``.
+        check_input_exists (bool): whether to tag messages with no input
+            data found as ``drop``. Requires ``job_config.data.inputs``.
+    """
+
+    WITH_OUTPUTS = True
+
+    def __init__(
+        self,
+        filter_ping=False,
+        check_output_exists=False,
+        check_input_exists=False,
+    ):
+        self.filter_ping = filter_ping
+        self.check_output_exists = check_output_exists
+        self.check_input_exists = check_input_exists
+
+    def setup(self, *args, **kwargs):
+        super(KlioIngress, self).setup(*args, **kwargs)
+        self._v1_recipients = _new_dofn(_KlioV1CheckRecipients)
+        self._recipients = _new_dofn(KlioCheckRecipients)
+        self._audit_log = _new_dofn(KlioUpdateAuditLog)
+        if self.filter_ping:
+            self._ping = _new_dofn(KlioFilterPing)
+        if self.check_output_exists:
+            self._output_exists = _new_dofn(KlioGcsCheckOutputExists)
+            self._force = _new_dofn(KlioFilterForce)
+        if self.check_input_exists:
+            self._input_exists = _new_dofn(KlioGcsCheckInputExists)
+
+        for dofn in self._dofns:
+            dofn.setup()
+
+    @property
+    def _dofns(self):
+        dofns = [self._v1_recipients, self._recipients, self._audit_log]
+        if self.filter_ping:
+            dofns.append(self._ping)
+        if self.check_output_exists:
+            dofns.extend([self._output_exists, self._force])
+        if self.check_input_exists:
+            dofns.append(self._input_exists)
+        return dofns
+
+    @staticmethod
+    def _get_tag(dofn, klio_message):
+        # ping/force filters & data existence checks yield one tagged output;
+        # nothing is yielded if the check errored (and it's already logged)
+        for output in dofn.process(klio_message):
+            return output.tag
+
+    def _should_process(self, klio_message):
+        if klio_message.version == klio_pb2.Version.V2:
+            if self._recipients._should_process(klio_message):
+                return True
+            self._recipients.drop_ctr.inc()
+            return False
+        return self._v1_recipients._should_process(klio_message)
+
+    def _get_state(self, klio_message):
+        process = _helpers.TaggedStates.PROCESS.value
+        found = _helpers.DataExistState.FOUND.value
+
+        if self.filter_ping:
+            tag = self._get_tag(self._ping, klio_message)
+            if tag != process:
+                return tag
+
+        if self.check_output_exists:
+            tag = self._get_tag(self._output_exists, klio_message)
+            if tag == found:
+                tag = self._get_tag(self._force, klio_message)
+                if tag != process:
+                    return tag
+            elif tag is None:
+                return None
+
+        if self.check_input_exists:
+            tag = self._get_tag(self._input_exists, klio_message)
+            if tag is None:
+                return None
+            if tag != found:
+                return _helpers.TaggedStates.DROP.value
+
+        return process
+
+    @decorators._set_klio_context
+    def process(self, raw_message):
+        klio_message = serializer.to_klio_message_view(
+            raw_message, self._klio.config, self._klio.logger
+        )
+        # dropped messages are processed if they're received again
+        dedup_key = _dedup.key(klio_message)
+        if not self._should_process(klio_message):
+            _dedup.forget(dedup_key)
+            yield pvalue.TaggedOutput(
+                _helpers.TaggedStates.DROP.value,
+                klio_message.SerializeToString(),
+            )
+            return
+
+        self._audit_log._update_audit_log(klio_message)
+        state = self._get_state(klio_message)
+        if state == _helpers.TaggedStates.DROP.value:
+            _dedup.forget(dedup_key)
+        if state is not None:
+            yield pvalue.TaggedOutput(state, klio_message.SerializeToString())
+
+
+class KlioDeduplicate(beam.DoFn, metaclass=_helpers._KlioBaseDoFnMetaclass):
+    """Tag incoming messages seen recently as duplicates.
+
+    Messages are identified by their ``data.element`` and, optionally,
+    some of their metadata fields. Messages already seen within the
+    configured TTL are tagged as ``drop``; all others as ``process``.
+    Recently seen messages are kept in a worker-local, in-memory cache.
+    Messages in force or ping mode are always tagged as ``process``.
+
+    Configured with ``job_config.dedup``. Emits the ``kmsg-dedup-hit``
+    and ``kmsg-dedup-miss`` counters.
+
+    .. code-block:: python
+
+        dedup = in_pcol | KlioDeduplicate()
+        to_process = dedup.process
+        _ = dedup.drop | KlioDrop()
+    """
+
+    WITH_OUTPUTS = True
+
+    @decorators._set_klio_context
+    def setup(self):
+        dedup_config = _dedup.parse_config(self._klio.config.job_config.dedup)
+        self._cache = _dedup.get_cache(dedup_config)
+
+        transform_name = self.__class__.__name__
+        self.hit_ctr = self._klio.metrics.counter(
+            "kmsg-dedup-hit", transform=transform_name
+        )
+        self.miss_ctr = self._klio.metrics.counter(
+            "kmsg-dedup-miss", transform=transform_name
+        )
+
+    @decorators._set_klio_context
+    def process(self, raw_message):
+        try:
+            klio_message = serializer.to_klio_message_view(
+                raw_message, self._klio.config, self._klio.logger
+            )
+        except Exception:
+            # not deduplicated; it's dropped (and logged) when processed
+            yield pvalue.TaggedOutput(
+                _helpers.TaggedStates.PROCESS.value, raw_message
+            )
+            return
+
+        if _dedup.skip(klio_message):
+            yield pvalue.TaggedOutput(
+                _helpers.TaggedStates.PROCESS.value, raw_message
+            )
+            return
+
+        key = self._cache.key(klio_message)
+        if self._cache.seen(key):
+            self.hit_ctr.inc()
+            self._klio.logger.debug(
+                "Dropping KlioMessage - '%s' was already received."
+                % klio_message.data.element
+            )
+            yield pvalue.TaggedOutput(
+                _helpers.TaggedStates.DROP.value, raw_message
+            )
+            return
+
+        self.miss_ctr.inc()
+        yield pvalue.TaggedOutput(
+            _helpers.TaggedStates.PROCESS.value, raw_message
+        )
+
+
+class KlioForgetDropped(beam.DoFn, metaclass=_helpers._KlioBaseDoFnMetaclass):
+    """Forget dropped messages in the worker's deduplication cache.
+
+    Used with ``job_config.dedup`` on messages that Klio drops before
+    processing them (i.e. messages not intended for the job, or with no
+    input data found), so that they're processed if they're received
+    again. See :class:`KlioDeduplicate`.
+    """
+
+    WITH_OUTPUTS = False
+
+    @decorators._set_klio_context
+    def process(self, raw_message):
+        klio_message = serializer.to_klio_message_view(
+            raw_message, self._klio.config, self._klio.logger
+        )
+        _dedup.forget(_dedup.key(klio_message))
+        yield raw_message
 
 
 class KlioDebugMessage(beam.PTransform):
@@ -714,6 +968,8 @@ class KlioTriggerUpstream(beam.PTransform):
         kmsg = serializer.to_klio_message(
             raw_kmsg, kconfig=self._klio.config, logger=self._klio.logger
         )
+        # the upstream job sends the message back to be processed
+        _dedup.forget(_dedup.key(kmsg))
 
         # Make sure upstream job doesn't skip the message
         upstream_job = self._generate_upstream_job_object()
@@ -731,7 +987,8 @@ class KlioTriggerUpstream(beam.PTransform):
                 self.upstream_job_name, kmsg.data.element.decode("utf-8")
             )
             self._klio.logger.log(self.log_level, msg)
-        return serializer.from_klio_message(kmsg)
+        # the upstream job reads the message as a delivery of its own
+        return ps_mgr.detach_token(serializer.from_klio_message(kmsg))
 
     def expand(self, pcoll):
         name = self.upstream_job_name
@@ -769,3 +1026,51 @@ class KlioAckInputMessage(beam.DoFn):
     def process(self, element):
         ps_mgr.MessageManager.mark_done(element)
         yield element
+
+
+class KlioAckDuplicateMessage(beam.DoFn):
+    """Duplicate message acknowledgement DoFn.
+
+    Acknowledges messages dropped by :class:`KlioDeduplicate` without
+    affecting another delivery of the same message that's still being
+    processed. See
+    :meth:`klio.message.pubsub_message_manager.MessageManager.mark_duplicate`.
+
+    Used when running on ``DirectGKERunner``.
+    """
+
+    def process(self, element):
+        ps_mgr.MessageManager.mark_duplicate(element)
+        yield element
+
+
+class KlioInlinePayload(beam.DoFn):
+    """Replace references to stored payloads with the payloads themselves.
+
+    Used when running on ``DirectGKERunner`` with
+    ``job_config.payload_store_threshold`` set, before messages are
+    written to the job's event output or acknowledged. See
+    :func:`klio.message.serializer.inline_payload`.
+    """
+
+    def process(self, element):
+        yield serializer.inline_payload(element)
+
+
+class KlioDetachDeliveryToken(beam.DoFn):
+    """Remove worker-local delivery tokens from outgoing messages.
+
+    Used when running on ``DirectGKERunner``, before messages are written
+    to the job's event output, so that the token of the Pub/Sub delivery a
+    message was read from doesn't leave the worker. See
+    :func:`klio.message.pubsub_message_manager.detach_token`.
+    """
+
+    def process(self, element):
+        if isinstance(element, bytes):
+            try:
+                element = ps_mgr.detach_token(element)
+            except klio_pb2._message.DecodeError:
+                # not a KlioMessage, so it can't have a token
+                pass
+        yield element
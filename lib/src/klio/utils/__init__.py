@@ -15,7 +15,11 @@
 
 """General utilities for managing a pipeline."""
 
-from klio.utils._thread_limiter import ThreadLimit, ThreadLimiter
+from klio.utils._thread_limiter import (
+    AdaptiveLimit,
+    ThreadLimit,
+    ThreadLimiter,
+)
 
 
-__all__ = ("ThreadLimit", "ThreadLimiter")
+__all__ = ("AdaptiveLimit", "ThreadLimit", "ThreadLimiter")
@@ -13,23 +13,156 @@
 # limitations under the License.
 #
 
+import collections
 import enum
 import logging
 import multiprocessing
 import threading
+import time
+
+
+# Weights are counted in integer millionths of a permit, so that fractional
+# weights acquired and released in any order add back up to exactly zero.
+_UNITS_PER_PERMIT = 10 ** 6
+
+
+def _to_units(weight):
+    return int(round(weight * _UNITS_PER_PERMIT))
+
+
+def _to_permits(units):
+    permits, remainder = divmod(units, _UNITS_PER_PERMIT)
+    if remainder:
+        return units / _UNITS_PER_PERMIT
+    return permits
 
 
 class _DummySemaphore(object):
     """Mock semaphore for API parity when no limit is set in ThreadLimiter."""
 
+    limit = None
+    waiting = 0
+
     def __init__(self, *args, **kwargs):
-        self._value = "NONE"
+        self._lock = threading.Lock()
+        self._held = 0
+
+    @property
+    def holders(self):
+        return _to_permits(self._held)
+
+    @property
+    def available(self):
+        return "NONE"
 
-    def acquire(self):
-        pass
+    def acquire(self, weight=1):
+        with self._lock:
+            self._held += _to_units(weight)
+        return False
 
-    def release(self):
-        pass
+    def release(self, weight=1):
+        with self._lock:
+            self._held -= _to_units(weight)
+
+
+class _ResizableSemaphore(object):
+    """Bounded, weighted semaphore whose number of permits can be changed.
+
+    Each acquire takes ``weight`` permits at once. Waiting acquires are
+    served in order, so a heavy one isn't starved by lighter ones slipping
+    past it. An acquire heavier than the whole limit is let in once no
+    permits are held, rather than blocking forever.
+
+    Also keeps track of how many permits are held and how many threads are
+    waiting for some.
+
+    Args:
+        limit (int): number of permits.
+    """
+
+    def __init__(self, limit):
+        # the fast paths only take the (C-implemented) lock; a condition is
+        # only created when a thread has to wait
+        self._lock = threading.Lock()
+        # conditions of waiting threads, first come first served
+        self._queue = collections.deque()
+        self.limit = limit
+        # permits held, in units (see `_to_units`)
+        self._held = 0
+
+    @property
+    def holders(self):
+        return _to_permits(self._held)
+
+    @property
+    def waiting(self):
+        return len(self._queue)
+
+    @property
+    def available(self):
+        return max(0, self.limit - self.holders)
+
+    def _fits(self, units):
+        # an idle semaphore lets in any weight
+        return (
+            self._held == 0
+            or self._held + units <= self.limit * _UNITS_PER_PERMIT
+        )
+
+    def _wake_next(self):
+        if self._queue:
+            self._queue[0].notify()
+
+    def acquire(self, weight=1):
+        """Acquire permits, blocking until enough are available.
+
+        Args:
+            weight (int, float): number of permits to acquire.
+        Returns:
+            bool: whether the caller had to wait for permits.
+        Raises:
+            ValueError: if ``weight`` is negative.
+        """
+        if weight < 0:
+            raise ValueError("Semaphore weight must not be negative")
+        units = _to_units(weight)
+        with self._lock:
+            if not self._queue and self._fits(units):
+                self._held += units
+                return False
+            turn = threading.Condition(self._lock)
+            self._queue.append(turn)
+            try:
+                while self._queue[0] is not turn or not self._fits(units):
+                    turn.wait()
+            finally:
+                self._queue.remove(turn)
+                # the next in line may fit in what's left
+                self._wake_next()
+            self._held += units
+        return True
+
+    def release(self, weight=1):
+        units = _to_units(weight)
+        with self._lock:
+            if units > self._held:
+                raise ValueError("Semaphore released too many times")
+            self._held -= units
+            self._wake_next()
+
+    def resize(self, limit):
+        """Change the number of permits.
+
+        Permits held beyond a reduced limit are kept until released.
+
+        Args:
+            limit (int): new number of permits.
+        """
+        with self._lock:
+            grown = limit > self.limit
+            self.limit = limit
+            if grown:
+                self._wake_next()
 
 
 class ThreadLimit(enum.Enum):
@@ -52,6 +185,180 @@ class ThreadLimit(enum.Enum):
     """Default thread limit (CPU count of worker machine via
     :func:`multiprocessing.cpu_count`).
     """
+    ADAPTIVE = 2
+    """Start from the default thread limit, and adjust it to CPU
+    utilization and latency with the defaults of :class:`AdaptiveLimit`.
+    """
+
+
+class AdaptiveLimit(object):
+    """Settings of a :class:`ThreadLimiter` adjusting its limit to load.
+
+    Every ``interval_sec``, on the next release of a thread, the limit is
+    adjusted like an AIMD (additive increase, multiplicative decrease)
+    controller:
+
+    * if the CPU utilization of the worker process exceeded
+      ``target_cpu_utilization``, or threads held the limiter for longer
+      on average than ``latency_tolerance`` times the lowest average seen,
+      the limit is multiplied by ``decrease_factor``;
+    * otherwise, if any thread had to wait for the limiter, the limit is
+      increased by one.
+
+    The lowest average is allowed to creep up by 5% per interval, so that
+    the limiter eventually accepts a lasting change in how long the work
+    takes.
+
+    Example usage:
+
+    .. code-block:: python
+
+        from klio import utils
+
+        thread_limiter = utils.ThreadLimiter(
+            max_thread_count=4,
+            adaptive=utils.AdaptiveLimit(max_thread_count=32),
+        )
+
+    Args:
+        min_thread_count (int): lowest limit. Defaults to ``1``.
+        max_thread_count (int): highest limit. Defaults to four times the
+            limiter's initial limit.
+        target_cpu_utilization (float): CPU utilization of the process
+            above which the limit is decreased, as a fraction of all CPUs.
+        latency_tolerance (float): factor of the lowest average time
+            threads held the limiter above which the limit is decreased.
+        decrease_factor (float): factor the limit is multiplied by when
+            decreased.
+        interval_sec (float): seconds between adjustments.
+    """
+
+    def __init__(
+        self,
+        min_thread_count=1,
+        max_thread_count=None,
+        target_cpu_utilization=0.9,
+        latency_tolerance=1.5,
+        decrease_factor=0.75,
+        interval_sec=10,
+    ):
+        self.min_thread_count = min_thread_count
+        self.max_thread_count = max_thread_count
+        self.target_cpu_utilization = target_cpu_utilization
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.interval_sec = interval_sec
+
+
+class _AdaptiveController(object):
+    """Adjusts the permits of a semaphore per :class:`AdaptiveLimit`.
+
+    Args:
+        semaphore (_ResizableSemaphore): semaphore to adjust.
+        settings (AdaptiveLimit): how to adjust it.
+        logger (logging.Logger): logger to log adjustments to.
+        name (str): name of the limiter, for logging.
+    """
+
+    BASELINE_DRIFT = 1.05
+
+    def __init__(self, semaphore, settings, logger, name):
+        self.semaphore = semaphore
+        self.settings = settings
+        self.min_limit = settings.min_thread_count
+        self.max_limit = settings.max_thread_count or 4 * semaphore.limit
+        self.logger = logger
+        self.name = name
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cpu_count = multiprocessing.cpu_count()
+        self._baseline = None
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self._count = 0
+        self._total_latency = 0.0
+        self.waited = False
+        self._started_wall = now
+        self._started_cpu = time.process_time()
+        self._next_adjust = now + self.settings.interval_sec
+
+    def acquired(self, waited):
+        """Track a thread that acquired the limiter.
+
+        Args:
+            waited (bool): whether the thread had to wait.
+        """
+        if waited:
+            self.waited = True
+        starts = getattr(self._local, "starts", None)
+        if starts is None:
+            starts = self._local.starts = []
+        starts.append(time.monotonic())
+
+    def released(self):
+        """Track a thread that released the limiter, adjusting the limit
+        if it's due.
+        """
+        now = time.monotonic()
+        starts = getattr(self._local, "starts", None)
+        with self._lock:
+            # a thread may release a limiter acquired by another one
+            if starts:
+                self._count += 1
+                self._total_latency += now - starts.pop()
+            if now < self._next_adjust:
+                return
+            limit = self._next_limit(now)
+            self._reset(now)
+        if limit is not None:
+            self.semaphore.resize(limit)
+
+    def _next_limit(self, now):
+        elapsed = now - self._started_wall
+        cpu_utilization = 0
+        if elapsed > 0:
+            cpu_utilization = (time.process_time() - self._started_cpu) / (
+                elapsed * self._cpu_count
+            )
+        if not self._count:
+            return None
+
+        latency = self._total_latency / self._count
+        baseline = self._baseline
+        if baseline is None:
+            self._baseline = latency
+        else:
+            self._baseline = min(latency, baseline * self.BASELINE_DRIFT)
+
+        limit = self.semaphore.limit
+        too_busy = cpu_utilization > self.settings.target_cpu_utilization
+        too_slow = (
+            baseline is not None
+            and latency > baseline * self.settings.latency_tolerance
+        )
+        if too_busy or too_slow:
+            new_limit = min(
+                limit - 1, int(limit * self.settings.decrease_factor)
+            )
+            new_limit = max(self.min_limit, new_limit)
+        elif self.waited:
+            new_limit = min(self.max_limit, limit + 1)
+        else:
+            return None
+        if new_limit == limit:
+            return None
+
+        self.logger.info(
+            "%s Adjusted thread limit from %d to %d (CPU utilization: "
+            "%.2f, average latency: %.3fs)",
+            self.name,
+            limit,
+            new_limit,
+            cpu_utilization,
+            latency,
+        )
+        return new_limit
 
 
 class ThreadLimiter(object):
@@ -86,28 +393,56 @@ class ThreadLimiter(object):
         limit_func = lambda: multiprocessing.cpu_count() * 4
         thread_limiter = ThreadLimiter(max_thread_count=limit_func)
 
+        # Adjust the limit to CPU utilization & latency, starting from the
+        # default limit
+        thread_limiter = ThreadLimiter(max_thread_count=ThreadLimit.ADAPTIVE)
+
         # Turn off thread limiting
         thread_limiter = ThreadLimiter(max_thread_count=ThreadLimit.NONE)
 
+        # Limit the total cost of concurrent work rather than the number
+        # of threads, e.g. to 600 seconds of audio
+        thread_limiter = ThreadLimiter(max_thread_count=600)
+        thread_limiter.acquire(weight=duration_sec)
+        ...
+        thread_limiter.release(weight=duration_sec)
+
     Args:
         max_thread_count (int, callable, ThreadLimit): number of threads
             to make available to the limiter, or a :func:`callable` that
             returns an ``int``. Values must be greater or equal to 0.
-            Set to :attr:`ThreadLimit.NONE` for no thread limits.
+            Set to :attr:`ThreadLimit.NONE` for no thread limits. This is
+            the initial limit when ``adaptive`` is set.
         name (str): Name of particular limiter. Defaults to object ID via
             ``id(self)``.
+        adaptive (bool, AdaptiveLimit): adjust the limit to CPU
+            utilization and latency; ``True`` for the defaults of
+            :class:`AdaptiveLimit`. Implied by
+            :attr:`ThreadLimit.ADAPTIVE`.
+    Raises:
+        ValueError: if ``adaptive`` is set without a thread limit.
     """
 
     _PREFIX = "KlioThreadLimiter"
 
-    def __init__(self, max_thread_count=ThreadLimit.DEFAULT, name=None):
+    def __init__(
+        self, max_thread_count=ThreadLimit.DEFAULT, name=None, adaptive=None
+    ):
         self.__repr_name = f"name={name}" if name else f"id={id(self)}"
         self.logger = logging.getLogger("klio.concurrency")
+        self._controller = None
 
+        if max_thread_count is ThreadLimit.ADAPTIVE:
+            max_thread_count = ThreadLimit.DEFAULT
+            adaptive = adaptive or True
         if max_thread_count is ThreadLimit.DEFAULT:
             max_thread_count = multiprocessing.cpu_count
 
         if max_thread_count is ThreadLimit.NONE:
+            if adaptive:
+                raise ValueError(
+                    "An adaptive ThreadLimiter requires a thread limit."
+                )
             self._dummy = True
             self._semaphore = _DummySemaphore()
             self.logger.debug(f"{self} Using unlimited semaphore")
@@ -116,20 +451,50 @@ class ThreadLimiter(object):
             self._dummy = False
             if callable(max_thread_count):
                 max_thread_count = max_thread_count()
-            self._semaphore = threading.BoundedSemaphore(max_thread_count)
+            self._semaphore = _ResizableSemaphore(max_thread_count)
             self.logger.debug(
-                f"{self} Initial semaphore value: {self._semaphore._value}"
+                f"{self} Initial semaphore value: {max_thread_count}"
             )
+            if adaptive:
+                if adaptive is True:
+                    adaptive = AdaptiveLimit()
+                self._controller = _AdaptiveController(
+                    self._semaphore, adaptive, self.logger, repr(self)
+                )
+
+    @property
+    def limit(self):
+        """int: Current number of threads allowed, or ``None`` when not
+        limited.
+        """
+        return self._semaphore.limit
+
+    @property
+    def holders(self):
+        """int: Number of threads currently holding the limiter, or the
+        total weight they hold if they acquired it with a ``weight``.
+        """
+        return self._semaphore.holders
+
+    @property
+    def waiting(self):
+        """int: Number of threads currently waiting for the limiter."""
+        return self._semaphore.waiting
 
     def _log(self, message):
-        threads_available = False
-        suffix_msg = ""
-        if not self._dummy:
-            threads_available = self._semaphore._value
-            suffix_msg = f" (available threads: {threads_available})"
-        self.logger.debug(f"{self} {message}{suffix_msg}")
-
-    def acquire(self):
+        # Callers check that debug logging is enabled first, so nothing is
+        # formatted on the hot path otherwise.
+        if self._dummy:
+            self.logger.debug("%s %s", self, message)
+        else:
+            self.logger.debug(
+                "%s %s (available threads: %s)",
+                self,
+                message,
+                self._semaphore.available,
+            )
+
+    def acquire(self, weight=1):
         """Acquire a semaphore (a thread).
 
         Acquiring a semaphore will activate an available thread in Beam's
@@ -137,19 +502,33 @@ class ThreadLimiter(object):
 
         If no semaphores are available, the method will block until one
         is released via :func:`ThreadLimiter.release`.
+
+        Args:
+            weight (int, float): how much of the limit to acquire, for
+                work that costs more (or less) than one thread's worth.
+                Work heavier than the whole limit runs alone. Must be
+                released with the same weight.
         """
-        self._log("Blocked – waiting on semaphore for an available thread")
-        self._semaphore.acquire()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log("Blocked – waiting on semaphore for an available thread")
+        waited = self._semaphore.acquire(weight)
+        if self._controller is not None:
+            self._controller.acquired(waited)
 
-    def release(self):
+    def release(self, weight=1):
         """Release a semaphore (a thread).
 
+        Args:
+            weight (int, float): weight the semaphore was acquired with.
         Raises:
-            `ValueError`: if the semaphore is released too many times (more
-                than the value of ``ThreadLimiter._semaphore._value``).
+            `ValueError`: if the semaphore is released more times than it
+                was acquired.
         """
-        self._semaphore.release()
-        self._log("Released semaphore")
+        self._semaphore.release(weight)
+        if self._controller is not None:
+            self._controller.released()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log("Released semaphore")
 
     def __repr__(self):
         return f"{self._PREFIX}({self.__repr_name})"
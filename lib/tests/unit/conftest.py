@@ -14,11 +14,38 @@
 #
 
 import logging
+import time
+import weakref
 
 import pytest
 
 from klio_core import config
 
+from klio.transforms import _drop_log
+
+
+def pytest_runtest_setup(item):
+    # wall-clock benchmarks depend on the machine, so they only run when
+    # selected, i.e. `pytest -m benchmark`
+    markexpr = item.config.getoption("markexpr", "")
+    if "benchmark" in item.keywords and "benchmark" not in markexpr:
+        pytest.skip("benchmark; select with `-m benchmark` to run")
+
+
+@pytest.fixture(autouse=True)
+def drop_loggers(monkeypatch):
+    """Forget the drops of each test's drop loggers once it's done.
+
+    Otherwise, their timers keep running, and the drops they didn't log
+    are logged when the test run exits.
+    """
+    drop_loggers = weakref.WeakSet()
+    monkeypatch.setattr(_drop_log, "_DROP_LOGGERS", drop_loggers)
+    yield drop_loggers
+    for drop_log in list(drop_loggers):
+        with drop_log._lock:
+            drop_log._end_interval(time.monotonic())
+
 
 @pytest.fixture
 def caplog(caplog):
@@ -113,6 +140,8 @@ def mock_config(mocker, monkeypatch):
     mconfig.pipeline_options.streaming = True
     mconfig.pipeline_options.project = "not-a-real-project"
     mconfig.pipeline_options.runner = "DirectRunner"
+    mconfig.job_config.parse_klio_message_once = False
+    mconfig.job_config.payload_store_threshold = 0
 
     mock_data_output = mocker.Mock(name="MockDataGcsOutput")
     mock_data_output.location = "gs://this-should-not-exist"
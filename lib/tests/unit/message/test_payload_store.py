@@ -0,0 +1,261 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from klio_core.proto import klio_pb2
+
+from klio.message import exceptions
+from klio.message import payload_store
+from klio.message import pubsub_message_manager as pmm
+from klio.message import serializer
+
+
+@pytest.fixture(autouse=True)
+def held(monkeypatch):
+    _held = {}
+    monkeypatch.setattr(payload_store, "_HELD", _held)
+    return _held
+
+
+@pytest.fixture
+def store(monkeypatch):
+    _store = payload_store.PayloadStore(threshold=10)
+    monkeypatch.setattr(payload_store, "_STORE", _store)
+    return _store
+
+
+@pytest.fixture
+def store_config(mock_config, monkeypatch):
+    monkeypatch.setattr(payload_store, "_STORE", None)
+    mock_config.job_config.payload_store_threshold = 10
+    mock_config.pipeline_options.runner = "DirectGKERunner"
+    return mock_config
+
+
+@pytest.fixture
+def klio_message():
+    msg = klio_pb2.KlioMessage()
+    msg.version = klio_pb2.Version.V2
+    msg.data.element = b"s0m3_tr4ck_1d"
+    return msg
+
+
+def test_store_put_get(store):
+    payload = b"a-large-payload"
+
+    handle = store.put(payload, b"an-element")
+
+    assert payload_store.is_handle(handle)
+    assert payload is store.get(handle)
+    assert 1 == len(store)
+    assert len(payload) == store.size
+
+
+def test_store_put_same_payload(store):
+    payload = b"a-large-payload"
+    handle = store.put(payload, b"an-element")
+
+    # the same payload for the same message is only stored once
+    assert handle == store.put(payload, b"an-element")
+    assert handle != store.put(payload, b"another-element")
+    # an equal copy isn't compared byte by byte
+    assert handle != store.put(bytes(bytearray(payload)), b"an-element")
+    assert 3 == len(store)
+
+    store.release(handle)
+    assert payload is store.get(handle)
+    store.release(handle)
+    with pytest.raises(exceptions.KlioMessagePayloadException):
+        store.get(handle)
+    assert 2 == len(store)
+
+
+def test_store_evict(store):
+    handles = [
+        store.put(b"a-large-payload", b"an-element"),
+        store.put(b"another-large-payload", b"an-element"),
+    ]
+    other_handle = store.put(b"a-large-payload", b"another-element")
+
+    payload_store.evict(b"an-element")
+
+    for handle in handles:
+        with pytest.raises(exceptions.KlioMessagePayloadException):
+            store.get(handle)
+    assert b"a-large-payload" == store.get(other_handle)
+    # evicting twice is fine
+    payload_store.evict(b"an-element")
+
+
+def test_store_evict_held(store, held):
+    # the same element is in progress in two messages
+    payload_store.hold(b"an-element")
+    payload_store.hold(b"an-element")
+    handle = store.put(b"a-large-payload", b"an-element")
+
+    payload_store.evict(b"an-element")
+    # a message that was never held doesn't free the other's payloads
+    payload_store.evict(b"an-element", held=False)
+    assert b"a-large-payload" == store.get(handle)
+
+    payload_store.evict(b"an-element")
+    with pytest.raises(exceptions.KlioMessagePayloadException):
+        store.get(handle)
+    assert {} == held
+
+
+@pytest.mark.parametrize(
+    "threshold,runner,exp_store",
+    (
+        (0, "DirectGKERunner", False),
+        (10, "DirectRunner", False),
+        (10, "DataflowRunner", False),
+        (10, "DirectGKERunner", True),
+    ),
+)
+def test_get_store(threshold, runner, exp_store, mock_config, monkeypatch):
+    monkeypatch.setattr(payload_store, "_STORE", None)
+    mock_config.job_config.payload_store_threshold = threshold
+    mock_config.pipeline_options.runner = runner
+
+    actual = payload_store.get_store(mock_config)
+
+    assert exp_store is (actual is not None)
+    assert actual is payload_store.get_store()
+    if exp_store:
+        assert actual is payload_store.get_store(mock_config)
+        assert threshold == actual.threshold
+
+
+@pytest.mark.parametrize("payload_size,exp_stored", ((10, False), (11, True)))
+def test_from_to_klio_message(
+    payload_size, exp_stored, klio_message, store_config
+):
+    payload = b"x" * payload_size
+
+    serialized = serializer.from_klio_message(
+        klio_message, payload, store_config
+    )
+
+    parsed = klio_pb2.KlioMessage.FromString(serialized)
+    assert exp_stored is payload_store.is_handle(parsed.data.payload)
+
+    actual = serializer.to_klio_message(serialized, store_config)
+    assert payload == actual.data.payload
+
+
+def test_from_klio_message_error_releases(
+    klio_message, store_config, monkeypatch, mocker
+):
+    monkeypatch.setattr(
+        serializer,
+        "_serialize_with_payload",
+        mocker.Mock(side_effect=ValueError("nope")),
+    )
+
+    with pytest.raises(ValueError):
+        serializer.from_klio_message(klio_message, b"x" * 100, store_config)
+
+    assert 0 == len(payload_store.get_store())
+
+
+def test_to_klio_message_missing_payload(klio_message, store_config):
+    serialized = serializer.from_klio_message(
+        klio_message, b"x" * 100, store_config
+    )
+    payload_store.evict(klio_message.data.element)
+
+    with pytest.raises(
+        exceptions.KlioMessagePayloadException, match="not found"
+    ):
+        serializer.to_klio_message(serialized, store_config)
+
+
+def test_to_klio_message_no_store(klio_message, monkeypatch):
+    monkeypatch.setattr(payload_store, "_STORE", None)
+    klio_message.data.payload = payload_store.HANDLE_PREFIX + b"abc"
+
+    with pytest.raises(
+        exceptions.KlioMessagePayloadException, match="no payload store"
+    ):
+        serializer.to_klio_message(klio_message)
+
+
+@pytest.mark.parametrize("parsed", (True, False))
+def test_inline_payload(parsed, klio_message, store_config):
+    payload = b"x" * 100
+    serialized = serializer.from_klio_message(
+        klio_message, payload, store_config
+    )
+    incoming = serialized
+    if parsed:
+        incoming = klio_pb2.KlioMessage.FromString(serialized)
+
+    actual = serializer.inline_payload(incoming)
+
+    if parsed:
+        assert actual is incoming
+    else:
+        actual = klio_pb2.KlioMessage.FromString(actual)
+    assert payload == actual.data.payload
+    # the outgoing message was the only reference
+    assert 0 == len(payload_store.get_store())
+
+
+@pytest.mark.parametrize(
+    "incoming",
+    (
+        b"not a klio message",
+        klio_pb2.KlioMessage(
+            data=klio_pb2.KlioMessage.Data(payload=b"x" * 100)
+        ).SerializeToString(),
+    ),
+)
+def test_inline_payload_not_stored(incoming):
+    assert incoming is serializer.inline_payload(incoming)
+
+
+def test_mark_done_evicts(klio_message, store_config, monkeypatch):
+    monkeypatch.setattr(pmm, "IN_FLIGHT", pmm._InFlightRegistry())
+    serializer.from_klio_message(klio_message, b"x" * 100, store_config)
+    assert 1 == len(payload_store.get_store())
+
+    pmm.MessageManager.mark_done(klio_message)
+
+    assert 0 == len(payload_store.get_store())
+
+
+def test_mark_done_keeps_other_messages_payloads(
+    klio_message, store_config, monkeypatch, mocker
+):
+    monkeypatch.setattr(pmm, "IN_FLIGHT", pmm._InFlightRegistry())
+    monkeypatch.setattr(pmm, "_get_or_create_scheduler", mocker.Mock())
+    kmsg_id = klio_message.data.element.decode("utf-8")
+    # the same element, published twice
+    for token in (1, 2):
+        message = pmm.PubSubKlioMessage(
+            "ack-{}".format(token), kmsg_id, key="msg-{}".format(token)
+        )
+        pmm.IN_FLIGHT.add(message, token)
+        payload_store.hold(klio_message.data.element)
+    serializer.from_klio_message(klio_message, b"x" * 100, store_config)
+    serialized = klio_message.SerializeToString()
+
+    pmm.MessageManager.mark_done(pmm.attach_token(serialized, 1))
+    assert 1 == len(payload_store.get_store())
+
+    pmm.MessageManager.mark_done(pmm.attach_token(serialized, 2))
+    assert 0 == len(payload_store.get_store())
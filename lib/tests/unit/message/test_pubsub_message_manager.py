@@ -27,6 +27,7 @@ from apache_beam.testing import test_pipeline as beam_test_pipeline
 from klio_core.proto import klio_pb2
 
 from klio.message import pubsub_message_manager as pmm
+from klio.message import view
 from klio.transforms import core
 from tests.unit import conftest
 
@@ -42,6 +43,13 @@ from klio.transforms import helpers  # NOQA: E402, I100, I202
 patcher.stop()
 
 
+@pytest.fixture(autouse=True)
+def in_flight(monkeypatch):
+    registry = pmm._InFlightRegistry(stripes=4)
+    monkeypatch.setattr(pmm, "IN_FLIGHT", registry)
+    return registry
+
+
 @pytest.fixture
 def patch_subscriber_client(mocker, monkeypatch):
     # patch out network calls in SubscriberClient instantiation
@@ -53,8 +61,8 @@ def patch_subscriber_client(mocker, monkeypatch):
 @pytest.fixture
 def msg_manager(patch_subscriber_client, mocker, monkeypatch):
     m = pmm.MessageManager("subscription")
-    mock_threadpool_exec = mocker.Mock()
-    monkeypatch.setattr(m, "executor", mock_threadpool_exec)
+    mock_scheduler = mocker.Mock()
+    monkeypatch.setattr(m, "scheduler", mock_scheduler)
     return m
 
 
@@ -136,62 +144,115 @@ def test_msg_manager_init(
     assert hb_logger == mm.hrt_logger
 
 
-# This plus the MockTrueFunc class is meant to mock the `foo in my_dict`
-# call, particularly helpful when needing to break out of a `while True` loop.
-# I couldn't otherwise find a way to mock a dictionary to return a different
-# value for the same key lookup.
-def true_once():
-    yield True
-    yield False
+@pytest.fixture
+def clock(mocker, monkeypatch):
+    mock_time = mocker.Mock()
+    mock_time.monotonic.return_value = 100
+    monkeypatch.setattr(pmm, "time", mock_time)
+    return mock_time
 
 
-class MockTrueFunc:
-    def __init__(self):
-        self.gen = true_once()
+def test_msg_manager_manage(
+    clock, mocker, monkeypatch, msg_manager, hb_logger, caplog
+):
+    mock_rm = mocker.Mock()
+    monkeypatch.setattr(msg_manager, "remove", mock_rm)
 
-    def __call__(self, *args, **kwargs):
-        return next(self.gen)
+    msg = pmm.PubSubKlioMessage(ack_id=1, kmsg_id="2")
+    msg.extend(10)
+
+    # due again once 80% of the extension passed
+    assert 108 == msg_manager.manage(msg)
+    msg_manager._client.modify_ack_deadline.assert_not_called()
+    hb_logs = [c for c in caplog.records if c.name == hb_logger.name]
+    assert 1 == len(hb_logs)
+    assert 100 == msg.last_heartbeat
+
+    clock.monotonic.return_value = 108
+    # next due for a heartbeat
+    assert 110 == msg_manager.manage(msg)
+    msg_manager.flush()
+    msg_manager._client.modify_ack_deadline.assert_called_once_with(
+        subscription=msg_manager._sub_name,
+        ack_ids=[1],
+        ack_deadline_seconds=msg_manager.DEFAULT_DEADLINE_EXTENSION,
+        timeout=msg_manager.REQUEST_TIMEOUT_SEC,
+    )
 
+    msg.done = True
+    assert msg_manager.manage(msg) is None
+    mock_rm.assert_called_once_with(msg)
 
-def test_msg_manager_manage(mocker, monkeypatch, msg_manager):
-    mock_time = mocker.Mock()
-    monkeypatch.setattr(pmm, "time", mock_time)
 
-    maybe_extend = mocker.Mock()
-    monkeypatch.setattr(msg_manager, "_maybe_extend", maybe_extend)
-    mock_rm = mocker.Mock()
-    monkeypatch.setattr(msg_manager, "remove", mock_rm)
+def test_msg_manager_heartbeat(clock, msg_manager, caplog):
+    msg = pmm.PubSubKlioMessage(ack_id=1, kmsg_id="2")
 
-    mock_entity_id_to_ack_id = mock.MagicMock()
-    mock_entity_id_to_ack_id.__contains__ = MockTrueFunc()
-    monkeypatch.setattr(pmm, "ENTITY_ID_TO_ACK_ID", mock_entity_id_to_ack_id)
+    msg_manager.heartbeat(msg)
 
-    msg = mocker.Mock(kmsg_id=1)
-    msg_manager.manage(msg)
+    assert 1 == len(caplog.records)
+    assert 100 == msg.last_heartbeat
 
-    maybe_extend.assert_called_once_with(msg)
-    mock_rm.assert_called_once_with(msg)
-    mock_time.sleep.assert_called_once_with(msg_manager.manager_sleep)
 
+class FakeManager(object):
+    manager_sleep = 3
 
-def test_msg_manager_heartbeat(mocker, monkeypatch, msg_manager, caplog):
-    mock_time = mocker.Mock()
-    monkeypatch.setattr(pmm, "time", mock_time)
+    def __init__(self, checks, error=None):
+        self.checks = checks
+        self.error = error
+        self.checked = []
+        self.done = threading.Event()
 
-    maybe_extend = mocker.Mock()
-    monkeypatch.setattr(msg_manager, "_maybe_extend", maybe_extend)
-    mock_rm = mocker.Mock()
-    monkeypatch.setattr(msg_manager, "remove", mock_rm)
+    def manage(self, message):
+        self.checked.append(message)
+        if len(self.checked) == self.checks:
+            self.done.set()
+        if self.error is not None and len(self.checked) == 1:
+            raise self.error
+        return None
 
-    mock_entity_id_to_ack_id = mock.MagicMock()
-    mock_entity_id_to_ack_id.__contains__ = MockTrueFunc()
-    monkeypatch.setattr(pmm, "ENTITY_ID_TO_ACK_ID", mock_entity_id_to_ack_id)
 
-    msg = mocker.Mock(kmsg_id=1)
-    msg_manager.heartbeat(msg)
+def test_scheduler_order(clock, mocker, monkeypatch):
+    monkeypatch.setattr(pmm.threading, "Thread", mocker.Mock())
+    scheduler = pmm._Scheduler()
+    manager = FakeManager(checks=3)
+
+    scheduler.schedule(manager, "a", 103)
+    scheduler.schedule(manager, "b", 101)
+    scheduler.schedule(manager, "c", 102)
+    # rescheduling replaces the previous entry
+    scheduler.schedule(manager, "b", 104)
+    scheduler.wake("c")
+    scheduler.wake("unknown")
+    clock.monotonic.return_value = 104
+
+    assert 3 == len(scheduler)
+    order = [scheduler._next_task()[0][3] for _ in range(3)]
+    assert ["c", "a", "b"] == order
+
+
+def test_scheduler_run(monkeypatch):
+    scheduler = pmm._Scheduler()
+    manager = FakeManager(checks=2000, error=Exception("oh no"))
+    now = pmm.time.monotonic()
+
+    for i in range(2000):
+        scheduler.schedule(manager, i, now - i)
+
+    assert manager.done.wait(timeout=10)
+    assert set(range(2000)) == set(manager.checked)
+    # rescheduled after the error, the rest are done
+    deadline = now + 10
+    while len(scheduler) > 1 and pmm.time.monotonic() < deadline:
+        pmm.time.sleep(0.001)
+    assert 1 == len(scheduler)
 
-    assert 2 == len(caplog.records)
-    mock_time.sleep.assert_called_once_with(msg_manager.heartbeat_sleep)
+
+def test_get_or_create_scheduler(msg_manager, monkeypatch):
+    monkeypatch.setattr(pmm, "_SCHEDULER", None)
+    scheduler = pmm._get_or_create_scheduler()
+
+    assert scheduler is pmm._get_or_create_scheduler()
+    assert scheduler is pmm.MessageManager("subscription").scheduler
 
 
 @pytest.mark.parametrize(
@@ -240,6 +301,8 @@ def test_msg_manager_extend_deadline(mocker, msg_manager, duration, caplog):
     kmsg = pmm.PubSubKlioMessage(ack_id=1, kmsg_id=2)
     kmsg.extend = mocker.Mock()
     msg_manager.extend_deadline(kmsg, duration)
+    msg_manager._client.modify_ack_deadline.assert_not_called()
+    msg_manager.flush()
 
     exp_duration = (
         duration if duration else msg_manager.DEFAULT_DEADLINE_EXTENSION
@@ -249,6 +312,7 @@ def test_msg_manager_extend_deadline(mocker, msg_manager, duration, caplog):
         "subscription": msg_manager._sub_name,
         "ack_ids": [kmsg.ack_id],
         "ack_deadline_seconds": exp_duration,
+        "timeout": msg_manager.REQUEST_TIMEOUT_SEC,
     }
     msg_manager._client.modify_ack_deadline.assert_called_once_with(**exp_req)
 
@@ -260,6 +324,7 @@ def test_msg_manager_extend_deadline_raises(msg_manager, caplog):
     kmsg = pmm.PubSubKlioMessage(ack_id=1, kmsg_id=2)
     msg_manager._client.modify_ack_deadline.side_effect = Exception("oh no")
     msg_manager.extend_deadline(kmsg, 12)
+    msg_manager.flush()
     assert 2 == len(caplog.records)
 
 
@@ -272,17 +337,19 @@ def _get_pubsub_message(klio_element):
 
 
 def _compare_objects_dicts(first, second):
-    return first.__dict__ == second.__dict__
+    # every message has a lock of its own
+    first_dict = dict(first.__dict__, lock=None)
+    second_dict = dict(second.__dict__, lock=None)
+    return first_dict == second_dict
 
 
 def test_convert_raw_pubsub_message(mocker, monkeypatch, msg_manager):
     mock_event = mocker.Mock()
     monkeypatch.setattr(pmm.threading, "Event", mock_event)
-    exp_message = pmm.PubSubKlioMessage("ack_id1", "kmsg_id1")
-
     kmsg = klio_pb2.KlioMessage()
     kmsg.data.element = b"kmsg_id1"
     kmsg_bytes = kmsg.SerializeToString()
+    exp_message = pmm.PubSubKlioMessage("ack_id1", "kmsg_id1", len(kmsg_bytes))
     pmsg = beam_pubsub.PubsubMessage(data=kmsg_bytes, attributes={})
 
     act_message = msg_manager._convert_raw_pubsub_message("ack_id1", pmsg)
@@ -292,7 +359,7 @@ def test_convert_raw_pubsub_message(mocker, monkeypatch, msg_manager):
     assert _compare_objects_dicts(exp_message, act_message)
 
 
-def test_msg_manager_add(mocker, monkeypatch, msg_manager, caplog):
+def test_msg_manager_add(mocker, monkeypatch, msg_manager, in_flight, caplog):
     extend_deadline = mocker.Mock()
     monkeypatch.setattr(msg_manager, "extend_deadline", extend_deadline)
     mock_event = mocker.Mock()
@@ -300,20 +367,120 @@ def test_msg_manager_add(mocker, monkeypatch, msg_manager, caplog):
 
     pmsg1 = _get_pubsub_message("2")
     pmsg2 = _get_pubsub_message("4")
-    psk_msg1 = pmm.PubSubKlioMessage(ack_id=1, kmsg_id="2")
-    psk_msg2 = pmm.PubSubKlioMessage(ack_id=3, kmsg_id="4")
+    psk_msg1 = pmm.PubSubKlioMessage(1, "2", len(pmsg1.data))
+    psk_msg2 = pmm.PubSubKlioMessage(3, "4", len(pmsg2.data))
 
-    msg_manager.add(ack_id=1, raw_pubsub_message=pmsg1)
-    msg_manager.add(ack_id=3, raw_pubsub_message=pmsg2)
+    token1 = msg_manager.add(ack_id=1, raw_pubsub_message=pmsg1)
+    token2 = msg_manager.add(ack_id=3, raw_pubsub_message=pmsg2)
+    psk_msg1.tokens[token1] = 1
+    psk_msg2.tokens[token2] = 3
 
-    assert 4 == msg_manager.executor.submit.call_count
+    assert token1 != token2
+    assert 2 == msg_manager.scheduler.schedule.call_count
     assert 2 == len(caplog.records)
-    assert _compare_objects_dicts(
-        psk_msg1, pmm.ENTITY_ID_TO_ACK_ID[psk_msg1.kmsg_id]
+    assert _compare_objects_dicts(psk_msg1, in_flight.get(token1))
+    assert _compare_objects_dicts(psk_msg2, in_flight.get(token2))
+
+
+def test_msg_manager_add_duplicate(
+    mocker, monkeypatch, msg_manager, in_flight
+):
+    extend_deadline = mocker.Mock()
+    monkeypatch.setattr(msg_manager, "extend_deadline", extend_deadline)
+
+    token = msg_manager.add(1, _get_pubsub_message("2"), message_id="a")
+    dup_token = msg_manager.add(3, _get_pubsub_message("2"), message_id="a")
+
+    # the duplicate delivery is handled along with the first one
+    assert 1 == msg_manager.scheduler.schedule.call_count
+    psk_msg = in_flight.get(token)
+    assert psk_msg is in_flight.get(dup_token)
+    assert 1 == psk_msg.ack_id
+    assert [1, 3] == psk_msg.ack_ids
+    assert {token: 1, dup_token: 3} == psk_msg.tokens
+    assert 2 == extend_deadline.call_count
+    extend_deadline.assert_called_with(psk_msg, psk_msg.ext_duration)
+
+
+def test_msg_manager_add_same_element(msg_manager, in_flight):
+    token = msg_manager.add(1, _get_pubsub_message("2"), message_id="a")
+    other_token = msg_manager.add(3, _get_pubsub_message("2"), message_id="b")
+
+    # different messages with the same element are handled separately
+    assert 2 == msg_manager.scheduler.schedule.call_count
+    assert 2 == len(in_flight)
+    assert in_flight.get(token) is not in_flight.get(other_token)
+
+    pmm.MessageManager.mark_done(
+        pmm.attach_token(_generate_kmsg("2"), other_token)
     )
-    assert _compare_objects_dicts(
-        psk_msg2, pmm.ENTITY_ID_TO_ACK_ID[psk_msg2.kmsg_id]
+
+    assert in_flight.get(token).done is False
+    assert in_flight.get(other_token) is None
+    assert 1 == len(in_flight)
+
+
+def test_msg_manager_in_flight(msg_manager, in_flight):
+    tokens = [
+        msg_manager.add(i, _get_pubsub_message(str(i))) for i in range(3)
+    ]
+    # redeliveries aren't counted again
+    msg_manager.add(3, _get_pubsub_message("0"))
+    size = len(_get_pubsub_message("0").data)
+
+    assert 3 == msg_manager.in_flight
+    assert 3 * size == msg_manager.in_flight_bytes
+
+    msg_manager.remove(in_flight.get(tokens[1]))
+
+    assert 2 == msg_manager.in_flight
+    assert 2 * size == msg_manager.in_flight_bytes
+
+
+def test_msg_manager_mark_duplicate(msg_manager, in_flight):
+    psk_msg = pmm.PubSubKlioMessage(ack_id=1, kmsg_id="2")
+    in_flight.add(psk_msg, 10)
+    in_flight.add(pmm.PubSubKlioMessage(ack_id=3, kmsg_id="2"), 11)
+
+    pmm.MessageManager.mark_duplicate(_generate_kmsg("2"))
+
+    # only the duplicate is done
+    assert psk_msg is in_flight.find("2")
+    assert [] == psk_msg.duplicate_ack_ids
+    assert [3] == psk_msg.done_duplicate_ack_ids
+
+    msg_manager._ack_done_duplicates(psk_msg)
+    msg_manager.flush()
+    msg_manager._client.acknowledge.assert_called_once_with(
+        msg_manager._sub_name, [3], timeout=msg_manager.REQUEST_TIMEOUT_SEC
     )
+    assert [] == psk_msg.done_duplicate_ack_ids
+
+    # no other deliveries in progress, so the message itself is done
+    pmm.MessageManager.mark_duplicate(_generate_kmsg("2"))
+    assert in_flight.find("2") is None
+    assert psk_msg.done is True
+
+
+def test_msg_manager_mark_duplicate_token(msg_manager, in_flight):
+    psk_msg = pmm.PubSubKlioMessage(ack_id=1, kmsg_id="2")
+    in_flight.add(psk_msg, 10)
+    in_flight.add(pmm.PubSubKlioMessage(ack_id=3, kmsg_id="2"), 11)
+
+    # the first delivery is the one dropped as a duplicate
+    pmm.MessageManager.mark_duplicate(
+        pmm.attach_token(_generate_kmsg("2"), 10)
+    )
+
+    assert 3 == psk_msg.ack_id
+    assert [1] == psk_msg.done_duplicate_ack_ids
+    assert in_flight.get(10) is None
+    assert psk_msg is in_flight.get(11)
+
+    pmm.MessageManager.mark_done(pmm.attach_token(_generate_kmsg("2"), 11))
+    assert psk_msg.done is True
+    assert in_flight.get(11) is None
+    assert 0 == len(in_flight)
 
 
 def test_msg_manager_remove(mocker, monkeypatch, msg_manager, caplog):
@@ -321,8 +488,11 @@ def test_msg_manager_remove(mocker, monkeypatch, msg_manager, caplog):
     psk_msg1 = pmm.PubSubKlioMessage(ack_id, kmsg_id)
 
     msg_manager.remove(psk_msg1)
+    msg_manager.flush()
     msg_manager._client.acknowledge.assert_called_once_with(
-        msg_manager._sub_name, [ack_id]
+        msg_manager._sub_name,
+        [ack_id],
+        timeout=msg_manager.REQUEST_TIMEOUT_SEC,
     )
     assert 1 == len(caplog.records)
 
@@ -333,9 +503,215 @@ def test_msg_manager_remove_raises(msg_manager, monkeypatch, caplog):
 
     msg_manager._client.acknowledge.side_effect = Exception("oh no")
     msg_manager.remove(psk_msg1)
+    msg_manager.flush()
     assert 2 == len(caplog.records)
 
 
+class FakeSubscriberClient(object):
+    """Records requests, and rejects those with any of `invalid_ack_ids`."""
+
+    def __init__(self, invalid_ack_ids=()):
+        self.invalid_ack_ids = set(invalid_ack_ids)
+        self.extended = []
+        self.acknowledged = []
+
+    def _check(self, ack_ids):
+        if self.invalid_ack_ids.intersection(ack_ids):
+            raise pmm.g_exceptions.InvalidArgument("expired ack ID")
+
+    def modify_ack_deadline(
+        self, subscription, ack_ids, ack_deadline_seconds, timeout
+    ):
+        self.extended.append((list(ack_ids), ack_deadline_seconds))
+        self._check(ack_ids)
+
+    def acknowledge(self, subscription, ack_ids, timeout):
+        self.acknowledged.append(list(ack_ids))
+        self._check(ack_ids)
+
+
+@pytest.fixture
+def fake_client(msg_manager, monkeypatch):
+    client = FakeSubscriberClient()
+    monkeypatch.setattr(msg_manager, "_client", client)
+    return client
+
+
+def test_msg_manager_batches(msg_manager, fake_client, in_flight):
+    tokens = [
+        msg_manager.add(i, _get_pubsub_message(str(i))) for i in range(100)
+    ]
+    messages = [in_flight.get(token) for token in tokens]
+    msg_manager.scheduler.flush_later.assert_called_with(msg_manager, mock.ANY)
+
+    msg_manager.flush()
+    for message in messages:
+        pmm.MessageManager.mark_done(_generate_kmsg(message.kmsg_id))
+        msg_manager.manage(message)
+    msg_manager.flush()
+
+    # one request each rather than one per message
+    assert [(list(range(100)), 30)] == fake_client.extended
+    assert [list(range(100))] == fake_client.acknowledged
+    # nothing left to send
+    msg_manager.flush()
+    assert 1 == len(fake_client.extended)
+
+
+def test_msg_manager_batches_max_size(msg_manager, fake_client, monkeypatch):
+    monkeypatch.setattr(msg_manager, "MAX_BATCH_SIZE", 40)
+    messages = [pmm.PubSubKlioMessage(i, str(i)) for i in range(50)]
+    for message in messages[:45]:
+        msg_manager.extend_deadline(message)
+    for message in messages[45:]:
+        msg_manager.extend_deadline(message, 60)
+
+    # sent once full
+    assert [(list(range(40)), 30)] == fake_client.extended
+
+    msg_manager.flush()
+    assert [
+        (list(range(40)), 30),
+        (list(range(40, 45)), 30),
+        (list(range(45, 50)), 60),
+    ] == fake_client.extended
+
+
+class _InterleavedLock(object):
+    # runs `before` once, right before the lock is first acquired
+    def __init__(self, lock, before):
+        self._lock = lock
+        self._before = before
+
+    def __enter__(self):
+        before, self._before = self._before, None
+        if before is not None:
+            before()
+        return self._lock.__enter__()
+
+    def __exit__(self, *args):
+        return self._lock.__exit__(*args)
+
+
+@pytest.mark.parametrize("duration", (30, 60))
+def test_msg_manager_extend_during_flush(
+    duration, msg_manager, fake_client, monkeypatch
+):
+    message = pmm.PubSubKlioMessage(1, "1")
+    # a flush on another thread swaps out pending extensions just as the
+    # extension is enqueued
+    monkeypatch.setattr(
+        msg_manager,
+        "_batch_lock",
+        _InterleavedLock(msg_manager._batch_lock, msg_manager.flush),
+    )
+
+    msg_manager.extend_deadline(message, duration)
+    msg_manager.flush()
+
+    # not lost in the extensions that were already flushed
+    assert [([1], duration)] == fake_client.extended
+
+
+def test_msg_manager_batches_invalid_ack_id(msg_manager, fake_client, caplog):
+    fake_client.invalid_ack_ids.add(2)
+    messages = [pmm.PubSubKlioMessage(i, str(i)) for i in range(4)]
+    for message in messages:
+        msg_manager.remove(message)
+
+    msg_manager.flush()
+
+    # halves are retried until the invalid ack ID is found, so only it
+    # fails
+    assert [[0, 1, 2, 3], [0, 1], [2, 3], [2], [3]] == fake_client.acknowledged
+    errors = [r for r in caplog.records if r.levelno == logging.ERROR]
+    assert 1 == len(errors)
+    assert "'2'" in errors[0].getMessage()
+    acked = [r for r in caplog.records if r.levelno == logging.INFO]
+    assert 3 == len(acked)
+
+
+def test_msg_manager_batches_bisect(msg_manager, fake_client, caplog):
+    fake_client.invalid_ack_ids.update([5, 900])
+    messages = [pmm.PubSubKlioMessage(i, str(i)) for i in range(1000)]
+    for message in messages:
+        msg_manager.extend_deadline(message)
+
+    msg_manager.flush()
+
+    # far fewer requests than one per ack ID
+    assert len(fake_client.extended) <= 1 + msg_manager.MAX_RETRY_REQUESTS
+    failed = [
+        ack_ids for ack_ids, _ in fake_client.extended if len(ack_ids) == 1
+    ]
+    assert [5] in failed
+    assert [900] in failed
+    # every valid ack ID was extended in one of the successful requests
+    extended = {
+        ack_id
+        for ack_ids, _ in fake_client.extended
+        if not fake_client.invalid_ack_ids.intersection(ack_ids)
+        for ack_id in ack_ids
+    }
+    assert set(range(1000)) - {5, 900} == extended
+    errors = [r for r in caplog.records if r.levelno == logging.ERROR]
+    assert 2 == len(errors)
+
+
+def test_msg_manager_batches_max_retries(msg_manager, fake_client, caplog):
+    # e.g. all of them expired
+    fake_client.invalid_ack_ids.update(range(1000))
+    messages = [pmm.PubSubKlioMessage(i, str(i)) for i in range(1000)]
+    for message in messages:
+        msg_manager.extend_deadline(message)
+
+    msg_manager.flush()
+
+    assert len(fake_client.extended) <= 1 + msg_manager.MAX_RETRY_REQUESTS
+    errors = [r for r in caplog.records if r.levelno == logging.ERROR]
+    assert 1000 == len(errors)
+
+
+def test_msg_manager_leases(msg_manager, fake_client, in_flight, mocker):
+    leases = [mocker.Mock(), mocker.Mock()]
+    msg_manager.add(1, _get_pubsub_message("1"), lease=leases[0])
+    msg_manager.add(2, _get_pubsub_message("1"), lease=leases[1])
+    msg_manager.add(3, _get_pubsub_message("1"))
+    message = in_flight.find("1")
+    assert {1: leases[0], 2: leases[1]} == message.leases
+
+    msg_manager.remove(message)
+    msg_manager.flush()
+
+    # acknowledged through the streaming pull, unless pulled
+    leases[0].ack.assert_called_once_with()
+    leases[1].ack.assert_called_once_with()
+    assert [[3]] == fake_client.acknowledged
+    # the streaming pull extends the deadlines of its own messages
+    assert [([3], 30)] == fake_client.extended
+
+
+def test_scheduler_flush_later(clock, mocker, monkeypatch):
+    monkeypatch.setattr(pmm.threading, "Thread", mocker.Mock())
+    scheduler = pmm._Scheduler()
+    first, second = mocker.Mock(), mocker.Mock()
+
+    scheduler.schedule(first, "a", 101)
+    scheduler.flush_later(first, 102)
+    scheduler.flush_later(second, 101.5)
+    clock.monotonic.return_value = 102
+
+    # checks due go first, so they're flushed along with the others
+    assert "a" == scheduler._next_task()[0][3]
+    entry, managers = scheduler._next_task()
+    assert entry is None
+    assert {first, second} == managers
+
+    scheduler._flush(managers)
+    first.flush.assert_called_once_with()
+    second.flush.assert_called_once_with()
+
+
 def _generate_kmsg(element):
     message = klio_pb2.KlioMessage()
     message.data.element = bytes(str(element), "utf-8")
@@ -351,10 +727,10 @@ def _assert_expected_msg(actual):
     assert actual_msg == expected_msg
 
 
-def test_klio_ack_input_msg(mocker, monkeypatch):
+def test_klio_ack_input_msg(mocker, monkeypatch, in_flight):
     ack_id, kmsg_id = 1, "2"
     psk_msg1 = pmm.PubSubKlioMessage(ack_id, kmsg_id)
-    monkeypatch.setitem(pmm.ENTITY_ID_TO_ACK_ID, psk_msg1.kmsg_id, psk_msg1)
+    in_flight.add(psk_msg1, 1)
     with beam_test_pipeline.TestPipeline() as p:
         (
             p
@@ -364,4 +740,80 @@ def test_klio_ack_input_msg(mocker, monkeypatch):
             | beam.Map(_assert_expected_msg)
         )
 
-    assert not pmm.ENTITY_ID_TO_ACK_ID.get("2")
+    assert in_flight.find("2") is None
+
+
+def test_attach_token():
+    serialized = _generate_kmsg("2")
+    assert pmm.read_token(serialized) is None
+
+    with_token = pmm.attach_token(serialized, 300)
+    assert 300 == pmm.read_token(with_token)
+    # a token attached before is replaced
+    replaced = pmm.attach_token(with_token, 5)
+    assert 5 == pmm.read_token(replaced)
+    assert len(with_token) - 1 == len(replaced)
+
+    # carried along while the message is processed
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.ParseFromString(replaced)
+    assert b"2" == kmsg.data.element
+    kmsg.data.payload = b"a payload"
+    assert 5 == pmm.read_token(kmsg)
+    assert 5 == pmm.read_token(view.KlioMessageView(replaced))
+
+
+def test_read_token_unknown_fields(mocker, monkeypatch):
+    # protobuf < 4.21
+    monkeypatch.setattr(pmm, "pb_unknown_fields", None)
+    kmsg = mocker.Mock(spec=klio_pb2.KlioMessage)
+    kmsg.UnknownFields.return_value = [
+        mocker.Mock(field_number=16, wire_type=view._VARINT, data=7),
+        mocker.Mock(field_number=pmm.TOKEN_FIELD, wire_type=2, data=b"x"),
+        mocker.Mock(
+            field_number=pmm.TOKEN_FIELD, wire_type=view._VARINT, data=5
+        ),
+    ]
+
+    assert 5 == pmm.read_token(kmsg)
+    # the message, payload & all, isn't serialized to find the token
+    kmsg.SerializeToString.assert_not_called()
+
+
+def test_detach_token():
+    serialized = _generate_kmsg("2")
+    assert serialized is pmm.detach_token(serialized)
+
+    with_token = pmm.attach_token(serialized, 300)
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.ParseFromString(with_token)
+    kmsg.data.payload = b"a payload"
+
+    detached = pmm.detach_token(kmsg.SerializeToString())
+    assert pmm.read_token(detached) is None
+    expected = klio_pb2.KlioMessage()
+    expected.ParseFromString(serialized)
+    expected.data.payload = b"a payload"
+    assert expected.SerializeToString() == detached
+
+
+def test_striped_dict():
+    striped = pmm._StripedDict(stripes=4)
+    values = [object() for _ in range(3)]
+
+    for key, value in enumerate(values):
+        striped.set(key, value)
+    assert values[0] is striped.setdefault(0, values[1])
+    striped.discard(0, values[1])
+    assert values[0] is striped.get(0)
+    striped.discard(0)
+    assert striped.get(0) is None
+    assert 2 == len(striped)
+
+    striped.append("a", values[0])
+    striped.append("a", values[1])
+    striped.remove("a", values[0])
+    assert values[1] is striped.first("a")
+    striped.remove("a", values[1])
+    assert striped.first("a") is None
+    assert 2 == len(striped)
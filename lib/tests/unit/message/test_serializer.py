@@ -13,8 +13,11 @@
 # limitations under the License.
 #
 
+import pickle
+
 import pytest
 
+from apache_beam import coders as beam_coders
 from apache_beam import pvalue
 from google.protobuf import message as gproto_message
 
@@ -99,6 +102,23 @@ def test_to_klio_message(klio_message, klio_message_str, klio_config, logger):
     logger.error.assert_not_called()
 
 
+def test_to_klio_message_already_parsed(klio_message, klio_config, logger):
+    actual_message = serializer.to_klio_message(
+        klio_message, klio_config, logger
+    )
+
+    assert klio_message is actual_message
+    logger.error.assert_not_called()
+
+
+@pytest.mark.parametrize("parsed", (True, False))
+def test_to_incoming_type(parsed, klio_message, klio_message_str):
+    incoming = klio_message if parsed else klio_message_str
+    expected = klio_message if parsed else klio_message_str
+
+    assert expected == serializer._to_incoming_type(klio_message, incoming)
+
+
 def test_to_klio_message_allow_non_kmsg(klio_config, logger, monkeypatch):
     monkeypatch.setattr(
         klio_config.job_config, "allow_non_klio_messages", True
@@ -133,6 +153,10 @@ def test_to_klio_message_raises(klio_config, logger, monkeypatch):
         (b"some payload", b"some payload"),
         (_get_klio_message().data, None),
         ("string payload", b"string payload"),
+        (bytearray(b"some payload"), b"some payload"),
+        (memoryview(b"some payload"), b"some payload"),
+        (memoryview(b"x" * 1024).cast("I"), b"x" * 1024),
+        (memoryview(b"x" * 1024)[::2], b"x" * 512),
     ),
 )
 def test_from_klio_message(klio_message, payload, exp_payload):
@@ -146,6 +170,91 @@ def test_from_klio_message(klio_message, payload, exp_payload):
     assert expected_str == actual_message
 
 
+def test_from_klio_message_same_data(klio_message):
+    klio_message.data.payload = b"some payload"
+    expected = _get_klio_message().SerializeToString()
+
+    actual_message = serializer.from_klio_message(
+        klio_message, klio_message.data
+    )
+    assert expected == actual_message
+
+
+@pytest.mark.parametrize("with_metadata", (True, False))
+@pytest.mark.parametrize(
+    "data",
+    (
+        {},
+        {"entity_id": "an-entity-id"},
+        {"element": b"an-element"},
+        {"entity_id": "an-entity-id", "element": b"an-element"},
+        {"payload": b"an-old-payload"},
+        {"element": b"an-element", "payload": b"an-old-payload"},
+    ),
+)
+@pytest.mark.parametrize("payload", (b"", b"x", b"x" * 50000))
+@pytest.mark.parametrize("splice_min_size", (None, 0))
+def test_from_klio_message_wire_format(
+    splice_min_size, payload, data, with_metadata, monkeypatch
+):
+    if splice_min_size is not None:
+        monkeypatch.setattr(
+            serializer, "_SPLICE_MIN_PAYLOAD_SIZE", splice_min_size
+        )
+    msg = klio_pb2.KlioMessage(version=klio_pb2.Version.V2)
+    if with_metadata:
+        msg.metadata.CopyFrom(_get_klio_message().metadata)
+    if data:
+        msg.data.CopyFrom(klio_pb2.KlioMessage.Data(**data))
+    expected = klio_pb2.KlioMessage()
+    expected.CopyFrom(msg)
+    expected.data.payload = payload
+
+    actual_message = serializer.from_klio_message(msg, payload)
+
+    # the payload is spliced in the same way protobuf would serialize it
+    assert expected.SerializeToString() == actual_message
+    if splice_min_size is not None and payload:
+        # the caller's message keeps its own payload
+        assert data.get("payload", b"") == msg.data.payload
+
+
+@pytest.mark.parametrize("error", (None, Exception("fuu")))
+def test_from_klio_message_splice_skips_old_payload(
+    error, mocker, monkeypatch
+):
+    monkeypatch.setattr(serializer, "_SPLICE_MIN_PAYLOAD_SIZE", 0)
+    msg = mocker.Mock()
+    msg.data.payload = b"an-old-payload"
+    serialized_payloads = []
+
+    def serialize():
+        serialized_payloads.append(msg.data.payload)
+        if error:
+            raise error
+        return klio_pb2.KlioMessage(
+            data=klio_pb2.KlioMessage.Data(element=b"an-element")
+        ).SerializeToString()
+
+    msg.SerializeToString.side_effect = serialize
+
+    if error:
+        with pytest.raises(Exception, match="fuu"):
+            serializer._serialize_with_payload(msg, b"a-new-payload")
+    else:
+        actual = serializer._serialize_with_payload(msg, b"a-new-payload")
+        expected = klio_pb2.KlioMessage(
+            data=klio_pb2.KlioMessage.Data(
+                element=b"an-element", payload=b"a-new-payload"
+            )
+        )
+        assert expected.SerializeToString() == actual
+
+    # the old payload is left out of the serialized message, & restored
+    assert [b""] == serialized_payloads
+    assert b"an-old-payload" == msg.data.payload
+
+
 def test_from_klio_message_v1():
     payload = b"some-payload"
     msg = klio_pb2.KlioMessage()
@@ -181,3 +290,14 @@ def test_from_klio_message_raises(klio_message):
         exceptions.KlioMessagePayloadException, match="Returned payload"
     ):
         serializer.from_klio_message(klio_message, payload)
+
+
+def test_klio_message_coder(klio_message):
+    coder = beam_coders.registry.get_coder(klio_pb2.KlioMessage)
+
+    assert isinstance(coder, serializer._KlioMessageCoder)
+    assert klio_message == coder.decode(coder.encode(klio_message))
+
+
+def test_pickle_klio_message(klio_message):
+    assert klio_message == pickle.loads(pickle.dumps(klio_message))
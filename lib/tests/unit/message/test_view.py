@@ -0,0 +1,218 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from google.protobuf import message as gproto_message
+
+from klio_core.proto import klio_pb2
+
+from klio.message import serializer
+from klio.message import view
+
+
+def _get_klio_job(job_name="klio-job"):
+    job = klio_pb2.KlioJob()
+    job.job_name = job_name
+    job.gcp_project = "test-project"
+    return job
+
+
+def _get_audit_log_item(job_name="klio-job"):
+    audit_log_item = klio_pb2.KlioJobAuditLogItem()
+    audit_log_item.timestamp.FromSeconds(1600000000)
+    audit_log_item.klio_job.CopyFrom(_get_klio_job(job_name))
+    return audit_log_item
+
+
+@pytest.fixture
+def klio_message():
+    msg = klio_pb2.KlioMessage()
+    msg.version = klio_pb2.Version.V2
+    msg.data.element = b"s0m3_tr4ck_1d"
+    msg.data.payload = b"some-payload" * 100
+    msg.metadata.ping = True
+    msg.metadata.downstream.extend([_get_klio_job("downstream")])
+    msg.metadata.visited.extend([_get_klio_job("visited")])
+    msg.metadata.job_audit_log.extend(
+        [_get_audit_log_item("parent"), _get_audit_log_item("grandparent")]
+    )
+    limited = msg.metadata.intended_recipients.limited
+    limited.recipients.extend([_get_klio_job()])
+    limited.trigger_children_of.CopyFrom(_get_klio_job())
+    return msg
+
+
+def test_view(klio_message):
+    serialized = klio_message.SerializeToString()
+
+    kmsg_view = view.KlioMessageView(serialized)
+
+    assert klio_pb2.Version.V2 == kmsg_view.version
+    assert b"s0m3_tr4ck_1d" == kmsg_view.data.element
+    assert "" == kmsg_view.data.entity_id
+    assert klio_message.data.payload == kmsg_view.data.payload
+    assert kmsg_view.metadata.ping is True
+    assert kmsg_view.metadata.force is False
+    assert list(klio_message.metadata.downstream) == list(
+        kmsg_view.metadata.downstream
+    )
+    assert list(klio_message.metadata.visited) == list(
+        kmsg_view.metadata.visited
+    )
+    assert 2 == len(kmsg_view.metadata.job_audit_log)
+    assert list(klio_message.metadata.job_audit_log) == list(
+        kmsg_view.metadata.job_audit_log
+    )
+    assert (
+        klio_message.metadata.intended_recipients
+        == kmsg_view.metadata.intended_recipients
+    )
+    # not changed, so the original bytes are handed back
+    assert serialized is kmsg_view.SerializeToString()
+    assert klio_message == kmsg_view.to_klio_message()
+
+
+@pytest.mark.parametrize(
+    "version",
+    (klio_pb2.Version.UNKNOWN, klio_pb2.Version.V1, klio_pb2.Version.V2),
+)
+@pytest.mark.parametrize(
+    "element,entity_id",
+    (
+        (b"an-element", None),
+        (None, "an-entity-id"),
+        (b"an-element", "an-entity-id"),
+        (None, None),
+    ),
+)
+def test_view_msg_compat(version, element, entity_id):
+    msg = klio_pb2.KlioMessage()
+    msg.version = version
+    if element:
+        msg.data.element = element
+    if entity_id:
+        msg.data.entity_id = entity_id
+    serialized = msg.SerializeToString()
+    expected = serializer._handle_msg_compat(msg)
+
+    kmsg_view = view.KlioMessageView(serialized)
+
+    assert expected.version == kmsg_view.version
+    assert expected.data.element == kmsg_view.data.element
+    assert expected == kmsg_view.to_klio_message()
+    actual = klio_pb2.KlioMessage.FromString(kmsg_view.SerializeToString())
+    assert expected == actual
+
+
+def test_view_merged_fields(klio_message):
+    # an embedded message field that occurs more than once is merged
+    update = klio_pb2.KlioMessage()
+    update.data.element = b"0th3r_tr4ck_1d"
+    update.metadata.force = True
+    update.metadata.job_audit_log.extend([_get_audit_log_item("other")])
+    update.metadata.intended_recipients.limited.recipients.extend(
+        [_get_klio_job("other")]
+    )
+    serialized = klio_message.SerializeToString() + update.SerializeToString()
+    expected = klio_pb2.KlioMessage.FromString(serialized)
+
+    kmsg_view = view.KlioMessageView(serialized)
+
+    assert expected.data.element == kmsg_view.data.element
+    assert expected.data.payload == kmsg_view.data.payload
+    assert kmsg_view.metadata.ping is True
+    assert kmsg_view.metadata.force is True
+    assert list(expected.metadata.job_audit_log) == list(
+        kmsg_view.metadata.job_audit_log
+    )
+    assert (
+        expected.metadata.intended_recipients
+        == kmsg_view.metadata.intended_recipients
+    )
+
+
+def test_view_update_recipients(klio_message):
+    kmsg_view = view.KlioMessageView(klio_message.SerializeToString())
+
+    kmsg_view.metadata.intended_recipients.anyone.SetInParent()
+
+    klio_message.metadata.intended_recipients.anyone.SetInParent()
+    actual = klio_pb2.KlioMessage.FromString(kmsg_view.SerializeToString())
+    assert klio_message == actual
+    assert klio_message == kmsg_view.to_klio_message()
+
+
+def test_view_extend_audit_log(klio_message):
+    serialized = klio_message.SerializeToString()
+    kmsg_view = view.KlioMessageView(serialized)
+    audit_log_item = _get_audit_log_item()
+
+    kmsg_view.metadata.job_audit_log.extend([audit_log_item])
+
+    klio_message.metadata.job_audit_log.extend([audit_log_item])
+    actual_serialized = kmsg_view.SerializeToString()
+    # appended to the original message rather than re-serialized
+    assert actual_serialized.startswith(serialized)
+    assert klio_message == klio_pb2.KlioMessage.FromString(actual_serialized)
+    assert 3 == len(kmsg_view.metadata.job_audit_log)
+    assert list(klio_message.metadata.job_audit_log) == list(
+        kmsg_view.metadata.job_audit_log
+    )
+    assert klio_message == kmsg_view.to_klio_message()
+
+
+@pytest.mark.parametrize(
+    "serialized",
+    (
+        b"Not a klio message",
+        # truncated length-delimited field
+        b"\x12\x10\x1a\x01",
+        # truncated varint
+        b"\x18\xff",
+    ),
+)
+def test_view_raises(serialized):
+    with pytest.raises(gproto_message.DecodeError):
+        view.KlioMessageView(serialized)
+
+
+def test_to_klio_message_view(klio_message, klio_config, mocker):
+    serialized = klio_message.SerializeToString()
+    logger = mocker.Mock()
+
+    actual = serializer.to_klio_message_view(serialized, klio_config, logger)
+
+    assert isinstance(actual, view.KlioMessageView)
+    assert actual is serializer.to_klio_message_view(actual)
+    assert klio_message is serializer.to_klio_message_view(klio_message)
+    logger.error.assert_not_called()
+
+
+def test_to_klio_message_view_non_kmsg(klio_config, mocker, monkeypatch):
+    logger = mocker.Mock()
+    incoming = b"Not a klio message"
+
+    with pytest.raises(gproto_message.DecodeError):
+        serializer.to_klio_message_view(incoming, klio_config, logger)
+    assert 1 == logger.error.call_count
+
+    monkeypatch.setattr(
+        klio_config.job_config, "allow_non_klio_messages", True
+    )
+    actual = serializer.to_klio_message_view(incoming, klio_config, logger)
+
+    assert isinstance(actual, klio_pb2.KlioMessage)
+    assert incoming == actual.data.element
@@ -59,6 +59,7 @@ def counter_metric(metric_params, relay_client):
         ("counter", dispatcher.CounterDispatcher),
         ("gauge", dispatcher.GaugeDispatcher),
         ("timer", dispatcher.TimerDispatcher),
+        ("histogram", dispatcher.HistogramDispatcher),
     ),
 )
 def test_get_metric_inst(method, cls, metrics_registry, metric_params):
@@ -86,6 +87,7 @@ def test_get_metric_inst(method, cls, metrics_registry, metric_params):
         ("counter", dispatcher.CounterDispatcher),
         ("gauge", dispatcher.GaugeDispatcher),
         ("timer", dispatcher.TimerDispatcher),
+        ("histogram", dispatcher.HistogramDispatcher),
         ("unknown", dispatcher.GaugeDispatcher),
     ),
 )
@@ -102,7 +104,7 @@ def test_marshal_unmarshal(
     exp_metric_data = metric_data.copy()
     if metric_type == "unknown":
         exp_metric_data["type"] = "gauge"
-    if metric_type == "timer":
+    if metric_type in ("timer", "histogram"):
         exp_metric_data["timer_unit"] = "ns"
     assert exp_metric_data == ret_metric_data
 
@@ -116,3 +118,37 @@ def test_marshal_unmarshal(
     assert metric_inst.value == ret_metric.value
     assert metric_inst.transform == ret_metric.transform
     assert metric_inst.kwargs == ret_metric.kwargs
+
+
+def test_histogram_flush_interval(relay_client, metric_params):
+    registry = client.MetricsRegistry(
+        relay_clients=[relay_client],
+        transform_name="HelloKlio",
+        flush_interval_sec=10,
+    )
+
+    histogram = registry.histogram(**metric_params)
+    assert 10 == histogram.flush_interval_sec
+
+    other = registry.histogram("other", flush_interval_sec=1)
+    assert 1 == other.flush_interval_sec
+
+
+@pytest.mark.parametrize("method", ("counter", "gauge", "timer"))
+def test_aggregate(method, relay_client, metric_params, mocker, monkeypatch):
+    mock_flusher = mocker.Mock()
+    monkeypatch.setattr(
+        dispatcher, "_get_or_create_flusher", lambda interval_sec: mock_flusher
+    )
+    registry = client.MetricsRegistry(
+        relay_clients=[relay_client],
+        transform_name="HelloKlio",
+        flush_interval_sec=0.5,
+        aggregate=True,
+    )
+
+    metric = getattr(registry, method)(**metric_params)
+
+    assert metric.aggregate
+    assert 0.5 == metric.flush_interval_sec
+    mock_flusher.register.assert_called_once_with(metric)
@@ -14,6 +14,7 @@
 #
 
 import logging
+import threading
 
 import pytest
 
@@ -139,35 +140,9 @@ def test_base_metric_logger(generic_dispatcher):
     )
 
 
-def test_base_metric_submit_callback(generic_dispatcher, mocker, caplog):
-    fut = mocker.Mock()
-    fut.result.return_value = None
-
-    generic_dispatcher._submit_callback(fut)
-
-    fut.result.assert_called_once_with()
-    assert not len(caplog.records)
-
-
-def test_base_metric_submit_callback_exception(
-    generic_dispatcher, mocker, caplog
-):
-    fut = mocker.Mock()
-    fut.result.side_effect = Exception("fuu")
-
-    generic_dispatcher._submit_callback(fut)
-
-    fut.result.assert_called_once_with()
-    assert 1 == len(caplog.records)
-    assert logging.WARNING == caplog.records[0].levelno
-
-
-def test_base_metric_submit(
-    generic_dispatcher, relay_client, mocker, monkeypatch
-):
-    mock_thread_pool, mock_future = mocker.Mock(), mocker.Mock()
-    mock_thread_pool.submit.return_value = mock_future
-    monkeypatch.setattr(generic_dispatcher, "_thread_pool", mock_thread_pool)
+def test_base_metric_submit(generic_dispatcher, relay_client, mocker):
+    mock_emitter = mocker.Mock()
+    generic_dispatcher._emitter = mock_emitter
 
     metric = mocker.Mock()
     metric.name, metric.transform = "my-metric", "my-transform"
@@ -175,10 +150,8 @@ def test_base_metric_submit(
 
     generic_dispatcher.submit(relay_client.emit, metric)
 
-    mock_thread_pool.submit.assert_called_once_with(relay_client.emit, metric)
-    assert expected_key == mock_future.metric_key
-    mock_future.add_done_callback.assert_called_once_with(
-        generic_dispatcher._submit_callback
+    mock_emitter.submit.assert_called_once_with(
+        relay_client.emit, metric, expected_key, generic_dispatcher._merge
     )
 
 
@@ -290,3 +263,549 @@ def test_timer_context_manager(
     assert 1 * 1e9 == timer.value
     metric.update.assert_called_once_with(timer.value)
     timer.submit.assert_called_once_with(relay_client.emit, metric)
+
+
+@pytest.fixture
+def histogram_metric(mocker):
+    # no `record` method, so only updated with summaries
+    return mocker.Mock(spec=["update"])
+
+
+@pytest.fixture
+def histogram_dispatcher(
+    relay_client,
+    metric_params,
+    histogram_metric,
+    mock_flusher,
+    mocker,
+    monkeypatch,
+):
+    relay_client.histogram.return_value = histogram_metric
+    histogram = dispatcher.HistogramDispatcher(
+        relay_clients=[relay_client], **metric_params
+    )
+    mock_submit_to_thread = mocker.Mock()
+    monkeypatch.setattr(histogram, "submit", mock_submit_to_thread)
+    return histogram
+
+
+def test_histogram_setup_metric_relay(
+    relay_client, metric, metric_params, mocker
+):
+    unsupported_relay = mocker.Mock()
+    unsupported_relay.histogram.return_value = None
+    relay_client.histogram.return_value = metric
+    metric_params["timer_unit"] = "ms"
+
+    histogram = dispatcher.HistogramDispatcher(
+        relay_clients=[relay_client, unsupported_relay], **metric_params
+    )
+
+    assert [(relay_client, metric)] == histogram.relay_to_metric
+    relay_client.histogram.assert_called_once_with(**metric_params)
+    # relay metric objects with a `record` method get every value
+    assert [metric] == histogram._sample_metrics
+
+
+def test_histogram_record(
+    histogram_dispatcher, relay_client, histogram_metric, monkeypatch
+):
+    for value in range(1, 101):
+        histogram_dispatcher.record(value)
+
+    assert 100 == histogram_dispatcher.value
+    # values are accumulated until the flush interval has passed
+    histogram_metric.update.assert_not_called()
+    histogram_dispatcher.submit.assert_not_called()
+
+    monkeypatch.setattr(histogram_dispatcher, "_next_flush", 0)
+    histogram_dispatcher.record(101)
+
+    histogram_metric.update.assert_called_once()
+    snapshot = histogram_metric.update.call_args[0][0]
+    assert 101 == snapshot.count
+    assert 1 == snapshot.min
+    assert 101 == snapshot.max
+    assert pytest.approx(51, rel=0.01) == snapshot.percentiles[50]
+    assert pytest.approx(100, rel=0.01) == snapshot.percentiles[99]
+    histogram_dispatcher.submit.assert_called_once_with(
+        relay_client.emit, histogram_metric
+    )
+    assert 0 < histogram_dispatcher._next_flush
+
+
+def test_histogram_record_samples(relay_client, metric, metric_params, mocker):
+    relay_client.histogram.return_value = metric
+    histogram = dispatcher.HistogramDispatcher(
+        relay_clients=[relay_client], **metric_params
+    )
+
+    histogram.record(5)
+
+    metric.record.assert_called_once_with(5)
+
+
+def test_histogram_flush(histogram_dispatcher, relay_client, histogram_metric):
+    # nothing recorded, nothing emitted
+    histogram_dispatcher.flush()
+    histogram_metric.update.assert_not_called()
+
+    histogram_dispatcher.record(5)
+    histogram_dispatcher.flush(sync=True)
+
+    histogram_metric.update.assert_called_once()
+    relay_client.emit.assert_called_once_with(histogram_metric)
+    histogram_dispatcher.submit.assert_not_called()
+
+    # values are only emitted once
+    histogram_dispatcher.flush()
+    histogram_metric.update.assert_called_once()
+
+
+def test_histogram_background_flush(
+    histogram_dispatcher, relay_client, histogram_metric, mock_flusher
+):
+    mock_flusher.register.assert_called_once_with(histogram_dispatcher)
+    histogram_dispatcher.record(5)
+
+    # not flushed before the flush interval has passed
+    histogram_dispatcher._flush()
+    histogram_metric.update.assert_not_called()
+
+    # flushed even though nothing else is recorded
+    histogram_dispatcher._next_flush = 0
+    histogram_dispatcher._flush()
+
+    histogram_metric.update.assert_called_once()
+    relay_client.emit.assert_called_once_with(histogram_metric)
+    histogram_dispatcher.submit.assert_not_called()
+
+
+def test_histogram_flush_sync_error(
+    histogram_dispatcher, relay_client, caplog
+):
+    relay_client.emit.side_effect = Exception("fuu")
+
+    histogram_dispatcher.record(5)
+    histogram_dispatcher.flush(sync=True)
+
+    assert 1 == len(caplog.records)
+    assert logging.WARNING == caplog.records[0].levelno
+
+
+def test_histogram_timer(histogram_dispatcher, monkeypatch, mocker):
+    mock_timeit = mocker.Mock()
+    # start, start, stop, flush check, stop, flush check
+    mock_timeit.default_timer.side_effect = [0.0, 1.0, 3.0, 3.0, 7.0, 7.0]
+    monkeypatch.setattr(dispatcher, "timeit", mock_timeit)
+    monkeypatch.setattr(histogram_dispatcher, "_next_flush", float("inf"))
+
+    with histogram_dispatcher:
+        histogram_dispatcher.start()
+        histogram_dispatcher.stop()
+
+    snapshot = histogram_dispatcher._histogram.snapshot()
+    # nested timings: 3.0 - 1.0, then 7.0 - 0.0 (seconds -> nanoseconds)
+    assert 2 == snapshot.count
+    assert 2.0 * 1e9 == snapshot.min
+    assert 7.0 * 1e9 == snapshot.max
+
+
+def test_histogram_stop_no_start(histogram_dispatcher, caplog):
+    histogram_dispatcher.stop()
+
+    assert 1 == len(caplog.records)
+    assert logging.WARNING == caplog.records[0].levelno
+    assert 0 == len(histogram_dispatcher._histogram)
+
+
+@pytest.fixture
+def mock_flusher(mocker, monkeypatch):
+    mock = mocker.Mock()
+    monkeypatch.setattr(
+        dispatcher, "_get_or_create_flusher", lambda interval_sec: mock
+    )
+    return mock
+
+
+@pytest.fixture
+def aggregate_relays(mocker):
+    # one relay emitted in the background, one updated directly
+    async_metric, sync_metric = mocker.Mock(), mocker.Mock()
+    async_relay = mocker.Mock(SYNCHRONOUS=False)
+    sync_relay = mocker.Mock(SYNCHRONOUS=True)
+    for metric_type in ("counter", "gauge", "timer"):
+        getattr(async_relay, metric_type).return_value = async_metric
+        getattr(sync_relay, metric_type).return_value = sync_metric
+    return async_relay, async_metric, sync_metric, sync_relay
+
+
+def _run_in_threads(func, num_threads=4):
+    threads = [threading.Thread(target=func) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_counter_aggregate(
+    aggregate_relays, metric_params, mock_flusher, mocker
+):
+    async_relay, async_metric, sync_metric, sync_relay = aggregate_relays
+    counter = dispatcher.CounterDispatcher(
+        relay_clients=[async_relay, sync_relay],
+        aggregate=True,
+        **metric_params
+    )
+    mock_flusher.register.assert_called_once_with(counter)
+    mock_submit = mocker.patch.object(counter, "submit")
+
+    def inc():
+        for _ in range(100):
+            counter.inc()
+        counter.inc(5)
+
+    _run_in_threads(inc)
+
+    # synchronous relays are still updated on every increment
+    assert 404 == sync_metric.update.call_count
+    async_metric.update.assert_not_called()
+    mock_submit.assert_not_called()
+    assert 4 == len(counter._accumulators)
+
+    counter._flush()
+
+    async_metric.update.assert_called_once_with(420)
+    async_relay.emit.assert_called_once_with(async_metric)
+
+    # nothing new to emit
+    counter._flush()
+    async_metric.update.assert_called_once_with(420)
+
+
+def test_accumulator_take_while_adding():
+    accumulator = dispatcher._Accumulator()
+    done = threading.Event()
+
+    def add():
+        for _ in range(10000):
+            accumulator.add(3)
+        done.set()
+
+    thread = threading.Thread(target=add)
+    thread.start()
+    deltas = []
+    while not done.is_set():
+        deltas.append(accumulator.take())
+    thread.join()
+    deltas.append(accumulator.take())
+
+    # every delta pairs a count with its own total, & none are lost
+    assert all(3 * count == total for count, total in deltas)
+    assert 10000 == sum(count for count, _ in deltas)
+    assert (0, 0) == accumulator.take()
+
+
+def test_gauge_aggregate(aggregate_relays, metric_params, mock_flusher):
+    async_relay, async_metric, sync_metric, sync_relay = aggregate_relays
+    gauge = dispatcher.GaugeDispatcher(
+        relay_clients=[async_relay, sync_relay],
+        aggregate=True,
+        **metric_params
+    )
+
+    gauge._flush()
+    async_metric.update.assert_not_called()
+
+    gauge.set(1)
+    gauge.set(2)
+    gauge._flush()
+
+    assert 2 == sync_metric.update.call_count
+    async_metric.update.assert_called_once_with(2)
+    async_relay.emit.assert_called_once_with(async_metric)
+
+    gauge._flush()
+    async_metric.update.assert_called_once_with(2)
+
+
+def test_timer_aggregate(
+    aggregate_relays, metric_params, mock_flusher, mocker, monkeypatch
+):
+    mock_timeit = mocker.Mock()
+    mock_timeit.default_timer.side_effect = [0.0, 1.0, 1.0, 4.0]
+    monkeypatch.setattr(dispatcher, "timeit", mock_timeit)
+    async_relay, async_metric, sync_metric, sync_relay = aggregate_relays
+    timer = dispatcher.TimerDispatcher(
+        relay_clients=[async_relay, sync_relay],
+        aggregate=True,
+        timer_unit="s",
+        **metric_params
+    )
+
+    with timer:
+        pass
+    with timer:
+        pass
+    timer._flush()
+
+    assert [mocker.call(1.0), mocker.call(3.0)] == (
+        sync_metric.update.call_args_list
+    )
+    # mean duration
+    async_metric.update.assert_called_once_with(2.0)
+
+
+@pytest.mark.parametrize(
+    "dispatcher_cls,update",
+    (
+        (dispatcher.CounterDispatcher, lambda d: d.inc(2)),
+        (dispatcher.GaugeDispatcher, lambda d: d.set(2)),
+        (dispatcher.TimerDispatcher, lambda d: (d.start(), d.stop())),
+    ),
+)
+def test_sync_relays(
+    dispatcher_cls, update, aggregate_relays, metric_params, mocker
+):
+    async_relay, async_metric, sync_metric, sync_relay = aggregate_relays
+    metric_dispatcher = dispatcher_cls(
+        relay_clients=[async_relay, sync_relay], **metric_params
+    )
+    mock_submit = mocker.patch.object(metric_dispatcher, "submit")
+
+    update(metric_dispatcher)
+
+    # synchronous relays are updated inline and never emitted
+    sync_metric.update.assert_called_once_with(metric_dispatcher.value)
+    sync_relay.emit.assert_not_called()
+    async_metric.update.assert_called_once_with(metric_dispatcher.value)
+    mock_submit.assert_called_once_with(async_relay.emit, async_metric)
+
+
+def test_emit_sync_error(generic_dispatcher, mocker, caplog):
+    emit = mocker.Mock(side_effect=Exception("fuu"))
+
+    generic_dispatcher._emit_sync(emit, mocker.Mock())
+
+    assert 1 == len(caplog.records)
+    assert logging.WARNING == caplog.records[0].levelno
+
+
+def test_flusher(mocker, caplog):
+    flushed = threading.Event()
+    ok_dispatcher = mocker.Mock()
+    ok_dispatcher._flush.side_effect = flushed.set
+    err_dispatcher = mocker.Mock()
+    err_dispatcher._flush.side_effect = Exception("fuu")
+    err_dispatcher.logger = logging.getLogger("klio.metrics.dispatcher")
+
+    flusher = dispatcher._Flusher(interval_sec=0.01)
+    flusher.register(err_dispatcher)
+    flusher.register(ok_dispatcher)
+
+    # flushes periodically
+    assert flushed.wait(5)
+
+    flusher.shutdown()
+    assert not flusher._thread.is_alive()
+    # errors of individual dispatchers are logged
+    assert any("fuu" in r.message for r in caplog.records)
+    # the final flush happens after the thread has stopped
+    call_count = ok_dispatcher._flush.call_count
+    assert 2 <= call_count
+    flusher.flush()
+    assert call_count + 1 == ok_dispatcher._flush.call_count
+
+
+def test_flush(mocker, monkeypatch):
+    mock_flusher = mocker.Mock()
+    monkeypatch.setattr(dispatcher, "_FLUSHER", mock_flusher)
+
+    dispatcher.flush()
+
+    mock_flusher.flush.assert_called_once_with()
+
+
+def test_shutdown(histogram_dispatcher, relay_client, mocker, monkeypatch):
+    mock_flusher = mocker.Mock()
+    monkeypatch.setattr(dispatcher, "_FLUSHER", mock_flusher)
+    mock_emitter = mocker.Mock()
+    monkeypatch.setattr(dispatcher, "_EMITTER", mock_emitter)
+    mock_flush = mocker.Mock()
+    monkeypatch.setattr(histogram_dispatcher, "flush", mock_flush)
+
+    dispatcher.shutdown()
+
+    mock_flusher.shutdown.assert_called_once_with()
+    assert dispatcher._FLUSHER is None
+    mock_flush.assert_called_once_with(sync=True)
+    mock_emitter.join.assert_called_once_with(
+        timeout=dispatcher.SHUTDOWN_TIMEOUT_SEC
+    )
+    relay_client.flush.assert_called_once_with()
+
+
+class BlockingRelay(object):
+    """Relay whose emits block until released, to fill the queue."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.emitted = []
+
+    def emit(self, metric):
+        self.started.set()
+        self.release.wait(5)
+        self.emitted.append((metric.name, metric.value))
+
+
+class QueuedMetric(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+def _merge_sum(pending_value, value):
+    return pending_value + value
+
+
+def _fill_emitter(overflow, submits):
+    relay = BlockingRelay()
+    emitter = dispatcher._BoundedEmitter(
+        num_workers=1, max_size=2, overflow=overflow
+    )
+    # the first metric is taken by the worker, which blocks on it
+    blocked = QueuedMetric("blocked", 0)
+    emitter.submit(relay.emit, blocked, "blocked", _merge_sum)
+    assert relay.started.wait(5)
+
+    for name, value in submits:
+        metric = QueuedMetric(name, value)
+        emitter.submit(relay.emit, metric, name, _merge_sum)
+    depth = len(emitter)
+
+    relay.release.set()
+    assert emitter.join(5)
+    return emitter, depth, relay.emitted[1:]
+
+
+@pytest.mark.parametrize(
+    "overflow,submits,exp_emitted,exp_dropped,exp_coalesced",
+    (
+        (
+            dispatcher.OVERFLOW_DROP_OLDEST,
+            [("a", 1), ("b", 2), ("c", 3)],
+            [("b", 2), ("c", 3)],
+            1,
+            0,
+        ),
+        (
+            dispatcher.OVERFLOW_DROP_NEWEST,
+            [("a", 1), ("b", 2), ("c", 3)],
+            [("a", 1), ("b", 2)],
+            1,
+            0,
+        ),
+        (
+            dispatcher.OVERFLOW_COALESCE,
+            [("a", 1), ("b", 2), ("a", 4)],
+            [("a", 5), ("b", 2)],
+            0,
+            1,
+        ),
+        # falls back to dropping the oldest without a metric to coalesce
+        (
+            dispatcher.OVERFLOW_COALESCE,
+            [("a", 1), ("b", 2), ("c", 3)],
+            [("b", 2), ("c", 3)],
+            1,
+            0,
+        ),
+    ),
+)
+def test_emitter_overflow(
+    overflow, submits, exp_emitted, exp_dropped, exp_coalesced
+):
+    emitter, depth, emitted = _fill_emitter(overflow, submits)
+
+    assert 2 == depth
+    assert exp_emitted == emitted
+    assert exp_dropped == emitter.dropped
+    assert exp_coalesced == emitter.coalesced
+    assert 0 == len(emitter)
+
+
+def test_emitter_emit_error(mocker, caplog):
+    emitter = dispatcher._BoundedEmitter(num_workers=1)
+    emit = mocker.Mock(side_effect=Exception("fuu"))
+
+    emitter.submit(emit, mocker.Mock(), "counter_my-metric", _merge_sum)
+
+    assert emitter.join(5)
+    assert 1 == len(caplog.records)
+    assert logging.WARNING == caplog.records[0].levelno
+    assert "counter_my-metric" in caplog.records[0].message
+
+
+def test_emitter_report(relay_client, metric, mocker, monkeypatch):
+    emitter = dispatcher._BoundedEmitter(
+        num_workers=1, relay_clients=[relay_client], report_interval_sec=0
+    )
+    emitter.dropped = 3
+    mock_submit = mocker.Mock()
+    monkeypatch.setattr(dispatcher.GaugeDispatcher, "submit", mock_submit)
+
+    emitter.submit(relay_client.emit, metric, "gauge_my-metric", None)
+
+    assert emitter.join(5)
+    relay_client.gauge.assert_has_calls(
+        [
+            mocker.call(
+                name="klio-metrics-queue-depth", value=0, transform=None
+            ),
+            mocker.call(name="klio-metrics-dropped", value=0, transform=None),
+        ]
+    )
+    metric.update.assert_called_with(3)
+    assert 2 == mock_submit.call_count
+
+
+@pytest.mark.parametrize(
+    "kwargs,exp_config,exp_warnings",
+    (
+        ({}, (10000, "drop_oldest"), 0),
+        (
+            {"max_queue_size": 10, "overflow_policy": "coalesce"},
+            (10, "coalesce"),
+            0,
+        ),
+        (
+            {"max_queue_size": 0, "overflow_policy": "drop_everything"},
+            (10000, "drop_oldest"),
+            2,
+        ),
+    ),
+)
+def test_configure_emitter(kwargs, exp_config, exp_warnings, caplog, mocker):
+    mocker.patch.dict(dispatcher._EMITTER_CONFIG)
+
+    dispatcher.configure_emitter(**kwargs)
+
+    assert exp_config == (
+        dispatcher._EMITTER_CONFIG["max_size"],
+        dispatcher._EMITTER_CONFIG["overflow"],
+    )
+    assert exp_warnings == len(caplog.records)
+
+
+def test_get_or_create_emitter(relay_client, mocker, monkeypatch):
+    monkeypatch.setattr(dispatcher, "_EMITTER", None)
+    mocker.patch.dict(
+        dispatcher._EMITTER_CONFIG, {"max_size": 10, "overflow": "coalesce"}
+    )
+
+    emitter = dispatcher._get_or_create_emitter([relay_client])
+
+    assert 10 == emitter.max_size
+    assert "coalesce" == emitter.overflow
+    assert emitter is dispatcher._get_or_create_emitter([relay_client])
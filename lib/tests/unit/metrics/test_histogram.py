@@ -0,0 +1,91 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import math
+import random
+
+import pytest
+
+from klio.metrics import histogram
+
+
+RANDOM = random.Random(0)
+
+
+@pytest.mark.parametrize(
+    "values",
+    (
+        list(range(1, 1001)),
+        [RANDOM.lognormvariate(15, 2) for _ in range(10000)],
+        [RANDOM.uniform(0.001, 0.002) for _ in range(1000)],
+    ),
+)
+def test_histogram_percentiles(values):
+    hist = histogram.Histogram()
+    for value in values:
+        hist.record(value)
+
+    snapshot = hist.snapshot(percentiles=(50, 99, 99.9))
+
+    values.sort()
+    assert len(values) == snapshot.count
+    assert pytest.approx(sum(values)) == snapshot.sum
+    assert values[0] == snapshot.min
+    assert values[-1] == snapshot.max
+    for percentile in (50, 99, 99.9):
+        # nearest-rank percentile
+        exp = values[math.ceil(percentile / 100.0 * len(values)) - 1]
+        # accurate to within the width of a bucket
+        assert pytest.approx(exp, rel=0.01) == snapshot.percentiles[percentile]
+
+
+def test_histogram_zero_and_negative_values():
+    hist = histogram.Histogram()
+    for value in (-1, 0, 0, 10):
+        hist.record(value)
+
+    snapshot = hist.snapshot(percentiles=(50, 100))
+
+    assert -1 == snapshot.min
+    assert -1 == snapshot.percentiles[50]
+    assert 10 == snapshot.percentiles[100]
+
+
+def test_histogram_snapshot_reset():
+    hist = histogram.Histogram()
+    hist.record(5)
+
+    assert 1 == hist.snapshot().count
+    assert 1 == hist.snapshot(reset=True).count
+    assert 0 == len(hist)
+
+    snapshot = hist.snapshot()
+    assert 0 == snapshot.count
+    assert 0 == snapshot.mean
+    assert {} == snapshot.percentiles
+
+
+def test_histogram_snapshot_summary():
+    hist = histogram.Histogram()
+    for value in (1, 2, 3, 4):
+        hist.record(value)
+
+    summary = hist.snapshot(percentiles=(50, 99.9)).summary()
+
+    exp_keys = ["count", "min", "max", "mean", "p50", "p99.9"]
+    assert exp_keys == list(summary)
+    assert 4 == summary["count"]
+    assert 2.5 == summary["mean"]
+    assert 4 == summary["p99.9"]
@@ -13,11 +13,13 @@
 # limitations under the License.
 #
 
+import json
 import logging
 import threading
 
 import pytest
 
+from klio.metrics import histogram
 from klio.metrics import logger
 
 
@@ -134,6 +136,27 @@ def test_client_timer(
     assert exp_timer_unit == timer.tags["unit"]
 
 
+@pytest.mark.parametrize(
+    "timer_unit,exp_timer_unit", ((None, "ns"), ("seconds", "s"))
+)
+def test_client_histogram(timer_unit, exp_timer_unit, client, caplog):
+    hist = client.histogram(name="my-histogram", timer_unit=timer_unit)
+    assert isinstance(hist, logger.LoggerHistogram)
+    exp_tags = {"metric_type": "histogram", "unit": exp_timer_unit}
+    assert exp_tags == hist.tags
+
+    snapshot = histogram.HistogramSnapshot(2, 4, 1, 3, {50: 1})
+    hist.update(snapshot)
+    client.emit(hist)
+
+    exp_log_record = (
+        "[my-histogram] value: {{'count': 2, 'min': 1, 'max': 3, "
+        "'mean': 2.0, 'p50': 1}} transform: 'None' tags: {}".format(exp_tags)
+    )
+    assert 1 == len(caplog.records)
+    assert exp_log_record == caplog.records[0].message
+
+
 def test_logger_counter():
     expected_tags = {"metric_type": "counter"}
 
@@ -170,3 +193,94 @@ def test_logger_disabled(disabled, exp, client, metric, caplog, monkeypatch):
     client.emit(metric)
 
     assert exp == len(caplog.records)
+
+
+def test_client_emit_level_disabled(client, metric, caplog, mocker):
+    caplog.set_level(logging.INFO, logger="klio.metrics")
+    client._thread_local.klio_metrics_logger = None
+    mock_unmarshal = mocker.spy(client, "unmarshal")
+
+    client.emit(metric)
+
+    assert 0 == len(caplog.records)
+    # the metric isn't even formatted
+    mock_unmarshal.assert_not_called()
+
+
+@pytest.fixture
+def batch_client(klio_config, mocker, monkeypatch):
+    monkeypatch.setattr(logger, "_BATCH", None)
+    mock_time = mocker.Mock()
+    mock_time.monotonic.return_value = 0.0
+    monkeypatch.setattr(logger, "time", mock_time)
+    klio_config.job_config.metrics = {
+        "logger": {"batch": True},
+        "flush_interval_sec": 10,
+    }
+    client = logger.MetricsLoggerClient(klio_config)
+    client._thread_local.klio_metrics_logger = None
+    return client, mock_time
+
+
+def test_client_emit_batch(batch_client, caplog):
+    client, mock_time = batch_client
+    counter = client.counter(name="my-counter", transform="MyTransform")
+    gauge = client.gauge(name="my-gauge", transform="MyTransform")
+    timer = client.timer(name="my-timer", transform="MyTransform")
+
+    for value in (1, 2):
+        counter.update(value)
+        client.emit(counter)
+        gauge.update(value)
+        client.emit(gauge)
+    for value in (1, 2, 6):
+        timer.update(value)
+        client.emit(timer)
+    assert 0 == len(caplog.records)
+
+    mock_time.monotonic.return_value = 10.0
+    counter.update(4)
+    client.emit(counter)
+
+    assert 1 == len(caplog.records)
+    assert {
+        "metrics": [
+            {
+                "name": "my-counter",
+                "transform": "MyTransform",
+                "tags": {"metric_type": "counter"},
+                "value": 7,
+            },
+            {
+                "name": "my-gauge",
+                "transform": "MyTransform",
+                "tags": {"metric_type": "gauge"},
+                "value": 2,
+            },
+            {
+                "name": "my-timer",
+                "transform": "MyTransform",
+                "tags": {"metric_type": "timer", "unit": "ns"},
+                "value": {"count": 3, "min": 1, "max": 6, "mean": 3.0},
+            },
+        ]
+    } == json.loads(caplog.records[0].message)
+
+    # the next batch starts empty
+    client.flush()
+    assert 1 == len(caplog.records)
+
+
+def test_client_flush_batch(batch_client, metric, caplog):
+    client, _ = batch_client
+    # clients share a batch
+    other_client = logger.MetricsLoggerClient(client.klio_config)
+    assert client._batch is other_client._batch
+
+    other_client.emit(metric)
+    client.flush()
+
+    assert 1 == len(caplog.records)
+    assert "fixture-counter" == (
+        json.loads(caplog.records[0].message)["metrics"][0]["name"]
+    )
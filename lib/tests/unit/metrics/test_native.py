@@ -17,6 +17,7 @@ import pytest
 
 from apache_beam import metrics as beam_metrics
 
+from klio.metrics import histogram
 from klio.metrics import native
 
 
@@ -97,10 +98,43 @@ def test_client_timer(
     mock_update.assert_called_once_with(1)
 
 
+@pytest.mark.parametrize(
+    "transform,exp_namespace",
+    ((None, "test-job"), ("test-transform", "test-transform")),
+)
+def test_client_histogram(
+    transform, exp_namespace, client, mocker, monkeypatch
+):
+    hist = client.histogram(
+        name="my-histogram", transform=transform, timer_unit="ms"
+    )
+
+    assert isinstance(hist, native.NativeHistogram)
+    assert isinstance(hist._distribution, beam_metrics.metricbase.Distribution)
+    assert exp_namespace == hist._distribution.metric_name.namespace
+    assert "my-histogram" == hist._distribution.metric_name.name
+    assert "ms" == hist.timer_unit
+
+    mock_update = mocker.Mock()
+    monkeypatch.setattr(hist._distribution, "update", mock_update)
+    hist.record(1)
+
+    mock_update.assert_called_once_with(1)
+
+    snapshot = histogram.HistogramSnapshot(1, 1, 1, 1, {50: 1, 99.9: 1})
+    hist.update(snapshot)
+
+    gauge_names = sorted(
+        g.metric_name.name for g in hist._percentile_gauges.values()
+    )
+    assert ["my-histogram-p50", "my-histogram-p99.9"] == gauge_names
+
+
 # just to get 100% coverage for the module
 def test_client_instance(client):
     assert "beam" == client.RELAY_CLIENT_NAME
     assert "s" == client.DEFAULT_TIME_UNIT
+    assert client.SYNCHRONOUS is True
 
     assert client.unmarshal("metric") is None
     assert client.emit("metric") is None
@@ -0,0 +1,229 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import urllib.error
+import urllib.request
+
+import pytest
+
+from klio.metrics import dispatcher
+from klio.metrics import prometheus
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    registry = prometheus._Registry()
+    monkeypatch.setattr(prometheus, "REGISTRY", registry)
+    return registry
+
+
+@pytest.fixture
+def mock_start_server(mocker, monkeypatch):
+    mock_start = mocker.Mock()
+    monkeypatch.setattr(prometheus, "start_server", mock_start)
+    return mock_start
+
+
+@pytest.fixture
+def client(klio_config, mock_start_server, monkeypatch):
+    monkeypatch.setattr(
+        klio_config.job_config,
+        "metrics",
+        {"prometheus": {"port": 1234, "buckets": [1, 0.5]}},
+    )
+    return prometheus.PrometheusMetricsClient(klio_config)
+
+
+def test_client(client, mock_start_server):
+    mock_start_server.assert_called_once_with(1234)
+    assert (0.5, 1) == client.buckets
+
+
+@pytest.mark.parametrize("prometheus_config", (True, {}))
+def test_client_defaults(
+    prometheus_config, klio_config, mock_start_server, monkeypatch
+):
+    monkeypatch.setattr(
+        klio_config.job_config, "metrics", {"prometheus": prometheus_config}
+    )
+    client = prometheus.PrometheusMetricsClient(klio_config)
+
+    mock_start_server.assert_called_once_with(prometheus.DEFAULT_PORT)
+    assert prometheus.DEFAULT_BUCKETS == client.buckets
+
+
+def test_counter(client, registry):
+    counter = client.counter(
+        "kmsg-received", transform="MyTransform", tags={"a-tag": "x"}
+    )
+    other_thread_counter = client.counter(
+        "kmsg-received", transform="MyTransform", tags={"a-tag": "x"}
+    )
+    counter.update(2)
+    other_thread_counter.update(1)
+
+    assert isinstance(counter, prometheus.PrometheusCounter)
+    exp_labels = {
+        "a_tag": "x",
+        "job_name": "test-job",
+        "transform": "MyTransform",
+    }
+    exp_unmarshalled = {
+        "name": "kmsg-received",
+        "value": 2,
+        "labels": exp_labels,
+    }
+    assert exp_unmarshalled == client.unmarshal(counter)
+    expected = (
+        "# TYPE kmsg_received_total counter\n"
+        'kmsg_received_total{a_tag="x",job_name="test-job",'
+        'transform="MyTransform"} 3\n'
+    )
+    assert expected == registry.render()
+
+
+def test_gauge(client, registry):
+    gauge = client.gauge("kmsg-in-flight")
+    gauge.update(4)
+    gauge.update(2.5)
+
+    expected = (
+        "# TYPE kmsg_in_flight gauge\n"
+        'kmsg_in_flight{job_name="test-job"} 2.5\n'
+    )
+    assert expected == registry.render()
+
+
+def test_timer(client, registry):
+    timer = client.timer("my-timer", transform="MyTransform")
+    timer.update(1.5)
+    timer.update(2)
+
+    expected = (
+        "# TYPE my_timer summary\n"
+        'my_timer_sum{job_name="test-job",transform="MyTransform"} 3.5\n'
+        'my_timer_count{job_name="test-job",transform="MyTransform"} 2\n'
+    )
+    assert expected == registry.render()
+
+
+def test_histogram(client, registry):
+    histogram = client.histogram("kmsg-timer")
+    for value in (0.1, 0.5, 0.75, 3):
+        histogram.record(value)
+    histogram.update(None)
+
+    expected = (
+        "# TYPE kmsg_timer histogram\n"
+        'kmsg_timer_bucket{job_name="test-job",le="0.5"} 2\n'
+        'kmsg_timer_bucket{job_name="test-job",le="1"} 3\n'
+        'kmsg_timer_bucket{job_name="test-job",le="+Inf"} 4\n'
+        'kmsg_timer_sum{job_name="test-job"} 4.35\n'
+        'kmsg_timer_count{job_name="test-job"} 4\n'
+    )
+    assert expected == registry.render()
+
+
+def test_type_conflict(client):
+    client.gauge("my-metric")
+
+    with pytest.raises(ValueError):
+        client.timer("my-metric")
+
+
+def test_dispatchers(client, registry):
+    # metrics are updated inline rather than emitted
+    counter = dispatcher.CounterDispatcher([client], "my-counter")
+    counter.inc()
+    counter.inc(2)
+    histogram = dispatcher.HistogramDispatcher(
+        [client], "my-histogram", timer_unit="s"
+    )
+    histogram.record(0.25)
+    histogram.flush(sync=True)
+
+    rendered = registry.render()
+    assert 'my_counter_total{job_name="test-job"} 3\n' in rendered
+    assert 'my_histogram_count{job_name="test-job"} 1\n' in rendered
+
+
+def test_register_gauge(registry, caplog):
+    size = [3]
+    prometheus.register_gauge("queue-size", lambda: size[0], queue="a")
+    prometheus.register_gauge("queue-size", lambda: 1 / 0, queue="b")
+
+    expected = '# TYPE queue_size gauge\nqueue_size{queue="a"} 3\n'
+    assert expected == registry.render()
+    assert 1 == len(caplog.records)
+
+    size[0] = 5
+    assert 'queue_size{queue="a"} 5\n' in registry.render()
+
+
+def test_escape_labels(registry):
+    prometheus.register_gauge("1gauge", lambda: 1, path='a\\"b"\n')
+
+    expected = '# TYPE _1gauge gauge\n_1gauge{path="a\\\\\\"b\\"\\n"} 1\n'
+    assert expected == registry.render()
+
+
+def test_start_server(registry, monkeypatch):
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    prometheus.register_gauge("my-gauge", lambda: 1)
+
+    server = prometheus.start_server(0, host="127.0.0.1")
+    try:
+        assert server is prometheus.start_server(0)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+        with urllib.request.urlopen(url + "/metrics") as resp:
+            assert prometheus.CONTENT_TYPE == resp.headers["Content-Type"]
+            actual = resp.read().decode("utf-8")
+        assert "# TYPE my_gauge gauge\nmy_gauge 1\n" == actual
+
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/nope")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_start_server_other_port(monkeypatch, caplog):
+    caplog.set_level(logging.INFO, logger="klio.metrics")
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    server = prometheus.start_server(0, host="127.0.0.1")
+    try:
+        port = server.server_address[1]
+        # one server per process
+        assert server is prometheus.start_server(port + 1)
+        assert 1 == len(caplog.records)
+        assert "Already serving metrics" in caplog.records[0].message
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_start_server_error(monkeypatch, caplog):
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    server = prometheus.start_server(0, host="127.0.0.1")
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    try:
+        port = server.server_address[1]
+        assert prometheus.start_server(port, host="127.0.0.1") is None
+        assert 1 == len(caplog.records)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -13,17 +13,29 @@
 # limitations under the License.
 #
 
+import json
+import socket
+
+from unittest import mock
+
 import pytest
 import shumway
 
+from klio.metrics import histogram
 from klio.metrics import shumway as kshumway
 
 
+@pytest.fixture(autouse=True)
+def clear_shared(monkeypatch):
+    monkeypatch.setattr(kshumway, "_RELAYS", {})
+    monkeypatch.setattr(kshumway, "_BATCHERS", {})
+
+
 @pytest.fixture
 def mock_shumway_client(mocker, monkeypatch):
     mock_client = mocker.create_autospec(shumway.MetricRelay, instance=True)
     monkeypatch.setattr(
-        kshumway.shumway, "MetricRelay", lambda x, y: mock_client
+        kshumway.shumway, "MetricRelay", lambda x, y, **kw: mock_client
     )
     return mock_client
 
@@ -129,6 +141,37 @@ def test_client_set_timer_unit(metrics_config, exp_timer_unit, klio_config):
     assert exp_timer_unit == client.timer_unit
 
 
+def test_client_histogram(client, mock_shumway_client):
+    hist = client.histogram(
+        name="my-histogram", transform="test-transform", timer_unit="ms"
+    )
+
+    assert isinstance(hist, kshumway.ShumwayHistogram)
+    exp_attrs = {"transform": "test-transform", "unit": "ms"}
+    assert exp_attrs == hist.attributes
+
+    snapshot = histogram.HistogramSnapshot(2, 4, 1, 3, {50: 1})
+    hist.update(snapshot)
+    client.emit(hist)
+
+    exp_attrs["job_name"] = "test-job"
+    exp_calls = [
+        mock.call(
+            metric="my-histogram",
+            value=value,
+            attributes=dict(exp_attrs, stat=stat),
+        )
+        for stat, value in (
+            ("count", 2),
+            ("min", 1),
+            ("max", 3),
+            ("mean", 2.0),
+            ("p50", 1),
+        )
+    ]
+    assert exp_calls == mock_shumway_client.emit.call_args_list
+
+
 @pytest.mark.parametrize("invalid_tag", ([], "foo", 123, set()))
 def test_metric_creation_raises_assert(invalid_tag, client):
     exp_error_msg = "`tags` for metric objects should be dictionaries"
@@ -136,3 +179,132 @@ def test_metric_creation_raises_assert(invalid_tag, client):
         client.counter(name="my-counter", tags=invalid_tag)
         client.gauge(name="my-gauge", tags=invalid_tag)
         client.timer(name="my-timer", tags=invalid_tag)
+
+
+def test_client_shares_relay(klio_config, mocker, monkeypatch):
+    mock_relay_cls = mocker.Mock()
+    monkeypatch.setattr(kshumway.shumway, "MetricRelay", mock_relay_cls)
+
+    client = kshumway.ShumwayMetricsClient(klio_config)
+    other_client = kshumway.ShumwayMetricsClient(klio_config)
+
+    assert client._shumway_client is other_client._shumway_client
+    mock_relay_cls.assert_called_once_with(
+        "test-job", "127.0.0.1", ffwd_port=shumway.FFWD_PORT
+    )
+
+
+class FFWDStandIn(object):
+    """Local UDP server counting the packets & bytes it receives."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.packets = []
+
+    def receive(self):
+        while True:
+            try:
+                self.packets.append(self.sock.recv(65536))
+            except socket.timeout:
+                return
+
+    @property
+    def num_bytes(self):
+        return sum(len(p) for p in self.packets)
+
+    @property
+    def points(self):
+        return [
+            json.loads(line)
+            for packet in self.packets
+            for line in packet.split(b"\n")
+        ]
+
+
+@pytest.fixture
+def ffwd():
+    stand_in = FFWDStandIn()
+    yield stand_in
+    stand_in.sock.close()
+
+
+def _ffwd_client(klio_config, ffwd, batch):
+    klio_config.job_config.metrics = {
+        "shumway": {"ffwd_port": ffwd.port, "batch": batch}
+    }
+    return kshumway.ShumwayMetricsClient(klio_config)
+
+
+def test_client_emit_unbatched(klio_config, ffwd):
+    client = _ffwd_client(klio_config, ffwd, batch=False)
+    counter = client.counter(name="my-counter", transform="test-transform")
+    counter.update(1)
+
+    for _ in range(3):
+        client.emit(counter)
+    ffwd.receive()
+
+    # a datagram per update
+    assert 3 == len(ffwd.packets)
+    assert {
+        "key": "test-job",
+        "attributes": {
+            "what": "my-counter",
+            "transform": "test-transform",
+            "job_name": "test-job",
+        },
+        "value": 1,
+        "type": "metric",
+        "tags": [],
+        "resources": {},
+    } == ffwd.points[0]
+
+
+def test_client_emit_batched(klio_config, ffwd):
+    client = _ffwd_client(klio_config, ffwd, batch={"max_packet_size": 512})
+    counter = client.counter(name="my-counter", transform="test-transform")
+    gauge = client.gauge(name="my-gauge", transform="test-transform")
+
+    for i in range(100):
+        counter.update(2)
+        client.emit(counter)
+        gauge.update(i)
+        client.emit(gauge)
+    for i in range(20):
+        client.emit(client.gauge(name="gauge-{}".format(i)))
+    ffwd.receive()
+    assert 0 == len(ffwd.packets)
+
+    client.flush()
+    ffwd.receive()
+
+    # repeated points are coalesced, and packed into few datagrams
+    points = ffwd.points
+    assert 22 == len(points)
+    assert 1 < len(ffwd.packets) < 22
+    assert all(len(packet) <= 512 for packet in ffwd.packets)
+    by_name = {p["attributes"]["what"]: p["value"] for p in points}
+    assert 200 == by_name["my-counter"]
+    assert 99 == by_name["my-gauge"]
+
+
+def test_client_emit_batched_interval(klio_config, ffwd, mocker, monkeypatch):
+    mock_time = mocker.Mock()
+    mock_time.monotonic.return_value = 0.0
+    monkeypatch.setattr(kshumway, "time", mock_time)
+    client = _ffwd_client(klio_config, ffwd, batch=True)
+    other_client = _ffwd_client(klio_config, ffwd, batch=True)
+    assert client._batcher is other_client._batcher
+    counter = client.counter(name="my-counter")
+    counter.update(1)
+
+    client.emit(counter)
+    mock_time.monotonic.return_value = kshumway.DEFAULT_FLUSH_INTERVAL_SEC
+    other_client.emit(counter)
+    ffwd.receive()
+
+    assert 1 == len(ffwd.packets)
+    assert 2 == ffwd.points[0]["value"]
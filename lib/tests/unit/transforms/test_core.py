@@ -17,6 +17,7 @@ import pytest
 
 from klio.metrics import logger as logger_metrics
 from klio.metrics import native as native_metrics
+from klio.metrics import prometheus
 from klio.metrics import shumway
 from klio.transforms import core as core_transforms
 
@@ -38,6 +39,22 @@ from klio.transforms import core as core_transforms
         ("directgkerunner", {"logger": False}, [shumway.ShumwayMetricsClient]),
         ("direct", {"shumway": False}, [logger_metrics.MetricsLoggerClient]),
         ("dataflow", {"shumway": False, "logger": False}, []),
+        # prometheus is only used when turned on, regardless of runner
+        (
+            "dataflow",
+            {"prometheus": True},
+            [prometheus.PrometheusMetricsClient],
+        ),
+        (
+            "directgkerunner",
+            {"prometheus": {"port": 9091}},
+            [shumway.ShumwayMetricsClient, prometheus.PrometheusMetricsClient],
+        ),
+        (
+            "directgkerunner",
+            {"prometheus": False},
+            [shumway.ShumwayMetricsClient],
+        ),
     ),
 )
 def test_klio_metrics(
@@ -54,6 +71,7 @@ def test_klio_metrics(
     monkeypatch.setattr(klio_config.job_config, "metrics", metrics_config)
     mock_config = mocker.PropertyMock(return_value=klio_config)
     monkeypatch.setattr(core_transforms.KlioContext, "config", mock_config)
+    monkeypatch.setattr(prometheus, "start_server", mocker.Mock())
 
     registry = klio_ns.metrics
 
@@ -20,6 +20,8 @@ import apache_beam as beam
 import pytest
 
 from apache_beam.testing import test_pipeline
+from apache_beam.testing import util as btest_util
+from apache_beam.transforms import window
 
 from klio_core.proto import klio_pb2
 
@@ -155,8 +157,8 @@ def test_retry_raises_runtime_invalid_delay(
 @pytest.mark.parametrize(
     "max_thread_count,patch_str",
     (
-        (None, "threading.BoundedSemaphore"),
-        (_thread_limiter.ThreadLimit.DEFAULT, "threading.BoundedSemaphore"),
+        (None, "_ResizableSemaphore"),
+        (_thread_limiter.ThreadLimit.DEFAULT, "_ResizableSemaphore"),
         (_thread_limiter.ThreadLimit.NONE, "_DummySemaphore"),
     ),
 )
@@ -181,15 +183,15 @@ def test_thread_limiting(
     func(kmsg.SerializeToString())
 
     assert 1 == mock_function.call_count
-    mock_semaphore.return_value.acquire.assert_called_once_with()
-    mock_semaphore.return_value.release.assert_called_once_with()
+    mock_semaphore.return_value.acquire.assert_called_once_with(1)
+    mock_semaphore.return_value.release.assert_called_once_with(1)
 
 
 @pytest.mark.parametrize(
     "max_thread_count,patch_str",
     (
-        (None, "threading.BoundedSemaphore"),
-        (_thread_limiter.ThreadLimit.DEFAULT, "threading.BoundedSemaphore"),
+        (None, "_ResizableSemaphore"),
+        (_thread_limiter.ThreadLimit.DEFAULT, "_ResizableSemaphore"),
         (_thread_limiter.ThreadLimit.NONE, "_DummySemaphore"),
     ),
 )
@@ -209,7 +211,7 @@ def test_thread_limiting_process_method(
     class TestDoFn(beam.DoFn):
         @decorators._handle_klio(**kwargs)
         def process(self, msg_data):
-            mock_semaphore.return_value.acquire.assert_called_once_with()
+            mock_semaphore.return_value.acquire.assert_called_once_with(1)
             mock_semaphore.return_value.release.assert_not_called()
             mock_function()
             return msg_data
@@ -223,15 +225,15 @@ def test_thread_limiting_process_method(
     [z for z in gen]
 
     assert 1 == mock_function.call_count
-    mock_semaphore.return_value.acquire.assert_called_once_with()
-    mock_semaphore.return_value.release.assert_called_once_with()
+    mock_semaphore.return_value.acquire.assert_called_once_with(1)
+    mock_semaphore.return_value.release.assert_called_once_with(1)
 
 
 @pytest.mark.parametrize(
     "max_thread_count,patch_str",
     (
-        (None, "threading.BoundedSemaphore"),
-        (_thread_limiter.ThreadLimit.DEFAULT, "threading.BoundedSemaphore"),
+        (None, "_ResizableSemaphore"),
+        (_thread_limiter.ThreadLimit.DEFAULT, "_ResizableSemaphore"),
         (_thread_limiter.ThreadLimit.NONE, "_DummySemaphore"),
     ),
 )
@@ -253,7 +255,7 @@ def test_thread_limiting_nonprocess_method(
     class TestMethod(object):
         @decorators._handle_klio(**kwargs)
         def other_method(self, msg_data):
-            mock_semaphore.return_value.acquire.assert_called_once_with()
+            mock_semaphore.return_value.acquire.assert_called_once_with(1)
             mock_semaphore.return_value.release.assert_not_called()
             mock_function()
             return msg_data
@@ -262,8 +264,32 @@ def test_thread_limiting_nonprocess_method(
     dofn.other_method(kmsg.SerializeToString())
 
     assert 1 == mock_function.call_count
-    mock_semaphore.return_value.acquire.assert_called_once_with()
-    mock_semaphore.return_value.release.assert_called_once_with()
+    mock_semaphore.return_value.acquire.assert_called_once_with(1)
+    mock_semaphore.return_value.release.assert_called_once_with(1)
+
+
+def test_handle_klio_process_method_dispatch(kmsg, mock_config):
+    def process(self, msg_data):
+        return msg_data.element
+
+    wrapped = decorators._handle_klio(process)
+
+    # the same decorated method is a generator on a DoFn, but not elsewhere
+    class TestDoFn(beam.DoFn):
+        pass
+
+    class TestNonDoFn(object):
+        pass
+
+    dofn, non_dofn = TestDoFn(), TestNonDoFn()
+    for _ in range(2):
+        actual_dofn = wrapped(dofn, kmsg.SerializeToString())
+        assert isinstance(actual_dofn, decorators.ThreadLimitGenerator)
+        assert 1 == len(list(actual_dofn))
+
+        actual_non_dofn = wrapped(non_dofn, kmsg.SerializeToString())
+        assert isinstance(actual_non_dofn, bytes)
+        assert dofn._klio is non_dofn._klio
 
 
 def test_thread_limiting_custom_limiter(
@@ -283,8 +309,63 @@ def test_thread_limiting_custom_limiter(
     func(kmsg.SerializeToString())
 
     assert 1 == mock_function.call_count
-    mock_semaphore.acquire.assert_called_once_with()
-    mock_semaphore.release.assert_called_once_with()
+    mock_semaphore.acquire.assert_called_once_with(1)
+    mock_semaphore.release.assert_called_once_with(1)
+
+
+def test_thread_limiting_cost(kmsg, mock_config, mocker, monkeypatch):
+    mock_semaphore = mocker.Mock()
+    limiter = _thread_limiter.ThreadLimiter(max_thread_count=10)
+    monkeypatch.setattr(limiter, "_semaphore", mock_semaphore)
+
+    def cost(msg_data):
+        return len(msg_data.element)
+
+    @decorators._handle_klio(thread_limiter=limiter, cost=cost)
+    def func(ctx, msg_data):
+        mock_semaphore.acquire.assert_called_once_with(7)
+        mock_semaphore.release.assert_not_called()
+
+    class TestDoFn(beam.DoFn):
+        @decorators._handle_klio(thread_limiter=limiter, cost=cost)
+        def process(self, msg_data):
+            yield msg_data
+            # held until everything yielded is consumed
+            mock_semaphore.release.assert_not_called()
+            yield msg_data
+
+    func(kmsg.SerializeToString())
+    mock_semaphore.release.assert_called_once_with(7)
+
+    mock_semaphore.reset_mock()
+    gen = TestDoFn().process(kmsg.SerializeToString())
+    assert 2 == len(list(gen))
+    mock_semaphore.acquire.assert_called_once_with(7)
+    mock_semaphore.release.assert_called_once_with(7)
+
+
+def test_thread_limiting_cost_error(kmsg, mock_config, mocker, monkeypatch):
+    mock_semaphore = mocker.Mock()
+    limiter = _thread_limiter.ThreadLimiter(max_thread_count=10)
+    monkeypatch.setattr(limiter, "_semaphore", mock_semaphore)
+
+    @decorators._handle_klio(thread_limiter=limiter, cost=lambda data: 3)
+    def func(ctx, msg_data):
+        raise Exception("fuu")
+
+    ret = func(kmsg.SerializeToString())
+
+    assert "drop" == ret.tag
+    mock_semaphore.acquire.assert_called_once_with(3)
+    mock_semaphore.release.assert_called_once_with(3)
+
+
+def test_thread_limiting_raises_invalid_cost(mock_config):
+    with pytest.raises(RuntimeError):
+
+        @decorators._handle_klio(cost=3)
+        def func(*args, **kwargs):
+            pass
 
 
 def test_thread_limiting_raises_mutex_args(kmsg, mocker, mock_config):
@@ -341,15 +422,19 @@ def test_retry_metrics(mock_config, kmsg):
         p | beam.Create(pcoll) | beam.ParDo(RetryDoFn())
 
     actual_counters = p.result.metrics().query()["counters"]
-    actual_timers = p.result.metrics().query()["distributions"]
+    actual_timers = {
+        d.key.metric.name: d
+        for d in p.result.metrics().query()["distributions"]
+    }
     assert 4 == len(actual_counters)
-    assert 1 == len(actual_timers)
+    assert 2 == len(actual_timers)
 
     received_ctr = actual_counters[0]
     retry_ctr = actual_counters[1]
     retry_err_ctr = actual_counters[2]
     drop_ctr = actual_counters[3]
-    msg_timer = actual_timers[0]
+    msg_timer = actual_timers["kmsg-timer"]
+    limiter_wait = actual_timers["kmsg-thread-limiter-wait"]
 
     assert 1 == received_ctr.committed
     assert "RetryDoFn.process" == received_ctr.key.metric.namespace
@@ -372,6 +457,9 @@ def test_retry_metrics(mock_config, kmsg):
     assert "RetryDoFn.process" == msg_timer.key.metric.namespace
     assert "kmsg-timer" == msg_timer.key.metric.name
 
+    assert len(pcoll) == limiter_wait.committed.count
+    assert "RetryDoFn.process" == limiter_wait.key.metric.namespace
+
 
 class TimeoutDoFn(beam.DoFn):
     @decorators._handle_klio
@@ -431,13 +519,17 @@ def test_handle_klio_metrics(mock_config, kmsg):
         p | beam.Create(pcoll) | beam.ParDo(SimpleDoFn())
 
     actual_counters = p.result.metrics().query()["counters"]
-    actual_timers = p.result.metrics().query()["distributions"]
+    actual_timers = {
+        d.key.metric.name: d
+        for d in p.result.metrics().query()["distributions"]
+    }
     assert 2 == len(actual_counters)
-    assert 1 == len(actual_timers)
+    assert 2 == len(actual_timers)
 
     received_ctr = actual_counters[0]
     success_ctr = actual_counters[1]
-    msg_timer = actual_timers[0]
+    msg_timer = actual_timers["kmsg-timer"]
+    limiter_wait = actual_timers["kmsg-thread-limiter-wait"]
 
     assert 1 == received_ctr.committed
     assert "SimpleDoFn.process" == received_ctr.key.metric.namespace
@@ -452,6 +544,49 @@ def test_handle_klio_metrics(mock_config, kmsg):
     assert "SimpleDoFn.process" == msg_timer.key.metric.namespace
     assert "kmsg-timer" == msg_timer.key.metric.name
 
+    assert len(pcoll) == limiter_wait.committed.count
+    assert "SimpleDoFn.process" == limiter_wait.key.metric.namespace
+
+
+def test_handle_klio_stats(mock_config, kmsg, mocker):
+    mock_config.job_config.metrics = {"stats_port": 9999}
+    mock_start_server = mocker.patch.object(decorators._stats, "start_server")
+
+    @decorators._handle_klio
+    def stats_func(ctx, item):
+        return item
+
+    mock_start_server.assert_called_once_with(9999)
+    stats = decorators._stats.get_stats(stats_func.__qualname__)
+    processed = stats.to_dict()["processed"]
+
+    stats_func(kmsg.SerializeToString())
+
+    assert processed + 1 == stats.to_dict()["processed"]
+    assert 0 == stats.in_flight
+
+
+def test_handle_klio_drop_logging(mock_config, kmsg, caplog):
+    mock_config.job_config.drop_logging = {
+        "max_per_interval": 2,
+        "max_summary_chars": 4,
+    }
+
+    @decorators._handle_klio
+    def func(ctx, item):
+        raise Exception("fuu")
+
+    for _ in range(5):
+        func(kmsg.SerializeToString())
+
+    drop_logs = [r for r in caplog.records if "Dropping" in r.message]
+    assert 2 == len(drop_logs)
+    assert (
+        "Dropping KlioMessage - exception occurred when calling 'func' with "
+        "'KlioMessage(element=b'3l3m'... (7 total), payload=0 bytes)'.\n"
+        "Error: fuu"
+    ) == drop_logs[0].message
+
 
 @decorators._inject_klio_context
 @decorators._serialize_klio_message
@@ -488,6 +623,211 @@ def test_serialize_klio_metrics(mock_config, kmsg):
     assert "kmsg-timer" == msg_timer.key.metric.name
 
 
+class BatchDoFn(beam.DoFn):
+    @decorators._handle_klio_batch(max_batch_size=2)
+    def process(self, items):
+        results = []
+        for item in items:
+            if item.element == b"fail":
+                results.append(ValueError("fail"))
+            else:
+                results.append(item.element + b"-payload")
+        return results
+
+
+def _process(dofn, element):
+    # Beam provides the timestamp & window when running in a pipeline
+    return list(
+        dofn.process(
+            _get_kmsg_bytes(element),
+            timestamp=0,
+            window=window.GlobalWindow(),
+        )
+    )
+
+
+def _get_kmsg_bytes(element):
+    msg = klio_pb2.KlioMessage()
+    msg.version = klio_pb2.Version.V2
+    msg.data.element = element
+    return msg.SerializeToString()
+
+
+def test_handle_klio_batch(mock_config):
+    pcoll = [_get_kmsg_bytes(e) for e in (b"one", b"two", b"three", b"fail")]
+
+    with test_pipeline.TestPipeline() as p:
+        outputs = (
+            p
+            | beam.Create(pcoll)
+            | beam.ParDo(BatchDoFn()).with_outputs("drop", main="main")
+        )
+        payloads = outputs.main | beam.Map(
+            lambda x: klio_pb2.KlioMessage.FromString(x).data.payload
+        )
+        btest_util.assert_that(
+            payloads,
+            btest_util.equal_to(
+                [b"one-payload", b"two-payload", b"three-payload"]
+            ),
+        )
+        btest_util.assert_that(
+            outputs.drop, btest_util.equal_to([pcoll[3]]), label="assert drop",
+        )
+
+    actual_counters = {
+        c.key.metric.name: c.committed
+        for c in p.result.metrics().query()["counters"]
+    }
+    assert 4 == actual_counters["kmsg-received"]
+    assert 3 == actual_counters["kmsg-success"]
+    assert 1 == actual_counters["kmsg-drop-error"]
+
+
+def test_handle_klio_batch_flush(mock_config, mocker):
+    mock_function = mocker.Mock()
+
+    class TestDoFn(beam.DoFn):
+        @decorators._handle_klio_batch(max_batch_size=2)
+        def process(self, items):
+            mock_function([item.element for item in items])
+            return [None] * len(items)
+
+    dofn = TestDoFn()
+    dofn.start_bundle()
+
+    assert [] == _process(dofn, b"one")
+    mock_function.assert_not_called()
+
+    assert 2 == len(_process(dofn, b"two"))
+    mock_function.assert_called_once_with([b"one", b"two"])
+
+    assert [] == _process(dofn, b"three")
+    actual = list(dofn.finish_bundle())
+    assert 1 == len(actual)
+    actual_kmsg = klio_pb2.KlioMessage.FromString(actual[0].value)
+    assert b"three" == actual_kmsg.data.element
+    mock_function.assert_called_with([b"three"])
+    assert [] == list(dofn.finish_bundle())
+
+
+@pytest.mark.parametrize("call_super", (True, False))
+def test_handle_klio_batch_flush_subclass(call_super, mock_config, mocker):
+    mock_function = mocker.Mock()
+
+    class TestDoFn(beam.DoFn):
+        @decorators._handle_klio_batch(max_batch_size=10)
+        def process(self, items):
+            mock_function([item.element for item in items])
+            return [None] * len(items)
+
+    class SubDoFn(TestDoFn):
+        def start_bundle(self):
+            if call_super:
+                super().start_bundle()
+
+        def finish_bundle(self):
+            if call_super:
+                yield from super().finish_bundle()
+            yield "sub-output"
+
+    dofn = SubDoFn()
+    dofn.start_bundle()
+    assert [] == _process(dofn, b"one")
+
+    actual = list(dofn.finish_bundle())
+
+    # flushed even if the override doesn't call `super()`, & only once
+    assert 2 == len(actual)
+    actual_kmsg = klio_pb2.KlioMessage.FromString(actual[0].value)
+    assert b"one" == actual_kmsg.data.element
+    assert "sub-output" == actual[1]
+    mock_function.assert_called_once_with([b"one"])
+
+
+def test_handle_klio_batch_max_wait(mock_config, mocker):
+    mock_function = mocker.Mock()
+
+    class TestDoFn(beam.DoFn):
+        @decorators._handle_klio_batch(max_batch_size=10, max_wait_ms=0)
+        def process(self, items):
+            mock_function([item.element for item in items])
+            return [None] * len(items)
+
+    dofn = TestDoFn()
+    dofn.start_bundle()
+
+    assert 1 == len(_process(dofn, b"one"))
+    mock_function.assert_called_once_with([b"one"])
+
+
+def test_handle_klio_batch_stats(mock_config, mocker):
+    in_flight = []
+
+    class TestDoFn(beam.DoFn):
+        @decorators._handle_klio_batch(max_batch_size=2)
+        def process(self, items):
+            in_flight.append(stats.in_flight)
+            return [None] * len(items)
+
+    stats = decorators._stats.get_stats(TestDoFn.process.__qualname__)
+    processed = stats.to_dict()["processed"]
+    dofn = TestDoFn()
+    dofn.start_bundle()
+
+    _process(dofn, b"one")
+    _process(dofn, b"two")
+
+    # each message of the batch is counted
+    assert [2] == in_flight
+    assert processed + 2 == stats.to_dict()["processed"]
+    assert 0 == stats.in_flight
+
+
+@pytest.mark.parametrize("results", (Exception("fuu"), [None]))
+def test_handle_klio_batch_raises(results, mock_config):
+    class TestDoFn(beam.DoFn):
+        @decorators._handle_klio_batch
+        def process(self, items):
+            if isinstance(results, Exception):
+                raise results
+            return results
+
+    dofn = TestDoFn()
+    dofn.start_bundle()
+    assert [] == _process(dofn, b"one")
+    assert [] == _process(dofn, b"two")
+
+    actual = list(dofn.finish_bundle())
+
+    # every message of the batch is dropped
+    assert ["drop", "drop"] == [a.tag for a in actual]
+    expected = [_get_kmsg_bytes(b"one"), _get_kmsg_bytes(b"two")]
+    assert expected == [a.value.value for a in actual]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    ({"max_batch_size": 0}, {"max_batch_size": "1"}, {"max_wait_ms": -1}),
+)
+def test_handle_klio_batch_raises_invalid_args(kwargs, mock_config):
+    with pytest.raises(RuntimeError, match="Invalid value"):
+        decorators._handle_klio_batch(**kwargs)
+
+
+def test_handle_klio_batch_raises_non_process(mock_config):
+    with pytest.raises(RuntimeError) as e:
+
+        class TestDoFn(beam.DoFn):
+            @decorators._handle_klio_batch
+            def not_process(self, items):
+                return items
+
+    # Python < 3.12 wraps errors raised when a class is created
+    err = e.value.__cause__ or e.value
+    assert "can only be used on" in str(err)
+
+
 @pytest.mark.parametrize(
     "items",
     ([], [1], [1, 2], [1, 2, 3], [Exception("Hey")], [1, Exception("HEY")]),
@@ -536,6 +876,42 @@ def test_threadlimitgenerator_del_release(mocker):
     limiter.release.assert_called_once_with()
 
 
+def test_threadlimitgenerator_close(mocker):
+    limiter = mocker.Mock()
+    closed = []
+
+    def test_gen():
+        try:
+            yield 1
+            yield 2
+        finally:
+            closed.append(True)
+
+    gen = decorators.ThreadLimitGenerator(limiter, test_gen())
+    assert 1 == next(gen)
+
+    gen.close()
+
+    # the wrapped generator is closed & the limiter released right away
+    assert [True] == closed
+    limiter.release.assert_called_once_with()
+    with pytest.raises(StopIteration):
+        next(gen)
+    gen.close()
+    del gen
+    limiter.release.assert_called_once_with()
+
+
+def test_threadlimitgenerator_acquire_error(mocker):
+    limiter = mocker.Mock()
+    limiter.acquire.side_effect = KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        decorators.ThreadLimitGenerator(limiter, iter([1]))
+
+    limiter.release.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "metrics_conf,expected_unit",
     (
@@ -0,0 +1,193 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from klio_core.proto import klio_pb2
+
+from klio.message import view
+from klio.transforms import _dedup
+from klio.transforms import _helpers
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(_dedup.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _kmsg(element, ping=False):
+    msg = klio_pb2.KlioMessage()
+    msg.version = klio_pb2.Version.V2
+    msg.data.element = element
+    msg.metadata.ping = ping
+    return msg
+
+
+@pytest.mark.parametrize(
+    "conf,exp",
+    (
+        ({}, (600, 100000, (), None, None)),
+        (True, (600, 100000, (), None, None)),
+        (
+            {"ttl_sec": 30, "max_size": 10, "key_metadata": ["ping"]},
+            (30, 10, ("ping",), None, None),
+        ),
+        ({"max_size": 10, "bloom_filter": True}, (600, 10, (), 100, 0.001)),
+        (
+            {"bloom_filter": {"capacity": 50, "error_rate": 0.1}},
+            (600, 100000, (), 50, 0.1),
+        ),
+    ),
+)
+def test_parse_config(conf, exp):
+    assert _dedup.DedupConfig(*exp) == _dedup.parse_config(conf)
+
+
+@pytest.mark.parametrize(
+    "conf",
+    (
+        "yes",
+        {"ttl_sec": 0},
+        {"max_size": -1},
+        {"ttl_sec": "10"},
+        {"key_metadata": ["not-a-field"]},
+        {"bloom_filter": {"error_rate": 1}},
+    ),
+)
+def test_parse_config_raises(conf):
+    with pytest.raises(_helpers.KlioConfigRuntimeError):
+        _dedup.parse_config(conf)
+
+
+def test_get_key():
+    key = _dedup.get_key(_kmsg(b"s0m3_tr4ck_1d"))
+
+    assert 16 == len(key)
+    assert key == _dedup.get_key(_kmsg(b"s0m3_tr4ck_1d", ping=True))
+    assert key != _dedup.get_key(_kmsg(b"an0th3r_tr4ck"))
+
+    # the key can be taken from a message view without parsing it
+    kmsg_bytes = _kmsg(b"s0m3_tr4ck_1d").SerializeToString()
+    assert key == _dedup.get_key(view.KlioMessageView(kmsg_bytes))
+
+
+def test_get_key_metadata():
+    key = _dedup.get_key(_kmsg(b"s0m3_tr4ck_1d"), ("ping",))
+    pinged_key = _dedup.get_key(_kmsg(b"s0m3_tr4ck_1d", ping=True), ("ping",))
+
+    assert key != pinged_key
+    assert key != _dedup.get_key(_kmsg(b"s0m3_tr4ck_1d"))
+
+
+def test_dedup_cache_ttl(now):
+    cache = _dedup.DedupCache(ttl_sec=60, max_size=10)
+
+    assert not cache.seen(b"a")
+    now[0] += 30
+    assert cache.seen(b"a")
+    assert not cache.seen(b"b")
+
+    now[0] += 30
+    # "a" expired, "b" hasn't yet
+    assert not cache.seen(b"a")
+    assert cache.seen(b"b")
+
+
+def test_dedup_cache_max_size(now):
+    cache = _dedup.DedupCache(ttl_sec=60, max_size=2)
+
+    for key in (b"a", b"b", b"c"):
+        assert not cache.seen(key)
+
+    assert 2 == len(cache)
+    # the oldest key was evicted
+    assert not cache.seen(b"a")
+    assert cache.seen(b"c")
+
+
+def test_dedup_cache_bloom_filter(now):
+    cache = _dedup.DedupCache(
+        ttl_sec=60, max_size=1, bloom_capacity=100, bloom_error_rate=0.001
+    )
+    keys = [_dedup.get_key(_kmsg(str(i).encode())) for i in range(3)]
+
+    for key in keys:
+        assert not cache.seen(key)
+
+    # evicted from the cache, but still remembered by the filter
+    assert 1 == len(cache)
+    assert all(cache.seen(key) for key in keys)
+
+    # the filter forgets keys after at most the TTL
+    now[0] += 60
+    assert not any(cache.seen(key) for key in keys)
+
+
+def test_dedup_cache_forget(now):
+    cache = _dedup.DedupCache(
+        ttl_sec=60, max_size=1, bloom_capacity=100, bloom_error_rate=0.001
+    )
+
+    assert not cache.seen(b"a")
+    cache.forget(b"a")
+    assert not cache.seen(b"a")
+    # forgetting an unknown key is fine
+    cache.forget(b"b")
+    # keys evicted into the Bloom filter can't be forgotten
+    assert not cache.seen(b"b")
+    cache.forget(b"a")
+    assert cache.seen(b"a")
+
+
+@pytest.mark.parametrize(
+    "force,ping,exp",
+    ((False, False, False), (True, False, True), (False, True, True)),
+)
+def test_skip(force, ping, exp):
+    kmsg = _kmsg(b"s0m3_tr4ck_1d", ping=ping)
+    kmsg.metadata.force = force
+
+    assert exp is _dedup.skip(kmsg)
+    assert exp is _dedup.skip(view.KlioMessageView(kmsg.SerializeToString()))
+
+
+def test_key_forget(monkeypatch):
+    monkeypatch.setattr(_dedup, "_CACHE", None)
+    kmsg = _kmsg(b"s0m3_tr4ck_1d", ping=True)
+    assert _dedup.key(kmsg) is None
+    # nothing to forget
+    _dedup.forget(None)
+
+    config = _dedup.parse_config({"key_metadata": ["ping"]})
+    cache = _dedup.get_cache(config)
+    key = _dedup.key(kmsg)
+    assert _dedup.get_key(kmsg, ("ping",)) == key
+    assert not cache.seen(key)
+
+    _dedup.forget(key)
+    assert not cache.seen(key)
+
+
+def test_get_cache(monkeypatch):
+    monkeypatch.setattr(_dedup, "_CACHE", None)
+    config = _dedup.parse_config({"ttl_sec": 30, "max_size": 5})
+
+    cache = _dedup.get_cache(config)
+
+    assert 30 == cache.ttl_sec
+    assert 5 == cache.max_size
+    assert cache is _dedup.get_cache(config)
@@ -0,0 +1,254 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+
+import pytest
+
+from klio_core.proto import klio_pb2
+
+from klio.message import view
+from klio.transforms import _drop_log
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("klio.test_drop_log")
+
+
+@pytest.fixture
+def klio_message():
+    msg = klio_pb2.KlioMessage()
+    msg.version = klio_pb2.Version.V2
+    msg.data.element = b"s0m3_tr4ck_1d"
+    msg.data.payload = b"x" * 1000
+    return msg
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(_drop_log.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.mark.parametrize(
+    "conf,exp",
+    (
+        ({}, (10, 60, 0.0, 200)),
+        (None, (10, 60, 0.0, 200)),
+        (
+            {
+                "max_per_interval": 1,
+                "interval_sec": 5,
+                "sample_rate": 0.5,
+                "max_summary_chars": 10,
+            },
+            (1, 5, 0.5, 10),
+        ),
+    ),
+)
+def test_from_config(conf, exp):
+    drop_log = _drop_log.DropLogger.from_config("a-transform", conf)
+
+    actual = (
+        drop_log.max_per_interval,
+        drop_log.interval_sec,
+        drop_log.sample_rate,
+        drop_log.max_summary_chars,
+    )
+    assert exp == actual
+    assert "a-transform" == drop_log.transform
+
+
+def test_summary(klio_message):
+    drop_log = _drop_log.DropLogger("a-transform", max_summary_chars=4)
+    exp = "KlioMessage(element=b's0m3'... (13 total), payload=1000 bytes)"
+
+    assert exp == str(drop_log.summary(klio_message))
+    kmsg_view = view.KlioMessageView(klio_message.SerializeToString())
+    assert exp == str(drop_log.summary(kmsg_view))
+    assert "b'some'... (14 total)" == str(drop_log.summary(b"some-raw-bytes"))
+    assert "[1, ..." == str(drop_log.summary([1, 2, 3]))
+
+
+def test_summary_is_lazy(mocker, logger):
+    drop_log = _drop_log.DropLogger("a-transform", max_per_interval=0)
+    item = mocker.MagicMock()
+
+    drop_log.error(logger, "Dropping %s", drop_log.summary(item))
+
+    # the drop wasn't logged, so the message wasn't summarized
+    item.data.payload.__len__.assert_not_called()
+
+
+def test_error_rate_limited(now, logger, caplog):
+    drop_log = _drop_log.DropLogger(
+        "a-transform", max_per_interval=2, interval_sec=60
+    )
+
+    for i in range(5):
+        drop_log.error(logger, "Dropping %s", i)
+
+    assert ["Dropping 0", "Dropping 1"] == caplog.messages
+    caplog.clear()
+
+    now[0] += 60
+    drop_log.error(logger, "Dropping %s", 5)
+
+    assert 2 == len(caplog.records)
+    assert logging.WARNING == caplog.records[0].levelno
+    assert caplog.messages[0].startswith(
+        "Dropped 5 KlioMessage(s) in 'a-transform' in the last 60s, 3 of "
+        "which were not logged."
+    )
+    assert "Dropping 5" == caplog.messages[1]
+
+
+def test_error_no_suppressed(now, logger, caplog):
+    drop_log = _drop_log.DropLogger("a-transform", max_per_interval=2)
+
+    drop_log.error(logger, "Dropping %s", 0)
+    now[0] += 60
+    drop_log.error(logger, "Dropping %s", 1)
+
+    # nothing was suppressed, so there's nothing to summarize
+    assert ["Dropping 0", "Dropping 1"] == caplog.messages
+
+
+@pytest.mark.parametrize(
+    "max_per_interval,sample_rate,exp_logged",
+    ((-1, 0.0, 10), (0, 0.0, 0), (0, 1.0, 10), (5, 0.0, 5)),
+)
+def test_error_sampled(
+    max_per_interval, sample_rate, exp_logged, now, logger, caplog
+):
+    drop_log = _drop_log.DropLogger(
+        "a-transform",
+        max_per_interval=max_per_interval,
+        sample_rate=sample_rate,
+    )
+
+    for i in range(10):
+        drop_log.error(logger, "Dropping %s", i)
+
+    assert exp_logged == len(caplog.records)
+
+
+def test_error_level_disabled(now, logger, caplog, mocker):
+    mock_should_log = mocker.patch.object(_drop_log.DropLogger, "_should_log")
+    caplog.set_level(logging.CRITICAL, logger=logger.name)
+    drop_log = _drop_log.DropLogger("a-transform")
+
+    drop_log.error(logger, "Dropping %s", 0)
+
+    assert not caplog.records
+    mock_should_log.assert_not_called()
+
+
+def test_error_flushed_at_end_of_interval(now, logger, caplog, mocker):
+    mock_timer = mocker.patch.object(_drop_log.threading, "Timer")
+    drop_log = _drop_log.DropLogger(
+        "a-transform", max_per_interval=1, interval_sec=60
+    )
+
+    drop_log.error(logger, "Dropping %s", 0)
+    now[0] += 15
+    for i in range(1, 4):
+        drop_log.error(logger, "Dropping %s", i)
+
+    # scheduled once, for the end of the interval
+    mock_timer.assert_called_once_with(45, drop_log._flush_timer)
+    assert ["Dropping 0"] == caplog.messages
+    caplog.clear()
+
+    # the timer fires without any further drops
+    now[0] += 45
+    mocker.patch.object(
+        _drop_log.threading,
+        "current_thread",
+        return_value=mock_timer.return_value,
+    )
+    drop_log._flush_timer()
+
+    assert 1 == len(caplog.records)
+    assert logging.WARNING == caplog.records[0].levelno
+    assert caplog.messages[0].startswith(
+        "Dropped 4 KlioMessage(s) in 'a-transform' in the last 60s, 3 of "
+        "which were not logged."
+    )
+    caplog.clear()
+
+    # a new interval started, and there's nothing left to summarize
+    drop_log.flush()
+    assert not caplog.records
+
+
+def test_error_flush_timer_cancelled(now, logger, caplog, mocker):
+    mock_timer = mocker.patch.object(_drop_log.threading, "Timer")
+    drop_log = _drop_log.DropLogger(
+        "a-transform", max_per_interval=0, interval_sec=60
+    )
+
+    drop_log.error(logger, "Dropping %s", 0)
+    now[0] += 60
+    drop_log.error(logger, "Dropping %s", 1)
+
+    # the drop ended the interval, so the timer has nothing to do
+    mock_timer.return_value.cancel.assert_called_once_with()
+    assert 1 == len(caplog.records)
+    caplog.clear()
+    drop_log._flush_timer()
+    assert not caplog.records
+
+
+def test_shutdown(now, logger, caplog, mocker, drop_loggers):
+    mocker.patch.object(_drop_log.threading, "Timer")
+    drop_log = _drop_log.DropLogger(
+        "a-transform", max_per_interval=0, interval_sec=60
+    )
+
+    drop_log.error(logger, "Dropping %s", 0)
+    now[0] += 10
+    _drop_log.shutdown()
+
+    assert 1 == len(caplog.records)
+    assert caplog.messages[0].startswith(
+        "Dropped 1 KlioMessage(s) in 'a-transform' in the last 10s, 1 of "
+        "which were not logged."
+    )
+
+    # only drops that weren't logged yet are logged at exit
+    assert not drop_loggers
+    caplog.clear()
+    _drop_log.shutdown()
+    assert not caplog.records
+
+
+def test_shutdown_after_flush(now, logger, caplog, mocker, drop_loggers):
+    mocker.patch.object(_drop_log.threading, "Timer")
+    drop_log = _drop_log.DropLogger(
+        "a-transform", max_per_interval=0, interval_sec=60
+    )
+
+    drop_log.error(logger, "Dropping %s", 0)
+    assert {drop_log} == set(drop_loggers)
+    drop_log.flush()
+    assert 1 == len(caplog.records)
+    caplog.clear()
+
+    _drop_log.shutdown()
+
+    assert not caplog.records
@@ -21,9 +21,12 @@ import pytest
 
 from apache_beam.options import pipeline_options
 from apache_beam.testing import test_pipeline
+from apache_beam.testing import util as btest_util
 
 from klio_core.proto import klio_pb2
 
+from klio.message import pubsub_message_manager as pmm
+from klio.transforms import _dedup
 from klio.transforms import core
 from tests.unit import conftest
 
@@ -403,9 +406,12 @@ def assert_audit(actual):
     exp_msg = klio_pb2.KlioMessage()
     exp_msg.version = klio_pb2.Version.V2
     exp_msg.metadata.job_audit_log.extend([audit_log_item])
-    expected = exp_msg.SerializeToString()
+    # the audit log item is appended to the serialized message rather than
+    # re-serializing it, so compare parsed messages instead of bytes
+    actual_msg = klio_pb2.KlioMessage()
+    actual_msg.ParseFromString(actual)
 
-    assert expected == actual
+    assert exp_msg == actual_msg
     return actual
 
 
@@ -434,6 +440,137 @@ def test_update_klio_log(mocker, monkeypatch, caplog, mock_config):
         assert False, "Expected debug audit log not found"
 
 
+def assert_parsed_audit(actual):
+    assert isinstance(actual, klio_pb2.KlioMessage)
+    return assert_audit(actual.SerializeToString())
+
+
+def test_update_klio_log_parsed(mocker, monkeypatch, mock_config):
+    mock_ts = mocker.Mock()
+    monkeypatch.setattr(klio_pb2.KlioJobAuditLogItem, "timestamp", mock_ts)
+    mock_config.job_config.parse_klio_message_once = True
+
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.version = klio_pb2.Version.V2
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = p | beam.Create([kmsg.SerializeToString()])
+        msg_version = in_pcol | helpers._KlioTagMessageVersion()
+        act_pcol = msg_version.v2 | helpers.KlioUpdateAuditLog()
+        _ = act_pcol | beam.Map(assert_parsed_audit)
+
+
+def assert_is_parsed(actual, parsed):
+    assert parsed == isinstance(actual, klio_pb2.KlioMessage)
+    return actual
+
+
+@pytest.mark.parametrize("parse_once", (True, False))
+def test_tag_message_version_parse_once(parse_once, mock_config):
+    mock_config.job_config.parse_klio_message_once = parse_once
+
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.version = klio_pb2.Version.V2
+    kmsg.data.element = b"s0m3_tr4ck_1d"
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = p | beam.Create([kmsg.SerializeToString()])
+        msg_version = in_pcol | helpers._KlioTagMessageVersion()
+        _ = msg_version.v2 | beam.Map(assert_is_parsed, parsed=parse_once)
+
+
+def _ingress_kmsg(element, ping=False, recipient="a-job"):
+    job = klio_pb2.KlioJob()
+    job.job_name = recipient
+    job.gcp_project = "not-a-real-project"
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.version = klio_pb2.Version.V2
+    kmsg.data.element = element
+    kmsg.metadata.ping = ping
+    kmsg.metadata.intended_recipients.limited.recipients.extend([job])
+    return kmsg.SerializeToString()
+
+
+def _to_element(raw_message):
+    kmsg = klio_pb2.KlioMessage()
+    kmsg.ParseFromString(raw_message)
+    # sanity check that the audit log was updated for non-dropped messages
+    assert len(kmsg.metadata.job_audit_log) <= 1
+    return kmsg.data.element
+
+
+def test_klio_ingress(mock_config, mocker):
+    dedup_cache = _dedup.DedupCache(ttl_sec=60, max_size=10)
+    mocker.patch.object(helpers._dedup, "_CACHE", dedup_cache)
+    mock_config.job_config.data.inputs[0].ping = False
+    mock_config.job_config.data.inputs[0].skip_klio_existence_check = False
+    mock_config.job_config.data.outputs[0].force = False
+    existing = [
+        "gs://this-should-not-exist/output-exists",
+        "gs://hopefully-this-bucket-doesnt-exist/input-exists",
+    ]
+    mock_gcs_client = mocker.patch("klio.transforms._helpers.gcsio.GcsIO")
+    mock_gcs_client.return_value.exists.side_effect = lambda p: p in existing
+
+    pcoll = [
+        _ingress_kmsg(b"input-exists"),
+        _ingress_kmsg(b"input-missing"),
+        _ingress_kmsg(b"output-exists"),
+        _ingress_kmsg(b"ping", ping=True),
+        _ingress_kmsg(b"not-recipient", recipient="other-job"),
+    ]
+    # deduplicated before ingress
+    keys = {}
+    for raw_message in pcoll:
+        kmsg = klio_pb2.KlioMessage.FromString(raw_message)
+        keys[kmsg.data.element] = dedup_cache.key(kmsg)
+        dedup_cache.seen(keys[kmsg.data.element])
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = p | beam.Create(pcoll)
+        ingress = in_pcol | helpers.KlioIngress(
+            filter_ping=True, check_output_exists=True, check_input_exists=True
+        )
+        process = ingress.process | "Process" >> beam.Map(_to_element)
+        pass_thru = ingress.pass_thru | "Pass" >> beam.Map(_to_element)
+        drop = ingress.drop | "Drop" >> beam.Map(_to_element)
+
+        btest_util.assert_that(
+            process, btest_util.equal_to([b"input-exists"]), label="process"
+        )
+        btest_util.assert_that(
+            pass_thru,
+            btest_util.equal_to([b"output-exists", b"ping"]),
+            label="pass_thru",
+        )
+        btest_util.assert_that(
+            drop,
+            btest_util.equal_to([b"input-missing", b"not-recipient"]),
+            label="drop",
+        )
+
+    actual_counters = {
+        (c.key.metric.namespace, c.key.metric.name): c.committed
+        for c in p.result.metrics().query()["counters"]
+    }
+    exp_counters = {
+        ("KlioCheckRecipients", "kmsg-drop-not-recipient"): 1,
+        ("KlioFilterPing", "kmsg-skip-ping"): 1,
+        ("KlioFilterPing", "kmsg-process-ping"): 3,
+        ("KlioGcsCheckOutputExists", "kmsg-data-found-output"): 1,
+        ("KlioGcsCheckOutputExists", "kmsg-data-not-found-output"): 2,
+        ("KlioFilterForce", "kmsg-skip-force"): 1,
+        ("KlioGcsCheckInputExists", "kmsg-data-found-input"): 1,
+        ("KlioGcsCheckInputExists", "kmsg-data-not-found-input"): 1,
+    }
+    assert exp_counters == actual_counters
+    # dropped messages are processed if received again
+    remembered = {
+        element for element, key in keys.items() if dedup_cache.seen(key)
+    }
+    assert {b"input-exists", b"output-exists", b"ping"} == remembered
+
+
 @pytest.mark.skipif(IS_PY36, reason="This test fails to pickle on 3.6")
 def test_trigger_upstream_job(mock_config, mocker, caplog):
     mock_gcs_client = mocker.patch("klio.transforms._helpers.gcsio.GcsIO")
@@ -459,8 +596,14 @@ def test_trigger_upstream_job(mock_config, mocker, caplog):
     options = pipeline_options.PipelineOptions([])
     options.view_as(pipeline_options.StandardOptions).streaming = True
 
+    # read as a delivery on DirectGKERunner
+    in_kmsg = pmm.attach_token(kmsg.SerializeToString(), 7)
+    dedup_cache = _dedup.DedupCache(ttl_sec=60, max_size=10)
+    mocker.patch.object(helpers._dedup, "_CACHE", dedup_cache)
+    dedup_cache.seen(dedup_cache.key(kmsg))
+
     with test_pipeline.TestPipeline(options=options) as p:
-        in_pcol = p | beam.Create([kmsg.SerializeToString()])
+        in_pcol = p | beam.Create([in_kmsg])
         input_data = in_pcol | helpers.KlioGcsCheckInputExists()
 
         _ = input_data.not_found | helpers.KlioTriggerUpstream(
@@ -488,6 +631,9 @@ def test_trigger_upstream_job(mock_config, mocker, caplog):
     assert "KlioTriggerUpstream" == trigger_upstream_ctr.key.metric.namespace
     assert "kmsg-trigger-upstream" == trigger_upstream_ctr.key.metric.name
 
+    # processed when the upstream job sends it back
+    assert not dedup_cache.seen(dedup_cache.key(kmsg))
+
     expected_log_msg = "Triggering upstream upstream-job for does_not_exist"
     for record in caplog.records:
         if expected_log_msg in record.message:
@@ -546,6 +692,62 @@ def test_klio_debug(mock_config):
     assert "kmsg-debug" == actual_counters[0].key.metric.name
 
 
+def test_klio_deduplicate(mock_config, mocker):
+    mock_config.job_config.dedup = {"ttl_sec": 60}
+    mocker.patch.object(helpers._dedup, "_CACHE", None)
+
+    pcoll = [
+        _ingress_kmsg(b"s0m3_tr4ck_1d"),
+        _ingress_kmsg(b"an0th3r_tr4ck"),
+        _ingress_kmsg(b"s0m3_tr4ck_1d"),
+        # ping messages are never deduplicated
+        _ingress_kmsg(b"an0th3r_tr4ck", ping=True),
+    ]
+
+    with test_pipeline.TestPipeline() as p:
+        in_pcol = p | beam.Create(pcoll)
+        dedup = in_pcol | helpers.KlioDeduplicate()
+        process = dedup.process | "Process" >> beam.Map(_to_element)
+        drop = dedup.drop | "Drop" >> beam.Map(_to_element)
+
+        btest_util.assert_that(
+            process,
+            btest_util.equal_to(
+                [b"s0m3_tr4ck_1d", b"an0th3r_tr4ck", b"an0th3r_tr4ck"]
+            ),
+            label="process",
+        )
+        btest_util.assert_that(
+            drop, btest_util.equal_to([b"s0m3_tr4ck_1d"]), label="drop"
+        )
+
+    actual_counters = {
+        (c.key.metric.namespace, c.key.metric.name): c.committed
+        for c in p.result.metrics().query()["counters"]
+    }
+    exp_counters = {
+        ("KlioDeduplicate", "kmsg-dedup-hit"): 1,
+        ("KlioDeduplicate", "kmsg-dedup-miss"): 2,
+    }
+    assert exp_counters == actual_counters
+
+
+def test_klio_forget_dropped(mock_config, mocker):
+    dedup_cache = _dedup.DedupCache(ttl_sec=60, max_size=10)
+    mocker.patch.object(helpers._dedup, "_CACHE", dedup_cache)
+    kmsg = _ingress_kmsg(b"s0m3_tr4ck_1d")
+    key = dedup_cache.key(klio_pb2.KlioMessage.FromString(kmsg))
+    dedup_cache.seen(key)
+
+    with test_pipeline.TestPipeline() as p:
+        forgotten = p | beam.Create([kmsg]) | helpers.KlioForgetDropped()
+
+        btest_util.assert_that(forgotten, btest_util.equal_to([kmsg]))
+
+    # processed if it's received again
+    assert not dedup_cache.seen(key)
+
+
 @pytest.mark.parametrize("global_ping", (True, False))
 def test_klio_filter_ping(global_ping, mock_config):
     mock_config.job_config.data.inputs[0].ping = global_ping
@@ -604,3 +806,23 @@ def test_klio_filter_force(global_force, mock_config):
         assert 1 == skip_ctr.committed
         assert "KlioFilterForce" == skip_ctr.key.metric.namespace
         assert "kmsg-skip-force" == skip_ctr.key.metric.name
+
+
+_KMSG = klio_pb2.KlioMessage(
+    data=klio_pb2.KlioMessage.Data(element=b"s0m3_tr4ck_1d")
+).SerializeToString()
+
+
+@pytest.mark.parametrize(
+    "element,expected",
+    (
+        (pmm.attach_token(_KMSG, 7), _KMSG),
+        (_KMSG, _KMSG),
+        (b"\x00not a klio message", b"\x00not a klio message"),
+        ("not bytes", "not bytes"),
+    ),
+)
+def test_klio_detach_delivery_token(element, expected):
+    assert [expected] == list(
+        helpers.KlioDetachDeliveryToken().process(element)
+    )
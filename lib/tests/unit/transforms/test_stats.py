@@ -0,0 +1,230 @@
+# Copyright 2021 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from klio import utils
+from klio.metrics import prometheus
+from klio.transforms import _stats
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(_stats.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def clear_stats(monkeypatch):
+    monkeypatch.setattr(_stats, "_STATS", {})
+    monkeypatch.setattr(_stats, "_REPORTER", None)
+
+
+def test_in_flight(now):
+    stats = _stats.TransformStats("MyTransform")
+
+    with stats:
+        with stats:
+            assert 2 == stats.in_flight
+        assert 1 == stats.in_flight
+
+    assert 0 == stats.in_flight
+    assert 2 == stats.to_dict()["processed"]
+
+
+def test_batch(now):
+    stats = _stats.TransformStats("MyTransform", window_sec=10)
+
+    with pytest.raises(ValueError):
+        with stats.batch(3):
+            assert 3 == stats.in_flight
+            raise ValueError("fuu")
+
+    # counted as processed, like a single message
+    assert 0 == stats.in_flight
+    assert 3 == stats.to_dict()["processed"]
+    now[0] += 1
+    assert 3 / 10 == stats.rate()
+
+
+def test_rate(now):
+    stats = _stats.TransformStats("MyTransform", window_sec=10)
+
+    for second in range(20):
+        now[0] = 1000.0 + second
+        for _ in range(second % 2 + 1):
+            with stats:
+                pass
+
+    # the current second isn't counted
+    assert 15 / 10 == stats.rate()
+    now[0] += 1
+    assert 15 / 10 == stats.rate()
+    # nothing processed in the last window
+    now[0] += 10
+    assert 0 == stats.rate()
+
+
+def test_report(now, mocker):
+    rate_gauge, in_flight_gauge = mocker.Mock(), mocker.Mock()
+    stats = _stats.TransformStats(
+        "MyTransform",
+        rate_gauge=rate_gauge,
+        in_flight_gauge=in_flight_gauge,
+        window_sec=10,
+    )
+
+    with stats:
+        pass
+    # only reported from the reporter thread
+    rate_gauge.set.assert_not_called()
+
+    now[0] += 1
+    stats.report()
+
+    rate_gauge.set.assert_called_once_with(0.1)
+    in_flight_gauge.set.assert_called_once_with(0)
+
+
+def test_reporter(clear_stats, now, mocker):
+    rate_gauge = mocker.Mock()
+    _stats._STATS["MyTransform"] = _stats.TransformStats(
+        "MyTransform", rate_gauge=rate_gauge, window_sec=10
+    )
+    _stats._STATS["Broken"] = mocker.Mock(transform="Broken")
+    _stats._STATS["Broken"].report.side_effect = ValueError("nope")
+    reporter = _stats._Reporter(interval_sec=3600)
+
+    try:
+        # nothing processed, but the gauge is still refreshed
+        reporter.report()
+        reporter.report()
+    finally:
+        reporter.shutdown()
+
+    assert 2 == rate_gauge.set.call_count
+    assert 2 == _stats._STATS["Broken"].report.call_count
+
+
+def test_wait_timed_limiter(now, mocker):
+    histogram = mocker.Mock()
+    stats = _stats.TransformStats(
+        "MyTransform", wait_histogram=histogram, wait_scale=1e3
+    )
+    limiter = mocker.Mock()
+
+    def acquire(weight):
+        now[0] += 0.5
+
+    limiter.acquire.side_effect = acquire
+    timed_limiter = _stats.WaitTimedLimiter(limiter, stats)
+
+    with timed_limiter:
+        limiter.acquire.assert_called_once_with(1)
+        limiter.release.assert_not_called()
+
+    limiter.release.assert_called_once_with(1)
+    histogram.record.assert_called_once_with(500.0)
+    actual = stats.to_dict()
+    assert 1 == actual["thread_limiter_waits"]
+    assert 0.5 == actual["thread_limiter_wait_sec"]
+
+
+def test_limiter_state(now, mocker):
+    gauges = {"holders": mocker.Mock(), "limit": mocker.Mock()}
+    stats = _stats.TransformStats("MyTransform", limiter_gauges=gauges)
+    limiter = utils.ThreadLimiter(max_thread_count=3)
+    _stats.WaitTimedLimiter(limiter, stats)
+
+    with limiter:
+        actual = stats.to_dict()
+        stats.report()
+
+    assert 1 == actual["thread_limiter_holders"]
+    assert 0 == actual["thread_limiter_waiting"]
+    assert 3 == actual["thread_limiter_limit"]
+    gauges["holders"].set.assert_called_once_with(1)
+    gauges["limit"].set.assert_called_once_with(3)
+
+
+def test_get_stats(clear_stats, mocker):
+    mock_reporter = mocker.patch.object(_stats, "_Reporter")
+    metrics = mocker.Mock()
+
+    stats = _stats.get_stats("MyTransform", metrics, timer_unit="ms")
+
+    assert stats is _stats.get_stats("MyTransform", metrics)
+    mock_reporter.assert_called_once_with()
+    metrics.gauge.assert_has_calls(
+        [
+            mocker.call("kmsg-per-sec", transform="MyTransform"),
+            mocker.call("kmsg-in-flight", transform="MyTransform"),
+            mocker.call(
+                "kmsg-thread-limiter-holders", transform="MyTransform"
+            ),
+            mocker.call("kmsg-thread-limiter-queue", transform="MyTransform"),
+            mocker.call("kmsg-thread-limiter-limit", transform="MyTransform"),
+        ]
+    )
+    metrics.histogram.assert_called_once_with(
+        "kmsg-thread-limiter-wait", transform="MyTransform", timer_unit="ms"
+    )
+    assert 1e3 == stats._wait_scale
+    assert {"MyTransform": stats.to_dict()} == _stats.snapshot()
+
+
+def test_start_server(clear_stats, monkeypatch):
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    stats = _stats.get_stats("MyTransform")
+    with stats:
+        pass
+
+    server = _stats.start_server(0, host="127.0.0.1")
+    try:
+        # the same server as Prometheus metrics
+        assert server is prometheus.start_server(0)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+        with urllib.request.urlopen(url + "/stats") as resp:
+            assert "application/json" == resp.headers["Content-Type"]
+            actual = json.loads(resp.read())
+        assert 1 == actual["MyTransform"]["processed"]
+
+        with urllib.request.urlopen(url + "/metrics") as resp:
+            assert prometheus.CONTENT_TYPE == resp.headers["Content-Type"]
+
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/nope")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_start_server_error(monkeypatch, caplog):
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    server = _stats.start_server(0, host="127.0.0.1")
+    monkeypatch.setattr(prometheus, "_SERVER", None)
+    try:
+        port = server.server_address[1]
+        assert _stats.start_server(port, host="127.0.0.1") is None
+        assert 1 == len(caplog.records)
+    finally:
+        server.shutdown()
+        server.server_close()
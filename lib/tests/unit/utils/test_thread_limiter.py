@@ -13,7 +13,11 @@
 # limitations under the License.
 #
 
+import logging
 import multiprocessing
+import threading
+import time
+import timeit
 
 import pytest
 
@@ -22,6 +26,9 @@ from klio.utils import _thread_limiter
 
 N_CPU = multiprocessing.cpu_count()
 BASE_LOG = "Initial semaphore value:"
+# Generous ceiling for an uncontended acquire & release, in seconds; they
+# take around 1.5µs on a laptop
+MAX_ACQUIRE_RELEASE_SEC = 20e-6
 
 
 @pytest.mark.parametrize(
@@ -51,6 +58,214 @@ def test_thread_limiter_ctx_mgr(max_thread_count, mocker, monkeypatch, caplog):
     with limiter:
         3 * 3
 
-    mock_semaphore.acquire.assert_called_once_with()
-    mock_semaphore.release.assert_called_once_with()
+    mock_semaphore.acquire.assert_called_once_with(1)
+    mock_semaphore.release.assert_called_once_with(1)
     assert 3 == len(caplog.messages)
+
+
+def test_resizable_semaphore():
+    semaphore = _thread_limiter._ResizableSemaphore(1)
+
+    assert semaphore.acquire() is False
+    assert (1, 0, 0) == (semaphore.holders, semaphore.waiting, 0)
+
+    acquired = threading.Event()
+
+    def acquire():
+        assert semaphore.acquire() is True
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    while not semaphore.waiting:
+        time.sleep(0.001)
+    assert not acquired.is_set()
+
+    # growing the limit lets the waiting thread in
+    semaphore.resize(2)
+    thread.join(timeout=5)
+    assert acquired.is_set()
+    assert (2, 0, 0) == (semaphore.holders, semaphore.waiting, 0)
+
+    semaphore.release()
+    semaphore.release()
+    with pytest.raises(ValueError):
+        semaphore.release()
+
+
+def test_resizable_semaphore_weights():
+    semaphore = _thread_limiter._ResizableSemaphore(4)
+    order = []
+
+    def acquire(weight):
+        semaphore.acquire(weight)
+        order.append(weight)
+
+    assert semaphore.acquire(3) is False
+    threads = []
+    # the heavy acquire is served first even though the light one fits
+    for weight in (2, 1):
+        thread = threading.Thread(target=acquire, args=(weight,))
+        thread.start()
+        threads.append(thread)
+        while semaphore.waiting < len(threads):
+            time.sleep(0.001)
+
+    semaphore.release(3)
+    for thread in threads:
+        thread.join(timeout=5)
+    assert [2, 1] == order
+    assert (3, 0) == (semaphore.holders, semaphore.waiting)
+
+    semaphore.release(3)
+    # heavier than the whole limit, but nothing else is held
+    assert semaphore.acquire(10) is False
+    semaphore.release(10)
+    with pytest.raises(ValueError):
+        semaphore.acquire(-1)
+    with pytest.raises(ValueError):
+        semaphore.release(1)
+
+
+def test_resizable_semaphore_fractional_weights():
+    semaphore = _thread_limiter._ResizableSemaphore(1)
+    weights = (0.1, 0.2, 0.3, 0.4)
+    for weight in weights:
+        assert semaphore.acquire(weight) is False
+    assert 1 == semaphore.holders
+    for weight in (0.3, 0.1, 0.4, 0.2):
+        semaphore.release(weight)
+
+    # released in a different order, but nothing is left held
+    assert 0 == semaphore.holders
+    assert 1 == semaphore.available
+    assert semaphore.acquire(5) is False
+    semaphore.release(5)
+    assert 0 == semaphore.holders
+
+
+def test_thread_limiter_state():
+    limiter = _thread_limiter.ThreadLimiter(max_thread_count=2)
+
+    with limiter:
+        assert 1 == limiter.holders
+        assert 0 == limiter.waiting
+        assert 2 == limiter.limit
+
+    assert 0 == limiter.holders
+
+    unlimited = _thread_limiter.ThreadLimiter(
+        max_thread_count=_thread_limiter.ThreadLimit.NONE
+    )
+    with unlimited:
+        assert 1 == unlimited.holders
+    assert unlimited.limit is None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = {"wall": 1000.0, "cpu": 0.0}
+    monkeypatch.setattr(
+        _thread_limiter.time, "monotonic", lambda: clock["wall"]
+    )
+    monkeypatch.setattr(
+        _thread_limiter.time, "process_time", lambda: clock["cpu"]
+    )
+    monkeypatch.setattr(
+        _thread_limiter.multiprocessing, "cpu_count", lambda: 2
+    )
+    return clock
+
+
+def _run_interval(limiter, clock, latency, cpu_utilization, waited=False):
+    # hold the limiter for `latency` seconds, then release it once the
+    # interval is over
+    limiter.acquire()
+    if waited:
+        limiter._controller.waited = True
+    clock["wall"] += 10
+    clock["cpu"] += 10 * 2 * cpu_utilization
+    limiter._controller._local.starts[-1] = clock["wall"] - latency
+    limiter.release()
+
+
+def test_thread_limiter_adaptive(clock, caplog):
+    limiter = _thread_limiter.ThreadLimiter(
+        max_thread_count=4,
+        adaptive=_thread_limiter.AdaptiveLimit(max_thread_count=5),
+    )
+
+    # not saturated: no change
+    _run_interval(limiter, clock, latency=1, cpu_utilization=0.5)
+    assert 4 == limiter.limit
+    # threads waited: additive increase, up to the max
+    _run_interval(limiter, clock, 1, 0.5, waited=True)
+    assert 5 == limiter.limit
+    _run_interval(limiter, clock, 1, 0.5, waited=True)
+    assert 5 == limiter.limit
+    # CPU saturated: multiplicative decrease
+    _run_interval(limiter, clock, 1, 0.95, waited=True)
+    assert 3 == limiter.limit
+    # latency over tolerance of the lowest latency: decrease
+    _run_interval(limiter, clock, 1.6, 0.5, waited=True)
+    assert 2 == limiter.limit
+    # ...down to the min
+    _run_interval(limiter, clock, 3, 0.5)
+    assert 1 == limiter.limit
+    _run_interval(limiter, clock, 5, 0.5)
+    assert 1 == limiter.limit
+
+    adjustments = [m for m in caplog.messages if "Adjusted" in m]
+    assert 4 == len(adjustments)
+
+
+def test_thread_limiter_adaptive_default(clock):
+    limiter = _thread_limiter.ThreadLimiter(
+        max_thread_count=_thread_limiter.ThreadLimit.ADAPTIVE
+    )
+
+    assert 2 == limiter.limit
+    assert 1 == limiter._controller.min_limit
+    assert 8 == limiter._controller.max_limit
+
+
+def test_thread_limiter_adaptive_unlimited():
+    with pytest.raises(ValueError):
+        _thread_limiter.ThreadLimiter(
+            max_thread_count=_thread_limiter.ThreadLimit.NONE, adaptive=True
+        )
+
+
+@pytest.mark.parametrize(
+    "max_thread_count", (2, _thread_limiter.ThreadLimit.NONE)
+)
+def test_thread_limiter_no_formatting(max_thread_count, mocker, caplog):
+    caplog.set_level(logging.INFO, logger="klio.concurrency")
+    limiter = _thread_limiter.ThreadLimiter(max_thread_count=max_thread_count)
+    mock_repr = mocker.patch.object(
+        _thread_limiter.ThreadLimiter, "__repr__", return_value="limiter"
+    )
+
+    with limiter:
+        pass
+
+    mock_repr.assert_not_called()
+    assert not caplog.records
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    "max_thread_count", (2, _thread_limiter.ThreadLimit.NONE)
+)
+def test_thread_limiter_acquire_release_benchmark(max_thread_count, caplog):
+    caplog.set_level(logging.INFO, logger="klio.concurrency")
+    limiter = _thread_limiter.ThreadLimiter(max_thread_count=max_thread_count)
+
+    def acquire_release():
+        limiter.acquire()
+        limiter.release()
+
+    number = 10000
+    best = min(timeit.repeat(acquire_release, number=number, repeat=3))
+
+    assert best / number < MAX_ACQUIRE_RELEASE_SEC